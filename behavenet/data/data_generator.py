@@ -29,6 +29,7 @@ import pickle
 import torch
 from torch.utils import data
 from torch.utils.data import SubsetRandomSampler
+from behavenet.tracing import trace_span
 
 
 __all__ = [
@@ -102,7 +103,7 @@ def split_trials(n_trials, rng_seed=0, train_tr=8, val_tr=1, test_tr=1, gap_tr=0
     return batch_idxs
 
 
-def _load_pkl_dict(path, key, idx=None, dtype='float32'):
+def _load_pkl_dict(path, key, idx=None, dtype='float32', cache=None):
     """Helper function to load pickled data.
 
     Parameters
@@ -115,6 +116,9 @@ def _load_pkl_dict(path, key, idx=None, dtype='float32'):
         if :obj:`NoneType` return all data, else return data from this index
     dtype : :obj:`str`
         numpy data type of data
+    cache : :obj:`dict` or :obj:`NoneType`, optional
+        unpickled dictionaries keyed by path; the file is only loaded if :obj:`path` is not already
+        in the cache, and then added to it
 
     Returns
     -------
@@ -122,8 +126,13 @@ def _load_pkl_dict(path, key, idx=None, dtype='float32'):
     :obj:`numpy.ndarray` is :obj:`idx=int`
 
     """
-    with open(path, 'rb') as f:
-        data_dict = pickle.load(f)
+    if cache is not None and path in cache:
+        data_dict = cache[path]
+    else:
+        with open(path, 'rb') as f:
+            data_dict = pickle.load(f)
+        if cache is not None:
+            cache[path] = data_dict
 
     if idx is None:
         samp = [data.astype(dtype) for data in data_dict[key]]
@@ -214,6 +223,9 @@ class SingleSessionDatasetBatchedLoad(data.Dataset):
         self.device = device
         self.as_numpy = as_numpy
 
+        # unpickled model outputs (e.g. latents), so that they are only loaded once
+        self._pkl_cache = {}
+
     def __str__(self):
         """Pretty printing of dataset info"""
         format_str = str('%s\n' % self.sess_str)
@@ -246,69 +258,73 @@ class SingleSessionDatasetBatchedLoad(data.Dataset):
         sample = OrderedDict()
         for signal in self.signals:
 
-            # index correct trial
-            if signal == 'images':
-                dtype = 'float32'
-                with h5py.File(self.paths[signal], 'r', libver='latest', swmr=True) as f:
-                    if idx is None:
-                        print('Warning: loading all images!')
-                        temp_data = []
-                        for tr in range(self.n_trials):
-                            temp_data.append(f[signal][str(
-                                'trial_%04i' % tr)][()].astype(dtype) / 255)
-                        sample[signal] = temp_data
-                    else:
-                        sample[signal] = [f[signal][str(
-                            'trial_%04i' % idx)][()].astype(dtype) / 255]
-
-            elif signal == 'masks':
-                dtype = 'float32'
-                with h5py.File(self.paths[signal], 'r', libver='latest', swmr=True) as f:
-                    if idx is None:
-                        print('Warning: loading all masks!')
-                        temp_data = []
-                        for tr in range(self.n_trials):
-                            temp_data.append(f[signal][str(
-                                'trial_%04i' % tr)][()].astype(dtype))
-                        sample[signal] = temp_data
-                    else:
-                        sample[signal] = f[signal][str('trial_%04i' % idx)][()].astype(dtype)
-
-            elif signal == 'neural' or signal == 'labels' or signal == 'labels_sc' \
-                    or signal == 'labels_masks':
-                dtype = 'float32'
-                with h5py.File(self.paths[signal], 'r', libver='latest', swmr=True) as f:
-                    if idx is None:
-                        temp_data = []
-                        for tr in range(self.n_trials):
-                            temp_data.append(f[signal][str(
-                                'trial_%04i' % tr)][()].astype(dtype))
-                        sample[signal] = temp_data
-                    else:
-                        sample[signal] = [f[signal][str('trial_%04i' % idx)][()].astype(dtype)]
-
-            elif signal == 'ae_latents' or signal == 'latents':
-                dtype = 'float32'
-                sample[signal] = self._try_to_load(signal, key='latents', idx=idx, dtype=dtype)
-
-            elif signal == 'ae_predictions':
-                dtype = 'float32'
-                sample[signal] = self._try_to_load(signal, key='predictions', idx=idx, dtype=dtype)
-
-            elif signal == 'arhmm' or signal == 'arhmm_states':
-                dtype = 'int32'
-                sample[signal] = self._try_to_load(signal, key='states', idx=idx, dtype=dtype)
-
-            elif signal == 'arhmm_predictions':
-                dtype = 'float32'
-                sample[signal] = self._try_to_load(signal, key='predictions', idx=idx, dtype=dtype)
+            with trace_span('load/%s' % signal, 'data', session=self.sess_str, trial=idx):
+                # index correct trial
+                if signal == 'images':
+                    dtype = 'float32'
+                    with h5py.File(self.paths[signal], 'r', libver='latest', swmr=True) as f:
+                        if idx is None:
+                            print('Warning: loading all images!')
+                            temp_data = []
+                            for tr in range(self.n_trials):
+                                temp_data.append(f[signal][str(
+                                    'trial_%04i' % tr)][()].astype(dtype) / 255)
+                            sample[signal] = temp_data
+                        else:
+                            sample[signal] = [f[signal][str(
+                                'trial_%04i' % idx)][()].astype(dtype) / 255]
+
+                elif signal == 'masks':
+                    dtype = 'float32'
+                    with h5py.File(self.paths[signal], 'r', libver='latest', swmr=True) as f:
+                        if idx is None:
+                            print('Warning: loading all masks!')
+                            temp_data = []
+                            for tr in range(self.n_trials):
+                                temp_data.append(f[signal][str(
+                                    'trial_%04i' % tr)][()].astype(dtype))
+                            sample[signal] = temp_data
+                        else:
+                            sample[signal] = f[signal][str('trial_%04i' % idx)][()].astype(dtype)
+
+                elif signal == 'neural' or signal == 'labels' or signal == 'labels_sc' \
+                        or signal == 'labels_masks':
+                    dtype = 'float32'
+                    with h5py.File(self.paths[signal], 'r', libver='latest', swmr=True) as f:
+                        if idx is None:
+                            temp_data = []
+                            for tr in range(self.n_trials):
+                                temp_data.append(f[signal][str(
+                                    'trial_%04i' % tr)][()].astype(dtype))
+                            sample[signal] = temp_data
+                        else:
+                            sample[signal] = [f[signal][str('trial_%04i' % idx)][()].astype(dtype)]
 
-            else:
-                raise ValueError('"%s" is an invalid signal type' % signal)
+                elif signal == 'ae_latents' or signal == 'latents':
+                    dtype = 'float32'
+                    sample[signal] = self._try_to_load(signal, key='latents', idx=idx, dtype=dtype)
+
+                elif signal == 'ae_predictions':
+                    dtype = 'float32'
+                    sample[signal] = self._try_to_load(
+                        signal, key='predictions', idx=idx, dtype=dtype)
+
+                elif signal == 'arhmm' or signal == 'arhmm_states':
+                    dtype = 'int32'
+                    sample[signal] = self._try_to_load(signal, key='states', idx=idx, dtype=dtype)
+
+                elif signal == 'arhmm_predictions':
+                    dtype = 'float32'
+                    sample[signal] = self._try_to_load(
+                        signal, key='predictions', idx=idx, dtype=dtype)
+
+                else:
+                    raise ValueError('"%s" is an invalid signal type' % signal)
 
             # apply transforms
             if self.transforms[signal]:
-                sample[signal] = [self.transforms[signal](samp) for samp in sample[signal]]
+                with trace_span('transform/%s' % signal, 'data'):
+                    sample[signal] = [self.transforms[signal](samp) for samp in sample[signal]]
 
             # transform into tensor
             if not self.as_numpy:
@@ -334,7 +350,8 @@ class SingleSessionDatasetBatchedLoad(data.Dataset):
         #             ('Could not open %s\nMust create %s from model;' +
         #              ' currently not implemented') % (self.paths[signal], key))
         try:
-            data = _load_pkl_dict(self.paths[signal], key, idx=idx, dtype=dtype)
+            data = _load_pkl_dict(
+                self.paths[signal], key, idx=idx, dtype=dtype, cache=self._pkl_cache)
         except FileNotFoundError:
             raise NotImplementedError(
                 ('Could not open %s\nMust create %s from model;' +
@@ -542,6 +559,11 @@ class ConcatSessionsGenerator(object):
             self.n_tot_batches[dtype] = np.sum(
                 [dataset.n_batches[dtype] for dataset in self.datasets])
 
+        self._build_iterators()
+
+    def _build_iterators(self):
+        """Create data loaders and iterators for all datasets and data types."""
+
         # create data loaders (will shuffle/batch/etc datasets)
         self.dataset_loaders = [None] * self.n_datasets
         for i, dataset in enumerate(self.datasets):
@@ -561,6 +583,25 @@ class ConcatSessionsGenerator(object):
             for dtype in self._dtypes:
                 self.dataset_iters[i][dtype] = iter(self.dataset_loaders[i][dtype])
 
+    def copy(self):
+        """Return a generator that shares datasets with this one but iterates independently.
+
+        Data splits, loaded data and cached model outputs are shared between the two generators,
+        while data loaders and iterators are not; this allows multiple models to be fit in the same
+        process without reloading data.
+
+        Returns
+        -------
+        :obj:`ConcatSessionsGenerator` object
+
+        """
+        import copy
+        data_generator = copy.copy(self)
+        data_generator.batch_ratios = np.copy(self.batch_ratios)
+        data_generator.n_tot_batches = dict(self.n_tot_batches)
+        data_generator._build_iterators()
+        return data_generator
+
     def __str__(self):
         """Pretty printing of dataset info"""
         if self.batch_load:
@@ -610,23 +651,74 @@ class ConcatSessionsGenerator(object):
             - **dataset** (:obj:`int`): dataset from which data batch is drawn
 
         """
-        while True:
-            # get next session
-            dataset = np.random.choice(np.arange(self.n_datasets), p=self.batch_ratios)
-
-            # get this session data
-            try:
-                sample = next(self.dataset_iters[dataset][dtype])
-                break
-            except StopIteration:
-                continue
-
-        if self.as_numpy:
-            for i, signal in enumerate(sample):
-                if signal != 'batch_idx':
-                    sample[signal] = [ss.cpu().detach().numpy() for ss in sample[signal]]
-        else:
-            if self.device == 'cuda':
-                sample = {key: val.to('cuda') for key, val in sample.items()}
+        with trace_span('next_batch', 'data', dtype=dtype):
+            while True:
+                # get next session
+                dataset = np.random.choice(np.arange(self.n_datasets), p=self.batch_ratios)
+
+                # get this session data
+                try:
+                    sample = next(self.dataset_iters[dataset][dtype])
+                    break
+                except StopIteration:
+                    continue
+
+            if self.as_numpy:
+                for i, signal in enumerate(sample):
+                    if signal != 'batch_idx':
+                        sample[signal] = [ss.cpu().detach().numpy() for ss in sample[signal]]
+            else:
+                if self.device == 'cuda':
+                    with trace_span('to_device', 'data'):
+                        sample = {key: val.to('cuda') for key, val in sample.items()}
 
         return sample, dataset
+
+    def next_mixed_batch(self, dtype, n_batches):
+        """Return several batches of data, possibly from different sessions, as a single batch.
+
+        Batches are drawn with :meth:`next_batch` and concatenated along the time dimension; the
+        returned datasets identify the session of each frame, for use with models that fit
+        session-specific io layers. The caller must not request more batches than remain in the
+        current epoch.
+
+        Parameters
+        ----------
+        dtype : :obj:`str`
+            'train' | 'val' | 'test'
+        n_batches : :obj:`int`
+            number of batches to concatenate
+
+        Returns
+        -------
+        :obj:`tuple`
+            - **sample** (:obj:`dict`): data batch with keys given by :obj:`signals` input to
+              class; 'batch_idx' contains the indices of all concatenated batches
+            - **dataset** (:obj:`torch.LongTensor` or :obj:`np.ndarray`): dataset of each frame,
+              on the same device as the data
+
+        """
+        samples = []
+        datasets = []
+        for _ in range(n_batches):
+            sample, dataset = self.next_batch(dtype)
+            samples.append(sample)
+            datasets.append(dataset)
+
+        mixed = {}
+        for signal in samples[0].keys():
+            if signal == 'batch_idx':
+                mixed[signal] = torch.cat([sample[signal] for sample in samples], dim=0)
+            elif self.as_numpy:
+                mixed[signal] = [np.concatenate([sample[signal][0] for sample in samples])]
+            else:
+                mixed[signal] = torch.cat([sample[signal] for sample in samples], dim=1)
+
+        # dataset of each frame
+        signal = self.signals[0][0]
+        n_frames = [len(sample[signal][0]) for sample in samples]
+        dataset = np.repeat(datasets, n_frames)
+        if not self.as_numpy:
+            dataset = torch.from_numpy(dataset).to(mixed[signal].device)
+
+        return mixed, dataset
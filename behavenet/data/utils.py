@@ -11,6 +11,9 @@ __all__ = [
     'get_data_generator_inputs', 'build_data_generator', 'check_same_training_split',
     'get_transforms_paths', 'load_labels_like_latents', 'get_region_list']
 
+# data generators built with `use_cache=True`, keyed by their inputs
+_DATA_GENERATOR_CACHE = {}
+
 
 def get_data_generator_inputs(hparams, sess_ids, check_splits=True):
     """Helper function for generating signals, transforms and paths.
@@ -335,7 +338,7 @@ def get_data_generator_inputs(hparams, sess_ids, check_splits=True):
     return hparams, signals_list, transforms_list, paths_list
 
 
-def build_data_generator(hparams, sess_ids, export_csv=True):
+def build_data_generator(hparams, sess_ids, export_csv=True, use_cache=False):
     """Helper function to build data generator from hparams dict.
 
     Parameters
@@ -346,6 +349,11 @@ def build_data_generator(hparams, sess_ids, export_csv=True):
         each entry is a session dict with keys 'lab', 'expt', 'animal', 'session'
     export_csv : :obj:`bool`, optional
         export csv file containing session info (useful when fitting multi-sessions)
+    use_cache : :obj:`bool`, optional
+        :obj:`True` to reuse a data generator previously built in the same process with identical
+        inputs (sessions, signals, transforms, paths and data splits); the returned generator
+        shares loaded data with the cached one but has its own iterators (see
+        :meth:`ConcatSessionsGenerator.copy`)
 
     Returns
     -------
@@ -365,13 +373,25 @@ def build_data_generator(hparams, sess_ids, export_csv=True):
         trial_splits = {'train_tr': trs[0], 'val_tr': trs[1], 'test_tr': trs[2], 'gap_tr': trs[3]}
     else:
         trial_splits = None
-    print('constructing data generator...', end='')
-    data_generator = ConcatSessionsGenerator(
-        hparams['data_dir'], sess_ids,
-        signals_list=signals, transforms_list=transforms, paths_list=paths,
-        device=hparams['device'], as_numpy=hparams['as_numpy'], batch_load=hparams['batch_load'],
-        rng_seed=hparams['rng_seed_data'], trial_splits=trial_splits,
-        train_frac=hparams['train_frac'])
+    # transforms are pickled so that their parameters (e.g. selected indices) are part of the key
+    cache_key = pickle.dumps((
+        hparams['data_dir'], sess_ids, signals, transforms, paths, hparams['device'],
+        hparams['as_numpy'], hparams['batch_load'], hparams['rng_seed_data'], trial_splits,
+        hparams['train_frac']))
+    if use_cache and cache_key in _DATA_GENERATOR_CACHE:
+        print('reusing data generator...', end='')
+        data_generator = _DATA_GENERATOR_CACHE[cache_key].copy()
+    else:
+        print('constructing data generator...', end='')
+        data_generator = ConcatSessionsGenerator(
+            hparams['data_dir'], sess_ids,
+            signals_list=signals, transforms_list=transforms, paths_list=paths,
+            device=hparams['device'], as_numpy=hparams['as_numpy'],
+            batch_load=hparams['batch_load'], rng_seed=hparams['rng_seed_data'],
+            trial_splits=trial_splits, train_frac=hparams['train_frac'])
+        if use_cache:
+            _DATA_GENERATOR_CACHE[cache_key] = data_generator
+            data_generator = data_generator.copy()
     # csv order will reflect dataset order in data generator
     if export_csv:
         export_session_info_to_csv(os.path.join(
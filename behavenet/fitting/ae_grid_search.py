@@ -1,19 +1,22 @@
 import os
-import time
-import numpy as np
-import random
 import torch
 import math
 
 from behavenet.data.utils import build_data_generator
+from behavenet.fitting.distributed import broadcast_object
+from behavenet.fitting.distributed import is_distributed
+from behavenet.fitting.distributed import is_main_process
 from behavenet.fitting.eval import export_train_plots
 from behavenet.fitting.hyperparam_utils import get_all_params
 from behavenet.fitting.hyperparam_utils import get_slurm_params
+from behavenet.fitting.hyperparam_utils import run_local_trials
 from behavenet.fitting.training import fit
 from behavenet.fitting.utils import _clean_tt_dir
 from behavenet.fitting.utils import _print_hparams
 from behavenet.fitting.utils import create_tt_experiment
 from behavenet.fitting.utils import export_hparams
+from behavenet.fitting.utils import find_warm_start_model
+from behavenet.fitting.utils import get_data_params
 from behavenet.models.aes import load_pretrained_ae
 
 
@@ -32,18 +35,20 @@ def main(hparams, *args):
     if hparams['model_type'] == 'conv' and hparams['n_ae_latents'] > hparams['max_latents']:
         raise ValueError('Number of latents higher than max latents, architecture will not work')
 
-    # Start at random times (so test tube creates separate folders)
-    np.random.seed(random.randint(0, 1000))
-    time.sleep(np.random.uniform(3))
-
-    # create test-tube experiment
-    hparams, sess_ids, exp = create_tt_experiment(hparams)
+    # create test-tube experiment; with distributed training only the main process logs
+    if is_main_process():
+        hparams, sess_ids, exp = create_tt_experiment(hparams)
+    else:
+        sess_ids, exp = None, None
+    hparams, sess_ids = broadcast_object((hparams, sess_ids))
     if hparams is None:
         print('Experiment exists! Aborting fit')
         return
 
     # build data generator
-    data_generator = build_data_generator(hparams, sess_ids)
+    data_generator = build_data_generator(
+        hparams, sess_ids, export_csv=is_main_process(),
+        use_cache=hparams.get('share_data_generator', False))
 
     # ####################
     # ### CREATE MODEL ###
@@ -83,21 +88,32 @@ def main(hparams, *args):
     model = Model(hparams)
     model.to(hparams['device'])
 
+    # initialize from the nearest completed model of the sweep if requested
+    if hparams.get('warm_start', False) and hparams['model_type'] == 'conv' \
+            and not hparams.get('pretrained_weights_path', None):
+        model_file = find_warm_start_model(hparams) if is_main_process() else None
+        hparams['pretrained_weights_path'] = broadcast_object(model_file)
+        if hparams['pretrained_weights_path'] is None:
+            print('No completed model to warm start from')
+        else:
+            print('Warm starting from %s' % hparams['pretrained_weights_path'])
+
     # load pretrained weights if specified
     model = load_pretrained_ae(model, hparams)
 
-    # Parallelize over gpus if desired
-    if hparams['n_parallel_gpus'] > 1:
+    # Parallelize over gpus if desired (distributed training already splits data over processes)
+    if hparams['n_parallel_gpus'] > 1 and not is_distributed():
         from behavenet.models import CustomDataParallel
         model = CustomDataParallel(model)
 
-    model.version = exp.version
+    model.version = hparams['version']
     torch_rng_seed = torch.get_rng_state()
     hparams['training_rng_seed'] = torch_rng_seed
 
     # save out hparams as csv and dict
     hparams['training_completed'] = False
-    export_hparams(hparams, exp)
+    if is_main_process():
+        export_hparams(hparams, exp)
     print('done')
 
     # ###################
@@ -106,7 +122,16 @@ def main(hparams, *args):
 
     print(model)
 
-    fit(hparams, model, data_generator, exp, method='ae')
+    if hparams['model_type'] == 'linear' and hparams.get('linear_ae_solver', 'sgd') != 'sgd':
+        # closed-form solution of linear autoencoders
+        from behavenet.fitting.pca import fit_pca
+        fit_pca(hparams, model, data_generator, exp, method=hparams['linear_ae_solver'])
+    else:
+        fit(hparams, model, data_generator, exp, method='ae')
+
+    # remaining exports are handled by the main process
+    if not is_main_process():
+        return
 
     # export training plots
     if hparams['export_train_plots']:
@@ -146,7 +171,13 @@ if __name__ == '__main__':
 
     else:
 
-        if hyperparams.device == 'cuda' or hyperparams.device == 'gpu':
+        if 'ddp_world_size' in hyperparams and hyperparams.ddp_world_size > 1:
+            # fit one trial at a time, each split across multiple data-parallel processes
+            from behavenet.fitting.distributed import launch
+            for trial in hyperparams.generate_trials(hyperparams.tt_n_cpu_trials):
+                launch(main, trial, hyperparams.ddp_world_size, backend=hyperparams.ddp_backend)
+
+        elif hyperparams.device == 'cuda' or hyperparams.device == 'gpu':
             if hyperparams.device == 'gpu':
                 hyperparams.device = 'cuda'
 
@@ -158,10 +189,17 @@ if __name__ == '__main__':
                 idx_end = (instance + 1) * hyperparams.n_parallel_gpus
                 parallel_gpu_ids.append(','.join(gpu_ids[idx_beg:idx_end]))
 
-            hyperparams.optimize_parallel_gpu(main, gpu_ids=parallel_gpu_ids)
+            run_local_trials(
+                main, hyperparams.generate_trials(hyperparams.tt_n_gpu_trials),
+                n_workers=len(parallel_gpu_ids), gpu_ids=parallel_gpu_ids,
+                group_fn=get_data_params if 'share_data_generator' in hyperparams
+                and hyperparams.share_data_generator else None)
 
         elif hyperparams.device == 'cpu':
-            hyperparams.optimize_parallel_cpu(
-                main,
-                nb_trials=hyperparams.tt_n_cpu_trials,
-                nb_workers=hyperparams.tt_n_cpu_workers)
+            run_local_trials(
+                main, hyperparams.generate_trials(hyperparams.tt_n_cpu_trials),
+                n_workers=hyperparams.tt_n_cpu_workers,
+                n_threads=hyperparams.tt_n_cpu_threads if 'tt_n_cpu_threads' in hyperparams
+                else None,
+                group_fn=get_data_params if 'share_data_generator' in hyperparams
+                and hyperparams.share_data_generator else None)
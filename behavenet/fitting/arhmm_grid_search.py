@@ -1,7 +1,5 @@
 import os
-import time
 import numpy as np
-import random
 import ssm
 import pickle
 
@@ -10,10 +8,12 @@ from behavenet.fitting.eval import export_states
 from behavenet.fitting.eval import export_train_plots
 from behavenet.fitting.hyperparam_utils import get_all_params
 from behavenet.fitting.hyperparam_utils import get_slurm_params
+from behavenet.fitting.hyperparam_utils import run_local_trials
 from behavenet.fitting.utils import _clean_tt_dir
 from behavenet.fitting.utils import _print_hparams
 from behavenet.fitting.utils import create_tt_experiment
 from behavenet.fitting.utils import export_hparams
+from behavenet.fitting.utils import get_data_params
 from behavenet.plotting.arhmm_utils import get_latent_arrays_by_dtype
 
 
@@ -32,10 +32,6 @@ def main(hparams):
     # print hparams to console
     _print_hparams(hparams)
 
-    # start at random times (so test tube creates separate folders)
-    np.random.seed(random.randint(0, 1000))
-    time.sleep(np.random.uniform(1))
-
     # create test-tube experiment
     hparams, sess_ids, exp = create_tt_experiment(hparams)
     if hparams is None:
@@ -43,7 +39,8 @@ def main(hparams):
         return
 
     # build data generator
-    data_generator = build_data_generator(hparams, sess_ids)
+    data_generator = build_data_generator(
+        hparams, sess_ids, use_cache=hparams.get('share_data_generator', False))
 
     # ####################
     # ### CREATE MODEL ###
@@ -258,10 +255,17 @@ if __name__ == '__main__':
                 hyperparams.device = 'cuda'
 
             gpu_ids = hyperparams.gpus_viz.split(';')
-            hyperparams.optimize_parallel_gpu(main, gpu_ids=gpu_ids)
+            run_local_trials(
+                main, hyperparams.generate_trials(hyperparams.tt_n_gpu_trials),
+                n_workers=len(gpu_ids), gpu_ids=gpu_ids,
+                group_fn=get_data_params if 'share_data_generator' in hyperparams
+                and hyperparams.share_data_generator else None)
 
         elif hyperparams.device == 'cpu':
-            hyperparams.optimize_parallel_cpu(
-                main,
-                nb_trials=hyperparams.tt_n_cpu_trials,
-                nb_workers=hyperparams.tt_n_cpu_workers)
+            run_local_trials(
+                main, hyperparams.generate_trials(hyperparams.tt_n_cpu_trials),
+                n_workers=hyperparams.tt_n_cpu_workers,
+                n_threads=hyperparams.tt_n_cpu_threads if 'tt_n_cpu_threads' in hyperparams
+                else None,
+                group_fn=get_data_params if 'share_data_generator' in hyperparams
+                and hyperparams.share_data_generator else None)
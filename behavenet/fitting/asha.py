@@ -0,0 +1,161 @@
+"""Asynchronous successive halving (ASHA) for early termination of grid search trials.
+
+Trials of a grid search are compared at a sequence of "rungs" - training epochs
+:obj:`min_epochs * reduction_factor ** k`. When a trial reaches a rung its validation loss is
+recorded, and the trial is only allowed to continue training if this loss is within the best
+:obj:`1 / reduction_factor` of all losses recorded at that rung so far; otherwise training stops.
+Decisions are made asynchronously (trials never wait for each other), so the scheduler works with
+any way of launching trials - a local process pool, multiple gpus or a SLURM cluster.
+
+Rung results are stored in an sqlite database in the experiment directory, which is shared by all
+trials that write to the same directory. Results are keyed by a sweep id, so that trials are only
+compared to other trials of the same grid search, and not to trials of earlier searches in the
+same directory. See [Li et al. 2020](https://arxiv.org/abs/1810.05934)
+for more details on ASHA.
+"""
+
+import os
+import sqlite3
+import numpy as np
+
+# to ignore imports for sphix-autoapidoc
+__all__ = ['ASHAScheduler', 'get_asha_scheduler']
+
+
+class ASHAScheduler(object):
+    """Stop trials whose validation loss is not among the best at each rung."""
+
+    def __init__(self, db_file, min_epochs=1, reduction_factor=3, max_epochs=None, sweep=''):
+        """
+
+        Parameters
+        ----------
+        db_file : :obj:`str`
+            absolute path of sqlite database that stores rung results; created if it does not exist
+        min_epochs : :obj:`int`, optional
+            epoch of the first rung
+        reduction_factor : :obj:`int`, optional
+            spacing of rungs, and inverse of the fraction of trials continuing at each rung
+        max_epochs : :obj:`int` or :obj:`NoneType`, optional
+            no rungs at or beyond this epoch
+        sweep : :obj:`str`, optional
+            id of the grid search; trials are only compared to trials with the same id
+
+        """
+        if min_epochs < 1:
+            raise ValueError('min_epochs must be at least 1')
+        if reduction_factor < 2:
+            raise ValueError('reduction_factor must be at least 2')
+        self.db_file = db_file
+        self.min_epochs = min_epochs
+        self.reduction_factor = reduction_factor
+        self.max_epochs = max_epochs
+        self.sweep = sweep
+        conn = self._connect()
+        try:
+            with conn:
+                columns = [row[1] for row in conn.execute('PRAGMA table_info(rungs)')]
+                if columns and 'sweep' not in columns:
+                    # results recorded before rungs were keyed by sweep cannot be attributed
+                    conn.execute('DROP TABLE rungs')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS rungs (sweep TEXT, trial TEXT, rung INTEGER, '
+                    'loss REAL, PRIMARY KEY (sweep, trial, rung))')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # long timeout; many trials may record results at the same time
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def get_rung(self, epoch):
+        """Return the rung index of an epoch.
+
+        Parameters
+        ----------
+        epoch : :obj:`int`
+            training epoch
+
+        Returns
+        -------
+        :obj:`int` or :obj:`NoneType`
+            rung index, or :obj:`NoneType` if :obj:`epoch` is not a rung
+
+        """
+        rung = 0
+        rung_epoch = self.min_epochs
+        while rung_epoch <= epoch:
+            if self.max_epochs is not None and rung_epoch >= self.max_epochs:
+                return None
+            if rung_epoch == epoch:
+                return rung
+            rung += 1
+            rung_epoch *= self.reduction_factor
+        return None
+
+    def should_stop(self, trial, epoch, loss):
+        """Record the validation loss of a trial and decide whether it should stop training.
+
+        Parameters
+        ----------
+        trial : :obj:`str`
+            unique trial id (e.g. model directory)
+        epoch : :obj:`int`
+            current training epoch
+        loss : :obj:`float`
+            current validation loss (lower is better)
+
+        Returns
+        -------
+        :obj:`bool`
+            :obj:`True` if the trial should stop training
+
+        """
+        rung = self.get_rung(epoch)
+        if rung is None:
+            return False
+        loss = float(loss) if np.isfinite(loss) else np.inf
+        conn = self._connect()
+        try:
+            # record result and read all results at this rung in a single transaction
+            conn.isolation_level = None
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT OR REPLACE INTO rungs (sweep, trial, rung, loss) VALUES (?, ?, ?, ?)',
+                (self.sweep, trial, rung, loss))
+            losses = [row[0] for row in conn.execute(
+                'SELECT loss FROM rungs WHERE sweep = ? AND rung = ?', (self.sweep, rung))]
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        # continue if among the best ceil(n / reduction_factor) results recorded so far
+        n_continue = int(np.ceil(len(losses) / self.reduction_factor))
+        cutoff = np.sort(losses)[n_continue - 1]
+        return bool(loss > cutoff)
+
+
+def get_asha_scheduler(hparams):
+    """Build an ASHA scheduler from hparams.
+
+    Parameters
+    ----------
+    hparams : :obj:`dict`
+        needs to contain keys 'expt_dir' and 'max_n_epochs'; ASHA is enabled with the key 'asha',
+        and configured with the keys 'asha_min_epochs', 'asha_reduction_factor' and
+        'asha_sweep_id' (set for all trials of a grid search by
+        :func:`behavenet.fitting.hyperparam_utils.add_dependent_params`)
+
+    Returns
+    -------
+    :obj:`ASHAScheduler` or :obj:`NoneType`
+        :obj:`NoneType` if ASHA is not enabled
+
+    """
+    if not hparams.get('asha', False):
+        return None
+    return ASHAScheduler(
+        os.path.join(hparams['expt_dir'], 'asha.db'),
+        min_epochs=hparams.get('asha_min_epochs', 1),
+        reduction_factor=hparams.get('asha_reduction_factor', 3),
+        max_epochs=hparams['max_n_epochs'],
+        sweep=hparams.get('asha_sweep_id', ''))
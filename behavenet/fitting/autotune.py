@@ -0,0 +1,336 @@
+"""Functions for automatically choosing the chunk size used to compute model losses.
+
+Every BehaveNet model splits a batch into chunks of :obj:`chunk_size` frames before pushing data
+through the network, so that gradients can be accumulated without storing the intermediate values
+of an entire batch. The functions in this module choose the largest chunk size that fits within a
+user-defined memory budget, separately for training (values and gradients are stored) and
+inference (only values are stored).
+
+Device memory counters are only available on gpus. On cpus the training chunk size is therefore
+taken from the analytical footprint estimate, while the inference chunk size is measured from the
+sizes of the layer activations in a forward pass on real data (see
+:func:`measure_inference_footprint`).
+"""
+
+import numpy as np
+import torch
+
+# to ignore imports for sphix-autoapidoc
+__all__ = [
+    'autotune_chunk_size', 'estimate_chunk_size', 'measure_chunk_footprint',
+    'measure_inference_footprint']
+
+DEFAULT_CHUNK_SIZE = 200
+
+
+def autotune_chunk_size(
+        hparams, model, data_generator, mem_limit_gb=None, min_chunk_size=1,
+        max_chunk_size=2000):
+    """Choose chunk sizes for training and inference that fit within a memory budget.
+
+    The search starts from an analytical estimate computed with
+    :func:`behavenet.models.ae_model_architecture_generator.estimate_model_footprint` (for
+    convolutional autoencoders). If the model lives on a gpu the estimate is then refined by
+    measuring the peak memory allocated while computing the loss on a real batch of data. On cpu
+    the inference chunk size is computed from the layer activations measured with
+    :func:`measure_inference_footprint`, and the training chunk size is the analytical estimate.
+
+    The chosen values are stored in :obj:`hparams` under the keys :obj:`'train_chunk_size'` and
+    :obj:`'inference_chunk_size'`; these keys are read by :func:`behavenet.fitting.training.fit`
+    and the export functions in :mod:`behavenet.fitting.eval`. If either key is already present in
+    :obj:`hparams` it is not overwritten.
+
+    Parameters
+    ----------
+    hparams : :obj:`dict`
+        model/training specification; the memory budget is read from the key
+        :obj:`'chunk_mem_limit_gb'` (or :obj:`'mem_limit_gb'`) if :obj:`mem_limit_gb` is not
+        provided
+    model : :obj:`PyTorch` model
+        model whose :obj:`loss` method accepts a :obj:`chunk_size` argument
+    data_generator : :obj:`ConcatSessionsGenerator` object
+        data generator used to serve a representative batch of data
+    mem_limit_gb : :obj:`float`, optional
+        memory budget in GB
+    min_chunk_size : :obj:`int`, optional
+        smallest allowed chunk size
+    max_chunk_size : :obj:`int`, optional
+        largest allowed chunk size
+
+    Returns
+    -------
+    :obj:`dict`
+        - 'train_chunk_size' (:obj:`int`)
+        - 'inference_chunk_size' (:obj:`int`)
+
+    """
+
+    if mem_limit_gb is None:
+        mem_limit_gb = hparams.get('chunk_mem_limit_gb', hparams.get('mem_limit_gb', 8.0))
+    budget = mem_limit_gb * 1e9
+
+    device = hparams.get('device', 'cpu')
+    measure = device == 'cuda' and torch.cuda.is_available()
+
+    data_generator.reset_iterators('train')
+    data, dataset = data_generator.next_batch('train')
+    data_generator.reset_iterators('train')
+
+    chunk_sizes = {}
+    for mode in ['train', 'inference']:
+
+        key = '%s_chunk_size' % mode
+        if hparams.get(key, None) is not None:
+            chunk_sizes[key] = int(hparams[key])
+            continue
+
+        if mode == 'inference' and not measure:
+            # footprint is linear in the number of frames
+            chunk_size = _solve_chunk_size(
+                measure_inference_footprint(model, data, 1, dataset=dataset),
+                measure_inference_footprint(model, data, 2, dataset=dataset),
+                budget, DEFAULT_CHUNK_SIZE)
+        else:
+            chunk_size = estimate_chunk_size(
+                model, budget, train=(mode == 'train'), default=DEFAULT_CHUNK_SIZE)
+        chunk_size = int(np.clip(chunk_size, min_chunk_size, max_chunk_size))
+
+        if measure:
+            def measure_fn(n):
+                return measure_chunk_footprint(
+                    model, data, n, dataset=dataset, train=(mode == 'train'))
+            chunk_size = _search_chunk_size(
+                measure_fn, budget, chunk_size, min_chunk_size, max_chunk_size)
+
+        chunk_sizes[key] = chunk_size
+        hparams[key] = chunk_size
+
+    print('chunk sizes: train=%i, inference=%i (memory budget %1.2f GB)' % (
+        chunk_sizes['train_chunk_size'], chunk_sizes['inference_chunk_size'], mem_limit_gb))
+
+    return chunk_sizes
+
+
+def estimate_chunk_size(model, budget, train=True, default=DEFAULT_CHUNK_SIZE):
+    """Analytically estimate the largest chunk size that fits within a memory budget.
+
+    The footprint of a convolutional autoencoder is linear in the number of frames; we evaluate
+    :func:`estimate_model_footprint` for one and two frames to recover the fixed cost (parameters)
+    and the cost per frame (inputs, intermediate values and gradients). When not training, the
+    gradient storage is not needed and the cost per frame is halved; this is a coarse
+    approximation, and :func:`autotune_chunk_size` measures the inference footprint instead.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+    budget : :obj:`float`
+        memory budget in bytes
+    train : :obj:`bool`, optional
+        :obj:`True` to account for gradient storage
+    default : :obj:`int`, optional
+        returned if the footprint of :obj:`model` cannot be estimated (e.g. linear autoencoders
+        and decoders)
+
+    Returns
+    -------
+    :obj:`int`
+        estimated chunk size
+
+    """
+    from behavenet.models.ae_model_architecture_generator import estimate_model_footprint
+
+    encoding = getattr(model, 'encoding', None)
+    if encoding is None or not hasattr(encoding, 'encoder') \
+            or not isinstance(encoding.encoder, torch.nn.ModuleList) \
+            or model.hparams.get('fit_sess_io_layers', False):
+        return default
+
+    input_dim = [
+        model.hparams['n_input_channels'], model.hparams['y_pixels'], model.hparams['x_pixels']]
+    with torch.no_grad():
+        bytes_1 = estimate_model_footprint(model, tuple([1] + input_dim))
+        bytes_2 = estimate_model_footprint(model, tuple([2] + input_dim))
+
+    if not train:
+        # halve the cost per frame, keep the fixed cost
+        bytes_2 = bytes_1 + (bytes_2 - bytes_1) / 2
+
+    return _solve_chunk_size(bytes_1, bytes_2, budget, default)
+
+
+def measure_chunk_footprint(model, data, chunk_size, dataset=0, train=True):
+    """Measure peak gpu memory allocated while computing the loss on a single chunk.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+    data : :obj:`dict`
+        batch of data returned by :obj:`ConcatSessionsGenerator.next_batch`; frames are repeated
+        if the batch contains fewer than :obj:`chunk_size` frames
+    chunk_size : :obj:`int`
+        number of frames in chunk
+    dataset : :obj:`int`, optional
+        used for session-specific io layers
+    train : :obj:`bool`, optional
+        :obj:`True` to compute gradients, :obj:`False` to evaluate without gradients
+
+    Returns
+    -------
+    :obj:`int`
+        peak memory in bytes; :obj:`np.inf` if the chunk does not fit on the device
+
+    """
+    chunk = _tile_batch(data, chunk_size)
+    if train:
+        model.train()
+    else:
+        model.eval()
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats()
+    try:
+        if train:
+            model.loss(chunk, dataset=dataset, accumulate_grad=True, chunk_size=chunk_size)
+        else:
+            with torch.no_grad():
+                model.loss(chunk, dataset=dataset, accumulate_grad=False, chunk_size=chunk_size)
+        peak = torch.cuda.max_memory_allocated()
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise e
+        peak = np.inf
+    finally:
+        model.zero_grad()
+        torch.cuda.empty_cache()
+    return peak
+
+
+def measure_inference_footprint(model, data, chunk_size, dataset=0):
+    """Measure the peak memory of a forward pass without gradients from the layer activations.
+
+    Forward hooks record the size of the inputs and outputs of every layer while computing the
+    loss on a single chunk. Without gradients the input of a layer is freed once the next layer
+    has been computed, so the peak is reached in the layer with the largest inputs plus outputs;
+    the memory of the model parameters is added to this peak. Unlike
+    :func:`measure_chunk_footprint`, this measurement does not rely on gpu memory counters and
+    can be used on any device.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+    data : :obj:`dict`
+        batch of data returned by :obj:`ConcatSessionsGenerator.next_batch`; frames are repeated
+        if the batch contains fewer than :obj:`chunk_size` frames
+    chunk_size : :obj:`int`
+        number of frames in chunk
+    dataset : :obj:`int`, optional
+        used for session-specific io layers
+
+    Returns
+    -------
+    :obj:`int`
+        peak memory in bytes
+
+    """
+
+    def _n_bytes(tensors):
+        if isinstance(tensors, torch.Tensor):
+            return tensors.element_size() * tensors.nelement()
+        elif isinstance(tensors, (list, tuple)):
+            return sum([_n_bytes(t) for t in tensors])
+        return 0
+
+    peak = [0]
+
+    def _hook(module, inputs, outputs):
+        peak[0] = max(peak[0], _n_bytes(inputs) + _n_bytes(outputs))
+
+    chunk = _tile_batch(data, chunk_size)
+    handles = [
+        m.register_forward_hook(_hook) for m in model.modules() if len(list(m.children())) == 0]
+    model.eval()
+    try:
+        with torch.no_grad():
+            model.loss(chunk, dataset=dataset, accumulate_grad=False, chunk_size=chunk_size)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return peak[0] + _n_bytes(list(model.parameters()))
+
+
+def _solve_chunk_size(bytes_1, bytes_2, budget, default):
+    """Largest chunk size within budget, given the footprints of chunks of one and two frames."""
+    per_frame = bytes_2 - bytes_1
+    fixed = bytes_1 - per_frame
+    if per_frame <= 0:
+        return default
+    return int(np.floor((budget - fixed) / per_frame))
+
+
+def _tile_batch(data, n_frames):
+    """Repeat/crop the frames of a data batch so that it contains exactly `n_frames` frames."""
+    tiled = {}
+    for key, val in data.items():
+        if key == 'batch_idx' or not isinstance(val, torch.Tensor):
+            tiled[key] = val
+            continue
+        n_t = val.shape[1]
+        n_reps = int(np.ceil(n_frames / n_t))
+        reps = [1, n_reps] + [1] * (val.dim() - 2)
+        tiled[key] = val.repeat(*reps)[:, :n_frames]
+    return tiled
+
+
+def _search_chunk_size(measure_fn, budget, init_chunk_size, min_chunk_size, max_chunk_size):
+    """Find the largest chunk size whose measured footprint is below the budget.
+
+    Starting from an initial guess, the chunk size is doubled until the budget is exceeded (or
+    halved until it is met), and the boundary is then refined with a binary search.
+
+    Parameters
+    ----------
+    measure_fn : callable
+        takes a chunk size and returns the measured footprint in bytes
+    budget : :obj:`float`
+        memory budget in bytes
+    init_chunk_size : :obj:`int`
+        initial guess
+    min_chunk_size : :obj:`int`
+        smallest allowed chunk size; returned if no chunk size fits within the budget
+    max_chunk_size : :obj:`int`
+        largest allowed chunk size
+
+    Returns
+    -------
+    :obj:`int`
+        chunk size
+
+    """
+    lo = None  # largest chunk size known to fit
+    hi = None  # smallest chunk size known not to fit
+    n = int(np.clip(init_chunk_size, min_chunk_size, max_chunk_size))
+
+    # bracket the boundary
+    while True:
+        if measure_fn(n) <= budget:
+            lo = n
+            if n >= max_chunk_size:
+                return max_chunk_size
+            n = min(2 * n, max_chunk_size)
+        else:
+            hi = n
+            if n <= min_chunk_size:
+                return min_chunk_size
+            n = max(n // 2, min_chunk_size)
+        if lo is not None and hi is not None:
+            break
+
+    # binary search between lo (fits) and hi (does not fit)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if measure_fn(mid) <= budget:
+            lo = mid
+        else:
+            hi = mid
+
+    return lo
@@ -1,19 +1,25 @@
 import os
-import time
-import numpy as np
-import random
 import torch
 import pickle
 
 from behavenet.data.utils import build_data_generator
+from behavenet.fitting.distributed import broadcast_object
+from behavenet.fitting.distributed import is_main_process
 from behavenet.fitting.hyperparam_utils import get_all_params
+from behavenet.fitting.hyperparam_utils import estimate_trial_cost
 from behavenet.fitting.hyperparam_utils import get_slurm_params
+from behavenet.fitting.hyperparam_utils import run_local_trials
+from behavenet.fitting.hyperparam_utils import group_trials
 from behavenet.fitting.training import fit
+from behavenet.fitting.training import fit_decoder_stack
 from behavenet.fitting.utils import _clean_tt_dir
 from behavenet.fitting.utils import _print_hparams
 from behavenet.fitting.utils import create_tt_experiment
 from behavenet.fitting.utils import export_hparams
+from behavenet.fitting.utils import export_session_info_to_csv
+from behavenet.fitting.utils import get_data_params
 from behavenet.models import Decoder
+from behavenet.models import DecoderStack
 
 
 def main(hparams, *args):
@@ -24,18 +30,62 @@ def main(hparams, *args):
     # print hparams to console
     _print_hparams(hparams)
 
-    # Start at random times (so test tube creates separate folders)
-    np.random.seed(random.randint(0, 1000))
-    time.sleep(np.random.uniform(1))
-
-    # create test-tube experiment
-    hparams, sess_ids, exp = create_tt_experiment(hparams)
+    # create test-tube experiment; with distributed training only the main process logs
+    if is_main_process():
+        hparams, sess_ids, exp = create_tt_experiment(hparams)
+    else:
+        sess_ids, exp = None, None
+    hparams, sess_ids = broadcast_object((hparams, sess_ids))
     if hparams is None:
         print('Experiment exists! Aborting fit')
         return
 
     # build data generator
-    data_generator = build_data_generator(hparams, sess_ids)
+    data_generator = build_data_generator(
+        hparams, sess_ids, export_csv=is_main_process(),
+        use_cache=hparams.get('share_data_generator', False))
+
+    _set_io_hparams(hparams, data_generator)
+
+    # ####################
+    # ### CREATE MODEL ###
+    # ####################
+    print('constructing model...', end='')
+    torch.manual_seed(hparams['rng_seed_model'])
+    torch_rng_seed = torch.get_rng_state()
+    hparams['model_build_rng_seed'] = torch_rng_seed
+    model = Decoder(hparams)
+    model.to(hparams['device'])
+    model.version = hparams['version']
+    torch_rng_seed = torch.get_rng_state()
+    hparams['training_rng_seed'] = torch_rng_seed
+
+    # save out hparams as csv and dict for easy reloading
+    hparams['training_completed'] = False
+    if is_main_process():
+        export_hparams(hparams, exp)
+    print('done')
+
+    # ####################
+    # ### TRAIN MODEL ###
+    # ####################
+
+    fit(hparams, model, data_generator, exp, method='nll')
+
+    # remaining exports are handled by the main process
+    if not is_main_process():
+        return
+
+    # update hparams upon successful training
+    hparams['training_completed'] = True
+    export_hparams(hparams, exp)
+
+    # get rid of unneeded logging info
+    _clean_tt_dir(hparams)
+
+
+def _set_io_hparams(hparams, data_generator):
+    """Add input/output sizes and upstream model paths to hparams."""
 
     ex_trial = data_generator.datasets[0].batch_idxs['train'][0]
     i_sig = hparams['input_signal']
@@ -79,36 +129,79 @@ def main(hparams, *args):
         tags = pickle.load(open(os.path.join(hparams['arhmm_model_path'], 'meta_tags.pkl'), 'rb'))
         hparams['ae_model_latents_file'] = tags['ae_model_latents_file']
 
+
+def main_stack(hparams_list, *args):
+    """Fit multiple decoders that only differ in training hparams on a single data stream.
+
+    All decoders must share data and architecture hparams (see
+    :func:`behavenet.fitting.hyperparam_utils.group_trials`); they are trained simultaneously as
+    a :class:`behavenet.models.DecoderStack` and each decoder is saved in its own test-tube
+    version directory. Decoders that cannot be stacked (e.g. lstms) are fit one at a time with
+    :func:`main`.
+    """
+
+    if any(hparams['model_type'] not in DecoderStack.model_types for hparams in hparams_list):
+        for hparams in hparams_list:
+            main(dict(hparams), *args)
+        return
+
+    # create test-tube experiments, skipping those that already exist
+    hparams_list_, exps = [], []
+    for hparams in hparams_list:
+        hparams = dict(hparams)
+        _print_hparams(hparams)
+        hparams, sess_ids_, exp = create_tt_experiment(hparams)
+        if hparams is None:
+            print('Experiment exists! Skipping fit')
+            continue
+        hparams_list_.append(hparams)
+        exps.append(exp)
+        sess_ids = sess_ids_
+    if len(hparams_list_) == 0:
+        return
+    hparams_list = hparams_list_
+
+    # build a single data generator shared by all decoders
+    data_generator = build_data_generator(
+        hparams_list[0], sess_ids, use_cache=hparams_list[0].get('share_data_generator', False))
+    for hparams in hparams_list[1:]:
+        export_session_info_to_csv(
+            os.path.join(hparams['expt_dir'], 'version_%i' % hparams['version']), sess_ids)
+
     # ####################
     # ### CREATE MODEL ###
     # ####################
-    print('constructing model...', end='')
-    torch.manual_seed(hparams['rng_seed_model'])
-    torch_rng_seed = torch.get_rng_state()
-    hparams['model_build_rng_seed'] = torch_rng_seed
-    model = Decoder(hparams)
-    model.to(hparams['device'])
-    model.version = exp.version
-    torch_rng_seed = torch.get_rng_state()
-    hparams['training_rng_seed'] = torch_rng_seed
+    print('constructing models...', end='')
+    models = []
+    for hparams, exp in zip(hparams_list, exps):
+        _set_io_hparams(hparams, data_generator)
+        torch.manual_seed(hparams['rng_seed_model'])
+        hparams['model_build_rng_seed'] = torch.get_rng_state()
+        model = Decoder(hparams)
+        model.to(hparams['device'])
+        model.version = hparams['version']
+        hparams['training_rng_seed'] = torch.get_rng_state()
+        models.append(model)
 
-    # save out hparams as csv and dict for easy reloading
-    hparams['training_completed'] = False
-    export_hparams(hparams, exp)
+        # save out hparams as csv and dict for easy reloading
+        hparams['training_completed'] = False
+        export_hparams(hparams, exp)
+    model_stack = DecoderStack(models)
     print('done')
 
     # ####################
     # ### TRAIN MODEL ###
     # ####################
 
-    fit(hparams, model, data_generator, exp, method='nll')
+    fit_decoder_stack(hparams_list, model_stack, data_generator, exps)
 
-    # update hparams upon successful training
-    hparams['training_completed'] = True
-    export_hparams(hparams, exp)
+    for hparams, exp in zip(hparams_list, exps):
+        # update hparams upon successful training
+        hparams['training_completed'] = True
+        export_hparams(hparams, exp)
 
-    # get rid of unneeded logging info
-    _clean_tt_dir(hparams)
+        # get rid of unneeded logging info
+        _clean_tt_dir(hparams)
 
 
 if __name__ == '__main__':
@@ -130,15 +223,47 @@ if __name__ == '__main__':
                 job_display_name=None)
 
     else:
-        if hyperparams.device == 'cuda' or hyperparams.device == 'gpu':
+
+        if 'n_stacked_decoders' in hyperparams and hyperparams.n_stacked_decoders > 1:
+            # fit groups of decoders that only differ in training hparams together
+            if hyperparams.device == 'gpu':
+                hyperparams.device = 'cuda'
+            stacks = group_trials(
+                hyperparams.generate_trials(hyperparams.tt_n_cpu_trials),
+                hyperparams.n_stacked_decoders,
+                can_group=lambda h: h['model_type'] in DecoderStack.model_types)
+            if hyperparams.device == 'cpu':
+                run_local_trials(
+                    main_stack, stacks, n_workers=hyperparams.tt_n_cpu_workers,
+                    n_threads=hyperparams.tt_n_cpu_threads if 'tt_n_cpu_threads' in hyperparams
+                    else None,
+                    cost_fn=lambda stack: sum(estimate_trial_cost(h) for h in stack))
+            else:
+                for stack in stacks:
+                    main_stack(stack)
+
+        elif 'ddp_world_size' in hyperparams and hyperparams.ddp_world_size > 1:
+            # fit one trial at a time, each split across multiple data-parallel processes
+            from behavenet.fitting.distributed import launch
+            for trial in hyperparams.generate_trials(hyperparams.tt_n_cpu_trials):
+                launch(main, trial, hyperparams.ddp_world_size, backend=hyperparams.ddp_backend)
+
+        elif hyperparams.device == 'cuda' or hyperparams.device == 'gpu':
             if hyperparams.device == 'gpu':
                 hyperparams.device = 'cuda'
 
             gpu_ids = hyperparams.gpus_viz.split(';')
-            hyperparams.optimize_parallel_gpu(main, gpu_ids=gpu_ids)
+            run_local_trials(
+                main, hyperparams.generate_trials(hyperparams.tt_n_gpu_trials),
+                n_workers=len(gpu_ids), gpu_ids=gpu_ids,
+                group_fn=get_data_params if 'share_data_generator' in hyperparams
+                and hyperparams.share_data_generator else None)
 
         elif hyperparams.device == 'cpu':
-            hyperparams.optimize_parallel_cpu(
-                main,
-                nb_trials=hyperparams.tt_n_cpu_trials,
-                nb_workers=hyperparams.tt_n_cpu_workers)
+            run_local_trials(
+                main, hyperparams.generate_trials(hyperparams.tt_n_cpu_trials),
+                n_workers=hyperparams.tt_n_cpu_workers,
+                n_threads=hyperparams.tt_n_cpu_threads if 'tt_n_cpu_threads' in hyperparams
+                else None,
+                group_fn=get_data_params if 'share_data_generator' in hyperparams
+                and hyperparams.share_data_generator else None)
@@ -0,0 +1,249 @@
+"""Helper functions for multi-process data-parallel training.
+
+A distributed fit runs one process per worker; every process holds a full copy of the model and
+processes a disjoint shard of the training/validation batches. Gradients are averaged across
+processes after each batch, so that all copies of the model take identical optimizer steps. Only
+the process with rank 0 logs metrics and writes files to disk.
+
+The gloo backend runs on cpu, which makes it possible to test distributed training on a single
+machine without gpus.
+"""
+
+import os
+import socket
+import numpy as np
+import torch
+import torch.distributed as dist
+
+# to ignore imports for sphix-autoapidoc
+__all__ = [
+    'launch', 'is_distributed', 'get_rank', 'get_world_size', 'is_main_process',
+    'broadcast_object', 'broadcast_parameters', 'average_gradients', 'all_reduce_min',
+    'shard_data_generator']
+
+
+def launch(fn, hparams, world_size, backend='gloo', start_method='spawn'):
+    """Run a training function in :obj:`world_size` processes that share a process group.
+
+    Parameters
+    ----------
+    fn : callable
+        function with signature :obj:`fn(hparams)`, e.g. the :obj:`main` function of
+        :mod:`behavenet.fitting.ae_grid_search`; must be picklable if :obj:`start_method='spawn'`
+    hparams : :obj:`dict` or :obj:`Namespace`
+        model/training specification passed to every process
+    world_size : :obj:`int`
+        number of processes
+    backend : :obj:`str`, optional
+        'gloo' (cpu) | 'nccl' (gpu)
+    start_method : :obj:`str`, optional
+        'spawn' | 'fork'; see :obj:`torch.multiprocessing.start_processes`
+
+    """
+    import torch.multiprocessing as mp
+    init_method = 'tcp://127.0.0.1:%i' % _find_free_port()
+    mp.start_processes(
+        _worker, args=(fn, hparams, world_size, backend, init_method), nprocs=world_size,
+        join=True, start_method=start_method)
+
+
+def _worker(rank, fn, hparams, world_size, backend, init_method):
+    """Initialize the process group for a single process and run the training function."""
+    dist.init_process_group(
+        backend=backend, init_method=init_method, rank=rank, world_size=world_size)
+    try:
+        device = hparams['device'] if isinstance(hparams, dict) else hparams.device
+        if device == 'cuda' and torch.cuda.is_available():
+            torch.cuda.set_device(rank % torch.cuda.device_count())
+        else:
+            # split cpu cores evenly between processes
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+        fn(hparams)
+    finally:
+        dist.destroy_process_group()
+
+
+def _find_free_port():
+    """Ask the OS for an unused port to host the process group rendezvous."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def is_distributed():
+    """Return :obj:`True` if the current process belongs to an initialized process group."""
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    """Return rank of the current process (0 if not distributed)."""
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    """Return number of processes in the process group (1 if not distributed)."""
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """Return :obj:`True` for the process responsible for logging and saving."""
+    return get_rank() == 0
+
+
+def broadcast_object(obj, src=0):
+    """Send a picklable python object from process :obj:`src` to all other processes.
+
+    Parameters
+    ----------
+    obj : :obj:`object`
+        object to send; ignored on processes other than :obj:`src`
+    src : :obj:`int`, optional
+        rank of sending process
+
+    Returns
+    -------
+    :obj:`object`
+        object from process :obj:`src`
+
+    """
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
+
+
+def broadcast_parameters(model, src=0):
+    """Copy the parameters and buffers of :obj:`model` on process :obj:`src` to all processes.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+    src : :obj:`int`, optional
+        rank of sending process
+
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, src=src)
+
+
+def average_gradients(model):
+    """Average gradients of all trainable parameters across processes.
+
+    Each process computes gradients on its own batch with :obj:`model.loss`, which splits the
+    batch into chunks and accumulates gradients over chunks. Averaging the accumulated gradients
+    once per batch (rather than once per chunk) keeps communication to a single all-reduce.
+
+    Parameters that did not receive a gradient on a process (e.g. session-specific io layers for
+    sessions that were not in the batch of that process) do not contribute to the average; if no
+    process computed a gradient for a parameter its gradient is left as :obj:`None`, so that the
+    optimizer skips it exactly as it would in single-process training.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+
+    """
+    if not is_distributed():
+        return
+
+    params = [p for p in model.parameters() if p.requires_grad]
+    if len(params) == 0:
+        return
+
+    # flatten all gradients into a single buffer (plus a count of contributing processes)
+    grads = []
+    counts = []
+    for p in params:
+        if p.grad is None:
+            grads.append(torch.zeros_like(p.data).view(-1))
+            counts.append(0.)
+        else:
+            grads.append(p.grad.data.view(-1))
+            counts.append(1.)
+    buffer = torch.cat(grads + [torch.tensor(counts, device=grads[0].device)])
+    dist.all_reduce(buffer, op=dist.ReduceOp.SUM)
+
+    n_counts = len(counts)
+    counts = buffer[-n_counts:]
+    offset = 0
+    for p, count in zip(params, counts):
+        numel = p.data.numel()
+        if count.item() == 0:
+            p.grad = None
+        else:
+            grad = buffer[offset:offset + numel].view_as(p.data) / count
+            if p.grad is None:
+                p.grad = grad.clone()
+            else:
+                p.grad.data.copy_(grad)
+        offset += numel
+
+
+def all_reduce_min(value):
+    """Return the minimum of a scalar integer across processes.
+
+    Parameters
+    ----------
+    value : :obj:`int`
+
+    Returns
+    -------
+    :obj:`int`
+
+    """
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([int(value)], dtype=torch.long)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+    return int(tensor.item())
+
+
+def shard_data_generator(data_generator, rank, world_size, dtypes=('train', 'val')):
+    """Restrict the batches served by a data generator to a single process.
+
+    Batches of each session are split round-robin across processes, so that every process sees a
+    disjoint subset of the trials. Calling this function with :obj:`world_size=1` restores the
+    full set of batches.
+
+    Parameters
+    ----------
+    data_generator : :obj:`ConcatSessionsGenerator` object
+    rank : :obj:`int`
+        rank of the current process
+    world_size : :obj:`int`
+        total number of processes
+    dtypes : :obj:`array-like`, optional
+        data types to shard; by default test batches are not sharded, since the test loss is only
+        computed by the main process
+
+    """
+    from torch.utils.data import SubsetRandomSampler
+
+    for i, dataset in enumerate(data_generator.datasets):
+        # keep a copy of the original batch indices so that sharding can be undone
+        if not hasattr(dataset, 'batch_idxs_full'):
+            dataset.batch_idxs_full = {
+                dtype: idxs for dtype, idxs in dataset.batch_idxs.items()}
+        for dtype in dtypes:
+            idxs = dataset.batch_idxs_full[dtype]
+            dataset.batch_idxs[dtype] = idxs[rank::world_size]
+            dataset.n_batches[dtype] = len(dataset.batch_idxs[dtype])
+            data_generator.dataset_loaders[i][dtype] = torch.utils.data.DataLoader(
+                dataset, batch_size=1, sampler=SubsetRandomSampler(dataset.batch_idxs[dtype]),
+                num_workers=0, pin_memory=False)
+            data_generator.dataset_iters[i][dtype] = iter(
+                data_generator.dataset_loaders[i][dtype])
+
+    for dtype in dtypes:
+        data_generator.n_tot_batches[dtype] = sum(
+            [dataset.n_batches[dtype] for dataset in data_generator.datasets])
+
+    # sessions are sampled in proportion to their number of (sharded) training batches
+    if 'train' in dtypes and data_generator.n_tot_batches['train'] > 0:
+        data_generator.batch_ratios = np.array(
+            [dataset.n_batches['train'] for dataset in data_generator.datasets]) \
+            / data_generator.n_tot_batches['train']
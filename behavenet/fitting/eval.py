@@ -7,7 +7,9 @@ def export_latents(data_generator, model, filename=None):
     """Export predicted latents using an already initialized data_generator and model.
 
     Latents are saved based on the model's hparams dict unless another file is provided. The
-    default filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_latents.pkl`.
+    default filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_latents.pkl`. If the hparams
+    key 'export_trace' is `True` and no trace is already active, a trace of the export is saved in
+    the model directory as `trace_export_latents.json`.
 
     Parameters
     ----------
@@ -28,6 +30,9 @@ def export_latents(data_generator, model, filename=None):
     import pickle
     import os
     import torch
+    from behavenet.tracing import save_trace, start_trace, trace_span
+
+    tracer = start_trace(enabled=model.hparams.get('export_trace', False))
 
     model.eval()
 
@@ -44,7 +49,7 @@ def export_latents(data_generator, model, filename=None):
             data, sess = data_generator.next_batch(dtype)
 
             # process batch, perhaps in chunks if full batch is too large to fit on gpu
-            chunk_size = 200
+            chunk_size = model.hparams.get('inference_chunk_size', 200)
             y = data['images'][0]
             if model.hparams['model_class'] == 'cond-ae' and \
                     model.hparams.get('conditional_encoder', False):
@@ -67,7 +72,8 @@ def export_latents(data_generator, model, filename=None):
                         y_in = torch.cat((y[idx_beg:idx_end], labels_2d[idx_beg:idx_end]), dim=1)
                     else:
                         y_in = y[idx_beg:idx_end]
-                    output = model.encoding(y_in, dataset=sess)
+                    with trace_span('encode', 'model', chunk=int(chunk)):
+                        output = model.encoding(y_in, dataset=sess)
                     if model.hparams['model_class'] == 'ps-vae':
                         curr_latents = torch.cat([output[0], output[1]], axis=1)
                     else:
@@ -83,7 +89,8 @@ def export_latents(data_generator, model, filename=None):
                     y_in = torch.cat((y, labels_2d), dim=1)
                 else:
                     y_in = y
-                output = model.encoding(y_in, dataset=sess)
+                with trace_span('encode', 'model'):
+                    output = model.encoding(y_in, dataset=sess)
                 if model.hparams['model_class'] == 'ps-vae':
                     curr_latents = torch.cat([output[0], output[1]], axis=1)
                 else:
@@ -108,9 +115,12 @@ def export_latents(data_generator, model, filename=None):
         print(
             'saving latents %i of %i:\n%s' % (sess + 1, data_generator.n_datasets, filename_save))
         latents_dict = {'latents': latents[sess], 'trials': dataset.batch_idxs}
-        with open(filename_save, 'wb') as f:
+        with trace_span('write_pickle', 'io'), open(filename_save, 'wb') as f:
             pickle.dump(latents_dict, f)
         filenames.append(filename_save)
+
+    save_trace(tracer, os.path.join(
+        model.hparams['expt_dir'], 'version_%i' % model.version, 'trace_export_latents.json'))
     return filenames
 
 
@@ -118,7 +128,9 @@ def export_states(hparams, data_generator, model, filename=None):
     """Export predicted latents using an already initialized data_generator and model.
 
     States are saved based on the hparams dict unless another file is provided. The default
-    filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_states.pkl`.
+    filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_states.pkl`. If the hparams key
+    'export_trace' is `True`, a trace of the export is saved in the model directory as
+    `trace_export_states.json`.
 
     Parameters
     ----------
@@ -140,6 +152,9 @@ def export_states(hparams, data_generator, model, filename=None):
 
     import pickle
     import os
+    from behavenet.tracing import save_trace, start_trace, trace_span
+
+    tracer = start_trace(enabled=hparams.get('export_trace', False))
 
     # initialize container for states
     states = [[] for _ in range(data_generator.n_datasets)]
@@ -160,7 +175,8 @@ def export_states(hparams, data_generator, model, filename=None):
                 y = data['ae_latents'][0][0]
             # batch_size = y.shape[0]
 
-            curr_states = model.most_likely_states(y)
+            with trace_span('most_likely_states', 'model'):
+                curr_states = model.most_likely_states(y)
 
             states[sess][data['batch_idx'].item()] = curr_states
 
@@ -178,9 +194,12 @@ def export_states(hparams, data_generator, model, filename=None):
         # save out array in pickle file
         print('saving states %i of %i:\n%s' % (sess + 1, data_generator.n_datasets, filename_save))
         states_dict = {'states': states[sess], 'trials': dataset.batch_idxs}
-        with open(filename_save, 'wb') as f:
+        with trace_span('write_pickle', 'io'), open(filename_save, 'wb') as f:
             pickle.dump(states_dict, f)
         filenames.append(filename_save)
+
+    save_trace(tracer, os.path.join(
+        hparams['expt_dir'], 'version_%i' % hparams['version'], 'trace_export_states.json'))
     return filenames
 
 
@@ -188,7 +207,9 @@ def export_predictions(data_generator, model, filename=None):
     """Export decoder predictions using an already initialized data_generator and model.
 
     Predictions are saved based on the model's hparams dict unless another file is provided. The
-    default filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_predictions.pkl`.
+    default filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_predictions.pkl`. If the
+    hparams key 'export_trace' is `True` and no trace is already active, a trace of the export is
+    saved in the model directory as `trace_export_predictions.json`.
 
     This function only supports pytorch decoding models - not autoencoders. To get AE
     reconstructions see the `get_reconstruction` function in this module.
@@ -211,6 +232,9 @@ def export_predictions(data_generator, model, filename=None):
 
     import pickle
     import os
+    from behavenet.tracing import save_trace, start_trace, trace_span
+
+    tracer = start_trace(enabled=model.hparams.get('export_trace', False))
 
     model.eval()
 
@@ -236,7 +260,7 @@ def export_predictions(data_generator, model, filename=None):
 
             # process batch, perhaps in chunks if full batch is too large
             # to fit on gpu
-            chunk_size = 200
+            chunk_size = model.hparams.get('inference_chunk_size', 200)
             batch_size = targets.shape[0]
             if batch_size > chunk_size:
                 # split into chunks
@@ -246,12 +270,14 @@ def export_predictions(data_generator, model, filename=None):
                     # max_lags
                     idx_beg = np.max([chunk * chunk_size - max_lags, 0])
                     idx_end = np.min([(chunk + 1) * chunk_size + max_lags, batch_size])
-                    outputs, _ = model(predictors[idx_beg:idx_end])
+                    with trace_span('predict', 'model', chunk=int(chunk)):
+                        outputs, _ = model(predictors[idx_beg:idx_end])
                     slc = (idx_beg + max_lags, idx_end - max_lags)
                     predictions[sess][data['batch_idx'].item()][slice(*slc), :] = \
                         outputs[max_lags:-max_lags].cpu().detach().numpy()
             else:
-                outputs, _ = model(predictors)
+                with trace_span('predict', 'model'):
+                    outputs, _ = model(predictors)
                 slc = (max_lags, -max_lags)
 
                 predictions[sess][data['batch_idx'].item()][slice(*slc), :] = \
@@ -273,9 +299,12 @@ def export_predictions(data_generator, model, filename=None):
             'saving predictions %i of %i to %s' %
             (sess + 1, data_generator.n_datasets, filename_save))
         predictions_dict = {'predictions': predictions[sess], 'trials': dataset.batch_idxs}
-        with open(filename_save, 'wb') as f:
+        with trace_span('write_pickle', 'io'), open(filename_save, 'wb') as f:
             pickle.dump(predictions_dict, f)
         filenames.append(filename_save)
+
+    save_trace(tracer, os.path.join(
+        model.hparams['expt_dir'], 'version_%i' % model.version, 'trace_export_predictions.json'))
     return filenames
 
 
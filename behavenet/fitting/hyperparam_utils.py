@@ -2,11 +2,11 @@ import commentjson
 import datetime
 import sys
 import os
+import numpy as np
 from subprocess import call
 from test_tube import HyperOptArgumentParser
 from test_tube.hpc import SlurmCluster, AbstractCluster
 from behavenet import get_user_dir
-from behavenet.models.ae_model_architecture_generator import load_handcrafted_arches
 
 
 def get_all_params(search_type='grid_search', args=None):
@@ -61,6 +61,7 @@ def add_to_parser(parser, arg_name, value):
 
 def add_dependent_params(parser, namespace):
     """Add params that are derived from json arguments."""
+    from behavenet.models.ae_model_architecture_generator import load_handcrafted_arches
 
     if namespace.model_class == 'ae' \
             or namespace.model_class == 'vae' \
@@ -120,6 +121,11 @@ def add_dependent_params(parser, namespace):
     else:
         pass
 
+    if getattr(namespace, 'asha', False):
+        # asha only compares trials generated by the same call to this function
+        sweep_id = '%s_%i' % (datetime.datetime.now().strftime('%Y-%m-%d__%H-%M-%S'), os.getpid())
+        parser.add_argument('--asha_sweep_id', default=sweep_id, type=str)
+
 
 class CustomSlurmCluster(SlurmCluster):
 
@@ -171,3 +177,261 @@ def get_slurm_params(hyperparams):
     )
 
     return cluster
+
+
+def group_trials(
+        trials, max_group_size, member_keys=('learning_rate', 'l2_reg', 'rng_seed_model'),
+        can_group=None):
+    """Group trials that only differ in the values of `member_keys`.
+
+    Trials in a group share data, architecture and batching hparams, so that they can be trained
+    together (see :class:`behavenet.models.decoders.DecoderStack`).
+
+    Parameters
+    ----------
+    trials : :obj:`list`
+        trials returned by :meth:`HyperOptArgumentParser.generate_trials`
+    max_group_size : :obj:`int`
+        maximum number of trials in a single group; larger groups are split
+    member_keys : :obj:`tuple` of :obj:`str`, optional
+        hparams that are allowed to differ within a group
+    can_group : callable or :obj:`NoneType`, optional
+        takes the hparams of a trial and returns :obj:`False` if the trial cannot be trained
+        together with other trials; such trials are returned in groups of their own
+
+    Returns
+    -------
+    :obj:`list` of :obj:`list` of :obj:`dict`
+        groups of trial hparams, in order of first appearance
+
+    """
+    groups = {}
+    for trial in trials:
+        hparams = vars(trial) if not isinstance(trial, dict) else trial
+        if can_group is not None and not can_group(hparams):
+            key = len(groups)
+        else:
+            key = tuple(sorted((k, repr(v)) for k, v in hparams.items() if k not in member_keys))
+        groups.setdefault(key, []).append(hparams)
+    return [
+        group[i:i + max_group_size] for group in groups.values()
+        for i in range(0, len(group), max_group_size)]
+
+
+def estimate_trial_cost(hparams):
+    """Estimate the relative cost of fitting a model.
+
+    This is a coarse heuristic used to order trials (most expensive first) so that long trials do
+    not end up running alone at the end of a grid search; only ratios between trials matter.
+
+    Parameters
+    ----------
+    hparams : :obj:`dict`
+        trial hparams
+
+    Returns
+    -------
+    :obj:`float`
+
+    """
+    cost = float(hparams.get('max_n_epochs', 1) or 1)
+    if 'y_pixels' in hparams and 'x_pixels' in hparams:
+        # ae-type models: cost scales with frame size, much more so for conv layers
+        cost *= hparams['y_pixels'] * hparams['x_pixels'] * hparams.get('n_input_channels', 1)
+        if hparams.get('model_type', 'conv') == 'conv':
+            cost *= 10
+    if 'n_hid_layers' in hparams:
+        # decoders: cost scales with lags and hidden units
+        cost *= (2 * hparams.get('n_lags', 0) + 1) * \
+            (1 + hparams['n_hid_layers'] * hparams.get('n_hid_units', 1))
+    return cost
+
+
+def _run_trials(main, trials, idxs, n_threads, gpu_id, queue):
+    """Fit trials one after the other in a worker process and report resource usage."""
+    import time
+    import traceback
+    import torch
+    if gpu_id is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_id)
+    torch.set_num_threads(n_threads)
+    for trial, idx in zip(trials, idxs):
+        t_wall = time.time()
+        t_cpu = time.process_time()
+        try:
+            main(trial)
+            status, error = 'completed', None
+        except Exception:
+            status, error = 'failed', traceback.format_exc()
+        queue.put({
+            'idx': idx, 'status': status, 'error': error, 'wall_s': time.time() - t_wall,
+            'cpu_s': time.process_time() - t_cpu})
+
+
+def run_local_trials(
+        main, trials, n_workers, n_threads=None, gpu_ids=None, cost_fn=None, group_fn=None,
+        start_method='spawn', poll_interval=0.5):
+    """Fit grid search trials in parallel on the local machine.
+
+    Trials are fit in worker processes, each with its own budget of cpu threads
+    (:func:`torch.set_num_threads` plus the OMP/MKL environment variables), so that parallel
+    trials do not oversubscribe the machine. The threads available are divided between the
+    running workers; when fewer jobs than workers remain, the remaining jobs receive more
+    threads. Jobs are queued in order of decreasing estimated cost. A trial that raises an
+    exception, or a worker that crashes (e.g. runs out of memory), is reported as failed without
+    affecting the other workers. A table of per-trial resource usage is printed once all trials
+    have finished.
+
+    By default each trial is fit in its own process. If :obj:`group_fn` is provided, trials for
+    which it returns the same value are fit one after the other in a single process; with
+    :func:`behavenet.fitting.utils.get_data_params` this allows trials that are fit on the same
+    data to share a data generator (see :func:`behavenet.data.utils.build_data_generator`).
+
+    Parameters
+    ----------
+    main : :obj:`callable`
+        function that fits a single trial; called as :obj:`main(trial)`
+    trials : :obj:`list`
+        trials to fit, e.g. returned by :meth:`HyperOptArgumentParser.generate_trials`; test-tube
+        namespaces are converted to dicts
+    n_workers : :obj:`int`
+        maximum number of processes running at the same time; set to the number of gpus if
+        :obj:`gpu_ids` is provided
+    n_threads : :obj:`int` or :obj:`NoneType`, optional
+        total number of cpu threads to divide between processes; defaults to all available cores
+    gpu_ids : :obj:`list` of :obj:`str` or :obj:`NoneType`, optional
+        each running process is assigned one entry, which is used for :obj:`CUDA_VISIBLE_DEVICES`
+    cost_fn : :obj:`callable` or :obj:`NoneType`, optional
+        function that returns the estimated cost of a trial; defaults to
+        :func:`estimate_trial_cost`
+    group_fn : :obj:`callable` or :obj:`NoneType`, optional
+        function of a trial; trials with equal return values are fit in the same process
+    start_method : :obj:`str`, optional
+        multiprocessing start method
+    poll_interval : :obj:`float`, optional
+        time (in seconds) between checks for finished trials
+
+    Returns
+    -------
+    :obj:`list` of :obj:`dict`
+        one dict per trial (in the original order) with keys 'status' ('completed' | 'failed' |
+        'crashed'), 'error', 'n_threads', 'gpu_id', 'wall_s' and 'cpu_s'
+
+    """
+    import multiprocessing as mp
+    import time
+
+    trials = [vars(t) if not isinstance(t, (dict, list)) else t for t in trials]
+    if cost_fn is None:
+        cost_fn = estimate_trial_cost
+    if n_threads is None:
+        n_threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+            else os.cpu_count()
+    if gpu_ids is not None:
+        n_workers = len(gpu_ids)
+    free_gpus = list(gpu_ids) if gpu_ids is not None else None
+
+    # collect trials into jobs (one process per job), most expensive jobs first
+    if group_fn is None:
+        jobs = [[i] for i in range(len(trials))]
+    else:
+        groups = {}
+        for i, trial in enumerate(trials):
+            groups.setdefault(repr(group_fn(trial)), []).append(i)
+        jobs = list(groups.values())
+    pending = sorted(jobs, key=lambda job: -sum(cost_fn(trials[i]) for i in job))
+
+    results = [None] * len(trials)
+    resources = {}  # trial index -> (n_threads, gpu_id) of the job that fits the trial
+    running = []  # (process, job, n_threads, gpu_id)
+    ctx = mp.get_context(start_method)
+    # workers write results to the pipe synchronously, so that all results sent by a worker can
+    # be read once it has exited, even if it crashed
+    queue = ctx.SimpleQueue()
+    t_beg = time.time()
+
+    def _collect(timeout):
+        # wait for the first result, then read all results sent so far
+        t_end = time.time() + timeout
+        while queue.empty() and time.time() < t_end:
+            time.sleep(min(0.01, timeout))
+        while not queue.empty():
+            result = queue.get()
+            idx = result.pop('idx')
+            n_threads_job, gpu_id = resources[idx]
+            results[idx] = dict(result, n_threads=n_threads_job, gpu_id=gpu_id)
+            if result['status'] == 'failed':
+                print('trial %i failed:\n%s' % (idx, result['error']))
+
+    while len(pending) > 0 or len(running) > 0:
+
+        # start new jobs with the threads (and gpus) not used by running jobs
+        while len(pending) > 0 and len(running) < n_workers:
+            n_free = n_threads - sum(r[2] for r in running)
+            n_slots = min(n_workers - len(running), len(pending))
+            n_threads_job = max(1, n_free // n_slots)
+            gpu_id = free_gpus.pop(0) if free_gpus is not None else None
+            job = pending.pop(0)
+            # environment variables are read by numerical libraries at import in spawned processes
+            env_old = {k: os.environ.get(k) for k in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS']}
+            for k in env_old:
+                os.environ[k] = str(n_threads_job)
+            process = ctx.Process(
+                target=_run_trials,
+                args=(main, [trials[i] for i in job], job, n_threads_job, gpu_id, queue))
+            process.start()
+            for k, v in env_old.items():
+                if v is None:
+                    del os.environ[k]
+                else:
+                    os.environ[k] = v
+            running.append((process, job, n_threads_job, gpu_id))
+            for i in job:
+                resources[i] = (n_threads_job, gpu_id)
+
+        # collect results and clean up finished processes
+        _collect(timeout=poll_interval)
+        for job_info in list(running):
+            process, job, n_threads_job, gpu_id = job_info
+            if process.is_alive():
+                continue
+            process.join()
+            # read results sent just before the process exited; trials of the job without a
+            # result were not finished when the process exited
+            _collect(timeout=0)
+            for i in job:
+                if results[i] is None:
+                    results[i] = {
+                        'status': 'crashed', 'error': 'exit code %s' % process.exitcode,
+                        'n_threads': n_threads_job, 'gpu_id': gpu_id, 'wall_s': np.nan,
+                        'cpu_s': np.nan}
+                    print('trial %i crashed with exit code %s' % (i, process.exitcode))
+            if free_gpus is not None:
+                free_gpus.append(gpu_id)
+            running.remove(job_info)
+
+    print(_format_utilization_report(results, time.time() - t_beg, n_threads))
+    return results
+
+
+def _format_utilization_report(results, wall_time, n_threads):
+    """Summarize resource usage of trials run by :func:`run_local_trials`."""
+    format_str = '\n== grid search resource usage ==\n'
+    format_str += '%6s %10s %8s %6s %10s %10s %8s\n' % (
+        'trial', 'status', 'threads', 'gpu', 'wall (s)', 'cpu (s)', '% util')
+    cpu_total = 0
+    for idx, result in enumerate(results):
+        util = 100 * result['cpu_s'] / (result['wall_s'] * result['n_threads']) \
+            if result['wall_s'] else np.nan
+        format_str += '%6i %10s %8i %6s %10.1f %10.1f %8.1f\n' % (
+            idx, result['status'], result['n_threads'], result['gpu_id'], result['wall_s'],
+            result['cpu_s'], util)
+        if np.isfinite(result['cpu_s']):
+            cpu_total += result['cpu_s']
+    n_failed = len([r for r in results if r['status'] != 'completed'])
+    format_str += \
+        'total wall time: %1.1f s; %i/%i trials failed; cpu utilization: %1.1f%% of %i ' \
+        'threads\n' % (
+            wall_time, n_failed, len(results), 100 * cpu_total / (wall_time * n_threads),
+            n_threads)
+    return format_str
@@ -1,18 +1,19 @@
 import os
-import time
-import numpy as np
-import random
 import torch
 
 from behavenet.data.utils import build_data_generator
+from behavenet.fitting.distributed import broadcast_object
+from behavenet.fitting.distributed import is_main_process
 from behavenet.fitting.eval import export_train_plots
 from behavenet.fitting.hyperparam_utils import get_all_params
 from behavenet.fitting.hyperparam_utils import get_slurm_params
+from behavenet.fitting.hyperparam_utils import run_local_trials
 from behavenet.fitting.training import fit
 from behavenet.fitting.utils import _clean_tt_dir
 from behavenet.fitting.utils import _print_hparams
 from behavenet.fitting.utils import create_tt_experiment
 from behavenet.fitting.utils import export_hparams
+from behavenet.fitting.utils import get_data_params
 from behavenet.models import ConvDecoder
 
 
@@ -28,18 +29,20 @@ def main(hparams, *args):
     # print hparams to console
     _print_hparams(hparams)
 
-    # Start at random times (so test tube creates separate folders)
-    np.random.seed(random.randint(0, 1000))
-    time.sleep(np.random.uniform(1))
-
-    # create test-tube experiment
-    hparams, sess_ids, exp = create_tt_experiment(hparams)
+    # create test-tube experiment; with distributed training only the main process logs
+    if is_main_process():
+        hparams, sess_ids, exp = create_tt_experiment(hparams)
+    else:
+        sess_ids, exp = None, None
+    hparams, sess_ids = broadcast_object((hparams, sess_ids))
     if hparams is None:
         print('Experiment exists! Aborting fit')
         return
 
     # build data generator
-    data_generator = build_data_generator(hparams, sess_ids)
+    data_generator = build_data_generator(
+        hparams, sess_ids, export_csv=is_main_process(),
+        use_cache=hparams.get('share_data_generator', False))
 
     # ####################
     # ### CREATE MODEL ###
@@ -59,13 +62,14 @@ def main(hparams, *args):
     # Load pretrained weights if specified
     # model = load_pretrained_ae(model, hparams)
 
-    model.version = exp.version
+    model.version = hparams['version']
     torch_rnd_seed = torch.get_rng_state()
     hparams['training_rnd_seed'] = torch_rnd_seed
 
     # save out hparams as csv and dict
     hparams['training_completed'] = False
-    export_hparams(hparams, exp)
+    if is_main_process():
+        export_hparams(hparams, exp)
     print('done')
 
     # ###################
@@ -74,6 +78,10 @@ def main(hparams, *args):
 
     fit(hparams, model, data_generator, exp, method='conv-decoder')
 
+    # remaining exports are handled by the main process
+    if not is_main_process():
+        return
+
     # export training plots
     if hparams['export_train_plots']:
         print('creating training plots...', end='')
@@ -112,15 +120,28 @@ if __name__ == '__main__':
 
     else:
 
-        if hyperparams.device == 'cuda' or hyperparams.device == 'gpu':
+        if 'ddp_world_size' in hyperparams and hyperparams.ddp_world_size > 1:
+            # fit one trial at a time, each split across multiple data-parallel processes
+            from behavenet.fitting.distributed import launch
+            for trial in hyperparams.generate_trials(hyperparams.tt_n_cpu_trials):
+                launch(main, trial, hyperparams.ddp_world_size, backend=hyperparams.ddp_backend)
+
+        elif hyperparams.device == 'cuda' or hyperparams.device == 'gpu':
             if hyperparams.device == 'gpu':
                 hyperparams.device = 'cuda'
 
             gpu_ids = hyperparams.gpus_viz.split(';')
-            hyperparams.optimize_parallel_gpu(main, gpu_ids=gpu_ids)
+            run_local_trials(
+                main, hyperparams.generate_trials(hyperparams.tt_n_gpu_trials),
+                n_workers=len(gpu_ids), gpu_ids=gpu_ids,
+                group_fn=get_data_params if 'share_data_generator' in hyperparams
+                and hyperparams.share_data_generator else None)
 
         elif hyperparams.device == 'cpu':
-            hyperparams.optimize_parallel_cpu(
-                main,
-                nb_trials=hyperparams.tt_n_cpu_trials,
-                nb_workers=hyperparams.tt_n_cpu_workers)
+            run_local_trials(
+                main, hyperparams.generate_trials(hyperparams.tt_n_cpu_trials),
+                n_workers=hyperparams.tt_n_cpu_workers,
+                n_threads=hyperparams.tt_n_cpu_threads if 'tt_n_cpu_threads' in hyperparams
+                else None,
+                group_fn=get_data_params if 'share_data_generator' in hyperparams
+                and hyperparams.share_data_generator else None)
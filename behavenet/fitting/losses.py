@@ -3,12 +3,14 @@
 import numpy as np
 import torch
 from torch.nn.modules.loss import _Loss
+from torch.utils.checkpoint import checkpoint
 from torch.distributions.multivariate_normal import MultivariateNormal
 
 # to ignore imports for sphix-autoapidoc
 __all__ = [
     'mse', 'gaussian_ll', 'gaussian_ll_to_mse', 'kl_div_to_std_normal', 'index_code_mi',
-    'total_correlation', 'dimension_wise_kl_to_std_normal', 'decomposed_kl', 'subspace_overlap']
+    'total_correlation', 'dimension_wise_kl_to_std_normal', 'decomposed_kl', 'subspace_overlap',
+    'r2_variance_weighted', 'fraction_correct']
 
 LN2PI = np.log(2 * np.pi)
 
@@ -146,7 +148,7 @@ def kl_div_to_std_normal(mu, logvar):
     return torch.mean(kl)
 
 
-def index_code_mi(z, mu, logvar):
+def index_code_mi(z, mu, logvar, block_size=None):
     """Estimate index code mutual information in a batch.
 
     We ignore the constant as it does not matter for the minimization. The constant should be
@@ -160,6 +162,9 @@ def index_code_mi(z, mu, logvar):
         mean parameter of shape (n_frames, n_dims)
     logvar : :obj:`torch.Tensor`
         log variance parameter of shape (n_frames, n_dims)
+    block_size : :obj:`int` or :obj:`NoneType`, optional
+        number of samples for which pairwise log densities are computed at once; memory scales as
+        (block_size, n_frames, n_dims). :obj:`NoneType` to use the whole batch
 
     Returns
     -------
@@ -167,28 +172,17 @@ def index_code_mi(z, mu, logvar):
         index code mutual information for batch, scalar value
 
     """
-    # Compute log(q(z(x_j)|x_i)) for every sample/dimension in the batch, which is a tensor of
-    # shape (n_frames, n_dims). In the following comments,
-    # (n_frames, n_frames, n_dims) are indexed by [j, i, l].
-    # z[:, None]: (n_frames, 1, n_dims)
-    # mu[None, :]: (1, n_frames, n_dims)
-    # logvar[None, :]: (1, n_frames, n_dims)
-    log_qz_prob = _gaussian_log_density_unsummed(z[:, None], mu[None, :], logvar[None, :])
-
     # Compute log(q(z(x_j))) as log(sum_i(q(z(x_j)|x_i))) + constant =
     # log(sum_i(prod_l q(z(x_j)_l|x_i))) + constant.
-    log_qz = torch.logsumexp(
-        torch.sum(log_qz_prob, dim=2, keepdim=False),  # sum over gaussian dims
-        dim=1,  # logsumexp over batch
-        keepdim=False)
+    log_qz, = _log_qz_terms(z, mu, logvar, block_size, product=False)
 
     # Compute log prod_l q(z(x_j)_l | x_j) = sum_l log q(z(x_j)_l | x_j)
-    log_qz_ = torch.diag(torch.sum(log_qz_prob, dim=2, keepdim=False))  # sum over gaussian dims
+    log_qz_ = torch.sum(_gaussian_log_density_unsummed(z, mu, logvar), dim=1)
 
     return torch.mean(log_qz_ - log_qz)
 
 
-def total_correlation(z, mu, logvar):
+def total_correlation(z, mu, logvar, block_size=None):
     """Estimate total correlation in a batch.
 
     Compute the expectation over a batch of:
@@ -208,6 +202,9 @@ def total_correlation(z, mu, logvar):
         mean parameter of shape (n_frames, n_dims)
     logvar : :obj:`torch.Tensor`
         log variance parameter of shape (n_frames, n_dims)
+    block_size : :obj:`int` or :obj:`NoneType`, optional
+        number of samples for which pairwise log densities are computed at once; memory scales as
+        (block_size, n_frames, n_dims). :obj:`NoneType` to use the whole batch
 
     Returns
     -------
@@ -215,32 +212,13 @@ def total_correlation(z, mu, logvar):
         total correlation for batch, scalar value
 
     """
-    # Compute log(q(z(x_j)|x_i)) for every sample/dimension in the batch, which is a tensor of
-    # shape (n_frames, n_dims). In the following comments,
-    # (n_frames, n_frames, n_dims) are indexed by [j, i, l].
-    # z[:, None]: (n_frames, 1, n_dims)
-    # mu[None, :]: (1, n_frames, n_dims)
-    # logvar[None, :]: (1, n_frames, n_dims)
-    log_qz_prob = _gaussian_log_density_unsummed(z[:, None], mu[None, :], logvar[None, :])
-
-    # Compute log prod_l p(z(x_j)_l) = sum_l(log(sum_i(q(z(x_j)_l|x_i))) + constant) for each
-    # sample in the batch, which is a vector of size (batch_size,).
-    log_qz_product = torch.sum(
-        torch.logsumexp(log_qz_prob, dim=1, keepdim=False),  # logsumexp over batch
-        dim=1,  # sum over gaussian dims
-        keepdim=False)
-
-    # Compute log(q(z(x_j))) as log(sum_i(q(z(x_j)|x_i))) + constant =
-    # log(sum_i(prod_l q(z(x_j)_l|x_i))) + constant.
-    log_qz = torch.logsumexp(
-        torch.sum(log_qz_prob, dim=2, keepdim=False),  # sum over gaussian dims
-        dim=1,  # logsumexp over batch
-        keepdim=False)
+    # Compute log(q(z(x_j))) and log prod_l p(z(x_j)_l) for each sample in the batch
+    log_qz, log_qz_product = _log_qz_terms(z, mu, logvar, block_size)
 
     return torch.mean(log_qz - log_qz_product)
 
 
-def dimension_wise_kl_to_std_normal(z, mu, logvar):
+def dimension_wise_kl_to_std_normal(z, mu, logvar, block_size=None):
     """Estimate dimensionwise KL divergence to standard normal in a batch.
 
     Parameters
@@ -251,6 +229,9 @@ def dimension_wise_kl_to_std_normal(z, mu, logvar):
         mean parameter of shape (n_frames, n_dims)
     logvar : :obj:`torch.Tensor`
         log variance parameter of shape (n_frames, n_dims)
+    block_size : :obj:`int` or :obj:`NoneType`, optional
+        number of samples for which pairwise log densities are computed at once; memory scales as
+        (block_size, n_frames, n_dims). :obj:`NoneType` to use the whole batch
 
     Returns
     -------
@@ -258,20 +239,9 @@ def dimension_wise_kl_to_std_normal(z, mu, logvar):
         dimension-wise KL to standard normal for batch, scalar value
 
     """
-    # Compute log(q(z(x_j)|x_i)) for every sample/dimension in the batch, which is a tensor of
-    # shape (n_frames, n_dims). In the following comments,
-    # (n_frames, n_frames, n_dims) are indexed by [j, i, l].
-    # z[:, None]: (n_frames, 1, n_dims)
-    # mu[None, :]: (1, n_frames, n_dims)
-    # logvar[None, :]: (1, n_frames, n_dims)
-    log_qz_prob = _gaussian_log_density_unsummed(z[:, None], mu[None, :], logvar[None, :])
-
     # Compute log prod_l p(z(x_j)_l) = sum_l(log(sum_i(q(z(x_j)_l|x_i))) + constant) for each
     # sample in the batch, which is a vector of size (batch_size,).
-    log_qz_product = torch.sum(
-        torch.logsumexp(log_qz_prob, dim=1, keepdim=False),  # logsumexp over batch
-        dim=1,  # sum over gaussian dims
-        keepdim=False)
+    log_qz_product, = _log_qz_terms(z, mu, logvar, block_size, joint=False)
 
     # Compute
     log_pz_prob = _gaussian_log_density_unsummed_std_normal(z)
@@ -280,7 +250,7 @@ def dimension_wise_kl_to_std_normal(z, mu, logvar):
     return torch.mean(log_qz_product - log_pz_product)
 
 
-def decomposed_kl(z, mu, logvar):
+def decomposed_kl(z, mu, logvar, block_size=None):
     """Decompose KL term in VAE loss.
 
     Decomposes the KL divergence loss term of the variational autoencoder into three terms:
@@ -299,6 +269,9 @@ def decomposed_kl(z, mu, logvar):
         mean parameter of shape (n_frames, n_dims)
     logvar : :obj:`torch.Tensor`
         log variance parameter of shape (n_frames, n_dims)
+    block_size : :obj:`int` or :obj:`NoneType`, optional
+        number of samples for which pairwise log densities are computed at once; memory scales as
+        (block_size, n_frames, n_dims). :obj:`NoneType` to use the whole batch
 
     Returns
     -------
@@ -309,35 +282,17 @@ def decomposed_kl(z, mu, logvar):
 
     """
 
-    # Compute log(q(z(x_j)|x_i)) for every sample/dimension in the batch, which is a tensor of
-    # shape (n_frames, n_dims). In the following comments, (n_frames, n_frames, n_dims) are indexed
-    # by [j, i, l].
-    #
-    # Note that the insertion of `None` expands dims to use torch's broadcasting feature
-    # z[:, None]: (n_frames, 1, n_dims)
-    # mu[None, :]: (1, n_frames, n_dims)
-    # logvar[None, :]: (1, n_frames, n_dims)
-    log_qz_prob = _gaussian_log_density_unsummed(z[:, None], mu[None, :], logvar[None, :])
-
     # Compute log(q(z(x_j))) as
     # log(sum_i(q(z(x_j)|x_i))) + constant
     # = log(sum_i(prod_l q(z(x_j)_l|x_i))) + constant
     # = log(sum_i(exp(sum_l log q(z(x_j)_l|x_i))) + constant (assumes q is factorized)
-    log_qz = torch.logsumexp(
-        torch.sum(log_qz_prob, dim=2, keepdim=False),  # sum over gaussian dims
-        dim=1,  # logsumexp over batch
-        keepdim=False)
+    # and log prod_l p(z(x_j)_l)
+    # = sum_l(log(sum_i(q(z(x_j)_l|x_i))) + constant
+    log_qz, log_qz_product = _log_qz_terms(z, mu, logvar, block_size)
 
     # Compute log prod_l q(z(x_j)_l | x_j)
     # = sum_l log q(z(x_j)_l | x_j)
-    log_qz_ = torch.diag(torch.sum(log_qz_prob, dim=2, keepdim=False))  # sum over gaussian dims
-
-    # Compute log prod_l p(z(x_j)_l)
-    # = sum_l(log(sum_i(q(z(x_j)_l|x_i))) + constant
-    log_qz_product = torch.sum(
-        torch.logsumexp(log_qz_prob, dim=1, keepdim=False),  # logsumexp over batch
-        dim=1,  # sum over gaussian dims
-        keepdim=False)
+    log_qz_ = torch.sum(_gaussian_log_density_unsummed(z, mu, logvar), dim=1)
 
     # Compute sum_l log p(z(x_j)_l)
     log_pz_prob = _gaussian_log_density_unsummed_std_normal(z)
@@ -350,6 +305,62 @@ def decomposed_kl(z, mu, logvar):
     return idx_code_mi, total_corr, dim_wise_kl
 
 
+def _log_qz_terms(z, mu, logvar, block_size=None, joint=True, product=True):
+    """Compute the batch estimates of log(q(z(x_j))) and/or log(prod_l q(z(x_j)_l)).
+
+    Both estimates require log(q(z(x_j)_l|x_i)) for all pairs of samples in the batch, a tensor
+    of shape (n_frames, n_frames, n_dims). It is computed for blocks of :obj:`block_size` samples
+    j at a time, and only the reduced terms of each block are kept; the results are the same as
+    with a single block. When gradients are required each block is recomputed in the backward
+    pass instead of being stored, so that memory is bounded by a single block there as well.
+
+    Returns
+    -------
+    :obj:`tuple`
+        requested terms, each of shape (n_frames,)
+
+    """
+    n_frames = z.shape[0]
+    if block_size is None or block_size >= n_frames:
+        return _log_qz_block(z, mu, logvar, joint, product)
+
+    recompute = torch.is_grad_enabled() and any(t.requires_grad for t in [z, mu, logvar])
+    blocks = []
+    for idx_beg in range(0, n_frames, block_size):
+        z_block = z[idx_beg:idx_beg + block_size]
+        if recompute:
+            blocks.append(checkpoint(
+                _log_qz_block, z_block, mu, logvar, joint, product, use_reentrant=False))
+        else:
+            blocks.append(_log_qz_block(z_block, mu, logvar, joint, product))
+    return tuple(torch.cat(terms) for terms in zip(*blocks))
+
+
+def _log_qz_block(z, mu, logvar, joint=True, product=True):
+    """Compute the terms of :func:`_log_qz_terms` for a block of samples :obj:`z`."""
+    # Compute log(q(z(x_j)|x_i)) for every sample/dimension in the block, which is a tensor of
+    # shape (n_block, n_frames, n_dims), indexed by [j, i, l].
+    #
+    # Note that the insertion of `None` expands dims to use torch's broadcasting feature
+    # z[:, None]: (n_block, 1, n_dims)
+    # mu[None, :]: (1, n_frames, n_dims)
+    # logvar[None, :]: (1, n_frames, n_dims)
+    log_qz_prob = _gaussian_log_density_unsummed(z[:, None], mu[None, :], logvar[None, :])
+
+    terms = []
+    if joint:
+        terms.append(torch.logsumexp(
+            torch.sum(log_qz_prob, dim=2, keepdim=False),  # sum over gaussian dims
+            dim=1,  # logsumexp over batch
+            keepdim=False))
+    if product:
+        terms.append(torch.sum(
+            torch.logsumexp(log_qz_prob, dim=1, keepdim=False),  # logsumexp over batch
+            dim=1,  # sum over gaussian dims
+            keepdim=False))
+    return tuple(terms)
+
+
 def _gaussian_log_density_unsummed(z, mu, logvar):
     """First step of Gaussian log-density computation, without summing over dimensions.
 
@@ -392,3 +403,55 @@ def subspace_overlap(A, B):
     eye = torch.eye(d, device=C.device)
     return torch.mean((torch.matmul(C, torch.transpose(C, 1, 0)) - eye).pow(2))
     # return torch.mean(torch.matmul(A, torch.transpose(B, 1, 0)).pow(2))
+
+
+def r2_variance_weighted(y_true, y_pred):
+    """Compute variance-weighted $R^2$ across output dimensions.
+
+    Equivalent to :obj:`sklearn.metrics.r2_score(y_true, y_pred, multioutput='variance_weighted')`
+    without importing sklearn, which is slow to load.
+
+    Parameters
+    ----------
+    y_true : :obj:`np.ndarray`
+        true data of shape (n_samples, n_dims)
+    y_pred : :obj:`np.ndarray`
+        predicted data of shape (n_samples, n_dims)
+
+    Returns
+    -------
+    :obj:`float`
+        $R^2$ of all dimensions, weighted by the variance of each dimension
+
+    """
+    if y_true.shape[0] < 2:
+        return np.nan
+    if y_true.ndim == 1:
+        y_true = y_true[:, None]
+        y_pred = y_pred[:, None]
+    numerator = np.sum((y_true - y_pred) ** 2, axis=0, dtype=np.float64)
+    denominator = np.sum((y_true - np.mean(y_true, axis=0)) ** 2, axis=0, dtype=np.float64)
+    # dimensions without variance do not contribute
+    valid = denominator != 0
+    if not np.any(valid):
+        return 1.0 if np.all(numerator == 0) else 0.0
+    return float(1 - np.sum(numerator[valid]) / np.sum(denominator))
+
+
+def fraction_correct(y_true, y_pred):
+    """Compute fraction of correctly classified samples.
+
+    Parameters
+    ----------
+    y_true : :obj:`np.ndarray`
+        true labels of shape (n_samples,)
+    y_pred : :obj:`np.ndarray`
+        predicted labels of shape (n_samples,)
+
+    Returns
+    -------
+    :obj:`float`
+        fraction correct
+
+    """
+    return float(np.mean(np.asarray(y_true) == np.asarray(y_pred)))
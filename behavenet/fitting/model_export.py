@@ -0,0 +1,379 @@
+"""Export trained models to self-contained TorchScript or ONNX files for deployment.
+
+Loading a model with :func:`behavenet.fitting.utils.get_best_model_and_data` rebuilds it from its
+hyperparameters, which requires behavenet and the paths of the data it was fit on. The functions
+in this module instead trace the parts of a trained model into files that only need pytorch (or
+onnxruntime) to run:
+
+* autoencoders (all classes with :obj:`encoding` and :obj:`decoding` attributes, linear or
+  convolutional) are exported as an encoder, mapping frames to latents, and a decoder, mapping
+  latents to frames. The max pooling indices of convolutional encoders are additional outputs of
+  the encoder and additional inputs of the decoder (in the same order); the unpooling output
+  sizes are fixed by the frame size and stored in the decoder.
+* convolutional decoders (:class:`behavenet.models.decoders.ConvDecoder`) are exported as a
+  decoder only.
+* mlp decoders (:class:`behavenet.models.decoders.Decoder`) are exported as a decoder mapping the
+  predictors of a trial to predictions (and precision matrices for 'mlp-mv' decoders).
+
+Each export directory contains one file per part and an :obj:`export.json` file describing the
+inputs and outputs of each part; :class:`ExportedModel` loads an export directory and runs it on
+numpy arrays without importing any other part of behavenet.
+
+Run from the top-level behavenet directory to export a trained model:
+
+    (behavenet) $: python behavenet/fitting/model_export.py --version_dir /path/to/version_0
+        --save_dir /path/to/export --format torchscript
+
+"""
+
+import json
+import os
+import warnings
+import numpy as np
+import torch
+from torch import nn
+
+# to ignore imports for sphix-autoapidoc
+__all__ = ['export_model', 'export_version', 'ExportedModel']
+
+
+class _EncoderExport(nn.Module):
+    """Map frames to latents (and max pooling indices) with the encoder of an autoencoder."""
+
+    def __init__(self, model, dataset):
+        super().__init__()
+        self.encoding = model.encoding
+        self.model_class = model.hparams['model_class']
+        self.variational = model.hparams.get('variational', False)
+        self.dataset = dataset
+
+    def forward(self, x):
+        outputs = self.encoding(x, dataset=self.dataset)
+        pool_idx = outputs[-2] if outputs[-2] is not None else []
+        if self.model_class == 'ps-vae':
+            # constrained and unconstrained latents, logvar
+            latents = (torch.cat([outputs[0], outputs[1]], dim=1), outputs[2])
+        elif self.variational:
+            latents = (outputs[0], outputs[1])
+        else:
+            latents = (outputs[0],)
+        return latents + tuple(pool_idx)
+
+
+class _DecoderExport(nn.Module):
+    """Map latents (and max pooling indices) to frames with the decoder of an autoencoder."""
+
+    def __init__(self, model, dataset, output_sizes):
+        from behavenet.models.aes import ConvAEDecoder
+        super().__init__()
+        self.decoding = model.decoding
+        self.is_conv = isinstance(model.decoding, ConvAEDecoder)
+        self.dataset = dataset
+        self.output_sizes = output_sizes
+
+    def forward(self, z, *pool_idx):
+        if not self.is_conv:
+            return self.decoding(z)
+        # decoder pops indices and sizes from the end of the lists
+        return self.decoding(
+            z, list(pool_idx), list(self.output_sizes), dataset=self.dataset)
+
+
+class _MLPExport(nn.Module):
+    """Map predictors of a trial to predictions (and precision matrices) with an mlp decoder."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model.model
+        self.full_cov = model.hparams['noise_dist'] == 'gaussian-full'
+
+    def forward(self, x):
+        y, precision = self.model(x)
+        return (y, precision) if self.full_cov else (y,)
+
+
+def _get_parts(model, dataset):
+    """Collect the modules to export with example inputs and input/output names."""
+    hparams = model.hparams
+    if hparams.get('conditional_encoder', False):
+        raise NotImplementedError('Export is not implemented for conditional encoders')
+    parts = {}
+    if hasattr(model, 'decoding'):
+        n_frames = 2
+        output_sizes = []
+        pool_idx = []
+        pool_names = []
+        if hasattr(model, 'encoding'):
+            encoder = _EncoderExport(model, dataset)
+            frames = torch.zeros(
+                n_frames, hparams['n_input_channels'], hparams['y_pixels'], hparams['x_pixels'])
+            with torch.no_grad():
+                outputs = encoder(frames)
+                sizes = model.encoding(frames, dataset=dataset)[-1] or []
+            output_sizes = [tuple(size[-2:]) for size in sizes]
+            n_latents = len(outputs) - len(sizes)
+            pool_idx = list(outputs[n_latents:])
+            latent_names = ['mu', 'logvar'] if n_latents == 2 else ['latents']
+            pool_names = ['pool_idx_%i' % i for i in range(len(pool_idx))]
+            parts['encoder'] = (encoder, (frames,), ['frames'], latent_names + pool_names)
+        # latents concatenated with labels for conditional autoencoders
+        z = torch.zeros(n_frames, hparams['hidden_layer_size'])
+        decoder = _DecoderExport(model, dataset, output_sizes)
+        parts['decoder'] = (
+            decoder, (z,) + tuple(pool_idx), ['latents'] + pool_names, ['frames'])
+    elif hparams.get('model_type', None) in ['mlp', 'mlp-mv']:
+        decoder = _MLPExport(model)
+        x = torch.zeros(2 * hparams['n_lags'] + 2, hparams['input_size'])
+        output_names = ['predictions', 'precision'] if decoder.full_cov else ['predictions']
+        parts['decoder'] = (decoder, (x,), ['predictors'], output_names)
+    else:
+        raise NotImplementedError(
+            'Export is only implemented for autoencoders, convolutional decoders and mlp '
+            'decoders')
+    return parts
+
+
+def export_model(model, save_dir, format='torchscript', dataset=0):
+    """Export a trained model to self-contained files.
+
+    Parameters
+    ----------
+    model : :obj:`behavenet.models` object
+        trained autoencoder, convolutional decoder or mlp decoder; the model itself is not
+        modified
+    save_dir : :obj:`str`
+        directory in which the exported files are saved; created if it does not exist
+    format : :obj:`str`, optional
+        'torchscript' | 'onnx' (requires the onnx package)
+    dataset : :obj:`int`, optional
+        dataset (session) whose session-specific io layers are exported, if any
+
+    Returns
+    -------
+    :obj:`dict`
+        contents of the :obj:`export.json` file saved in :obj:`save_dir`
+
+    """
+    import copy
+
+    if format not in ['torchscript', 'onnx']:
+        raise ValueError('"%s" is not a valid export format' % format)
+
+    # export a cpu copy in eval mode; hparams may contain objects that cannot be copied
+    hparams = model.hparams
+    model.hparams = None
+    model_cpu = copy.deepcopy(model).to('cpu')
+    model.hparams = hparams
+    model_cpu.hparams = dict(hparams, device='cpu')
+    model_cpu.eval()
+
+    os.makedirs(save_dir, exist_ok=True)
+    metadata = {
+        'format': format,
+        'model_class': hparams.get('model_class', None),
+        'model_type': hparams.get('model_type', None),
+        'dataset': dataset,
+        'parts': {}}
+    if 'y_pixels' in hparams and 'x_pixels' in hparams:
+        metadata['frame_shape'] = [
+            hparams['n_input_channels'], hparams['y_pixels'], hparams['x_pixels']]
+    for name, (module, example_inputs, input_names, output_names) in \
+            _get_parts(model_cpu, dataset).items():
+        module.eval()
+        filename = '%s.%s' % (name, 'pt' if format == 'torchscript' else 'onnx')
+        filepath = os.path.join(save_dir, filename)
+        with warnings.catch_warnings():
+            # the batch size is traced from tensor shapes and remains dynamic
+            warnings.simplefilter('ignore', torch.jit.TracerWarning)
+            # torch.jit is deprecated in favor of torch.export, which cannot yet export max
+            # unpooling layers
+            warnings.simplefilter('ignore', FutureWarning)
+            if format == 'torchscript':
+                with torch.no_grad():
+                    traced = torch.jit.trace(module, example_inputs, check_trace=False)
+                torch.jit.save(traced, filepath)
+            else:
+                warnings.simplefilter('ignore', DeprecationWarning)
+                dynamic_axes = {n: {0: 'n_frames'} for n in input_names + output_names}
+                torch.onnx.export(
+                    module, example_inputs, filepath, input_names=input_names,
+                    output_names=output_names, dynamic_axes=dynamic_axes, opset_version=17,
+                    dynamo=False)
+        metadata['parts'][name] = {
+            'file': filename, 'inputs': input_names, 'outputs': output_names}
+
+    with open(os.path.join(save_dir, 'export.json'), 'w') as f:
+        json.dump(metadata, f, indent=4)
+    return metadata
+
+
+def export_version(version_dir, save_dir=None, format='torchscript', dataset=0):
+    """Export the model saved in a test tube version directory.
+
+    Parameters
+    ----------
+    version_dir : :obj:`str`
+        version directory containing :obj:`meta_tags.pkl` and :obj:`best_val_model.pt`
+    save_dir : :obj:`str` or :obj:`NoneType`, optional
+        directory in which the exported files are saved; defaults to :obj:`version_dir/export`
+    format : :obj:`str`, optional
+        'torchscript' | 'onnx'
+    dataset : :obj:`int`, optional
+        dataset (session) whose session-specific io layers are exported, if any
+
+    Returns
+    -------
+    :obj:`dict`
+        contents of the :obj:`export.json` file saved in :obj:`save_dir`
+
+    """
+    import pickle
+    from behavenet.fitting.utils import get_model_class
+
+    with open(os.path.join(version_dir, 'meta_tags.pkl'), 'rb') as f:
+        hparams = pickle.load(f)
+    hparams['device'] = 'cpu'
+    model = get_model_class(hparams['model_class'])(hparams)
+    model.load_state_dict(
+        torch.load(os.path.join(version_dir, 'best_val_model.pt'), map_location='cpu'))
+    if save_dir is None:
+        save_dir = os.path.join(version_dir, 'export')
+    return export_model(model, save_dir, format=format, dataset=dataset)
+
+
+class ExportedModel(object):
+    """Run a model exported with :func:`export_model` on numpy arrays.
+
+    Only pytorch (for TorchScript exports) or onnxruntime (for ONNX exports) is required; the
+    exported files and :obj:`export.json` can be copied to a machine without behavenet.
+
+    """
+
+    def __init__(self, export_dir, device='cpu'):
+        """
+
+        Parameters
+        ----------
+        export_dir : :obj:`str`
+            directory created by :func:`export_model`
+        device : :obj:`str`, optional
+            device of TorchScript modules; ONNX exports run on the cpu
+
+        """
+        with open(os.path.join(export_dir, 'export.json'), 'r') as f:
+            self.metadata = json.load(f)
+        self.device = device
+        self.parts = {}
+        for name, part in self.metadata['parts'].items():
+            filepath = os.path.join(export_dir, part['file'])
+            if self.metadata['format'] == 'torchscript':
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', FutureWarning)
+                    self.parts[name] = torch.jit.load(filepath, map_location=device)
+            else:
+                import onnxruntime
+                self.parts[name] = onnxruntime.InferenceSession(filepath)
+
+    def run(self, part, *inputs):
+        """Run one exported part.
+
+        Parameters
+        ----------
+        part : :obj:`str`
+            'encoder' | 'decoder'
+        inputs : :obj:`np.ndarray`
+            inputs in the order given by :obj:`metadata['parts'][part]['inputs']`
+
+        Returns
+        -------
+        :obj:`dict`
+            outputs keyed by the names in :obj:`metadata['parts'][part]['outputs']`
+
+        """
+        names = self.metadata['parts'][part]['outputs']
+        if self.metadata['format'] == 'torchscript':
+            with torch.no_grad():
+                outputs = self.parts[part](*[torch.as_tensor(x).to(self.device) for x in inputs])
+            if torch.is_tensor(outputs):
+                outputs = (outputs,)
+            outputs = [y.cpu().numpy() for y in outputs]
+        else:
+            outputs = self.parts[part].run(None, {
+                name: np.asarray(x) for name, x
+                in zip(self.metadata['parts'][part]['inputs'], inputs)})
+        return dict(zip(names, outputs))
+
+    def encode(self, frames):
+        """Encode frames with the encoder of an autoencoder.
+
+        Parameters
+        ----------
+        frames : :obj:`np.ndarray`
+            shape (n_frames, n_channels, y_pix, x_pix); uint8 frames are scaled to [0, 1] like the
+            frames served by :class:`behavenet.data.data_generator.ConcatSessionsGenerator`
+
+        Returns
+        -------
+        :obj:`dict`
+            'latents' (or 'mu' and 'logvar' for variational models) and 'pool_idx_[i]' for each
+            max pooling layer
+
+        """
+        frames = np.asarray(frames)
+        if frames.dtype == np.uint8:
+            frames = frames / 255
+        return self.run('encoder', frames.astype('float32'))
+
+    def decode(self, latents, pool_idx=None):
+        """Decode latents into frames.
+
+        Parameters
+        ----------
+        latents : :obj:`np.ndarray`
+            shape (n_frames, n_latents); for conditional autoencoders the labels are concatenated
+            to the latents
+        pool_idx : :obj:`list` of :obj:`np.ndarray`, optional
+            max pooling indices returned by :meth:`encode`; required if the encoder has max
+            pooling layers
+
+        Returns
+        -------
+        :obj:`np.ndarray`
+            shape (n_frames, n_channels, y_pix, x_pix)
+
+        """
+        inputs = [np.asarray(latents, dtype='float32')] + list(pool_idx or [])
+        return self.run('decoder', *inputs)['frames']
+
+    def predict(self, predictors):
+        """Predict the outputs of an mlp decoder for a trial.
+
+        Parameters
+        ----------
+        predictors : :obj:`np.ndarray`
+            shape (n_frames, input_size)
+
+        Returns
+        -------
+        :obj:`dict`
+            'predictions' of shape (n_frames, output_size), and 'precision' of shape (n_frames,
+            output_size, output_size) for 'mlp-mv' decoders
+
+        """
+        return self.run('decoder', np.asarray(predictors, dtype='float32'))
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--version_dir', type=str)
+    parser.add_argument('--save_dir', default=None, type=str)
+    parser.add_argument('--format', default='torchscript', type=str)
+    parser.add_argument('--dataset', default=0, type=int)
+    namespace, _ = parser.parse_known_args()
+    metadata = export_version(
+        namespace.version_dir, save_dir=namespace.save_dir, format=namespace.format,
+        dataset=namespace.dataset)
+    print(json.dumps(metadata, indent=4))
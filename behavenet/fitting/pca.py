@@ -0,0 +1,284 @@
+"""Fit linear autoencoders in closed form with principal component analysis.
+
+The mse-optimal linear autoencoder with :obj:`n_ae_latents` latents reconstructs each frame from
+its projection onto the top :obj:`n_ae_latents` principal components of the training frames. A
+linear :class:`behavenet.models.aes.AE` therefore does not need to be trained with stochastic
+gradient descent: :func:`fit_pca` computes the principal components from the training frames
+served by a data generator, writes them into the weights of the model, and logs the same metrics
+as :func:`behavenet.fitting.training.fit`.
+
+Frames are streamed from the data generator one batch at a time, and frames of all sessions
+contribute to a single set of components (a linear autoencoder shares its weights across
+sessions). Two solvers are available:
+
+* **exact**: the covariance matrix of all pixels is accumulated over the training batches and
+  diagonalized; memory scales as :obj:`n_pixels ** 2`, and the data is read twice.
+* **randomized**: randomized subspace iteration; the covariance matrix is only ever applied to a
+  block of :obj:`n_ae_latents + n_oversamples` vectors, so memory scales as
+  :obj:`n_pixels * (n_ae_latents + n_oversamples)`, and the data is read :obj:`n_iter + 2` times.
+
+Masked pixels are excluded from the pixel means and set to the mean before computing the
+covariance, so that they do not contribute to it.
+"""
+
+import os
+import torch
+
+# to ignore imports for sphix-autoapidoc
+__all__ = ['compute_pca', 'set_pca_weights', 'fit_pca']
+
+
+def _iterate_frames(data_generator, dtype, device):
+    """Yield the flattened frames and masks of all batches of :obj:`dtype` as float64."""
+    data_generator.reset_iterators(dtype)
+    for _ in range(data_generator.n_tot_batches[dtype]):
+        data, _ = data_generator.next_batch(dtype)
+        x = torch.as_tensor(data['images'][0], device=device)
+        x = x.reshape(x.shape[0], -1).double()
+        if 'masks' in data:
+            # masks are broadcast to the frames, as in the autoencoder loss
+            m = torch.as_tensor(data['masks'][0], device=device)
+            m = torch.broadcast_to(m.reshape(-1, x.shape[1]), x.shape).double()
+        else:
+            m = None
+        yield x, m
+    data_generator.reset_iterators(dtype)
+
+
+def _compute_mean(data_generator, device):
+    """Compute the mean of each pixel over unmasked training frames."""
+    total = 0
+    count = 0
+    n_frames = 0
+    for x, m in _iterate_frames(data_generator, 'train', device):
+        if m is None:
+            total = total + x.sum(dim=0)
+            count = count + x.shape[0]
+        else:
+            total = total + (x * m).sum(dim=0)
+            count = count + m.sum(dim=0)
+        n_frames += x.shape[0]
+    # pixels that are masked in every frame are left at zero
+    count = torch.clamp(torch.as_tensor(count, dtype=torch.float64, device=device), min=1)
+    return total / count, n_frames
+
+
+def _apply_covariance(data_generator, mean, vectors, device):
+    """Compute C @ vectors for the covariance matrix C of the training frames, one batch at a
+    time; if :obj:`vectors` is :obj:`NoneType` C itself is returned. The trace of C is returned
+    as well."""
+    result = 0
+    sum_sq = 0
+    n_frames = 0
+    for x, m in _iterate_frames(data_generator, 'train', device):
+        x = x - mean
+        if m is not None:
+            x = x * m
+        if vectors is None:
+            result = result + x.t() @ x
+        else:
+            result = result + x.t() @ (x @ vectors)
+        sum_sq += torch.sum(x ** 2).item()
+        n_frames += x.shape[0]
+    return result / n_frames, sum_sq / n_frames
+
+
+def compute_pca(
+        data_generator, n_components, method='exact', n_iter=4, n_oversamples=10, rng_seed=0,
+        device='cpu'):
+    """Compute the principal components of the training frames served by a data generator.
+
+    Parameters
+    ----------
+    data_generator : :obj:`ConcatSessionsGenerator` object
+        serves batches of frames under the key 'images' (and optionally 'masks'); frames from all
+        sessions must have the same size
+    n_components : :obj:`int`
+        number of principal components
+    method : :obj:`str`, optional
+        'exact' | 'randomized'; see module documentation
+    n_iter : :obj:`int`, optional
+        number of subspace iterations (randomized method)
+    n_oversamples : :obj:`int`, optional
+        number of additional random vectors used to find the subspace (randomized method)
+    rng_seed : :obj:`int`, optional
+        seed of the random starting subspace (randomized method)
+    device : :obj:`str`, optional
+        device on which frames are accumulated
+
+    Returns
+    -------
+    :obj:`dict`
+        - 'mean' (:obj:`torch.Tensor`): pixel means of shape (n_pixels,)
+        - 'components' (:obj:`torch.Tensor`): orthonormal principal components of shape
+          (n_pixels, n_components), ordered by decreasing variance
+        - 'explained_variance' (:obj:`torch.Tensor`): variance of each component
+        - 'total_variance' (:obj:`float`): summed variance of all pixels
+        - 'n_frames' (:obj:`int`): number of training frames
+
+    """
+    mean, n_frames = _compute_mean(data_generator, device)
+    n_pixels = mean.shape[0]
+    if n_components > n_pixels:
+        raise ValueError(
+            'Cannot compute %i components of %i-dimensional frames' % (n_components, n_pixels))
+
+    if method == 'exact':
+        cov, total_variance = _apply_covariance(data_generator, mean, None, device)
+        evals, evecs = torch.linalg.eigh(cov)
+        evals = evals.flip(0)[:n_components]
+        components = evecs.flip(1)[:, :n_components]
+    elif method == 'randomized':
+        n_vectors = min(n_components + n_oversamples, n_pixels)
+        generator = torch.Generator().manual_seed(rng_seed)
+        vectors = torch.randn(n_pixels, n_vectors, generator=generator, dtype=torch.float64)
+        vectors, _ = torch.linalg.qr(vectors.to(device))
+        for _ in range(n_iter):
+            vectors, _ = torch.linalg.qr(
+                _apply_covariance(data_generator, mean, vectors, device)[0])
+        # project the covariance matrix onto the subspace and diagonalize it there
+        cov_vectors, total_variance = _apply_covariance(data_generator, mean, vectors, device)
+        evals, evecs = torch.linalg.eigh(vectors.t() @ cov_vectors)
+        evals = evals.flip(0)[:n_components]
+        components = vectors @ evecs.flip(1)[:, :n_components]
+    else:
+        raise ValueError('"%s" is not a valid pca method' % method)
+
+    # fix the sign of each component so that results are reproducible
+    idx_max = torch.argmax(torch.abs(components), dim=0)
+    signs = torch.sign(components[idx_max, torch.arange(n_components)])
+    components = components * signs
+
+    return {
+        'mean': mean, 'components': components, 'explained_variance': evals,
+        'total_variance': total_variance, 'n_frames': n_frames}
+
+
+def set_pca_weights(model, pca):
+    """Write principal components into the weights of a linear autoencoder.
+
+    The encoder projects mean-subtracted frames onto the components, and the decoder maps latents
+    back to frames with the transposed projection plus the pixel means.
+
+    Parameters
+    ----------
+    model : :obj:`AE` object
+        autoencoder with :obj:`model_type='linear'`
+    pca : :obj:`dict`
+        output of :func:`compute_pca`; the number of components must match the number of latents
+
+    """
+    if model.hparams['model_type'] != 'linear':
+        raise ValueError('PCA weights can only be set for linear autoencoders')
+    encoder = model.encoding.encoder
+    components = pca['components'].to(device=encoder.weight.device, dtype=encoder.weight.dtype)
+    mean = pca['mean'].to(device=encoder.weight.device, dtype=encoder.weight.dtype)
+    if components.shape != encoder.weight.t().shape:
+        raise ValueError('PCA components of shape %s do not match encoder weights of shape %s' % (
+            tuple(components.shape), tuple(encoder.weight.shape)))
+    with torch.no_grad():
+        encoder.weight.copy_(components.t())
+        encoder.bias.copy_(-components.t() @ mean)
+        if model.decoding.encoder is None:
+            model.decoding.decoder.weight.copy_(components)
+            model.decoding.decoder.bias.copy_(mean)
+        else:
+            # decoder uses transposed encoder weights
+            model.decoding.bias.copy_(mean)
+
+
+def fit_pca(hparams, model, data_generator, exp, method='exact'):
+    """Fit a linear autoencoder in closed form; replaces :func:`behavenet.fitting.training.fit`.
+
+    The principal components of the training frames are computed with :func:`compute_pca` and
+    written into the model weights. The model is then evaluated on the training, validation and
+    test data, and the losses are saved to :obj:`metrics.csv` in the model directory as if the
+    model had been fit for a single epoch, so that downstream analyses (e.g. choosing the best
+    model of an experiment) do not depend on how the model was fit. The model is saved as
+    :obj:`best_val_model.pt`, and latents are exported if the :obj:`hparams` key
+    :obj:`'export_latents'` is :obj:`True`.
+
+    Parameters
+    ----------
+    hparams : :obj:`dict`
+        model/training specification; the :obj:`hparams` keys :obj:`'pca_n_iter'` and
+        :obj:`'pca_n_oversamples'` are passed to :func:`compute_pca` for the randomized method.
+        The fraction of variance explained by the components is stored under the key
+        :obj:`'pca_explained_variance'`
+    model : :obj:`AE` object
+        autoencoder with :obj:`model_type='linear'`
+    data_generator : :obj:`ConcatSessionsGenerator` object
+        data generator to serve data batches
+    exp : :obj:`test_tube.Experiment` object
+        for logging
+    method : :obj:`str`, optional
+        'exact' | 'randomized'; see module documentation
+
+    """
+    from behavenet.fitting.distributed import is_distributed
+    from behavenet.fitting.training import Logger, MetricsWriter
+
+    if is_distributed():
+        raise NotImplementedError('PCA fitting is not implemented for distributed training')
+    if hparams.get('model_class', 'ae') != 'ae':
+        raise NotImplementedError(
+            'PCA fitting is only implemented for the "ae" model class, not "%s"'
+            % hparams['model_class'])
+
+    pca = compute_pca(
+        data_generator, hparams['n_ae_latents'], method=method,
+        n_iter=hparams.get('pca_n_iter', 4), n_oversamples=hparams.get('pca_n_oversamples', 10),
+        rng_seed=hparams.get('rng_seed_model', 0), device=hparams.get('device', 'cpu'))
+    set_pca_weights(model, pca)
+    hparams['pca_explained_variance'] = \
+        torch.sum(pca['explained_variance']).item() / pca['total_variance']
+    print('fraction of variance explained by %i components: %1.4f' % (
+        hparams['n_ae_latents'], hparams['pca_explained_variance']))
+
+    expt_dir = os.path.join(hparams['expt_dir'], 'version_%i' % exp.version)
+    metrics_writer = MetricsWriter(os.path.join(expt_dir, 'metrics.csv'), exp=exp)
+    logger = Logger(n_datasets=data_generator.n_datasets)
+    chunk_size = hparams.get('inference_chunk_size', 200)
+    model.eval()
+
+    # losses on training and validation data, logged as epoch 0
+    for dtype in ['train', 'val']:
+        logger.reset_metrics(dtype)
+        data_generator.reset_iterators(dtype)
+        n_batches = data_generator.n_tot_batches[dtype]
+        with torch.no_grad():
+            for _ in range(n_batches):
+                data, dataset = data_generator.next_batch(dtype)
+                loss_dict = model.loss(
+                    data, dataset=dataset, accumulate_grad=False, chunk_size=chunk_size)
+                logger.update_metrics(dtype, loss_dict, dataset=dataset)
+        best_epoch = 0 if dtype == 'val' else None
+        metrics_writer.log(logger.create_metric_row(
+            dtype, 0, n_batches - 1, -1, trial=-1, by_dataset=False, best_epoch=best_epoch))
+        if data_generator.n_datasets > 1:
+            for dataset in range(data_generator.n_datasets):
+                metrics_writer.log(logger.create_metric_row(
+                    dtype, 0, n_batches - 1, dataset, trial=-1, by_dataset=True,
+                    best_epoch=best_epoch))
+
+    model.save(os.path.join(expt_dir, 'best_val_model.pt'))
+    if hparams.get('save_last_model', False):
+        model.save(os.path.join(expt_dir, 'last_model.pt'))
+
+    # losses on test data, for each batch
+    data_generator.reset_iterators('test')
+    with torch.no_grad():
+        for i_test in range(data_generator.n_tot_batches['test']):
+            data, dataset = data_generator.next_batch('test')
+            logger.reset_metrics('test')
+            loss_dict = model.loss(
+                data, dataset=dataset, accumulate_grad=False, chunk_size=chunk_size)
+            logger.update_metrics('test', loss_dict, dataset=dataset)
+            metrics_writer.log(logger.create_metric_row(
+                'test', 0, i_test, dataset, trial=data['batch_idx'].item(), by_dataset=True))
+    metrics_writer.close()
+
+    if hparams.get('export_latents', False):
+        print('exporting latents')
+        from behavenet.fitting.eval import export_latents
+        export_latents(data_generator, model)
@@ -0,0 +1,277 @@
+"""Post-training int8 quantization of trained models for fast inference on cpus.
+
+The encoder of an autoencoder (:class:`behavenet.models.aes.ConvAEEncoder` or
+:class:`behavenet.models.aes.LinearAEEncoder`) or the :class:`behavenet.models.decoders.MLP` of a
+decoder is replaced by an int8 version, and the resulting model can be passed to the export
+functions in :mod:`behavenet.fitting.eval` (:func:`export_latents`, :func:`export_predictions`)
+like the original model; the data generator must serve data on the cpu.
+
+Two methods are available:
+
+* **static**: weights and activations are quantized; the range of each activation is calibrated
+  on frames from the training split. All convolutional and linear layers run in int8.
+* **dynamic**: only the weights of linear layers are quantized ahead of time, and activations are
+  quantized on the fly; no calibration data is needed, but convolutional layers run in fp32.
+
+Quantized models are saved with :func:`save_quantized_model` and loaded with
+:func:`load_quantized_model`; :func:`quantization_report` compares the outputs and speed of a
+quantized model to those of the original model.
+"""
+
+import copy
+import os
+import time
+import warnings
+import numpy as np
+import torch
+from torch import nn
+
+# to ignore imports for sphix-autoapidoc
+__all__ = [
+    'quantize_model', 'save_quantized_model', 'load_quantized_model', 'quantization_report']
+
+
+def _get_quantized_attr(model):
+    """Return the name of the submodule of a model that is quantized."""
+    hparams = model.hparams
+    if hparams.get('model_type', None) in ['mlp', 'mlp-mv'] and hasattr(model, 'model'):
+        return 'model'
+    if hasattr(model, 'encoding') and hparams.get('model_type', None) in ['conv', 'linear']:
+        if hparams.get('fit_sess_io_layers', False):
+            raise NotImplementedError(
+                'Quantization is not implemented for session-specific io layers')
+        if hparams.get('conditional_encoder', False):
+            raise NotImplementedError('Quantization is not implemented for conditional encoders')
+        return 'encoding'
+    raise NotImplementedError(
+        'Quantization is only implemented for autoencoders and mlp decoders')
+
+
+def _get_example_input(model):
+    hparams = model.hparams
+    if _get_quantized_attr(model) == 'model':
+        return torch.zeros(2 * hparams['n_lags'] + 2, hparams['input_size'])
+    return torch.zeros(
+        1, hparams['n_input_channels'], hparams['y_pixels'], hparams['x_pixels'])
+
+
+def _get_inputs(model, data):
+    if _get_quantized_attr(model) == 'model':
+        return data[model.hparams['input_signal']][0]
+    return data['images'][0]
+
+
+def _copy_to_cpu(model):
+    hparams = model.hparams
+    model.hparams = None  # hparams may contain objects that cannot be copied
+    model_cpu = copy.deepcopy(model).to('cpu')
+    model.hparams = hparams
+    model_cpu.hparams = dict(hparams, device='cpu')
+    model_cpu.eval()
+    return model_cpu
+
+
+def _quantize_module(module, method, backend, calibration_inputs):
+    """Quantize a module; :obj:`calibration_inputs` is a list of input tensors."""
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favor of the separate torchao package
+        warnings.simplefilter('ignore')
+        if method == 'dynamic':
+            return quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+        elif method == 'static':
+            if any(isinstance(m, nn.MaxPool2d) for m in module.modules()):
+                raise NotImplementedError(
+                    'Static quantization is not implemented for max pooling layers; use '
+                    'method="dynamic"')
+            torch.backends.quantized.engine = backend
+            prepared = prepare_fx(
+                module, get_default_qconfig_mapping(backend),
+                example_inputs=(calibration_inputs[0],))
+            with torch.no_grad():
+                for inputs in calibration_inputs:
+                    prepared(inputs)
+            return convert_fx(prepared)
+        else:
+            raise ValueError('"%s" is not a valid quantization method' % method)
+
+
+def quantize_model(
+        model, data_generator=None, method='static', n_calibration_batches=10, backend='x86'):
+    """Create an int8 copy of an autoencoder or mlp decoder for cpu inference.
+
+    Parameters
+    ----------
+    model : :obj:`AE` or :obj:`Decoder` object
+        trained model; the model itself is not modified
+    data_generator : :obj:`ConcatSessionsGenerator` object or :obj:`NoneType`, optional
+        serves calibration batches from the training split; required for static quantization
+    method : :obj:`str`, optional
+        'static' | 'dynamic'
+    n_calibration_batches : :obj:`int`, optional
+        number of training batches used to calibrate activation ranges (static quantization)
+    backend : :obj:`str`, optional
+        quantized engine: 'x86' | 'fbgemm' (x86 cpus) | 'qnnpack' (arm cpus)
+
+    Returns
+    -------
+    :obj:`AE` or :obj:`Decoder` object
+        quantized copy of the model on the cpu; the quantization settings are stored in the
+        attribute :obj:`quantization`
+
+    """
+    attr = _get_quantized_attr(model)
+    model_q = _copy_to_cpu(model)
+
+    calibration_inputs = []
+    if method == 'static':
+        if data_generator is None:
+            raise ValueError('Static quantization requires a data generator for calibration')
+        chunk_size = model.hparams.get('inference_chunk_size', 200)
+        data_generator.reset_iterators('train')
+        n_batches = min(n_calibration_batches, data_generator.n_tot_batches['train'])
+        for _ in range(n_batches):
+            data, _ = data_generator.next_batch('train')
+            inputs = torch.as_tensor(_get_inputs(model, data)).float().cpu()
+            if attr == 'model':
+                # temporal convolution needs the entire trial
+                calibration_inputs.append(inputs)
+            else:
+                calibration_inputs += list(torch.split(inputs, chunk_size))
+        data_generator.reset_iterators('train')
+
+    module = _quantize_module(getattr(model_q, attr), method, backend, calibration_inputs)
+    setattr(model_q, attr, module)
+    model_q.quantization = {'method': method, 'backend': backend}
+    return model_q
+
+
+def save_quantized_model(model, filepath=None):
+    """Save the parameters of a quantized model.
+
+    Parameters
+    ----------
+    model : :obj:`AE` or :obj:`Decoder` object
+        model returned by :func:`quantize_model`
+    filepath : :obj:`str` or :obj:`NoneType`, optional
+        absolute path of saved parameters; if :obj:`NoneType`, parameters are saved in the model
+        directory as :obj:`best_val_model_int8_[method].pt`
+
+    Returns
+    -------
+    :obj:`str`
+        absolute path of saved parameters
+
+    """
+    if filepath is None:
+        filepath = os.path.join(
+            model.hparams['expt_dir'], 'version_%i' % model.version,
+            'best_val_model_int8_%s.pt' % model.quantization['method'])
+    torch.save({**model.quantization, 'state_dict': model.state_dict()}, filepath)
+    return filepath
+
+
+def load_quantized_model(model, filepath):
+    """Load a model saved with :func:`save_quantized_model`.
+
+    Parameters
+    ----------
+    model : :obj:`AE` or :obj:`Decoder` object
+        model with the same architecture as the quantized model, e.g. loaded with
+        :func:`behavenet.fitting.utils.get_best_model_and_data`; the model itself is not modified
+    filepath : :obj:`str`
+        absolute path of saved parameters
+
+    Returns
+    -------
+    :obj:`AE` or :obj:`Decoder` object
+        quantized model on the cpu
+
+    """
+    saved = torch.load(filepath, map_location='cpu')
+    attr = _get_quantized_attr(model)
+    model_q = _copy_to_cpu(model)
+    # quantization parameters are overwritten by the saved parameters
+    module = _quantize_module(
+        getattr(model_q, attr), saved['method'], saved['backend'], [_get_example_input(model)])
+    setattr(model_q, attr, module)
+    model_q.load_state_dict(saved['state_dict'])
+    model_q.quantization = {'method': saved['method'], 'backend': saved['backend']}
+    return model_q
+
+
+def quantization_report(model, model_q, data_generator, dtype='val', n_batches=None):
+    """Compare the outputs and inference time of a quantized model to those of the fp32 model.
+
+    Outputs are latents for autoencoders and predictions for decoders; both models are run on
+    the cpu with the same number of threads.
+
+    Parameters
+    ----------
+    model : :obj:`AE` or :obj:`Decoder` object
+        fp32 model
+    model_q : :obj:`AE` or :obj:`Decoder` object
+        quantized model returned by :func:`quantize_model` or :func:`load_quantized_model`
+    data_generator : :obj:`ConcatSessionsGenerator` object
+        serves evaluation batches
+    dtype : :obj:`str`, optional
+        'train' | 'val' | 'test'
+    n_batches : :obj:`int` or :obj:`NoneType`, optional
+        maximum number of batches to evaluate; all batches of :obj:`dtype` if :obj:`NoneType`
+
+    Returns
+    -------
+    :obj:`dict`
+        - 'n_frames' (:obj:`int`): number of evaluated frames
+        - 'rmse' (:obj:`float`): root mean square error of quantized outputs
+        - 'max_abs_error' (:obj:`float`): maximum absolute error of quantized outputs
+        - 'rel_error' (:obj:`float`): rmse divided by the standard deviation of fp32 outputs
+        - 'r2' (:obj:`float`): variance-weighted $R^2$ of quantized outputs w.r.t. fp32 outputs
+        - 'fp32_time' (:obj:`float`): inference time of the fp32 model (seconds)
+        - 'int8_time' (:obj:`float`): inference time of the quantized model (seconds)
+        - 'speedup' (:obj:`float`): ratio of fp32 and int8 inference times
+
+    """
+    from behavenet.fitting.losses import r2_variance_weighted
+
+    attr = _get_quantized_attr(model)
+    model = _copy_to_cpu(model)
+    chunk_size = model.hparams.get('inference_chunk_size', 200)
+
+    def _outputs(module, inputs):
+        if attr == 'model':
+            return module(inputs)[0]
+        return torch.cat([module(x)[0] for x in torch.split(inputs, chunk_size)])
+
+    outputs = []
+    outputs_q = []
+    times = [0, 0]
+    if n_batches is None:
+        n_batches = data_generator.n_tot_batches[dtype]
+    n_batches = min(n_batches, data_generator.n_tot_batches[dtype])
+    data_generator.reset_iterators(dtype)
+    with torch.no_grad():
+        for _ in range(n_batches):
+            data, _ = data_generator.next_batch(dtype)
+            inputs = torch.as_tensor(_get_inputs(model, data)).float().cpu()
+            for i, (module, container) in enumerate([
+                    (getattr(model, attr), outputs), (getattr(model_q, attr), outputs_q)]):
+                t_beg = time.perf_counter()
+                container.append(_outputs(module, inputs).numpy())
+                times[i] += time.perf_counter() - t_beg
+    data_generator.reset_iterators(dtype)
+
+    outputs = np.concatenate(outputs)
+    outputs_q = np.concatenate(outputs_q)
+    rmse = np.sqrt(np.mean((outputs - outputs_q) ** 2))
+    return {
+        'n_frames': outputs.shape[0],
+        'rmse': rmse,
+        'max_abs_error': np.max(np.abs(outputs - outputs_q)),
+        'rel_error': rmse / np.std(outputs),
+        'r2': r2_variance_weighted(outputs, outputs_q),
+        'fp32_time': times[0],
+        'int8_time': times[1],
+        'speedup': times[0] / times[1]}
@@ -0,0 +1,533 @@
+"""Indexed registry of the test-tube versions in an experiment directory.
+
+Finding out whether a model has already been fit requires comparing its hyperparameters with
+those of every version in the experiment directory. Rather than unpickling each
+:obj:`meta_tags.pkl` file, the registry stores a hash of the model params (see
+:func:`behavenet.fitting.utils.get_model_params`) of each version in an sqlite database in the
+experiment directory, so that matching versions can be looked up directly.
+
+The registry is updated by :func:`behavenet.fitting.utils.export_hparams` whenever hyperparameters
+are exported. Versions that are not registered (e.g. fit with an older version of behavenet) are
+added from their :obj:`meta_tags.pkl` files the next time the registry is synced with the
+directory tree; :meth:`ExperimentRegistry.rebuild` re-indexes all versions from scratch.
+
+The database is never deleted or recreated by behavenet. If it cannot be opened (e.g. the
+experiment directory is read-only, or the file is corrupted) an :obj:`sqlite3.Error` is raised,
+and callers fall back to reading the files of every version; delete :obj:`registry.db` to have the
+registry rebuilt from the directory tree.
+
+The registry also caches the best value of a training measure (e.g. the minimum validation loss)
+of each version that has finished training, so that the best version of an experiment can be found
+with a single query rather than by reading every :obj:`metrics.csv` file; the files of a version
+are only read the first time it is queried. Cached values of a version are invalidated when its
+hyperparameters are registered again.
+
+Finally, the registry coordinates jobs that start at the same time: new version directories are
+allocated with exclusive directory creation (:func:`allocate_version`), and a
+job claims the model params it is about to fit (:meth:`ExperimentRegistry.claim`) so that
+concurrent jobs with identical hyperparameters do not both train. A claim is released when the
+hyperparameters of the finished model are exported, and is considered stale if the claiming
+process has died or its version directory has not been modified for
+:obj:`ExperimentRegistry.claim_timeout` seconds. Claims held by the current process never block:
+a process fits one model at a time, so such a claim was left by a fit that raised an exception
+(e.g. a trial retried by a grid search worker).
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import socket
+import sqlite3
+import time
+import numpy as np
+
+# to ignore imports for sphix-autoapidoc
+__all__ = ['ExperimentRegistry', 'allocate_version', 'hash_model_params', 'read_best_measures']
+
+
+def _canonical(value):
+    """Convert a param value so that values that compare equal have the same json encoding."""
+    if hasattr(value, 'item') and not isinstance(value, (list, tuple, dict)):
+        # numpy scalars
+        value = value.item()
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    return value
+
+
+def hash_model_params(params):
+    """Compute a canonical hash of a model params dict.
+
+    Parameters
+    ----------
+    params : :obj:`dict`
+        output of :func:`behavenet.fitting.utils.get_model_params`
+
+    Returns
+    -------
+    :obj:`str`
+        hex digest; identical for dicts with equal keys and values
+
+    """
+    return hashlib.sha1(_to_json(params).encode('utf-8')).hexdigest()
+
+
+def _to_json(params):
+    return json.dumps(_canonical(params), sort_keys=True, default=str)
+
+
+class ExperimentRegistry(object):
+    """Map model params of each test-tube version in an experiment directory to version numbers."""
+
+    # seconds without changes to the version directory after which a claim is stale
+    claim_timeout = 24 * 3600
+
+    def __init__(self, expt_dir):
+        """
+
+        Parameters
+        ----------
+        expt_dir : :obj:`str`
+            test tube experiment directory containing version_%i subdirectories
+
+        Raises
+        ------
+        :obj:`sqlite3.Error`
+            if the database cannot be opened or created
+
+        """
+        self.expt_dir = expt_dir
+        self.db_file = os.path.join(expt_dir, 'registry.db')
+        self._create_table()
+
+    def _connect(self):
+        # long timeout; many trials may register versions at the same time
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def _create_table(self):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS versions (version INTEGER PRIMARY KEY, '
+                    'params_hash TEXT, params TEXT, training_completed INTEGER)')
+                conn.execute(
+                    'CREATE INDEX IF NOT EXISTS params_hash_idx ON versions (params_hash)')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS best_measures (version INTEGER, measure TEXT, '
+                    'best_def TEXT, value REAL, PRIMARY KEY (version, measure, best_def))')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS claims (params_hash TEXT PRIMARY KEY, '
+                    'version INTEGER, host TEXT, pid INTEGER, claimed_at REAL)')
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _get_row(version, hparams):
+        from behavenet.fitting.utils import get_model_params
+        try:
+            params = get_model_params(hparams)
+        except (KeyError, NotImplementedError):
+            # hparams do not define a model; version can never be matched
+            return version, None, None, int(bool(hparams.get('training_completed', False)))
+        return (
+            version, hash_model_params(params), _to_json(params),
+            int(bool(hparams.get('training_completed', False))))
+
+    def update(self, version, hparams):
+        """Register the hyperparameters of a version.
+
+        Parameters
+        ----------
+        version : :obj:`int`
+            test tube version
+        hparams : :obj:`dict`
+            hyperparameters exported to the :obj:`meta_tags.pkl` file of this version
+
+        """
+        row = self._get_row(version, hparams)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO versions '
+                    '(version, params_hash, params, training_completed) VALUES (?, ?, ?, ?)', row)
+                conn.execute('DELETE FROM best_measures WHERE version = ?', (version,))
+                if row[3]:
+                    # finished models release their claim
+                    conn.execute(
+                        'DELETE FROM claims WHERE params_hash = ? AND version = ?',
+                        (row[1], version))
+        finally:
+            conn.close()
+
+    def sync(self, versions=None):
+        """Add unregistered versions and remove versions that no longer exist.
+
+        Only the :obj:`meta_tags.pkl` files of unregistered versions are loaded.
+
+        Parameters
+        ----------
+        versions : :obj:`list` of :obj:`str`, optional
+            version subdirectories of the experiment directory; listed if :obj:`NoneType`
+
+        """
+        if versions is None:
+            versions = [d.name for d in os.scandir(self.expt_dir) if d.is_dir()]
+        on_disk = set()
+        for version in versions:
+            try:
+                on_disk.add(int(version.split('_')[-1]))
+            except ValueError:
+                continue
+        conn = self._connect()
+        try:
+            registered = set(row[0] for row in conn.execute('SELECT version FROM versions'))
+        finally:
+            conn.close()
+
+        rows = []
+        for version in sorted(on_disk - registered):
+            meta_file = os.path.join(self.expt_dir, 'version_%i' % version, 'meta_tags.pkl')
+            try:
+                with open(meta_file, 'rb') as f:
+                    hparams = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                # hparams not exported yet; try again on next sync
+                continue
+            rows.append(self._get_row(version, hparams))
+        removed = [(version,) for version in registered - on_disk]
+        if len(rows) == 0 and len(removed) == 0:
+            return
+
+        conn = self._connect()
+        try:
+            with conn:
+                # do not overwrite versions registered by other processes in the meantime
+                conn.executemany(
+                    'INSERT OR IGNORE INTO versions '
+                    '(version, params_hash, params, training_completed) VALUES (?, ?, ?, ?)', rows)
+                conn.executemany('DELETE FROM versions WHERE version = ?', removed)
+                conn.executemany('DELETE FROM best_measures WHERE version = ?', removed)
+        finally:
+            conn.close()
+
+    def rebuild(self):
+        """Re-index all versions from their :obj:`meta_tags.pkl` files."""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM versions')
+                conn.execute('DELETE FROM best_measures')
+                conn.execute('DELETE FROM claims')
+        finally:
+            conn.close()
+        self.sync()
+
+    def claim(self, params, version):
+        """Claim model params for a version that is about to be fit.
+
+        Parameters
+        ----------
+        params : :obj:`dict`
+            output of :func:`behavenet.fitting.utils.get_model_params`
+        version : :obj:`int`
+            version that will be fit with these params
+
+        Returns
+        -------
+        :obj:`bool`
+            :obj:`False` if a model with these params has finished training, or if they are
+            claimed by another process that is still running
+
+        """
+        params_hash = hash_model_params(params)
+        conn = self._connect()
+        try:
+            # check and claim in a single transaction
+            conn.isolation_level = None
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                completed = conn.execute(
+                    'SELECT 1 FROM versions WHERE params_hash = ? AND training_completed = 1',
+                    (params_hash,)).fetchone()
+                claim = conn.execute(
+                    'SELECT version, host, pid, claimed_at FROM claims WHERE params_hash = ?',
+                    (params_hash,)).fetchone()
+                if completed is not None or (claim is not None and not self._is_stale(*claim)):
+                    conn.execute('ROLLBACK')
+                    return False
+                conn.execute(
+                    'INSERT OR REPLACE INTO claims (params_hash, version, host, pid, claimed_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (params_hash, version, socket.gethostname(), os.getpid(), time.time()))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        return True
+
+    def _is_stale(self, version, host, pid, claimed_at):
+        """Check whether the job holding a claim is still fitting its model."""
+        if host == socket.gethostname() and pid == os.getpid():
+            # left by a fit of this process that failed
+            return True
+        if host == socket.gethostname() and os.name == 'posix':
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        version_dir = os.path.join(self.expt_dir, 'version_%i' % version)
+        if not os.path.isdir(version_dir):
+            return True
+        last_modified = claimed_at
+        for filepath in [version_dir, os.path.join(version_dir, 'metrics.csv')]:
+            mtime = _get_mtime(filepath)
+            if mtime is not None:
+                last_modified = max(last_modified, mtime * 1e-9)
+        return time.time() - last_modified > self.claim_timeout
+
+    def get_best_measures(self, versions, measure='val_loss', best_def='min'):
+        """Get the best value of a training measure for each version that has finished training.
+
+        The registry is synced with :obj:`versions`; completion status and cached values are then
+        read with a single query, and :obj:`metrics.csv` files are only read for completed
+        versions whose value has not been cached yet.
+
+        Parameters
+        ----------
+        versions : :obj:`list` of :obj:`str`
+            version subdirectories of the experiment directory
+        measure : :obj:`str`, optional
+            heading in csv file
+        best_def : :obj:`str`, optional
+            how :obj:`measure` should be parsed; 'min' | 'max'
+
+        Returns
+        -------
+        :obj:`dict`
+            best value of :obj:`measure` for each completed version, keyed by subdirectory name
+
+        """
+        self.sync(versions)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                'SELECT v.version, b.version IS NOT NULL, b.value FROM versions v '
+                'LEFT JOIN best_measures b ON b.version = v.version AND b.measure = ? '
+                'AND b.best_def = ? WHERE v.training_completed = 1',
+                (measure, best_def)).fetchall()
+        finally:
+            conn.close()
+
+        requested = set(versions)
+        best_measures = {}
+        new_rows = []
+        for version_int, is_cached, value in rows:
+            version = 'version_%i' % version_int
+            if version not in requested:
+                continue
+            if not is_cached:
+                training_completed, value = _summarize_version(
+                    os.path.join(self.expt_dir, version), measure, best_def)
+                if not training_completed:
+                    # registered status is out of date; version is re-registered on rebuild
+                    continue
+                new_rows.append((version_int, measure, best_def, value))
+            best_measures[version] = np.nan if value is None else value
+
+        if len(new_rows) > 0:
+            try:
+                conn = self._connect()
+                try:
+                    with conn:
+                        conn.executemany(
+                            'INSERT OR REPLACE INTO best_measures (version, measure, best_def, '
+                            'value) VALUES (?, ?, ?, ?)', new_rows)
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                print('could not cache best measures in experiment registry (%s)' % e)
+
+        return best_measures
+
+    def find(self, params, training_completed=True):
+        """Find versions with matching model params.
+
+        Parameters
+        ----------
+        params : :obj:`dict`
+            output of :func:`behavenet.fitting.utils.get_model_params`
+        training_completed : :obj:`bool`, optional
+            :obj:`True` to only return versions that have finished training
+
+        Returns
+        -------
+        :obj:`list` of :obj:`int`
+            matching versions in increasing order
+
+        """
+        query = 'SELECT version FROM versions WHERE params_hash = ?'
+        if training_completed:
+            query += ' AND training_completed = 1'
+        conn = self._connect()
+        try:
+            versions = [row[0] for row in conn.execute(
+                query + ' ORDER BY version', (hash_model_params(params),))]
+        finally:
+            conn.close()
+        return versions
+
+    def find_neighbors(self, params, keys, training_completed=True):
+        """Find versions whose model params differ from :obj:`params` in :obj:`keys` only.
+
+        Model params are compared with those stored in the registry, without loading any files.
+        The distance between two versions is the sum over :obj:`keys` of the relative differences
+        :obj:`|a - b| / max(|a|, |b|)`; versions that differ in a non-numeric value of
+        :obj:`keys` are not returned.
+
+        Parameters
+        ----------
+        params : :obj:`dict`
+            output of :func:`behavenet.fitting.utils.get_model_params`
+        keys : :obj:`list` of :obj:`str`
+            params that are allowed to differ, e.g. :obj:`['vae.beta']`
+        training_completed : :obj:`bool`, optional
+            :obj:`True` to only return versions that have finished training
+
+        Returns
+        -------
+        :obj:`list` of :obj:`tuple`
+            (version, distance) of each matching version, in increasing order of distance
+
+        """
+        target = json.loads(_to_json(params))
+        query = 'SELECT version, params FROM versions WHERE params IS NOT NULL'
+        if training_completed:
+            query += ' AND training_completed = 1'
+        conn = self._connect()
+        try:
+            rows = conn.execute(query + ' ORDER BY version').fetchall()
+        finally:
+            conn.close()
+
+        neighbors = []
+        for version, params_json in rows:
+            other = json.loads(params_json)
+            if set(other.keys()) != set(target.keys()) \
+                    or any(other[key] != target[key] for key in target if key not in keys):
+                continue
+            distance = 0.0
+            for key in keys:
+                a, b = target.get(key), other.get(key)
+                if a == b:
+                    continue
+                if not isinstance(a, (int, float)) or not isinstance(b, (int, float)):
+                    distance = None
+                    break
+                distance += abs(a - b) / max(abs(a), abs(b))
+            if distance is not None:
+                neighbors.append((version, distance))
+        return sorted(neighbors, key=lambda neighbor: neighbor[1])
+
+
+def _get_mtime(filepath):
+    try:
+        return os.stat(filepath).st_mtime_ns
+    except OSError:
+        return None
+
+
+def read_best_measures(expt_dir, versions, measure='val_loss', best_def='min'):
+    """Read the best value of a training measure for each version from its files.
+
+    Unlike :meth:`ExperimentRegistry.get_best_measures` nothing is cached; used when the registry
+    cannot be opened.
+
+    Parameters
+    ----------
+    expt_dir : :obj:`str`
+        test tube experiment directory containing version_%i subdirectories
+    versions : :obj:`list` of :obj:`str`
+        version subdirectories of the experiment directory
+    measure : :obj:`str`, optional
+        heading in csv file
+    best_def : :obj:`str`, optional
+        how :obj:`measure` should be parsed; 'min' | 'max'
+
+    Returns
+    -------
+    :obj:`dict`
+        best value of :obj:`measure` for each completed version, keyed by subdirectory name
+
+    """
+    best_measures = {}
+    for version in versions:
+        version_dir = os.path.join(expt_dir, version)
+        if not os.path.exists(os.path.join(version_dir, 'meta_tags.pkl')):
+            continue
+        training_completed, value = _summarize_version(version_dir, measure, best_def)
+        if training_completed:
+            best_measures[version] = np.nan if value is None else value
+    return best_measures
+
+
+def _summarize_version(version_dir, measure, best_def):
+    """Return completion status and best value of a training measure of a single version."""
+    import pandas as pd
+    with open(os.path.join(version_dir, 'meta_tags.pkl'), 'rb') as f:
+        meta_tags = pickle.load(f)
+    if not meta_tags['training_completed']:
+        return False, None
+    metric = pd.read_csv(os.path.join(version_dir, 'metrics.csv'), usecols=[measure])
+    if best_def == 'min':
+        value = metric[measure].min()
+    elif best_def == 'max':
+        value = metric[measure].max()
+    else:
+        raise ValueError('"%s" is an invalid best_def' % best_def)
+    return True, None if np.isnan(value) else float(value)
+
+
+def allocate_version(expt_dir):
+    """Create a new test-tube version directory.
+
+    The directory is created with :func:`os.mkdir`, which fails if the directory already exists;
+    concurrent jobs therefore never receive the same version.
+
+    Parameters
+    ----------
+    expt_dir : :obj:`str`
+        test tube experiment directory containing version_%i subdirectories
+
+    Returns
+    -------
+    :obj:`int`
+        new version
+
+    """
+    version = -1
+    for d in os.listdir(expt_dir):
+        if d.startswith('version_'):
+            try:
+                version = max(version, int(d.split('_')[-1]))
+            except ValueError:
+                continue
+    while True:
+        version += 1
+        try:
+            os.mkdir(os.path.join(expt_dir, 'version_%i' % version))
+            return version
+        except FileExistsError:
+            continue
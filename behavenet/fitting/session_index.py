@@ -0,0 +1,157 @@
+"""Persistent index of the session directories in a save directory.
+
+Resolving sessions (:func:`behavenet.fitting.utils.get_session_dir`,
+:func:`behavenet.fitting.utils.find_session_dirs`) walks the
+:obj:`save_dir/lab/expt/animal/session` tree and reads the :obj:`session_info.csv` file of every
+multisession directory. The session index caches directory listings and the contents of
+:obj:`session_info.csv` files in the json file :obj:`save_dir/.session_index.json`, together with
+their modification times; a cached entry is only used while the modification time of the
+directory (or file) is unchanged, so the index is refreshed incrementally as sessions and
+multisessions are added.
+"""
+
+import json
+import os
+import time
+
+# to ignore imports for sphix-autoapidoc
+__all__ = ['SessionIndex', 'get_session_index']
+
+# indices loaded by this process, keyed by save directory
+_SESSION_INDICES = {}
+
+# entries modified this recently are not cached; further changes within the resolution of file
+# modification times would go unnoticed
+_RACY_SECONDS = 2
+
+
+class SessionIndex(object):
+    """Cache directory listings and :obj:`session_info.csv` files, invalidated by mtime."""
+
+    def __init__(self, save_dir):
+        """
+
+        Parameters
+        ----------
+        save_dir : :obj:`str`
+            base save directory; the index is stored in this directory
+
+        """
+        self.save_dir = save_dir
+        self.index_file = os.path.join(save_dir, '.session_index.json')
+        self._updated = {'subdirs': {}, 'session_info': {}}
+        index = self._load()
+        self.subdirs = index['subdirs']
+        self.session_info = index['session_info']
+
+    def _load(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+            return {'subdirs': index['subdirs'], 'session_info': index['session_info']}
+        except (IOError, ValueError, KeyError):
+            return {'subdirs': {}, 'session_info': {}}
+
+    def _cache(self, key, path, mtime, value):
+        if time.time() - mtime * 1e-9 < _RACY_SECONDS:
+            return
+        getattr(self, key)[path] = [mtime, value]
+        self._updated[key][path] = [mtime, value]
+
+    def get_subdirs(self, path):
+        """Get all first-level subdirectories in a given path; see
+        :func:`behavenet.fitting.utils.get_subdirs`.
+
+        Parameters
+        ----------
+        path : :obj:`str`
+            absolute path
+
+        Returns
+        -------
+        :obj:`list`
+            first-level subdirectories in :obj:`path`
+
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            raise NotADirectoryError('%s is not a path' % path)
+        entry = self.subdirs.get(path)
+        if entry is not None and entry[0] == mtime:
+            subdirs = list(entry[1])
+        else:
+            try:
+                subdirs = next(os.walk(path))[1]
+            except StopIteration:
+                subdirs = []
+            self._cache('subdirs', path, mtime, subdirs)
+        if len(subdirs) == 0:
+            raise StopIteration('%s does not contain any subdirectories' % path)
+        return subdirs
+
+    def read_session_info(self, session_dir):
+        """Read the :obj:`session_info.csv` file of a session directory; see
+        :func:`behavenet.fitting.utils.read_session_info_from_csv`.
+
+        Parameters
+        ----------
+        session_dir : :obj:`str`
+            absolute path of directory that contains a :obj:`session_info.csv` file
+
+        Returns
+        -------
+        :obj:`list` of :obj:`dict`
+            dict for each session which contains lab/expt/animal/session
+
+        """
+        from behavenet.fitting.utils import read_session_info_from_csv
+        session_file = os.path.join(session_dir, 'session_info.csv')
+        mtime = os.stat(session_file).st_mtime_ns
+        entry = self.session_info.get(session_file)
+        if entry is not None and entry[0] == mtime:
+            sessions = entry[1]
+        else:
+            sessions = read_session_info_from_csv(session_file)
+            self._cache('session_info', session_file, mtime, sessions)
+        # callers may modify the returned dicts
+        return [dict(sess) for sess in sessions]
+
+    def flush(self):
+        """Write new entries to the index file.
+
+        Entries added by other processes since the index was loaded are kept; failures to write
+        (e.g. a read-only save directory) are ignored.
+
+        """
+        if len(self._updated['subdirs']) == 0 and len(self._updated['session_info']) == 0:
+            return
+        index = self._load()
+        for key in ['subdirs', 'session_info']:
+            index[key].update(self._updated[key])
+        tmp_file = '%s.%i.tmp' % (self.index_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_file, self.index_file)
+        except OSError:
+            return
+        self._updated = {'subdirs': {}, 'session_info': {}}
+
+
+def get_session_index(save_dir):
+    """Get the session index of a save directory, loading it once per process.
+
+    Parameters
+    ----------
+    save_dir : :obj:`str`
+        base save directory
+
+    Returns
+    -------
+    :obj:`SessionIndex`
+
+    """
+    if save_dir not in _SESSION_INDICES:
+        _SESSION_INDICES[save_dir] = SessionIndex(save_dir)
+    return _SESSION_INDICES[save_dir]
@@ -0,0 +1,483 @@
+"""Run trained models on live data streams.
+
+The export functions in :mod:`behavenet.fitting.eval` push entire trials of finished hdf5 files
+through a model. The classes in this module instead process data as it arrives - e.g. frames of a
+live behavioral video, or neural activity to be decoded online, in a closed-loop experiment - and
+keep track of the latency of every processed sample.
+"""
+
+import time
+from collections import deque
+import numpy as np
+import torch
+import torch.nn.functional as functional
+
+# to ignore imports for sphix-autoapidoc
+__all__ = ['LatencyTracker', 'StreamingEncoder', 'StreamingDecoder']
+
+
+class LatencyTracker(object):
+    """Record per-sample latencies and summarize them with percentiles."""
+
+    def __init__(self, max_len=10000):
+        """
+
+        Parameters
+        ----------
+        max_len : :obj:`int`, optional
+            number of most recent latencies kept for computing percentiles
+
+        """
+        self.latencies = deque(maxlen=max_len)
+        self.n_samples = 0
+        self._t_first = None
+        self._t_last = None
+
+    def reset(self):
+        """Remove all recorded latencies."""
+        self.latencies.clear()
+        self.n_samples = 0
+        self._t_first = None
+        self._t_last = None
+
+    def update(self, t_arrival, t_done):
+        """Record latencies of samples that were processed together.
+
+        Parameters
+        ----------
+        t_arrival : :obj:`array-like`
+            arrival time of each sample (seconds, :func:`time.perf_counter` clock)
+        t_done : :obj:`float`
+            time at which the samples were processed
+
+        """
+        t_arrival = np.atleast_1d(t_arrival)
+        self.latencies.extend(t_done - t_arrival)
+        self.n_samples += len(t_arrival)
+        if self._t_first is None:
+            self._t_first = np.min(t_arrival)
+        self._t_last = t_done
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Summarize recorded latencies.
+
+        Parameters
+        ----------
+        percentiles : :obj:`tuple`, optional
+            latency percentiles to compute
+
+        Returns
+        -------
+        :obj:`dict`
+            - 'n_samples' (:obj:`int`): total number of processed samples
+            - 'throughput' (:obj:`float`): samples per second between the first arrival and the
+              last processed sample
+            - 'mean_ms' (:obj:`float`): mean latency
+            - 'max_ms' (:obj:`float`): max latency
+            - 'p[n]_ms' (:obj:`float`): latency percentiles
+
+        """
+        summary = {'n_samples': self.n_samples}
+        if len(self.latencies) == 0:
+            return summary
+        latencies = 1000 * np.array(self.latencies)
+        elapsed = self._t_last - self._t_first
+        summary['throughput'] = self.n_samples / elapsed if elapsed > 0 else np.nan
+        summary['mean_ms'] = float(np.mean(latencies))
+        summary['max_ms'] = float(np.max(latencies))
+        for p, val in zip(percentiles, np.percentile(latencies, percentiles)):
+            summary['p%g_ms' % p] = float(val)
+        return summary
+
+
+class StreamingEncoder(object):
+    """Encode frames of a live video stream with a trained autoencoder.
+
+    Frames can be encoded directly with :meth:`encode` (a single frame or a micro-batch of frames),
+    or queued one at a time with :meth:`push`: queued frames are encoded together once
+    :obj:`batch_size` frames are waiting, or once the oldest frame has waited for
+    :obj:`max_delay` seconds, which bounds the latency of every frame by :obj:`max_delay` plus the
+    time needed to encode one micro-batch.
+
+    Frames are uint8 (or float in [0, 1]) arrays of shape (y_pix, x_pix), (n_channels, y_pix,
+    x_pix) or (n_frames, n_channels, y_pix, x_pix), and are scaled like the frames served by
+    :class:`behavenet.data.data_generator.ConcatSessionsGenerator`. Frames with a different size
+    than the model input are resized if :obj:`resize=True`.
+
+    A blank micro-batch is encoded on construction, so that one-time costs (memory allocation,
+    kernel selection) do not add to the latency of the first frames.
+
+    """
+
+    def __init__(self, model, dataset=0, batch_size=1, max_delay=0.0, resize=False):
+        """
+
+        Parameters
+        ----------
+        model : :obj:`AE` object
+            trained autoencoder (any model class with an :obj:`encoding` method)
+        dataset : :obj:`int`, optional
+            dataset (session) of the stream; used with session-specific io layers
+        batch_size : :obj:`int`, optional
+            maximum number of queued frames encoded together by :meth:`push`
+        max_delay : :obj:`float`, optional
+            maximum time (seconds) a frame waits in the queue of :meth:`push`
+        resize : :obj:`bool`, optional
+            :obj:`True` to resize frames that do not match the model input size (bilinear
+            interpolation)
+
+        """
+        if model.hparams['model_class'] == 'cond-ae' \
+                and model.hparams.get('conditional_encoder', False):
+            raise NotImplementedError('Streaming is not implemented for conditional encoders')
+        self.model = model
+        self.model.eval()
+        self.model_class = model.hparams['model_class']
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.resize = resize
+        self.input_dim = (
+            model.hparams['n_input_channels'], model.hparams['y_pixels'],
+            model.hparams['x_pixels'])
+        self.device = next(model.parameters()).device
+        self.latency = LatencyTracker()
+        self.n_frames = 0  # number of frames encoded so far
+        self._queue = []
+        self._t_queue = []
+        # warm up
+        self.n_latents = self.encode(
+            np.zeros((batch_size,) + self.input_dim, dtype='uint8')).shape[1]
+        self.reset()
+
+    @classmethod
+    def from_hparams(cls, hparams, version='best', **kwargs):
+        """Load a trained model with
+        :func:`behavenet.fitting.utils.get_best_model_and_data` and build a streaming encoder.
+
+        Parameters
+        ----------
+        hparams : :obj:`dict`
+            needs to contain enough information to specify an autoencoder
+        version : :obj:`str` or :obj:`int`, optional
+            test tube model version; 'best' to load the best model
+        kwargs
+            additional arguments for the :class:`StreamingEncoder` constructor
+
+        Returns
+        -------
+        :obj:`StreamingEncoder` object
+
+        """
+        from behavenet.fitting.utils import get_best_model_and_data
+        model, _ = get_best_model_and_data(hparams, load_data=False, version=version)
+        return cls(model, **kwargs)
+
+    def reset(self):
+        """Clear the frame queue, frame counter and recorded latencies."""
+        self._queue = []
+        self._t_queue = []
+        self.n_frames = 0
+        self.latency.reset()
+
+    def _preprocess(self, frames):
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[None, None]
+        elif frames.ndim == 3:
+            frames = frames[None]
+        if frames.dtype == np.uint8:
+            x = torch.from_numpy(frames).to(self.device).float().div_(255)
+        else:
+            x = torch.as_tensor(frames, dtype=torch.float32, device=self.device)
+        if x.shape[1] != self.input_dim[0]:
+            raise ValueError(
+                'Frames have %i channels; model expects %i' % (x.shape[1], self.input_dim[0]))
+        if tuple(x.shape[2:]) != self.input_dim[1:]:
+            if not self.resize:
+                raise ValueError(
+                    'Frame size %s does not match model input size %s; use resize=True' %
+                    (tuple(x.shape[2:]), self.input_dim[1:]))
+            x = functional.interpolate(
+                x, size=self.input_dim[1:], mode='bilinear', align_corners=False)
+        return x
+
+    def _encode(self, x):
+        with torch.no_grad():
+            output = self.model.encoding(x, dataset=self.dataset)
+            if self.model_class == 'ps-vae':
+                latents = torch.cat([output[0], output[1]], dim=1)
+            else:
+                latents = output[0]
+            if self.model_class == 'cond-ae-msp':
+                # push latents through linear transformation
+                latents = self.model.U(latents)
+        return latents.cpu().numpy()
+
+    def encode(self, frames):
+        """Encode a single frame or a micro-batch of frames immediately.
+
+        Parameters
+        ----------
+        frames : :obj:`np.ndarray`
+            shape (y_pix, x_pix), (n_channels, y_pix, x_pix) or (n_frames, n_channels, y_pix,
+            x_pix)
+
+        Returns
+        -------
+        :obj:`np.ndarray`
+            latents of shape (n_frames, n_latents)
+
+        """
+        t_arrival = time.perf_counter()
+        latents = self._encode(self._preprocess(frames))
+        self.latency.update(np.full(latents.shape[0], t_arrival), time.perf_counter())
+        self.n_frames += latents.shape[0]
+        return latents
+
+    def push(self, frame, t_arrival=None):
+        """Queue a single frame; encode queued frames if the queue is full or has waited too long.
+
+        Parameters
+        ----------
+        frame : :obj:`np.ndarray`
+            shape (y_pix, x_pix) or (n_channels, y_pix, x_pix)
+        t_arrival : :obj:`float`, optional
+            arrival time of the frame (e.g. camera timestamp converted to the
+            :func:`time.perf_counter` clock); defaults to the current time
+
+        Returns
+        -------
+        :obj:`tuple`
+            - frame indices (:obj:`np.ndarray`): index of each encoded frame in the stream
+            - latents (:obj:`np.ndarray`): shape (n_encoded_frames, n_latents); no frames are
+              encoded if the queue is neither full nor too old
+
+        """
+        frame = np.asarray(frame)
+        self._queue.append(frame[None] if frame.ndim == 2 else frame)
+        self._t_queue.append(time.perf_counter() if t_arrival is None else t_arrival)
+        if len(self._queue) >= self.batch_size \
+                or time.perf_counter() - self._t_queue[0] >= self.max_delay:
+            return self.flush()
+        return self.poll()
+
+    def poll(self):
+        """Encode queued frames if the oldest queued frame has waited for :obj:`max_delay` seconds.
+
+        Call this regularly if frames may arrive at irregular intervals, so that queued frames
+        are not held back until the next frame arrives.
+
+        Returns
+        -------
+        :obj:`tuple`
+            see :meth:`push`
+
+        """
+        if len(self._queue) > 0 and time.perf_counter() - self._t_queue[0] >= self.max_delay:
+            return self.flush()
+        return np.zeros(0, dtype='int'), np.zeros((0, self.n_latents))
+
+    def flush(self):
+        """Encode all queued frames.
+
+        Returns
+        -------
+        :obj:`tuple`
+            see :meth:`push`
+
+        """
+        if len(self._queue) == 0:
+            return np.zeros(0, dtype='int'), np.zeros((0, self.n_latents))
+        latents = self._encode(self._preprocess(np.stack(self._queue)))
+        self.latency.update(self._t_queue, time.perf_counter())
+        idxs = np.arange(self.n_frames, self.n_frames + latents.shape[0])
+        self.n_frames += latents.shape[0]
+        self._queue = []
+        self._t_queue = []
+        return idxs, latents
+
+
+class StreamingDecoder(object):
+    """Decode a stream of neural activity one frame at a time with a trained mlp decoder.
+
+    The first layer of an mlp decoder is a temporal convolution over a window of
+    :obj:`2 * n_lags + 1` frames centered on the predicted frame. The streaming decoder keeps the
+    most recent window in a ring buffer, so that each new frame only requires the window to be
+    multiplied with the (flattened) convolution weights, followed by the remaining layers. The
+    prediction for frame :obj:`t` depends on frames up to :obj:`t + n_lags`, and is therefore
+    emitted with a fixed lag of :obj:`n_lags` frames.
+
+    Frames before the start of a trial are zero, as in the zero padding of the batch
+    :meth:`behavenet.models.decoders.MLP.forward`; calling :meth:`flush` at the end of a trial
+    pads the trial with zeros in the same way and emits the remaining predictions, so that the
+    streamed predictions of a trial are identical to those of the batch model.
+
+    Decoders with a full-covariance gaussian noise model (:obj:`noise_dist='gaussian-full'`, e.g.
+    'mlp-mv' decoders) also predict a precision matrix for each frame; for these decoders
+    :meth:`push` and :meth:`flush` return the precision matrices as a third element.
+
+    """
+
+    def __init__(self, model):
+        """
+
+        Parameters
+        ----------
+        model : :obj:`Decoder` object
+            trained decoder with :obj:`model_type` 'mlp' or 'mlp-mv'
+
+        """
+        if model.hparams['model_type'] not in ['mlp', 'mlp-mv']:
+            raise NotImplementedError(
+                'Streaming is not implemented for "%s" decoders' % model.hparams['model_type'])
+        self.model = model
+        self.model.eval()
+        self.n_lags = model.hparams['n_lags']
+        self.window = 2 * self.n_lags + 1
+        self.input_size = model.hparams['input_size']
+        self.output_size = model.hparams['output_size']
+        self.device = next(model.parameters()).device
+        self.latency = LatencyTracker()
+        self.return_precision = model.hparams['noise_dist'] == 'gaussian-full'
+
+        # flatten temporal convolution; window is ordered from oldest to newest frame
+        mlp = model.model
+        conv = getattr(mlp.decoder, 'conv1d_layer_00')
+        self._conv_weight = conv.weight.detach().permute(0, 2, 1).reshape(
+            conv.out_channels, -1).t().contiguous()
+        self._conv_bias = conv.bias.detach()
+
+        # ring buffer is stored twice so that each window is a contiguous slice
+        self._buffer = torch.zeros(2 * self.window, self.input_size, device=self.device)
+        self._pos = 0
+        self.n_frames = 0  # number of frames pushed in current trial
+        self.reset()
+
+    @classmethod
+    def from_hparams(cls, hparams, version='best'):
+        """Load a trained model with
+        :func:`behavenet.fitting.utils.get_best_model_and_data` and build a streaming decoder.
+
+        Parameters
+        ----------
+        hparams : :obj:`dict`
+            needs to contain enough information to specify a decoder
+        version : :obj:`str` or :obj:`int`, optional
+            test tube model version; 'best' to load the best model
+
+        Returns
+        -------
+        :obj:`StreamingDecoder` object
+
+        """
+        from behavenet.fitting.utils import get_best_model_and_data
+        model, _ = get_best_model_and_data(hparams, load_data=False, version=version)
+        return cls(model)
+
+    def reset(self):
+        """Start a new trial: clear the ring buffer and frame counter."""
+        self._buffer.zero_()
+        self._pos = 0
+        self.n_frames = 0
+
+    def _write(self, frame):
+        # returns the window ending with this frame
+        self._buffer[self._pos] = frame
+        self._buffer[self._pos + self.window] = frame
+        self._pos = (self._pos + 1) % self.window
+        return self._buffer[self._pos:self._pos + self.window]
+
+    def _decode(self, windows):
+        mlp = self.model.model
+        x = windows.reshape(windows.shape[0], -1)
+        precision = None
+        for name, layer in mlp.decoder.named_children():
+            if name == mlp.final_layer and self.return_precision:
+                # precision is computed from the input of the final layer; without hidden layers
+                # this is the predicted frame itself, in the center of the window
+                y = mlp.precision_sqrt(windows[:, self.n_lags] if name == 'conv1d_layer_00' else x)
+                y = y.reshape(-1, self.output_size, self.output_size)
+                precision = torch.bmm(y, y.transpose(1, 2)).cpu().numpy()
+            if name == 'conv1d_layer_00':
+                x = torch.addmm(self._conv_bias, x, self._conv_weight)
+            else:
+                x = layer(x)
+        if self.return_precision:
+            return x.cpu().numpy(), precision
+        return (x.cpu().numpy(),)
+
+    def _empty(self):
+        outputs = (np.zeros(0, dtype='int'), np.zeros((0, self.output_size)))
+        if self.return_precision:
+            outputs += (np.zeros((0, self.output_size, self.output_size)),)
+        return outputs
+
+    def push(self, frames):
+        """Add one or more frames of neural activity to the stream.
+
+        Parameters
+        ----------
+        frames : :obj:`np.ndarray` or :obj:`torch.Tensor`
+            shape (input_size,) or (n_frames, input_size)
+
+        Returns
+        -------
+        :obj:`tuple`
+            - frame indices (:obj:`np.ndarray`): index of each predicted frame in the current
+              trial; each new frame completes the window of the frame :obj:`n_lags` frames earlier
+            - predictions (:obj:`np.ndarray`): shape (n_predicted_frames, output_size)
+            - precisions (:obj:`np.ndarray`): shape (n_predicted_frames, output_size,
+              output_size); only returned by decoders with :obj:`noise_dist='gaussian-full'`
+
+        """
+        t_arrival = time.perf_counter()
+        frames = torch.as_tensor(frames, dtype=torch.float32, device=self.device)
+        if frames.dim() == 1:
+            frames = frames[None]
+        return self._push(frames, t_arrival)
+
+    def _push(self, frames, t_arrival, pad=False):
+        if frames.shape[0] == 1 and (pad or self.n_frames >= self.n_lags):
+            # single frame that completes a window
+            idx = self.n_frames - self.n_lags
+            if not pad:
+                self.n_frames += 1
+            with torch.no_grad():
+                outputs = self._decode(self._write(frames[0])[None])
+            self.latency.update(t_arrival, time.perf_counter())
+            return (np.array([idx]),) + outputs
+        with torch.no_grad():
+            windows = torch.empty(
+                frames.shape[0], self.window, self.input_size, device=self.device)
+            for i, frame in enumerate(frames):
+                windows[i] = self._write(frame)
+            idxs = np.arange(self.n_frames, self.n_frames + frames.shape[0]) - self.n_lags
+            if not pad:
+                self.n_frames += frames.shape[0]
+            # the first n_lags frames of a trial do not complete a window
+            valid = idxs >= 0
+            if not np.all(valid):
+                windows = windows[torch.as_tensor(valid, device=self.device)]
+                idxs = idxs[valid]
+            if len(idxs) == 0:
+                return self._empty()
+            outputs = self._decode(windows)
+        self.latency.update(np.full(len(idxs), t_arrival), time.perf_counter())
+        return (idxs,) + outputs
+
+    def flush(self):
+        """End the current trial: emit the predictions of the last :obj:`n_lags` frames.
+
+        Returns
+        -------
+        :obj:`tuple`
+            see :meth:`push`
+
+        """
+        t_arrival = time.perf_counter()
+        n_pad = self.n_lags if self.n_frames > 0 else 0
+        outputs = self._push(
+            torch.zeros(n_pad, self.input_size, device=self.device), t_arrival, pad=True)
+        self.reset()
+        return outputs
@@ -5,12 +5,15 @@ import os
 import numpy as np
 from tqdm import tqdm
 import torch
+from behavenet.tracing import save_trace
+from behavenet.tracing import start_trace
+from behavenet.tracing import trace_span
 
 # TODO: make it easy to finish training if unexpectedly stopped
 # TODO: save models at prespecified intervals (check ae recon as a func of epoch w/o retraining)
 
 # to ignore imports for sphix-autoapidoc
-__all__ = ['Logger', 'EarlyStopping', 'fit']
+__all__ = ['Logger', 'PhaseTimer', 'MetricsWriter', 'EarlyStopping', 'fit', 'fit_decoder_stack']
 
 
 class Logger(object):
@@ -94,6 +97,33 @@ class Logger(object):
                     self.metrics_by_dataset[dataset][dtype][key] = 0
                 self.metrics_by_dataset[dataset][dtype][key] += val
 
+    def all_reduce_metrics(self, dtype):
+        """Sum metrics over all processes of a distributed fit.
+
+        After this call every process holds the same metrics, computed over the batches seen by
+        all processes; this is a no-op outside of distributed training.
+
+        Parameters
+        ----------
+        dtype : :obj:`str`
+            datatype to reduce metrics for (e.g. 'train', 'val', 'test')
+
+        """
+        from behavenet.fitting.distributed import is_distributed, get_world_size
+        if not is_distributed():
+            return
+        import torch.distributed as dist
+
+        local = {
+            'aggregate': self.metrics[dtype],
+            'by_dataset': [m[dtype] for m in self.metrics_by_dataset]}
+        gathered = [None] * get_world_size()
+        dist.all_gather_object(gathered, local)
+
+        self.metrics[dtype] = _sum_dicts([g['aggregate'] for g in gathered])
+        for dataset, m in enumerate(self.metrics_by_dataset):
+            m[dtype] = _sum_dicts([g['by_dataset'][dataset] for g in gathered])
+
     def create_metric_row(
             self, dtype, epoch, batch, dataset, trial, best_epoch=None, by_dataset=False):
         """Export metrics and other data (e.g. epoch) for logging train progress.
@@ -170,6 +200,303 @@ class Logger(object):
         return self.metrics[dtype]['loss'] / self.metrics[dtype]['batches']
 
 
+class PhaseTimer(object):
+    """Accumulate wall time and call counts for the phases of the training loop.
+
+    Each phase (e.g. loading the next batch, computing the loss, taking an optimizer step) is
+    timed with the context manager returned by :meth:`phase`, or bracketed by calls to
+    :meth:`start` and :meth:`stop`. Times are accumulated separately for
+    each phase/session pair, exported once per epoch and summarized at the end of training. When
+    the timer is disabled every method returns immediately, so the timer can be left in the hot
+    path of the training loop.
+
+    Phases timed with :meth:`phase` are also recorded as spans if a trace is active (see
+    :mod:`behavenet.tracing`), independently of whether the timer itself is enabled.
+    """
+
+    def __init__(self, enabled=True, synchronize=False):
+        """
+
+        Parameters
+        ----------
+        enabled : :obj:`bool`, optional
+            :obj:`False` to turn all methods into no-ops
+        synchronize : :obj:`bool`, optional
+            :obj:`True` to wait for queued cuda kernels at phase boundaries; without this gpu time
+            is attributed to whichever phase next blocks on the gpu
+
+        """
+        import time
+        self.enabled = enabled
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self._clock = time.perf_counter
+        self._starts = {}
+        self._t_init = self._clock()
+        # accumulated over the current epoch
+        self.times = {}
+        self.counts = {}
+        # accumulated over all epochs
+        self.total_times = {}
+        self.total_counts = {}
+
+    def phase(self, phase, dataset=None):
+        """Context manager that times a phase.
+
+        The elapsed time is only added to the running totals if no exception is raised inside the
+        phase.
+
+        Parameters
+        ----------
+        phase : :obj:`str`
+            name of phase
+        dataset : :obj:`int` or :obj:`NoneType`, optional
+            session the phase is computed on; can also be set inside the phase through the
+            :obj:`dataset` attribute of the returned object, e.g. when the session is only known
+            after loading a batch
+
+        """
+        return _TimedPhase(self, phase, dataset)
+
+    def start(self, phase):
+        """Start timing a phase.
+
+        Parameters
+        ----------
+        phase : :obj:`str`
+            name of phase
+
+        """
+        if self.enabled and self.synchronize:
+            torch.cuda.synchronize()
+        if not self.enabled:
+            return
+        self._starts[phase] = self._clock()
+
+    def stop(self, phase, dataset=None):
+        """Stop timing a phase and add the elapsed time to the running totals.
+
+        Parameters
+        ----------
+        phase : :obj:`str`
+            name of phase; must match a previous call to :meth:`start`
+        dataset : :obj:`int` or :obj:`NoneType`, optional
+            session the phase was computed on; :obj:`NoneType` for phases not tied to a session
+
+        """
+        if self.enabled and self.synchronize:
+            torch.cuda.synchronize()
+        if not self.enabled:
+            return
+        elapsed = self._clock() - self._starts.pop(phase)
+        key = (phase, -1 if dataset is None else int(dataset))
+        self.times[key] = self.times.get(key, 0) + elapsed
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def export_epoch(self, epoch, filepath=None):
+        """Append timings of the current epoch to a csv file and reset epoch accumulators.
+
+        The csv file has one row per phase/session pair, with columns 'epoch', 'phase',
+        'dataset', 'n_calls', 'total_s' and 'mean_ms'; :obj:`dataset=-1` denotes phases not tied
+        to a single session.
+
+        Parameters
+        ----------
+        epoch : :obj:`int`
+            current training epoch
+        filepath : :obj:`str` or :obj:`NoneType`, optional
+            absolute path of csv file; if :obj:`NoneType` timings are only accumulated
+
+        """
+        if not self.enabled:
+            return
+        import csv
+        rows = []
+        for (phase, dataset), total in sorted(self.times.items()):
+            n_calls = self.counts[(phase, dataset)]
+            rows.append({
+                'epoch': epoch, 'phase': phase, 'dataset': dataset, 'n_calls': n_calls,
+                'total_s': total, 'mean_ms': 1000 * total / n_calls})
+            self.total_times[(phase, dataset)] = self.total_times.get((phase, dataset), 0) + total
+            self.total_counts[(phase, dataset)] = \
+                self.total_counts.get((phase, dataset), 0) + n_calls
+        if filepath is not None and len(rows) > 0:
+            write_header = not os.path.exists(filepath)
+            with open(filepath, 'a') as f:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+                if write_header:
+                    writer.writeheader()
+                writer.writerows(rows)
+        self.times = {}
+        self.counts = {}
+
+    def summary(self):
+        """Return a table of the time spent in each phase, summed over sessions and epochs.
+
+        Returns
+        -------
+        :obj:`str`
+
+        """
+        if not self.enabled:
+            return ''
+        times = {}
+        counts = {}
+        for (phase, _), total in list(self.total_times.items()) + list(self.times.items()):
+            times[phase] = times.get(phase, 0) + total
+        for (phase, _), n_calls in list(self.total_counts.items()) + list(self.counts.items()):
+            counts[phase] = counts.get(phase, 0) + n_calls
+        wall = self._clock() - self._t_init
+        format_str = '%-24s %10s %12s %12s %8s\n' % (
+            'phase', 'calls', 'total (s)', 'mean (ms)', '% wall')
+        format_str += '-' * 70 + '\n'
+        for phase in sorted(times, key=lambda p: -times[p]):
+            format_str += '%-24s %10i %12.3f %12.3f %8.1f\n' % (
+                phase, counts[phase], times[phase], 1000 * times[phase] / counts[phase],
+                100 * times[phase] / wall)
+        format_str += '-' * 70 + '\n'
+        format_str += '%-24s %10s %12.3f\n' % ('wall time', '', wall)
+        return format_str
+
+
+class _TimedPhase(object):
+    """Context manager returned by :meth:`PhaseTimer.phase`."""
+
+    __slots__ = ['timer', 'phase', 'dataset', 'span']
+
+    def __init__(self, timer, phase, dataset):
+        self.timer = timer
+        self.phase = phase
+        self.dataset = dataset
+        self.span = trace_span(phase, 'train')
+
+    def __enter__(self):
+        self.span.__enter__()
+        self.timer.start(self.phase)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.timer.stop(self.phase, self.dataset)
+        return self.span.__exit__(exc_type, exc_value, traceback)
+
+
+class MetricsWriter(object):
+    """Append rows of training metrics to a csv file without rewriting it.
+
+    :meth:`test_tube.Experiment.save` rewrites the full metrics csv (along with the experiment
+    meta files) on every call, so the cost of logging grows with the number of rows already
+    logged. This class appends new rows to :obj:`metrics.csv` instead, and only flushes buffered
+    rows to disk once every :obj:`flush_interval` seconds (and on :meth:`close`). The resulting
+    file has the same schema as the one written by test-tube - one column per metric, in order of
+    first appearance, plus a :obj:`created_at` timestamp - so that it can be read by
+    :func:`behavenet.fitting.utils.get_best_model_version`,
+    :func:`behavenet.fitting.eval.export_train_plots` and
+    :func:`behavenet.plotting.load_metrics_csv_as_df`.
+
+    The file is rewritten only when a row introduces a new column (e.g. the first training row
+    after a validation row), which happens a handful of times per fit.
+
+    Rows are also added to :obj:`exp.metrics`, so that later calls to :obj:`exp.save()` (e.g. from
+    :func:`behavenet.fitting.utils.export_hparams`) write the same metrics file.
+    """
+
+    def __init__(self, filepath, exp=None, flush_interval=30):
+        """
+
+        Parameters
+        ----------
+        filepath : :obj:`str`
+            absolute path of csv file; any existing file is overwritten on the first flush
+        exp : :obj:`test_tube.Experiment` object or :obj:`NoneType`, optional
+            experiment whose in-memory metrics are kept in sync
+        flush_interval : :obj:`float`, optional
+            minimum time (in seconds) between writes to disk; 0 to write on every call to
+            :meth:`flush`
+
+        """
+        import time
+        self.filepath = filepath
+        self.exp = exp
+        self.flush_interval = flush_interval
+        self._clock = time.time
+        self._last_flush = self._clock()
+        self.rows = [] if exp is None else list(getattr(exp, 'metrics', []))
+        self.columns = []
+        self._n_written = 0
+        self._rewrite = True
+        for row in self.rows:
+            self._update_columns(row)
+
+    def _update_columns(self, row):
+        for key in row.keys():
+            if key not in self.columns:
+                self.columns.append(key)
+                self._rewrite = True
+
+    def log(self, metrics):
+        """Add a row of metrics to the buffer.
+
+        Parameters
+        ----------
+        metrics : :obj:`dict`
+            metrics for a single row, e.g. the output of :meth:`Logger.create_metric_row`
+
+        """
+        from datetime import datetime
+        row = {}
+        for key, val in metrics.items():
+            # convert numpy/torch scalars to python types
+            row[key] = val.item() if hasattr(val, 'item') else val
+        if 'created_at' not in row:
+            row['created_at'] = str(datetime.utcnow())
+        self._update_columns(row)
+        self.rows.append(row)
+        if self.exp is not None and hasattr(self.exp, 'metrics'):
+            self.exp.metrics.append(row)
+
+    def flush(self, force=False):
+        """Write buffered rows to disk.
+
+        Parameters
+        ----------
+        force : :obj:`bool`, optional
+            :obj:`True` to write buffered rows even if :obj:`flush_interval` seconds have not
+            passed since the last write
+
+        """
+        import csv
+        if not force and self._clock() - self._last_flush < self.flush_interval:
+            return
+        if self._rewrite:
+            # new columns; write header and all rows to a temporary file, then swap
+            tmp_file = self.filepath + '.tmp'
+            with open(tmp_file, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self.columns)
+                writer.writeheader()
+                writer.writerows(self.rows)
+            os.replace(tmp_file, self.filepath)
+            self._rewrite = False
+        elif self._n_written < len(self.rows):
+            with open(self.filepath, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self.columns)
+                writer.writerows(self.rows[self._n_written:])
+        self._n_written = len(self.rows)
+        self._last_flush = self._clock()
+
+    def close(self):
+        """Write all remaining rows to disk."""
+        self.flush(force=True)
+
+
+def _sum_dicts(dicts):
+    """Sum values of a list of dicts key by key; keys missing from a dict are treated as 0."""
+    summed = {}
+    for d in dicts:
+        for key, val in d.items():
+            summed[key] = summed.get(key, 0) + val
+    return summed
+
+
 class EarlyStopping(object):
     """Stop training when a monitored quantity has stopped improving.
 
@@ -258,13 +585,41 @@ def fit(hparams, model, data_generator, exp, method='ae'):
     the first half of the batches have been processed, then again after all batches have been
     processed.
 
-    Monitored metrics are saved in a csv file in the model directory. This logging is handled by
-    the :obj:`testtube` package and the class :class:`Logger`.
+    Monitored metrics are saved in the csv file :obj:`metrics.csv` in the model directory. Metrics
+    are computed by the class :class:`Logger` and appended to the csv file by the class
+    :class:`MetricsWriter`, which writes buffered rows to disk at most once every
+    :obj:`hparams['metrics_flush_interval']` seconds (and always at the end of training).
+
+    If called from within an initialized :obj:`torch.distributed` process group (see
+    :func:`behavenet.fitting.distributed.launch`), training and validation batches are sharded
+    across processes, gradients are averaged after every batch and metrics are summed over
+    processes before logging. Only the process with rank 0 logs metrics, saves models, computes
+    the test loss and exports model outputs; :obj:`exp` may be :obj:`None` on all other processes.
 
     At the end of training, model outputs (such as latents for autoencoder models, or predictions
     for decoder models) can optionally be computed and saved using the :obj:`hparams` keys
     :obj:`'export_latents'` or :obj:`'export_predictions'`, respectively.
 
+    If the :obj:`hparams` key :obj:`'profile_phases'` is :obj:`True`, the wall time spent in each
+    phase of the training loop (loading batches, computing losses, optimizer steps, checkpointing,
+    logging, etc.) is recorded by :class:`PhaseTimer`, exported to the csv file
+    :obj:`phase_timing.csv` in the model directory once per epoch, and summarized in a table at
+    the end of training. If the :obj:`hparams` key :obj:`'export_trace'` is :obj:`True`, the same
+    phases - along with data loading, transforms, loss chunks and backward passes - are recorded
+    as spans and saved in the trace-event file :obj:`trace_fit.json` in the model directory.
+
+    If the :obj:`hparams` key :obj:`'asha'` is :obj:`True`, the validation loss is compared to
+    those of other trials in the same experiment directory at rung epochs, and training stops if
+    the trial is not among the best; see :mod:`behavenet.fitting.asha`. The epoch at which a trial
+    was stopped is stored in :obj:`hparams['asha_stopped_epoch']`.
+
+    Autoencoders fit to multiple sessions can draw training batches from several sessions at once
+    with the :obj:`hparams` key :obj:`'n_sessions_per_batch'`; each gradient step is then taken on
+    this many batches concatenated into a single batch (see
+    :meth:`behavenet.data.data_generator.ConcatSessionsGenerator.next_mixed_batch`), and
+    session-specific io layers are applied to each frame according to its session. Training
+    metrics are then only logged in aggregate over sessions.
+
     Parameters
     ----------
     hparams : :obj:`dict`
@@ -273,13 +628,48 @@ def fit(hparams, model, data_generator, exp, method='ae'):
         model to fit
     data_generator : :obj:`ConcatSessionsGenerator` object
         data generator to serve data batches
-    exp : :obj:`test_tube.Experiment` object
-        for logging training progress
+    exp : :obj:`test_tube.Experiment` object or :obj:`NoneType`
+        for logging training progress; only used by the main process
     method : :obj:`str`
         specifies the type of loss - 'ae' | 'ae-msp' | 'nll' | 'conv-decoder'
 
     """
 
+    from behavenet.fitting import distributed
+
+    tracer = start_trace(
+        enabled=hparams.get('export_trace', False) and distributed.is_main_process())
+    try:
+        _fit(hparams, model, data_generator, exp, method=method)
+    finally:
+        # stop tracing even if training fails; the trace up to the failure is saved
+        if tracer is not None:
+            save_trace(tracer, os.path.join(
+                hparams['expt_dir'], 'version_%i' % exp.version, 'trace_fit.json'))
+
+
+def _fit(hparams, model, data_generator, exp, method='ae'):
+    """Training loop of :func:`fit`; see :func:`fit` for parameters."""
+
+    from behavenet.fitting import distributed
+
+    # distributed setup: each process trains on a different subset of batches
+    is_distributed = distributed.is_distributed()
+    is_main = distributed.is_main_process()
+    if is_distributed:
+        distributed.shard_data_generator(
+            data_generator, distributed.get_rank(), distributed.get_world_size())
+        distributed.broadcast_parameters(model)
+    # all processes must take the same number of gradient steps
+    n_train_batches = distributed.all_reduce_min(data_generator.n_tot_batches['train'])
+
+    # concatenate batches from several sessions into each training step
+    n_sessions_per_batch = hparams.get('n_sessions_per_batch', 1)
+    if n_sessions_per_batch > 1 and method != 'ae':
+        raise NotImplementedError(
+            'n_sessions_per_batch > 1 is only implemented for autoencoders, not "%s"' % method)
+    n_train_steps = int(np.ceil(n_train_batches / n_sessions_per_batch))
+
     # optimizer setup
     optimizer = torch.optim.Adam(
         model.get_parameters(), lr=hparams['learning_rate'], weight_decay=hparams.get('l2_reg', 0),
@@ -287,6 +677,15 @@ def fit(hparams, model, data_generator, exp, method='ae'):
 
     # logging setup
     logger = Logger(n_datasets=data_generator.n_datasets)
+    timer = PhaseTimer(
+        enabled=hparams.get('profile_phases', False), synchronize=hparams['device'] == 'cuda')
+
+    # choose chunk sizes that fit within the memory budget
+    if hparams.get('autotune_chunk_size', False):
+        from behavenet.fitting.autotune import autotune_chunk_size
+        autotune_chunk_size(hparams, model, data_generator)
+    train_chunk_size = hparams.get('train_chunk_size', 200)
+    inference_chunk_size = hparams.get('inference_chunk_size', 200)
 
     # early stopping setup
     if hparams['enable_early_stop']:
@@ -300,20 +699,36 @@ def fit(hparams, model, data_generator, exp, method='ae'):
     best_val_epoch = None
     best_val_model = None
     val_check_batch = np.append(
-        hparams['val_check_interval'] * data_generator.n_tot_batches['train'] *
+        hparams['val_check_interval'] * n_train_steps *
         np.arange(1, int((hparams['max_n_epochs'] + 1) / hparams['val_check_interval'])),
-        [data_generator.n_tot_batches['train'] * hparams['max_n_epochs'],
-         data_generator.n_tot_batches['train'] * (hparams['max_n_epochs'] + 1)]).astype('int')
+        [n_train_steps * hparams['max_n_epochs'],
+         n_train_steps * (hparams['max_n_epochs'] + 1)]).astype('int')
 
     # set random seeds for training
     if hparams.get('rng_seed_train', None) is None:
         rng_train = np.random.randint(0, 10000)
     else:
         rng_train = int(hparams['rng_seed_train'])
+    rng_train = distributed.broadcast_object(rng_train)
     torch.manual_seed(rng_train)
     np.random.seed(rng_train)
 
-    expt_dir = os.path.join(hparams['expt_dir'], 'version_%i' % exp.version)
+    if is_main:
+        expt_dir = os.path.join(hparams['expt_dir'], 'version_%i' % exp.version)
+        timing_file = os.path.join(expt_dir, 'phase_timing.csv')
+        metrics_writer = MetricsWriter(
+            os.path.join(expt_dir, 'metrics.csv'), exp=exp,
+            flush_interval=hparams.get('metrics_flush_interval', 30))
+    else:
+        expt_dir = None
+        timing_file = None
+        metrics_writer = None
+
+    # successive halving across grid search trials; decisions are made by the main process
+    asha = None
+    if hparams.get('asha', False) and is_main:
+        from behavenet.fitting.asha import get_asha_scheduler
+        asha = get_asha_scheduler(hparams)
 
     i_epoch = 0
     best_model_saved = False
@@ -322,93 +737,140 @@ def fit(hparams, model, data_generator, exp, method='ae'):
         # through `max_n_epochs` training epochs
 
         print_epoch(i_epoch, hparams['max_n_epochs'])
-
-        # control how data is batched to that models can be restarted from a particular epoch
-        torch.manual_seed(rng_train + i_epoch)  # order of trials within sessions
-        np.random.seed(rng_train + i_epoch)  # order of sessions
-
-        logger.reset_metrics('train')
-        data_generator.reset_iterators('train')
-        model.curr_epoch = i_epoch  # for updating annealed loss terms
-
-        for i_train in tqdm(range(data_generator.n_tot_batches['train'])):
-
-            model.train()
-
-            # zero out gradients. Don't want gradients from previous iterations
-            optimizer.zero_grad()
-
-            # get next minibatch and put it on the device
-            data, dataset = data_generator.next_batch('train')
-
-            # call the appropriate loss function
-            loss_dict = model.loss(data, dataset=dataset, accumulate_grad=True)
-            logger.update_metrics('train', loss_dict, dataset=dataset)
-
-            # step (evaluate untrained network on epoch 0)
-            if i_epoch > 0:
-                optimizer.step()
-
-            # check validation according to schedule
-            curr_batch = (i_train + 1) + i_epoch * data_generator.n_tot_batches['train']
-            if np.any(curr_batch == val_check_batch):
-
-                logger.reset_metrics('val')
-                data_generator.reset_iterators('val')
-                model.eval()
-
-                for i_val in range(data_generator.n_tot_batches['val']):
-
-                    # get next minibatch and put it on the device
-                    data, dataset = data_generator.next_batch('val')
-
-                    # call the appropriate loss function
-                    loss_dict = model.loss(data, dataset=dataset, accumulate_grad=False)
-                    logger.update_metrics('val', loss_dict, dataset=dataset)
-
-                # save best val model
-                if logger.get_loss('val') < best_val_loss:
-                    best_val_loss = logger.get_loss('val')
-                    model.save(os.path.join(expt_dir, 'best_val_model.pt'))
-                    best_model_saved = True
-
-                    model.hparams = None
-                    best_val_model = copy.deepcopy(model)
-                    model.hparams = hparams
-                    best_val_model.hparams = hparams
-                    best_val_epoch = i_epoch
-
-                # export aggregated metrics on val data
-                exp.log(logger.create_metric_row(
-                    'val', i_epoch, i_train, -1, trial=-1,
-                    by_dataset=False, best_epoch=best_val_epoch))
-                # export individual session metrics on val data
-                if data_generator.n_datasets > 1:
-                    exp.log(logger.create_metric_row(
-                        'val', i_epoch, i_train, dataset, trial=-1,
-                        by_dataset=True, best_epoch=best_val_epoch))
-                exp.save()
-
-            # export training metrics at end of epoch
-            if (i_train + 1) % data_generator.n_tot_batches['train'] == 0:
-
-                # export aggregated metrics on train data
-                exp.log(logger.create_metric_row(
-                    'train', i_epoch, i_train, -1, trial=-1,
-                    by_dataset=False, best_epoch=best_val_epoch))
-                # export individual session metrics on train/val data
-                if data_generator.n_datasets > 1:
-                    for dataset in range(data_generator.n_datasets):
-                        exp.log(logger.create_metric_row(
-                            'train', i_epoch, i_train, dataset, trial=-1,
-                            by_dataset=True, best_epoch=best_val_epoch))
-                exp.save()
+        with trace_span('epoch', 'train', epoch=i_epoch):
+            # control how data is batched to that models can be restarted from a particular epoch
+            torch.manual_seed(rng_train + i_epoch)  # order of trials within sessions
+            np.random.seed(rng_train + i_epoch)  # order of sessions
+
+            logger.reset_metrics('train')
+            data_generator.reset_iterators('train')
+            model.curr_epoch = i_epoch  # for updating annealed loss terms
+
+            for i_train in tqdm(range(n_train_steps), disable=not is_main):
+
+                model.train()
+
+                # zero out gradients. Don't want gradients from previous iterations
+                optimizer.zero_grad()
+
+                # get next minibatch and put it on the device
+                with timer.phase('train/next_batch') as phase:
+                    if n_sessions_per_batch > 1:
+                        n_batches = min(
+                            n_sessions_per_batch, n_train_batches - i_train * n_sessions_per_batch)
+                        data, dataset = data_generator.next_mixed_batch('train', n_batches)
+                        # metrics and timings of mixed batches are not tied to a single session
+                        dataset_log = None
+                    else:
+                        data, dataset = data_generator.next_batch('train')
+                        dataset_log = dataset
+                    phase.dataset = dataset_log
+
+                # call the appropriate loss function
+                with timer.phase('train/loss', dataset_log):
+                    loss_dict = model.loss(
+                        data, dataset=dataset, accumulate_grad=True, chunk_size=train_chunk_size)
+                    logger.update_metrics('train', loss_dict, dataset=dataset_log)
+
+                # step (evaluate untrained network on epoch 0)
+                if i_epoch > 0:
+                    if is_distributed:
+                        with timer.phase('train/grad_sync'):
+                            distributed.average_gradients(model)
+                    with timer.phase('train/optimizer_step'):
+                        optimizer.step()
+
+                # check validation according to schedule
+                curr_batch = (i_train + 1) + i_epoch * n_train_steps
+                if np.any(curr_batch == val_check_batch):
+
+                    with trace_span('validation', 'train'):
+                        logger.reset_metrics('val')
+                        data_generator.reset_iterators('val')
+                        model.eval()
+
+                        for i_val in range(data_generator.n_tot_batches['val']):
+
+                            # get next minibatch and put it on the device
+                            with timer.phase('val/next_batch') as phase:
+                                data, dataset = data_generator.next_batch('val')
+                                phase.dataset = dataset
+
+                            # call the appropriate loss function
+                            with timer.phase('val/loss', dataset):
+                                loss_dict = model.loss(
+                                    data, dataset=dataset, accumulate_grad=False,
+                                    chunk_size=inference_chunk_size)
+                                logger.update_metrics('val', loss_dict, dataset=dataset)
+                        logger.all_reduce_metrics('val')
+
+                    # save best val model
+                    if logger.get_loss('val') < best_val_loss:
+                        with timer.phase('checkpoint'):
+                            best_val_loss = logger.get_loss('val')
+                            if is_main:
+                                model.save(os.path.join(expt_dir, 'best_val_model.pt'))
+                            best_model_saved = True
+
+                            model.hparams = None
+                            best_val_model = copy.deepcopy(model)
+                            model.hparams = hparams
+                            best_val_model.hparams = hparams
+                            best_val_epoch = i_epoch
+
+                    # export aggregated metrics on val data
+                    if is_main:
+                        with timer.phase('logging'):
+                            metrics_writer.log(logger.create_metric_row(
+                                'val', i_epoch, i_train, -1, trial=-1,
+                                by_dataset=False, best_epoch=best_val_epoch))
+                            # export individual session metrics on val data
+                            if data_generator.n_datasets > 1:
+                                metrics_writer.log(logger.create_metric_row(
+                                    'val', i_epoch, i_train, dataset, trial=-1,
+                                    by_dataset=True, best_epoch=best_val_epoch))
+                            metrics_writer.flush()
+
+                # export training metrics at end of epoch
+                if (i_train + 1) % n_train_steps == 0:
+
+                    logger.all_reduce_metrics('train')
+                    if is_main:
+                        with timer.phase('logging'):
+                            # export aggregated metrics on train data
+                            metrics_writer.log(logger.create_metric_row(
+                                'train', i_epoch, i_train, -1, trial=-1,
+                                by_dataset=False, best_epoch=best_val_epoch))
+                            # export individual session metrics on train/val data
+                            if data_generator.n_datasets > 1 and n_sessions_per_batch == 1:
+                                for dataset in range(data_generator.n_datasets):
+                                    metrics_writer.log(logger.create_metric_row(
+                                        'train', i_epoch, i_train, dataset, trial=-1,
+                                        by_dataset=True, best_epoch=best_val_epoch))
+                            metrics_writer.flush()
+
+            timer.export_epoch(i_epoch, timing_file)
 
         if hparams['enable_early_stop']:
             early_stop.on_val_check(i_epoch, logger.get_loss('val'))
             if early_stop.should_stop:
                 break
 
+        # stop trials that are not among the best of the grid search at this rung
+        if hparams.get('asha', False):
+            stop = asha is not None and logger.metrics['val']['batches'] > 0 \
+                and asha.should_stop(expt_dir, i_epoch, logger.get_loss('val'))
+            if distributed.broadcast_object(stop):
+                print('\n== trial stopped by ASHA at epoch %i ==\n' % i_epoch)
+                hparams['asha_stopped_epoch'] = i_epoch
+                break
+
+    # only the main process saves models and evaluates test data
+    if not is_main:
+        return
+    if is_distributed:
+        distributed.shard_data_generator(data_generator, 0, 1)
+
     # save out last model as best model if no best model saved
     if not best_model_saved:
         model.save(os.path.join(expt_dir, 'best_val_model.pt'))
@@ -430,30 +892,267 @@ def fit(hparams, model, data_generator, exp, method='ae'):
     for i_test in range(data_generator.n_tot_batches['test']):
 
         # get next minibatch and put it on the device
-        data, dataset = data_generator.next_batch('test')
+        with timer.phase('test/next_batch') as phase:
+            data, dataset = data_generator.next_batch('test')
+            phase.dataset = dataset
 
         # call the appropriate loss function
-        logger.reset_metrics('test')
-        loss_dict = model.loss(data, dataset=dataset, accumulate_grad=False)
-        logger.update_metrics('test', loss_dict, dataset=dataset)
+        with timer.phase('test/loss', dataset):
+            logger.reset_metrics('test')
+            loss_dict = model.loss(
+                data, dataset=dataset, accumulate_grad=False, chunk_size=inference_chunk_size)
+            logger.update_metrics('test', loss_dict, dataset=dataset)
 
         # calculate metrics for each *batch* (rather than whole dataset)
-        exp.log(logger.create_metric_row(
+        metrics_writer.log(logger.create_metric_row(
             'test', i_epoch, i_test, dataset, trial=data['batch_idx'].item(), by_dataset=True))
 
-    exp.save()
+    metrics_writer.close()
 
     # export latents
-    if method == 'ae' and hparams['export_latents']:
-        print('exporting latents')
-        from behavenet.fitting.eval import export_latents
-        export_latents(data_generator, best_val_model)
-    elif method == 'nll' and hparams['export_predictions']:
-        print('exporting predictions')
-        from behavenet.fitting.eval import export_predictions
-        export_predictions(data_generator, best_val_model)
-    elif method == 'conv-decoder' and hparams.get('export_predictions', False):
-        print('warning! exporting predictions not currently implemented for convolutional decoder')
+    with timer.phase('export'):
+        if method == 'ae' and hparams['export_latents']:
+            print('exporting latents')
+            from behavenet.fitting.eval import export_latents
+            export_latents(data_generator, best_val_model)
+        elif method == 'nll' and hparams['export_predictions']:
+            print('exporting predictions')
+            from behavenet.fitting.eval import export_predictions
+            export_predictions(data_generator, best_val_model)
+        elif method == 'conv-decoder' and hparams.get('export_predictions', False):
+            print(
+                'warning! exporting predictions not currently implemented for convolutional '
+                'decoder')
+
+    # report where training time went
+    timer.export_epoch(i_epoch, timing_file)
+    if timer.enabled:
+        print('\n== time spent in each phase of training ==')
+        print(timer.summary())
+
+
+def fit_decoder_stack(hparams_list, model, data_generator, exps):
+    """Fit a stack of decoders simultaneously on a single stream of data batches.
+
+    Each member of a :class:`behavenet.models.decoders.DecoderStack` is trained as if it were fit
+    on its own with :func:`fit` (using :obj:`method='nll'`): it has its own optimizer (with its own
+    learning rate and l2 regularization), its own early stopping criterion, its own best
+    validation checkpoint and its own metrics file in its own model directory. All members see the
+    same sequence of training batches, so the training hparams that control batching
+    (:obj:`'rng_seed_train'`, :obj:`'val_check_interval'`, :obj:`'max_n_epochs'`) are taken from
+    the first member. Members that meet their early stopping criterion are no longer updated or
+    evaluated; training ends when all members have stopped or the maximum number of epochs is
+    reached. If the :obj:`hparams` key :obj:`'asha'` is :obj:`True`, each member is also treated
+    as a separate trial by the ASHA scheduler (see :mod:`behavenet.fitting.asha`).
+
+    Parameters
+    ----------
+    hparams_list : :obj:`list` of :obj:`dict`
+        model/training specification for each member
+    model : :obj:`DecoderStack` object
+        stack of decoders to fit
+    data_generator : :obj:`ConcatSessionsGenerator` object
+        data generator to serve data batches
+    exps : :obj:`list` of :obj:`test_tube.Experiment` objects
+        for logging training progress of each member
+
+    """
+
+    hparams = hparams_list[0]
+    members = list(model.members)
+    n_members = len(members)
+    n_train_batches = data_generator.n_tot_batches['train']
+    train_chunk_size = hparams.get('train_chunk_size', 200)
+    inference_chunk_size = hparams.get('inference_chunk_size', 200)
+
+    # per-member optimization, early stopping and logging
+    optimizers = []
+    early_stops = []
+    loggers = []
+    metrics_writers = []
+    expt_dirs = [
+        os.path.join(h['expt_dir'], 'version_%i' % e.version) for h, e in zip(hparams_list, exps)]
+    for hparams_, member, expt_dir, exp in zip(hparams_list, members, expt_dirs, exps):
+        optimizers.append(torch.optim.Adam(
+            member.get_parameters(), lr=hparams_['learning_rate'],
+            weight_decay=hparams_.get('l2_reg', 0), amsgrad=True))
+        if hparams_['enable_early_stop']:
+            early_stops.append(EarlyStopping(
+                patience=hparams_['early_stop_history'], min_epochs=hparams_['min_n_epochs']))
+        else:
+            early_stops.append(None)
+        loggers.append(Logger(n_datasets=data_generator.n_datasets))
+        metrics_writers.append(MetricsWriter(
+            os.path.join(expt_dir, 'metrics.csv'), exp=exp,
+            flush_interval=hparams_.get('metrics_flush_interval', 30)))
+
+    best_val_losses = [np.inf] * n_members
+    best_val_epochs = [None] * n_members
+    best_val_models = [None] * n_members
+    last_epochs = [0] * n_members
+    val_check_batch = np.append(
+        hparams['val_check_interval'] * n_train_batches *
+        np.arange(1, int((hparams['max_n_epochs'] + 1) / hparams['val_check_interval'])),
+        [n_train_batches * hparams['max_n_epochs'],
+         n_train_batches * (hparams['max_n_epochs'] + 1)]).astype('int')
+
+    # set random seeds for training
+    if hparams.get('rng_seed_train', None) is None:
+        rng_train = np.random.randint(0, 10000)
+    else:
+        rng_train = int(hparams['rng_seed_train'])
+    torch.manual_seed(rng_train)
+    np.random.seed(rng_train)
+
+    # successive halving across grid search trials
+    asha = None
+    if hparams.get('asha', False):
+        from behavenet.fitting.asha import get_asha_scheduler
+        asha = get_asha_scheduler(hparams)
+
+    # indices of members that are still training
+    active = list(range(n_members))
+    for i_epoch in range(hparams['max_n_epochs'] + 1):
+
+        print_epoch(i_epoch, hparams['max_n_epochs'])
+
+        torch.manual_seed(rng_train + i_epoch)  # order of trials within sessions
+        np.random.seed(rng_train + i_epoch)  # order of sessions
+
+        for m in active:
+            loggers[m].reset_metrics('train')
+            members[m].curr_epoch = i_epoch
+            last_epochs[m] = i_epoch
+        data_generator.reset_iterators('train')
+
+        for i_train in tqdm(range(n_train_batches)):
+
+            model.train()
+            for m in active:
+                optimizers[m].zero_grad()
+
+            data, dataset = data_generator.next_batch('train')
+            loss_dicts = model.loss(
+                data, dataset=dataset, accumulate_grad=True, chunk_size=train_chunk_size,
+                members=active)
+            for m, loss_dict in zip(active, loss_dicts):
+                loggers[m].update_metrics('train', loss_dict, dataset=dataset)
+
+            # step (evaluate untrained network on epoch 0)
+            if i_epoch > 0:
+                for m in active:
+                    optimizers[m].step()
+
+            # check validation according to schedule
+            curr_batch = (i_train + 1) + i_epoch * n_train_batches
+            if np.any(curr_batch == val_check_batch):
+
+                for m in active:
+                    loggers[m].reset_metrics('val')
+                data_generator.reset_iterators('val')
+                model.eval()
+
+                for i_val in range(data_generator.n_tot_batches['val']):
+                    data, dataset = data_generator.next_batch('val')
+                    loss_dicts = model.loss(
+                        data, dataset=dataset, accumulate_grad=False,
+                        chunk_size=inference_chunk_size, members=active)
+                    for m, loss_dict in zip(active, loss_dicts):
+                        loggers[m].update_metrics('val', loss_dict, dataset=dataset)
+
+                for m in active:
+                    # save best val model
+                    if loggers[m].get_loss('val') < best_val_losses[m]:
+                        best_val_losses[m] = loggers[m].get_loss('val')
+                        members[m].save(os.path.join(expt_dirs[m], 'best_val_model.pt'))
+                        members[m].hparams = None
+                        best_val_models[m] = copy.deepcopy(members[m])
+                        members[m].hparams = hparams_list[m]
+                        best_val_models[m].hparams = hparams_list[m]
+                        best_val_epochs[m] = i_epoch
+
+                    # export aggregated metrics on val data
+                    metrics_writers[m].log(loggers[m].create_metric_row(
+                        'val', i_epoch, i_train, -1, trial=-1,
+                        by_dataset=False, best_epoch=best_val_epochs[m]))
+                    # export individual session metrics on val data
+                    if data_generator.n_datasets > 1:
+                        metrics_writers[m].log(loggers[m].create_metric_row(
+                            'val', i_epoch, i_train, dataset, trial=-1,
+                            by_dataset=True, best_epoch=best_val_epochs[m]))
+                    metrics_writers[m].flush()
+
+            # export training metrics at end of epoch
+            if (i_train + 1) % n_train_batches == 0:
+                for m in active:
+                    # export aggregated metrics on train data
+                    metrics_writers[m].log(loggers[m].create_metric_row(
+                        'train', i_epoch, i_train, -1, trial=-1,
+                        by_dataset=False, best_epoch=best_val_epochs[m]))
+                    # export individual session metrics on train/val data
+                    if data_generator.n_datasets > 1:
+                        for dataset in range(data_generator.n_datasets):
+                            metrics_writers[m].log(loggers[m].create_metric_row(
+                                'train', i_epoch, i_train, dataset, trial=-1,
+                                by_dataset=True, best_epoch=best_val_epochs[m]))
+                    metrics_writers[m].flush()
+
+        # remove members that meet their early stopping criterion or are stopped by ASHA
+        for m in list(active):
+            if early_stops[m] is not None:
+                early_stops[m].on_val_check(i_epoch, loggers[m].get_loss('val'))
+                if early_stops[m].should_stop:
+                    active.remove(m)
+                    continue
+            if asha is not None and loggers[m].metrics['val']['batches'] > 0 \
+                    and asha.should_stop(expt_dirs[m], i_epoch, loggers[m].get_loss('val')):
+                print('\n== member %i stopped by ASHA at epoch %i ==\n' % (m, i_epoch))
+                hparams_list[m]['asha_stopped_epoch'] = i_epoch
+                active.remove(m)
+        if len(active) == 0:
+            break
+
+    for m in range(n_members):
+
+        # save out last model as best model if no best model saved
+        if best_val_models[m] is None:
+            members[m].save(os.path.join(expt_dirs[m], 'best_val_model.pt'))
+            members[m].hparams = None
+            best_val_models[m] = copy.deepcopy(members[m])
+            members[m].hparams = hparams_list[m]
+            best_val_models[m].hparams = hparams_list[m]
+
+        # save out last model
+        if hparams_list[m].get('save_last_model', False):
+            members[m].save(os.path.join(expt_dirs[m], 'last_model.pt'))
+
+    # compute test loss
+    data_generator.reset_iterators('test')
+    model.eval()
+
+    for i_test in range(data_generator.n_tot_batches['test']):
+
+        data, dataset = data_generator.next_batch('test')
+        loss_dicts = model.loss(data, dataset=dataset, accumulate_grad=False,
+                                chunk_size=inference_chunk_size)
+
+        # calculate metrics for each *batch* (rather than whole dataset)
+        for m, loss_dict in enumerate(loss_dicts):
+            loggers[m].reset_metrics('test')
+            loggers[m].update_metrics('test', loss_dict, dataset=dataset)
+            metrics_writers[m].log(loggers[m].create_metric_row(
+                'test', last_epochs[m], i_test, dataset, trial=data['batch_idx'].item(),
+                by_dataset=True))
+
+    for metrics_writer in metrics_writers:
+        metrics_writer.close()
+
+    # export predictions
+    for m in range(n_members):
+        if hparams_list[m]['export_predictions']:
+            print('exporting predictions')
+            from behavenet.fitting.eval import export_predictions
+            export_predictions(data_generator, best_val_models[m])
 
 
 def print_epoch(curr, total):
@@ -8,9 +8,14 @@ import numpy as np
 __all__ = [
     'get_subdirs', 'get_session_dir', 'get_expt_dir', 'read_session_info_from_csv',
     'export_session_info_to_csv', 'contains_session', 'find_session_dirs', 'experiment_exists',
-    'get_model_params', 'export_hparams', 'get_lab_example', 'get_region_dir',
-    'create_tt_experiment', 'get_best_model_version',
-    'get_best_model_and_data']
+    'find_warm_start_model', 'get_model_params', 'get_data_params', 'export_hparams',
+    'get_lab_example', 'get_region_dir', 'create_tt_experiment', 'get_best_model_version',
+    'get_model_class', 'get_best_model_and_data']
+
+# model params that may differ between a model and the model it is warm started from
+_WARM_START_KEYS = [
+    'n_ae_latents', 'vae.beta', 'beta_tcvae.beta', 'ps_vae.alpha', 'ps_vae.beta', 'ps_vae.gamma',
+    'msp.alpha']
 
 
 def get_subdirs(path):
@@ -59,9 +64,11 @@ def _get_multisession_paths(base_dir, lab='', expt='', animal=''):
         list of absolute paths
 
     """
+    from behavenet.fitting.session_index import get_session_index
     multi_paths = []
     try:
-        sub_dirs = get_subdirs(os.path.join(base_dir, lab, expt, animal))
+        index = get_session_index(base_dir)
+        sub_dirs = index.get_subdirs(os.path.join(base_dir, lab, expt, animal))
         for sub_dir in sub_dirs:
             if sub_dir[:5] == 'multi':
                 # record top-level multi-session directory
@@ -73,7 +80,7 @@ def _get_multisession_paths(base_dir, lab='', expt='', animal=''):
     return multi_paths
 
 
-def _get_single_sessions(base_dir, depth, curr_depth):
+def _get_single_sessions(base_dir, depth, curr_depth, index=None):
     """Recursively search through non-multisession directories for all single sessions.
 
     Parameters
@@ -83,6 +90,8 @@ def _get_single_sessions(base_dir, depth, curr_depth):
         depth of recursion
     curr_depth : :obj:`int`
         current depth in recursion
+    index : :obj:`behavenet.fitting.session_index.SessionIndex`, optional
+        used to list subdirectories if not :obj:`NoneType`
 
     Returns
     -------
@@ -93,11 +102,12 @@ def _get_single_sessions(base_dir, depth, curr_depth):
     session_list = []
     if curr_depth < depth:
         curr_depth += 1
-        sub_dirs = get_subdirs(base_dir)
+        sub_dirs = get_subdirs(base_dir) if index is None else index.get_subdirs(base_dir)
         for sub_dir in sub_dirs:
             if sub_dir[:12] != 'multisession':
                 session_list += _get_single_sessions(
-                    os.path.join(base_dir, sub_dir), depth=depth, curr_depth=curr_depth)
+                    os.path.join(base_dir, sub_dir), depth=depth, curr_depth=curr_depth,
+                    index=index)
     elif curr_depth == depth:
         # take previous 4 directories (lab/expt/animal/session)
         sess_path = base_dir.split(os.sep)
@@ -161,6 +171,8 @@ def get_session_dir(hparams, session_source='save'):
     contain information about the sessions that comprise the multisession; this file is used to
     determine whether or not a new multisession directory needs to be created.
 
+    Directory listings and :obj:`session_info.csv` files are read through the session index of
+    the save directory (see :class:`behavenet.fitting.session_index.SessionIndex`).
 
     Parameters
     ----------
@@ -177,8 +189,10 @@ def get_session_dir(hparams, session_source='save'):
         - sessions_single (:obj:`list`)
 
     """
+    from behavenet.fitting.session_index import get_session_index
 
     save_dir = hparams['save_dir']
+    index = get_session_index(save_dir)
     if session_source == 'save':
         sess_dir = hparams['save_dir']
     elif session_source == 'data':
@@ -230,14 +244,14 @@ def get_session_dir(hparams, session_source='save'):
             # get all experiments from one lab
             multisession_paths = _get_multisession_paths(save_dir, lab=lab)
             sessions_single = _get_single_sessions(
-                os.path.join(sess_dir, lab), depth=3, curr_depth=0)
+                os.path.join(sess_dir, lab), depth=3, curr_depth=0, index=index)
             session_dir_base = os.path.join(save_dir, lab)
         elif hparams['animal'] == 'all':
             # get all animals from one experiment
             expt = hparams['expt']
             multisession_paths = _get_multisession_paths(save_dir, lab=lab, expt=expt)
             sessions_single = _get_single_sessions(
-                os.path.join(sess_dir, lab, expt), depth=2, curr_depth=0)
+                os.path.join(sess_dir, lab, expt), depth=2, curr_depth=0, index=index)
             session_dir_base = os.path.join(save_dir, lab, expt)
         elif hparams['session'] == 'all':
             # get all sessions from one animal
@@ -246,7 +260,7 @@ def get_session_dir(hparams, session_source='save'):
             multisession_paths = _get_multisession_paths(
                 save_dir, lab=lab, expt=expt, animal=animal)
             sessions_single = _get_single_sessions(
-                os.path.join(sess_dir, lab, expt, animal), depth=1, curr_depth=0)
+                os.path.join(sess_dir, lab, expt, animal), depth=1, curr_depth=0, index=index)
             session_dir_base = os.path.join(save_dir, lab, expt, animal)
         else:
             multisession_paths = []
@@ -260,7 +274,7 @@ def get_session_dir(hparams, session_source='save'):
     if hparams.get('multisession', None) is not None and len(hparams.get('sessions_csv', [])) == 0:
         session_dir = os.path.join(session_dir_base, 'multisession-%02i' % hparams['multisession'])
         # overwrite sessions_single with whatever is in requested multisession
-        sessions_single = read_session_info_from_csv(os.path.join(session_dir, 'session_info.csv'))
+        sessions_single = index.read_session_info(session_dir)
         for sess in sessions_single:
             sess.pop('save_dir', None)
     elif len(sessions_single) > 1:
@@ -268,8 +282,7 @@ def get_session_dir(hparams, session_source='save'):
         found_match = False
         multi_idx = None
         for session_multi in multisession_paths:
-            csv_file = os.path.join(session_multi, 'session_info.csv')
-            sessions_multi = read_session_info_from_csv(csv_file)
+            sessions_multi = index.read_session_info(session_multi)
             for d in sessions_multi:
                 # save path doesn't matter for comparison
                 d.pop('save_dir', None)
@@ -298,6 +311,8 @@ def get_session_dir(hparams, session_source='save'):
     else:
         session_dir = session_dir_base
 
+    index.flush()
+
     return session_dir, sessions_single
 
 
@@ -476,7 +491,7 @@ def export_session_info_to_csv(session_dir, ids_list):
             session_writer.writerow(ids)
 
 
-def contains_session(session_dir, session_id):
+def contains_session(session_dir, session_id, index=None):
     """Determine if session defined by `session_id` dict is in the multi-session `session_dir`.
 
     Parameters
@@ -485,13 +500,18 @@ def contains_session(session_dir, session_id):
         absolute path to multi-session directory that contains a :obj:`session_info.csv` file
     session_id : :obj:`dict`
         must contain keys 'lab', 'expt', 'animal' and 'session'
+    index : :obj:`behavenet.fitting.session_index.SessionIndex`, optional
+        used to read :obj:`session_info.csv` if not :obj:`NoneType`
 
     Returns
     -------
     :obj:`bool`
 
     """
-    session_ids = read_session_info_from_csv(os.path.join(session_dir, 'session_info.csv'))
+    if index is None:
+        session_ids = read_session_info_from_csv(os.path.join(session_dir, 'session_info.csv'))
+    else:
+        session_ids = index.read_session_info(session_dir)
     contains_sess = False
     for sess_id in session_ids:
         sess_id.pop('save_dir', None)
@@ -516,38 +536,40 @@ def find_session_dirs(hparams):
 
     """
     # TODO: refactor like get_session_dir?
+    from behavenet.fitting.session_index import get_session_index
+    index = get_session_index(hparams['save_dir'])
     ids = {s: hparams[s] for s in ['lab', 'expt', 'animal', 'session']}
     lab = hparams['lab']
-    expts = get_subdirs(os.path.join(hparams['save_dir'], lab))
+    expts = index.get_subdirs(os.path.join(hparams['save_dir'], lab))
     # need to grab all multi-sessions as well as the single session
     session_dirs = []  # full paths
     session_ids = []  # dict of lab/expt/animal/session
     for expt in expts:
         if expt[:5] == 'multi':
             session_dir = os.path.join(hparams['save_dir'], lab, expt)
-            if contains_session(session_dir, ids):
+            if contains_session(session_dir, ids, index=index):
                 session_dirs.append(session_dir)
                 session_ids.append({
                     'lab': lab, 'expt': 'all', 'animal': '', 'session': '',
                     'multisession': int(expt[-2:])})
             continue
         else:
-            animals = get_subdirs(os.path.join(hparams['save_dir'], lab, expt))
+            animals = index.get_subdirs(os.path.join(hparams['save_dir'], lab, expt))
         for animal in animals:
             if animal[:5] == 'multi':
                 session_dir = os.path.join(hparams['save_dir'], lab, expt, animal)
-                if contains_session(session_dir, ids):
+                if contains_session(session_dir, ids, index=index):
                     session_dirs.append(session_dir)
                     session_ids.append({
                         'lab': lab, 'expt': expt, 'animal': 'all', 'session': '',
                         'multisession': int(animal[-2:])})
                 continue
             else:
-                sessions = get_subdirs(os.path.join(hparams['save_dir'], lab, expt, animal))
+                sessions = index.get_subdirs(os.path.join(hparams['save_dir'], lab, expt, animal))
             for session in sessions:
                 session_dir = os.path.join(hparams['save_dir'], lab, expt, animal, session)
                 if session[:5] == 'multi':
-                    if contains_session(session_dir, ids):
+                    if contains_session(session_dir, ids, index=index):
                         session_dirs.append(session_dir)
                         session_ids.append({
                             'lab': lab, 'expt': expt, 'animal': animal, 'session': 'all',
@@ -559,12 +581,17 @@ def find_session_dirs(hparams):
                         session_ids.append({
                             'lab': lab, 'expt': expt, 'animal': animal, 'session': session,
                             'multisession': None})
+    index.flush()
     return session_dirs, session_ids
 
 
 def experiment_exists(hparams, which_version=False):
     """Search testtube versions to find if experiment with the same hyperparameters has been fit.
 
+    Versions are looked up in the experiment registry (see
+    :class:`behavenet.fitting.registry.ExperimentRegistry`), which is synced with the version
+    subdirectories first; if the registry cannot be used, all versions are searched.
+
     Parameters
     ----------
     hparams : :obj:`dict`
@@ -581,7 +608,8 @@ def experiment_exists(hparams, which_version=False):
 
     """
 
-    import pickle
+    import sqlite3
+    from behavenet.fitting.registry import ExperimentRegistry
 
     # fill out path info if not present
     if 'expt_dir' not in hparams:
@@ -602,6 +630,14 @@ def experiment_exists(hparams, which_version=False):
     # get model-specific params
     hparams_less = get_model_params(hparams)
 
+    try:
+        registry = ExperimentRegistry(hparams['expt_dir'])
+        registry.sync(tt_versions)
+        # only load hparams of registered matches, in case a version has changed on disk
+        tt_versions = ['version_%i' % v for v in registry.find(hparams_less)]
+    except (sqlite3.Error, OSError) as e:
+        print('could not use experiment registry (%s); searching all versions' % e)
+
     found_match = False
     version = None
     for version in tt_versions:
@@ -626,6 +662,73 @@ def experiment_exists(hparams, which_version=False):
         return found_match
 
 
+def find_warm_start_model(hparams):
+    """Find the weights of the nearest completed model of a sweep to initialize a new model from.
+
+    Candidates are the completed versions with the same experiment name in the experiment
+    directories of all numbers of latents; they are looked up in the experiment registry of each
+    directory (see :meth:`behavenet.fitting.registry.ExperimentRegistry.find_neighbors`). A
+    candidate must have the same model params as :obj:`hparams` except for the number of latents
+    and the weights of the loss terms (:obj:`vae.beta`, :obj:`beta_tcvae.beta`,
+    :obj:`ps_vae.alpha`, :obj:`ps_vae.beta`, :obj:`ps_vae.gamma`, :obj:`msp.alpha`), and the same
+    architecture apart from the number of latents. The nearest candidate is the one with the
+    smallest summed relative difference in these params.
+
+    Parameters
+    ----------
+    hparams : :obj:`dict`
+        needs to contain :obj:`expt_dir`, :obj:`experiment_name` and the model params
+
+    Returns
+    -------
+    :obj:`str` or :obj:`NoneType`
+        path to the :obj:`best_val_model.pt` file of the nearest version; :obj:`NoneType` if no
+        candidate is found
+
+    """
+
+    import sqlite3
+    from behavenet.fitting.registry import ExperimentRegistry
+    from behavenet.fitting.registry import hash_model_params
+
+    def _get_arch(hparams_):
+        arch = hparams_.get('architecture_params', {})
+        return hash_model_params(
+            {key: val for key, val in arch.items() if key not in ['n_ae_latents', 'mem_size_gb']})
+
+    params = get_model_params(hparams)
+    arch = _get_arch(hparams)
+
+    # experiment directories of all numbers of latents, e.g. session_dir/ae/conv/08_latents/expt
+    model_dir = os.path.dirname(os.path.dirname(hparams['expt_dir']))
+    candidates = []
+    for latents_dir in sorted(os.listdir(model_dir)):
+        expt_dir = os.path.join(model_dir, latents_dir, hparams['experiment_name'])
+        if not latents_dir.endswith('_latents') or not os.path.isdir(expt_dir):
+            continue
+        try:
+            registry = ExperimentRegistry(expt_dir)
+            registry.sync()
+            neighbors = registry.find_neighbors(params, _WARM_START_KEYS)
+        except (sqlite3.Error, OSError) as e:
+            print('could not use experiment registry of %s (%s)' % (expt_dir, e))
+            continue
+        candidates += [(distance, expt_dir, version) for version, distance in neighbors]
+
+    for _, expt_dir, version in sorted(candidates):
+        version_dir = os.path.join(expt_dir, 'version_%i' % version)
+        model_file = os.path.join(version_dir, 'best_val_model.pt')
+        try:
+            with open(os.path.join(version_dir, 'meta_tags.pkl'), 'rb') as f:
+                hparams_ = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            continue
+        if _get_arch(hparams_) == arch and os.path.exists(model_file):
+            return model_file
+
+    return None
+
+
 def get_model_params(hparams):
     """Returns dict containing all params considered essential for defining a model in that class.
 
@@ -744,11 +847,56 @@ def get_model_params(hparams):
     return hparams_less
 
 
+def get_data_params(hparams):
+    """Returns dict containing the params in :func:`get_model_params` that determine model inputs.
+
+    Models with identical data params are fit on the same data (same signals, transforms and
+    train/val/test splits), and can therefore share a data generator.
+
+    Parameters
+    ----------
+    hparams : :obj:`dict`
+        all relevant hparams for the given model class will be pulled from this dict
+
+    Returns
+    -------
+    :obj:`dict`
+        hparams dict
+
+    """
+
+    hparams_less = get_model_params(hparams)
+
+    # architecture and training params
+    model_keys = [
+        'rng_seed_model', 'model_type', 'learning_rate', 'l2_reg', 'fit_sess_io_layers',
+        'msp.alpha', 'vae.beta', 'beta_tcvae.beta', 'ps_vae.alpha', 'ps_vae.beta', 'ps_vae.gamma',
+        'n_lags', 'n_hid_layers', 'n_hid_units', 'activation']
+    if hparams['model_class'] in [
+            'ae', 'vae', 'beta-tcvae', 'cond-vae', 'cond-ae', 'cond-ae-msp', 'ps-vae']:
+        # n_ae_latents specifies the upstream ae (and therefore the data) for all other classes
+        model_keys.append('n_ae_latents')
+    if hparams['model_class'] in ['arhmm', 'hmm', 'arhmm-labels', 'hmm-labels']:
+        # n_arhmm_states specifies the upstream arhmm (and therefore the data) for decoders
+        model_keys += ['n_arhmm_states', 'n_arhmm_lags', 'noise_type', 'transitions', 'kappa']
+    for key in model_keys:
+        hparams_less.pop(key, None)
+
+    # sessions and data location
+    data_keys = [
+        'data_dir', 'lab', 'expt', 'animal', 'session', 'device', 'as_numpy', 'batch_load']
+    for key in data_keys:
+        if key in hparams:
+            hparams_less[key] = hparams[key]
+
+    return hparams_less
+
+
 def export_hparams(hparams, exp):
     """Export hyperparameter dictionary.
 
     The dict is export once as a csv file (for easy human reading) and again as a pickled dict
-    (for easy python loading/parsing).
+    (for easy python loading/parsing), and the version is added to the experiment registry.
 
     Parameters
     ----------
@@ -759,10 +907,18 @@ def export_hparams(hparams, exp):
 
     """
     import pickle
+    import sqlite3
+    from behavenet.fitting.registry import ExperimentRegistry
     # save out as pickle
     meta_file = os.path.join(hparams['expt_dir'], 'version_%i' % exp.version, 'meta_tags.pkl')
     with open(meta_file, 'wb') as f:
         pickle.dump(hparams, f)
+    # register model params so that the version can be found without loading the pickle; the
+    # version is registered from the pickle on the next sync if the registry cannot be updated
+    try:
+        ExperimentRegistry(hparams['expt_dir']).update(exp.version, hparams)
+    except (sqlite3.Error, OSError) as e:
+        print('could not update experiment registry (%s)' % e)
     # save out as csv
     exp.tag(hparams)
     exp.save()
@@ -829,6 +985,10 @@ def get_region_dir(hparams):
 def create_tt_experiment(hparams):
     """Create test-tube experiment for logging training and storing models.
 
+    A new version directory is allocated atomically, and the model params are claimed in the
+    experiment registry (see :class:`behavenet.fitting.registry.ExperimentRegistry`) so that
+    concurrent jobs with the same hyperparameters do not fit the same model.
+
     Parameters
     ----------
     hparams : :obj:`dict`
@@ -837,29 +997,46 @@ def create_tt_experiment(hparams):
     Returns
     -------
     :obj:`tuple`
-        - if experiment defined by hparams already exists, returns :obj:`(None, None, None)`
+        - if experiment defined by hparams already exists (or is being fit by another job),
+          returns :obj:`(None, None, None)`
         - if experiment does not exist, returns :obj:`(hparams, sess_ids, exp)`
 
     """
+    import sqlite3
     from test_tube import Experiment
+    from behavenet.fitting.registry import ExperimentRegistry
+    from behavenet.fitting.registry import allocate_version
 
     # get session_dir
     hparams['session_dir'], sess_ids = get_session_dir(
         hparams, session_source=hparams.get('all_source', 'save'))
     if not os.path.isdir(hparams['session_dir']):
-        os.makedirs(hparams['session_dir'])
+        # other jobs may create the same directories at the same time
+        os.makedirs(hparams['session_dir'], exist_ok=True)
         export_session_info_to_csv(hparams['session_dir'], sess_ids)
     hparams['expt_dir'] = get_expt_dir(hparams)
-    if not os.path.isdir(hparams['expt_dir']):
-        os.makedirs(hparams['expt_dir'])
+    os.makedirs(hparams['expt_dir'], exist_ok=True)
 
     # check to see if experiment already exists
     if experiment_exists(hparams):
         return None, None, None
 
+    # allocate a new version and claim its hparams, in case identical jobs started concurrently
+    version = allocate_version(hparams['expt_dir'])
+    try:
+        claimed = ExperimentRegistry(hparams['expt_dir']).claim(get_model_params(hparams), version)
+    except (sqlite3.Error, OSError) as e:
+        print('could not claim hparams in experiment registry (%s)' % e)
+        claimed = True
+    if not claimed:
+        os.rmdir(os.path.join(hparams['expt_dir'], 'version_%i' % version))
+        print('Experiment is being fit by another job')
+        return None, None, None
+
     exp = Experiment(
         name=hparams['experiment_name'],
         debug=False,
+        version=version,
         save_dir=os.path.dirname(hparams['expt_dir']))
     exp.save()
     hparams['version'] = exp.version
@@ -887,30 +1064,25 @@ def get_best_model_version(expt_dir, measure='val_loss', best_def='min', n_best=
         list of best models, with best first
 
     """
-    import pickle
+    import sqlite3
     import pandas as pd
+    from behavenet.fitting.registry import ExperimentRegistry
+    from behavenet.fitting.registry import read_best_measures
     # gather all versions
     versions = get_subdirs(expt_dir)
-    # load csv files with model metrics (saved out from test tube)
+    # get best measure of each completed version (cached in the experiment registry)
+    try:
+        best_measures = ExperimentRegistry(expt_dir).get_best_measures(
+            versions, measure, best_def)
+    except (sqlite3.Error, OSError) as e:
+        print('could not use experiment registry (%s); reading all versions' % e)
+        best_measures = read_best_measures(expt_dir, versions, measure, best_def)
     metrics = []
     for i, version in enumerate(versions):
-        # make sure training has been completed
-        meta_file = os.path.join(expt_dir, version, 'meta_tags.pkl')
-        if not os.path.exists(meta_file):
-            continue
-        with open(meta_file, 'rb') as f:
-            meta_tags = pickle.load(f)
-        if not meta_tags['training_completed']:
+        if version not in best_measures:
             continue
-        # read metrics csv file
-        metric = pd.read_csv(os.path.join(expt_dir, version, 'metrics.csv'))
-
-        # get validation loss of best model
-        if best_def == 'min':
-            val_loss = metric[measure].min()
-        elif best_def == 'max':
-            val_loss = metric[measure].max()
-        metrics.append(pd.DataFrame({'loss': val_loss, 'version': version}, index=[i]))
+        metrics.append(
+            pd.DataFrame({'loss': best_measures[version], 'version': version}, index=[i]))
     # put everything in pandas dataframe
     metrics_df = pd.concat(metrics, sort=False)
     # get version with smallest loss
@@ -932,6 +1104,49 @@ def get_best_model_version(expt_dir, measure='val_loss', best_def='min', n_best=
     return best_versions
 
 
+def get_model_class(model_class):
+    """Get the model class that is fit for a given :obj:`model_class` hyperparameter.
+
+    Parameters
+    ----------
+    model_class : :obj:`str`
+        e.g. 'ae' | 'vae' | 'neural-ae'; see :func:`get_best_model_and_data` for all options
+
+    Returns
+    -------
+    :obj:`behavenet.models` class
+
+    """
+    if model_class == 'ae':
+        from behavenet.models import AE as Model
+    elif model_class == 'vae':
+        from behavenet.models import VAE as Model
+    elif model_class == 'cond-ae':
+        from behavenet.models import ConditionalAE as Model
+    elif model_class == 'cond-vae':
+        from behavenet.models import ConditionalVAE as Model
+    elif model_class == 'cond-ae-msp':
+        from behavenet.models import AEMSP as Model
+    elif model_class == 'beta-tcvae':
+        from behavenet.models import BetaTCVAE as Model
+    elif model_class == 'ps-vae':
+        from behavenet.models import PSVAE as Model
+    elif model_class == 'labels-images':
+        from behavenet.models import ConvDecoder as Model
+    elif model_class == 'neural-ae' or model_class == 'neural-ae-me' \
+            or model_class == 'neural-arhmm' \
+            or model_class == 'neural-labels':
+        from behavenet.models import Decoder as Model
+    elif model_class == 'ae-neural' or model_class == 'arhmm-neural' \
+            or model_class == 'labels-neural':
+        from behavenet.models import Decoder as Model
+    elif model_class == 'arhmm':
+        raise NotImplementedError('Cannot use get_best_model_and_data() for ssm models')
+    else:
+        raise NotImplementedError
+    return Model
+
+
 def get_best_model_and_data(hparams, Model=None, load_data=True, version='best', data_kwargs=None):
     """Load the best model (and data) defined by hparams out of all available test-tube versions.
 
@@ -1014,34 +1229,7 @@ def get_best_model_and_data(hparams, Model=None, load_data=True, version='best',
 
     # build model
     if Model is None:
-        if hparams['model_class'] == 'ae':
-            from behavenet.models import AE as Model
-        elif hparams['model_class'] == 'vae':
-            from behavenet.models import VAE as Model
-        elif hparams['model_class'] == 'cond-ae':
-            from behavenet.models import ConditionalAE as Model
-        elif hparams['model_class'] == 'cond-vae':
-            from behavenet.models import ConditionalVAE as Model
-        elif hparams['model_class'] == 'cond-ae-msp':
-            from behavenet.models import AEMSP as Model
-        elif hparams['model_class'] == 'beta-tcvae':
-            from behavenet.models import BetaTCVAE as Model
-        elif hparams['model_class'] == 'ps-vae':
-            from behavenet.models import PSVAE as Model
-        elif hparams['model_class'] == 'labels-images':
-            from behavenet.models import ConvDecoder as Model
-        elif hparams['model_class'] == 'neural-ae' or hparams['model_class'] == 'neural-ae-me' \
-                or hparams['model_class'] == 'neural-arhmm' \
-                or hparams['model_class'] == 'neural-labels':
-            from behavenet.models import Decoder as Model
-        elif hparams['model_class'] == 'ae-neural' or hparams['model_class'] == 'arhmm-neural' \
-                or hparams['model_class'] == 'labels-neural':
-            from behavenet.models import Decoder as Model
-        elif hparams['model_class'] == 'arhmm':
-            raise NotImplementedError('Cannot use get_best_model_and_data() for ssm models')
-        else:
-            raise NotImplementedError
-
+        Model = get_model_class(hparams['model_class'])
     model = Model(hparams_new)
     model.version = int(best_version.split('_')[1])
     model.load_state_dict(torch.load(model_file, map_location=lambda storage, loc: storage))
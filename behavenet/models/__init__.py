@@ -1,4 +1,4 @@
 from behavenet.models.aes import AE, ConditionalAE, AEMSP
 from behavenet.models.base import CustomDataParallel
-from behavenet.models.decoders import Decoder, ConvDecoder
+from behavenet.models.decoders import Decoder, DecoderStack, ConvDecoder
 from behavenet.models.vaes import VAE, ConditionalVAE, BetaTCVAE, PSVAE
@@ -5,9 +5,14 @@ from behavenet.models import AE
 
 
 def draw_archs(
-        batch_size, input_dim, n_ae_latents, n_archs=100, check_memory=True, mem_limit_gb=5.0):
+        batch_size, input_dim, n_ae_latents, n_archs=100, check_memory=True, mem_limit_gb=5.0,
+        cost_budget=None, sort_by=None):
     """Generate multiple random autoencoder architectures with a fixed number of latents.
 
+    Candidates can be checked against a compute/memory budget with the analytical estimates of
+    :func:`estimate_arch_cost` before any model is built; candidates over budget are skipped
+    without counting towards :obj:`n_archs`.
+
     Parameters
     ----------
     batch_size : :obj:`int`
@@ -23,6 +28,12 @@ def draw_archs(
         threshold
     mem_limit_gb : :obj:`float`, optional
         memory threshold in GB
+    cost_budget : :obj:`dict` or :obj:`NoneType`, optional
+        maximum value of any of the costs returned by :func:`estimate_arch_cost` (computed with
+        :obj:`batch_size`), e.g. :obj:`{'flops': 2e9, 'train_bytes': 4e9}`
+    sort_by : :obj:`str` or :obj:`NoneType`, optional
+        key of the costs returned by :func:`estimate_arch_cost`; architectures are returned in
+        increasing order of this cost. :obj:`NoneType` to return them in the order generated
 
     Returns
     -------
@@ -31,12 +42,26 @@ def draw_archs(
 
     """
 
+    def _get_cost(arch):
+        return estimate_arch_cost(arch, batch_size=batch_size)
+
     all_archs = []
     arch_trial_num = 0
     while len(all_archs) < n_archs:
 
+        if cost_budget is not None and arch_trial_num >= 1000 * n_archs:
+            raise ValueError(
+                'Found %i of %i architectures within the cost budget after %i trials' % (
+                    len(all_archs), n_archs, arch_trial_num))
+
         new_arch = get_possible_arch(input_dim, n_ae_latents, arch_seed=arch_trial_num)
         arch_trial_num += 1
+
+        # Check analytical costs, before building the model
+        if cost_budget is not None:
+            cost = _get_cost(new_arch)
+            if any(cost[key] > val for key, val in cost_budget.items()):
+                continue
         # Check max memory, keep if smaller than limit, print if rejecting
         if check_memory:
             copied_arch = copy.deepcopy(new_arch)
@@ -64,6 +89,9 @@ def draw_archs(
         if matching == 0:
             all_archs.append(new_arch)
 
+    if sort_by is not None:
+        all_archs = sorted(all_archs, key=lambda arch: _get_cost(arch)[sort_by])
+
     return all_archs
 
 
@@ -479,6 +507,361 @@ def estimate_model_footprint(model, input_dim, cutoff_size=20):
     return curr_bytes * 1.2  # safety blanket
 
 
+def estimate_arch_cost(
+        arch, batch_size=1, bytes_per_value=4, flops_per_s=1e12, bytes_per_s=2e11):
+    """Estimate the compute and memory cost of an autoencoder architecture without building it.
+
+    Costs are computed analytically from the layers that :class:`behavenet.models.aes.AE` builds
+    from the architecture dict (convolutions, transposed convolutions, batch norm, pooling,
+    nonlinearities and linear layers to and from the latents); session-specific io layers and
+    conditional inputs are not counted.
+
+    FLOPs count one multiply-add as two operations; the backward pass is assumed to cost twice
+    the forward pass. The output of each layer is assumed to be stored for the backward pass,
+    which holds a gradient of the same size. Training memory includes the parameters, their
+    gradients and two Adam moments. The latency of each layer is the larger of its compute time
+    and the time needed to read its input and write its output (roofline model), given the
+    throughput :obj:`flops_per_s` and memory bandwidth :obj:`bytes_per_s` of the device; the
+    defaults are the order of magnitude of a recent gpu running fp32 convolutions.
+
+    Parameters
+    ----------
+    arch : :obj:`dict`
+        architecture dict, e.g. from :func:`draw_archs` or :func:`load_handcrafted_arch`
+    batch_size : :obj:`int`, optional
+        number of frames pushed through the model at once (memory estimates)
+    bytes_per_value : :obj:`int`, optional
+        4 for float32, 2 for float16
+    flops_per_s : :obj:`float`, optional
+        device throughput in floating point operations per second (latency estimates)
+    bytes_per_s : :obj:`float`, optional
+        device memory bandwidth in bytes per second (latency estimates)
+
+    Returns
+    -------
+    :obj:`dict`
+        - 'n_params' (:obj:`int`): number of parameters
+        - 'flops' (:obj:`int`): FLOPs of a forward pass, per frame
+        - 'flops_train' (:obj:`int`): FLOPs of a forward and backward pass, per frame
+        - 'activation_bytes' (:obj:`int`): layer outputs stored for the backward pass, per frame
+        - 'peak_activation_bytes' (:obj:`int`): largest input plus output of a single layer, per
+          frame; the working memory of a forward pass without gradients
+        - 'train_bytes' (:obj:`int`): memory of a training step on :obj:`batch_size` frames
+        - 'inference_bytes' (:obj:`int`): memory of a forward pass on :obj:`batch_size` frames
+        - 'latency_ms' (:obj:`float`): forward pass time per frame
+        - 'train_latency_ms' (:obj:`float`): forward and backward pass time per frame
+
+    """
+
+    layers = []  # (macs, n_params, input size, output size) for each layer
+
+    def _add(macs, n_params, size_in, size_out):
+        layers.append((int(macs), int(n_params), int(size_in), int(size_out)))
+
+    def _add_activations(size, batch_norm, n_channels):
+        if batch_norm:
+            _add(size, 2 * n_channels, size, size)
+        _add(0, 0, size, size)
+
+    batch_norm = bool(arch.get('ae_batch_norm', False))
+    variational = arch.get('variational', False) or arch.get('model_class', 'ae') in [
+        'vae', 'beta-tcvae', 'ps-vae', 'cond-vae']
+    n_latents = arch['n_ae_latents']
+
+    # encoder
+    c_in, y_in, x_in = arch['ae_input_dim']
+    layer_types = arch['ae_encoding_layer_type']
+    for i_layer, layer_type in enumerate(layer_types):
+        c_out = arch['ae_encoding_n_channels'][i_layer]
+        y_out = arch['ae_encoding_y_dim'][i_layer]
+        x_out = arch['ae_encoding_x_dim'][i_layer]
+        size_in = c_in * y_in * x_in
+        size_out = c_out * y_out * x_out
+        if layer_type == 'conv':
+            k = arch['ae_encoding_kernel_size'][i_layer]
+            _add(size_out * c_in * k * k, c_out * (c_in * k * k + 1), size_in, size_out)
+            if batch_norm:
+                _add(size_out, 2 * c_out, size_out, size_out)
+            if i_layer == len(layer_types) - 1 or layer_types[i_layer + 1] != 'maxpool':
+                _add(0, 0, size_out, size_out)  # leaky relu
+        elif layer_type == 'maxpool':
+            # pooling indices are stored as int64
+            _add(0, 0, size_in, size_out + size_out * 8 / bytes_per_value)
+            _add(0, 0, size_out, size_out)  # leaky relu
+        c_in, y_in, x_in = c_out, y_out, x_out
+    size_in = c_in * y_in * x_in
+    n_ff = 2 if variational else 1
+    _add(n_ff * size_in * n_latents, n_ff * (size_in + 1) * n_latents, size_in, n_ff * n_latents)
+
+    # decoder
+    c_in, y_in, x_in = arch['ae_decoding_starting_dim']
+    size_in = c_in * y_in * x_in
+    _add(n_latents * size_in, (n_latents + 1) * size_in, n_latents, size_in)
+    layer_types = arch['ae_decoding_layer_type']
+    last_ff = arch.get('ae_decoding_last_FF_layer', False)
+    for i_layer, layer_type in enumerate(layer_types):
+        y_out = arch['ae_decoding_y_dim'][i_layer]
+        x_out = arch['ae_decoding_x_dim'][i_layer]
+        size_in = c_in * y_in * x_in
+        if layer_type == 'unpool':
+            c_out = c_in
+            _add(0, 0, size_in, c_out * y_out * x_out)
+        elif layer_type == 'convtranspose':
+            c_out = arch['ae_decoding_n_channels'][i_layer]
+            k = arch['ae_decoding_kernel_size'][i_layer]
+            size_out = c_out * y_out * x_out
+            _add(size_in * c_out * k * k, c_out * (c_in * k * k + 1), size_in, size_out)
+            if i_layer == len(layer_types) - 1 and not last_ff:
+                _add(0, 0, size_out, size_out)  # sigmoid
+            else:
+                if batch_norm:
+                    _add(size_out, 2 * c_out, size_out, size_out)
+                _add(0, 0, size_out, size_out)  # leaky relu
+        c_in, y_in, x_in = c_out, y_out, x_out
+    if last_ff:
+        size_in = c_in * y_in * x_in
+        size_out = int(np.prod(arch['ae_input_dim']))
+        _add(size_in * size_out, (size_in + 1) * size_out, size_in, size_out)
+        _add(0, 0, size_out, size_out)  # sigmoid
+
+    macs, n_params, sizes_in, sizes_out = [np.array(v, dtype='float64') for v in zip(*layers)]
+    input_size = np.prod(arch['ae_input_dim'])
+    param_bytes = np.sum(n_params) * bytes_per_value
+    activation_bytes = np.sum(sizes_out) * bytes_per_value
+    peak_activation_bytes = np.max(sizes_in + sizes_out) * bytes_per_value
+
+    # roofline model per layer; parameters are read once per batch
+    layer_bytes = (sizes_in + sizes_out + n_params / batch_size) * bytes_per_value
+    latency = np.sum(np.maximum(2 * macs / flops_per_s, layer_bytes / bytes_per_s))
+    # backward pass: twice the compute, reads stored outputs and writes gradients
+    latency_train = latency + np.sum(np.maximum(
+        4 * macs / flops_per_s, 2 * layer_bytes / bytes_per_s))
+
+    return {
+        'n_params': int(np.sum(n_params)),
+        'flops': int(2 * np.sum(macs)),
+        'flops_train': int(6 * np.sum(macs)),
+        'activation_bytes': int(activation_bytes),
+        'peak_activation_bytes': int(peak_activation_bytes),
+        'train_bytes': int(
+            4 * param_bytes + batch_size * (input_size * bytes_per_value + 2 * activation_bytes)),
+        'inference_bytes': int(param_bytes + batch_size * peak_activation_bytes),
+        'latency_ms': float(latency * 1e3),
+        'train_latency_ms': float(latency_train * 1e3)}
+
+
+def benchmark_archs(
+        archs, batch_size, n_steps=10, device=None, throughput_budget=None, sort_by=None,
+        save_file=None):
+    """Measure the throughput and peak memory of autoencoder architectures on this machine.
+
+    Each architecture is instantiated as an :class:`behavenet.models.aes.AE` and fed synthetic
+    frames of dimension :obj:`arch['ae_input_dim']`. A training step (forward pass, mse loss,
+    backward pass and Adam update) and an eval-mode forward pass without gradients are each timed
+    over :obj:`n_steps` repeats, after one warm-up step; the median time is converted to frames
+    per second.
+
+    On gpu, peak memory is read from the allocator. On cpu, training memory is the size of the
+    tensors saved for the backward pass plus the parameters, gradients and optimizer state, and
+    inference memory is the largest input plus output of a single layer plus the parameters (as
+    in :func:`behavenet.fitting.autotune.measure_inference_footprint`). Architectures that do
+    not fit on the device have zero throughput and infinite peak memory.
+
+    The analytical estimates of :func:`estimate_arch_cost` ('n_params', 'flops') are included
+    for comparison.
+
+    Parameters
+    ----------
+    archs : :obj:`list` of :obj:`dict`
+        architecture dicts, e.g. from :func:`draw_archs` or :func:`load_handcrafted_arches`
+    batch_size : :obj:`int`
+        number of frames per step
+    n_steps : :obj:`int`, optional
+        number of timed steps per architecture
+    device : :obj:`str` or :obj:`NoneType`, optional
+        'cpu' | 'cuda'; :obj:`NoneType` to use the gpu if available
+    throughput_budget : :obj:`dict` or :obj:`NoneType`, optional
+        minimum value of any of the measured throughputs, e.g.
+        :obj:`{'train_frames_per_s': 500}`; architectures below budget are marked in the
+        'within_budget' column
+    sort_by : :obj:`str` or :obj:`NoneType`, optional
+        column used to rank architectures, in decreasing order for throughputs and increasing
+        order otherwise; defaults to 'train_frames_per_s'
+    save_file : :obj:`str` or :obj:`NoneType`, optional
+        save the ranked table as a csv file
+
+    Returns
+    -------
+    :obj:`pd.DataFrame`
+        one row per architecture, ranked; the 'arch' column indexes into :obj:`archs`
+
+    """
+
+    import pandas as pd
+    import torch
+
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if sort_by is None:
+        sort_by = 'train_frames_per_s'
+
+    rows = []
+    for a, arch in enumerate(archs):
+        cost = estimate_arch_cost(arch, batch_size=batch_size)
+        row = {
+            'arch': a,
+            'ae_network_type': arch['ae_network_type'],
+            'n_ae_latents': arch['n_ae_latents'],
+            'n_params': cost['n_params'],
+            'flops': cost['flops']}
+        row.update(_benchmark_arch(arch, batch_size, n_steps, device))
+        rows.append(row)
+        torch.cuda.empty_cache()
+
+    results = pd.DataFrame(rows)
+    if throughput_budget is not None:
+        results['within_budget'] = np.all(
+            [results[key] >= val for key, val in throughput_budget.items()], axis=0)
+    results = results.sort_values(
+        sort_by, ascending=not sort_by.endswith('frames_per_s'), kind='stable')
+    results.insert(0, 'rank', np.arange(len(results)))
+    results = results.reset_index(drop=True)
+
+    if save_file is not None:
+        results.to_csv(save_file, index=False)
+
+    return results
+
+
+def _benchmark_arch(arch, batch_size, n_steps, device):
+    """Time training and inference steps of a single architecture on synthetic frames."""
+
+    import torch
+
+    hparams = copy.deepcopy(arch)
+    input_dim = list(arch['ae_input_dim'])
+    hparams.update({
+        'model_class': 'ae', 'n_input_channels': input_dim[0], 'y_pixels': input_dim[1],
+        'x_pixels': input_dim[2], 'device': device})
+
+    results = {
+        'train_frames_per_s': 0.0, 'inference_frames_per_s': 0.0,
+        'train_peak_bytes': np.inf, 'inference_peak_bytes': np.inf}
+    model = None
+    try:
+        torch.manual_seed(0)
+        model = AE(hparams).to(device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+        x = torch.rand([batch_size] + input_dim, device=device)
+
+        def train_step():
+            optimizer.zero_grad()
+            y = model(x)[0]
+            torch.mean((y - x) ** 2).backward()
+            optimizer.step()
+
+        def inference_step():
+            with torch.no_grad():
+                model(x)
+
+        model.train()
+        results['train_frames_per_s'] = _time_frames_per_s(train_step, batch_size, n_steps)
+        results['train_peak_bytes'] = _measure_peak_bytes(model, x, optimizer, train=True)
+        model.eval()
+        results['inference_frames_per_s'] = _time_frames_per_s(
+            inference_step, batch_size, n_steps)
+        results['inference_peak_bytes'] = _measure_peak_bytes(model, x, optimizer, train=False)
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise e
+    finally:
+        del model
+
+    return results
+
+
+def _time_frames_per_s(fn, n_frames, n_steps):
+    """Median number of frames per second over repeated calls of `fn`, after one warm-up call."""
+
+    import time
+    import torch
+
+    fn()
+    times = []
+    for _ in range(n_steps):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t_beg = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - t_beg)
+    return float(n_frames / np.median(times))
+
+
+def _measure_peak_bytes(model, x, optimizer, train=True):
+    """Peak memory of a training step (`train=True`) or of a forward pass without gradients."""
+
+    import torch
+
+    def _n_bytes(tensors):
+        if isinstance(tensors, torch.Tensor):
+            return tensors.element_size() * tensors.nelement()
+        elif isinstance(tensors, (list, tuple)):
+            return sum([_n_bytes(t) for t in tensors])
+        return 0
+
+    if x.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        optimizer.zero_grad()
+        if train:
+            torch.mean((model(x)[0] - x) ** 2).backward()
+            optimizer.step()
+        else:
+            with torch.no_grad():
+                model(x)
+        torch.cuda.synchronize()
+        return int(torch.cuda.max_memory_allocated())
+
+    params = list(model.parameters())
+    param_bytes = _n_bytes(params)
+
+    if train:
+        # tensors saved for the backward pass, counting shared storage once
+        param_ptrs = set([p.data_ptr() for p in params] + [x.data_ptr()])
+        saved = {}
+
+        def _pack(tensor):
+            if tensor.data_ptr() not in param_ptrs:
+                saved[tensor.data_ptr()] = max(saved.get(tensor.data_ptr(), 0), _n_bytes(tensor))
+            return tensor
+
+        optimizer.zero_grad()
+        with torch.autograd.graph.saved_tensors_hooks(_pack, lambda tensor: tensor):
+            loss = torch.mean((model(x)[0] - x) ** 2)
+        loss.backward()
+        optimizer.step()
+        state_bytes = sum([
+            _n_bytes(list(state.values())) for state in optimizer.state.values()])
+        return int(_n_bytes(x) + sum(saved.values()) + 2 * param_bytes + state_bytes)
+
+    peak = [0]
+
+    def _hook(module, inputs, outputs):
+        peak[0] = max(peak[0], _n_bytes(inputs) + _n_bytes(outputs))
+
+    handles = [
+        m.register_forward_hook(_hook) for m in model.modules() if len(list(m.children())) == 0]
+    try:
+        with torch.no_grad():
+            model(x)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return int(peak[0] + param_bytes)
+
+
 def get_handcrafted_dims(arch, symmetric=True):
     """Compute input/output dims as well as necessary padding for handcrafted architectures.
 
@@ -1,17 +1,35 @@
 """Autoencoder models implemented in PyTorch."""
 
 import numpy as np
-from sklearn.metrics import r2_score
 import torch
 from torch import nn
 import torch.nn.functional as functional
 import behavenet.fitting.losses as losses
-from behavenet.models.base import BaseModule, BaseModel
+from behavenet.tracing import trace_span
+from behavenet.models.base import BaseModule, BaseModel, SessionIOLayers, slice_dataset
 
 # to ignore imports for sphix-autoapidoc
 __all__ = [
     'ConvAEEncoder', 'ConvAEDecoder', 'LinearAEEncoder', 'LinearAEDecoder', 'AE', 'ConditionalAE',
-    'AEMSP', 'load_pretrained_ae']
+    'AEMSP', 'load_pretrained_ae', 'optimize_for_inference']
+
+# kinds of layers in convolutional encoders/decoders that need special handling in forward passes
+_LAYER, _POOL, _UNPOOL, _SESS_IO, _CONV_T, _LINEAR = range(6)
+
+
+def _get_layer_kind(layer):
+    if isinstance(layer, nn.MaxPool2d):
+        return _POOL
+    elif isinstance(layer, nn.MaxUnpool2d):
+        return _UNPOOL
+    elif isinstance(layer, SessionIOLayers):
+        return _SESS_IO
+    elif isinstance(layer, nn.ConvTranspose2d):
+        return _CONV_T
+    elif isinstance(layer, nn.Linear):
+        return _LINEAR
+    else:
+        return _LAYER
 
 
 class ConvAEEncoder(BaseModule):
@@ -34,11 +52,13 @@ class ConvAEEncoder(BaseModule):
             - 'ae_encoding_x_padding' (:obj:`list`)
             - 'ae_encoding_y_padding' (:obj:`list`)
             - 'ae_encoding_layer_type' (:obj:`list`)
+            - 'ae_channels_last' (:obj:`bool`, optional): use the channels-last memory format
 
         """
         super().__init__()
         self.hparams = hparams
         self.encoder = None
+        self.channels_last = hparams.get('ae_channels_last', False)
         self.build_model()
 
     def __str__(self):
@@ -67,7 +87,7 @@ class ConvAEEncoder(BaseModule):
                 # convolution layer
                 args = self._get_conv2d_args(i_layer, global_layer_num)
                 if self.hparams.get('fit_sess_io_layers', False) and i_layer == 0:
-                    module = nn.ModuleList([
+                    module = SessionIOLayers([
                         nn.Conv2d(
                             in_channels=args['in_channels'],
                             out_channels=args['out_channels'],
@@ -124,6 +144,14 @@ class ConvAEEncoder(BaseModule):
         if self.hparams.get('variational', False):
             self.logvar = nn.Linear(last_conv_size, self.hparams['n_ae_latents'])
 
+        self._resolve_layers()
+        if self.channels_last:
+            self.to(memory_format=torch.channels_last)
+
+    def _resolve_layers(self):
+        """Find the kind of each layer once, rather than on every forward pass."""
+        self._layer_kinds = tuple(_get_layer_kind(layer) for layer in self.encoder)
+
     def _get_conv2d_args(self, layer, global_layer):
 
         if layer == 0:
@@ -185,8 +213,8 @@ class ConvAEEncoder(BaseModule):
         ----------
         x : :obj:`torch.Tensor` object
             input data
-        dataset : :obj:`int`
-            used with session-specific io layers
+        dataset : :obj:`int` or :obj:`torch.Tensor`
+            used with session-specific io layers; a tensor of per-frame datasets mixes sessions
 
         Returns
         -------
@@ -198,20 +226,22 @@ class ConvAEEncoder(BaseModule):
         """
         # loop over layers, have to collect pool_idx and output sizes if using max pooling to use
         # in unpooling
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         pool_idx = []
         target_output_size = []
-        for layer in self.encoder:
-            if isinstance(layer, nn.MaxPool2d):
+        for kind, layer in zip(self._layer_kinds, self.encoder):
+            if kind == _POOL:
                 target_output_size.append(x.size())
                 x, idx = layer(x)
                 pool_idx.append(idx)
-            elif isinstance(layer, nn.ModuleList):
-                x = layer[dataset](x)
+            elif kind == _SESS_IO:
+                x = layer(x, dataset)
             else:
                 x = layer(x)
 
         # reshape for ff layer
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         if self.hparams.get('variational', False):
             return self.FF(x), self.logvar(x), pool_idx, target_output_size
         else:
@@ -240,11 +270,13 @@ class ConvAEDecoder(BaseModule):
             - 'ae_decoding_layer_type' (:obj:`list`)
             - 'ae_decoding_starting_dim' (:obj:`list`)
             - 'ae_decoding_last_FF_layer' (:obj:`bool`)
+            - 'ae_channels_last' (:obj:`bool`, optional): use the channels-last memory format
 
         """
         super().__init__()
         self.hparams = hparams
         self.decoder = None
+        self.channels_last = hparams.get('ae_channels_last', False)
         self.build_model()
 
     def __str__(self):
@@ -298,7 +330,7 @@ class ConvAEDecoder(BaseModule):
                 if self.hparams.get('fit_sess_io_layers', False) \
                         and i_layer == (len(self.hparams['ae_decoding_n_channels']) - 1) \
                         and not self.hparams['ae_decoding_last_FF_layer']:
-                    module = nn.ModuleList([
+                    module = SessionIOLayers([
                         nn.ConvTranspose2d(
                             in_channels=args['in_channels'],
                             out_channels=args['out_channels'],
@@ -358,6 +390,24 @@ class ConvAEDecoder(BaseModule):
             self.decoder.add_module(
                 str('sigmoid%i' % global_layer_num), nn.Sigmoid())
 
+        self._resolve_layers()
+        if self.channels_last:
+            self.to(memory_format=torch.channels_last)
+
+    def _resolve_layers(self):
+        """Find the kind of each layer, and the cropping that follows it, once rather than on
+        every forward pass."""
+        self._layer_kinds = []
+        for name, layer in self.decoder.named_children():
+            pads = self.conv_t_pads.get(name, None)
+            # asymmetric padding for convtranspose layer if necessary (-i does cropping!)
+            crop = None if pads is None else [-int(i) for i in pads]
+            self._layer_kinds.append((_get_layer_kind(layer), crop))
+        self._layer_kinds = tuple(self._layer_kinds)
+        # python ints; dims in hparams may be numpy ints
+        self._starting_dim = tuple(int(d) for d in self.hparams['ae_decoding_starting_dim'])
+        self._output_dim = tuple(int(d) for d in self.hparams['ae_input_dim'])
+
     def _get_convtranspose2d_args(self, layer, global_layer):
 
         # input channels
@@ -440,8 +490,8 @@ class ConvAEDecoder(BaseModule):
             max pooling indices from encoder for unpooling
         target_output_size : :obj:`list`
             layer-specific output sizes from encoder for unpooling
-        dataset : :obj:`int`
-            used with session-specific io layers
+        dataset : :obj:`int` or :obj:`torch.Tensor`
+            used with session-specific io layers; a tensor of per-frame datasets mixes sessions
 
         Returns
         -------
@@ -451,37 +501,27 @@ class ConvAEDecoder(BaseModule):
         """
         # First ff layer/resize to be convolutional input
         x = self.FF(x)
-        x = x.view(
-            x.size(0),
-            self.hparams['ae_decoding_starting_dim'][0],
-            self.hparams['ae_decoding_starting_dim'][1],
-            self.hparams['ae_decoding_starting_dim'][2])
+        x = x.view(x.size(0), *self._starting_dim)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
 
-        for name, layer in self.decoder.named_children():
-            if isinstance(layer, nn.MaxUnpool2d):
+        for (kind, crop), layer in zip(self._layer_kinds, self.decoder):
+            if kind == _UNPOOL:
                 idx = pool_idx.pop(-1)
                 outsize = target_output_size.pop(-1)
                 x = layer(x, idx, outsize)
-            elif isinstance(layer, nn.ConvTranspose2d):
+            elif kind == _CONV_T:
                 x = layer(x)
-                if self.conv_t_pads[name] is not None:
-                    # asymmetric padding for convtranspose layer if necessary
-                    # (-i does cropping!)
-                    x = functional.pad(x, [-i for i in self.conv_t_pads[name]])
-            elif isinstance(layer, nn.ModuleList):
-                x = layer[dataset](x)
-                if self.conv_t_pads[name] is not None:
-                    # asymmetric padding for convtranspose layer if necessary
-                    # (-i does cropping!)
-                    x = functional.pad(x, [-i for i in self.conv_t_pads[name]])
-            elif isinstance(layer, nn.Linear):
-                x = x.view(x.shape[0], -1)
+                if crop is not None:
+                    x = functional.pad(x, crop)
+            elif kind == _SESS_IO:
+                x = layer(x, dataset)
+                if crop is not None:
+                    x = functional.pad(x, crop)
+            elif kind == _LINEAR:
+                x = x.reshape(x.shape[0], -1)
                 x = layer(x)
-                x = x.view(
-                    -1,
-                    self.hparams['ae_input_dim'][0],
-                    self.hparams['ae_input_dim'][1],
-                    self.hparams['ae_input_dim'][2])
+                x = x.view(-1, *self._output_dim)
             else:
                 x = layer(x)
 
@@ -730,8 +770,9 @@ class AE(BaseModel):
         ----------
         data : :obj:`dict`
             batch of data; keys should include 'images' and 'masks', if necessary
-        dataset : :obj:`int`, optional
-            used for session-specific io layers
+        dataset : :obj:`int` or :obj:`torch.Tensor`, optional
+            used for session-specific io layers; a tensor of shape (n_frames,) holds the dataset
+            of each frame in a batch that mixes sessions
         accumulate_grad : :obj:`bool`, optional
             accumulate gradient for training step
         chunk_size : :obj:`int`, optional
@@ -753,20 +794,23 @@ class AE(BaseModel):
         loss_val = 0
         for chunk in range(n_chunks):
 
-            idx_beg = chunk * chunk_size
-            idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
+            with trace_span('loss_chunk', 'model', chunk=int(chunk)):
+                idx_beg = chunk * chunk_size
+                idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
 
-            x_in = x[idx_beg:idx_end]
-            m_in = m[idx_beg:idx_end] if m is not None else None
-            x_hat, _ = self.forward(x_in, dataset=dataset)
+                x_in = x[idx_beg:idx_end]
+                m_in = m[idx_beg:idx_end] if m is not None else None
+                dataset_in = slice_dataset(dataset, idx_beg, idx_end)
+                x_hat, _ = self.forward(x_in, dataset=dataset_in)
 
-            loss = losses.mse(x_in, x_hat, m_in)
+                loss = losses.mse(x_in, x_hat, m_in)
 
-            if accumulate_grad:
-                loss.backward()
+                if accumulate_grad:
+                    with trace_span('backward', 'model'):
+                        loss.backward()
 
-            # get loss value (weighted by batch size)
-            loss_val += loss.item() * (idx_end - idx_beg)
+                # get loss value (weighted by batch size)
+                loss_val += loss.item() * (idx_end - idx_beg)
 
         loss_val /= batch_size
 
@@ -876,22 +920,25 @@ class ConditionalAE(AE):
         loss_val = 0
         for chunk in range(n_chunks):
 
-            idx_beg = chunk * chunk_size
-            idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
+            with trace_span('loss_chunk', 'model', chunk=int(chunk)):
+                idx_beg = chunk * chunk_size
+                idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
 
-            x_in = x[idx_beg:idx_end]
-            y_in = y[idx_beg:idx_end]
-            m_in = m[idx_beg:idx_end] if m is not None else None
-            y_2d_in = y_2d[idx_beg:idx_end] if y_2d is not None else None
-            x_hat, _ = self.forward(x_in, labels=y_in, labels_2d=y_2d_in, dataset=dataset)
+                x_in = x[idx_beg:idx_end]
+                y_in = y[idx_beg:idx_end]
+                m_in = m[idx_beg:idx_end] if m is not None else None
+                y_2d_in = y_2d[idx_beg:idx_end] if y_2d is not None else None
+                dataset_in = slice_dataset(dataset, idx_beg, idx_end)
+                x_hat, _ = self.forward(x_in, labels=y_in, labels_2d=y_2d_in, dataset=dataset_in)
 
-            loss = losses.mse(x_in, x_hat, m_in)
+                loss = losses.mse(x_in, x_hat, m_in)
 
-            if accumulate_grad:
-                loss.backward()
+                if accumulate_grad:
+                    with trace_span('backward', 'model'):
+                        loss.backward()
 
-            # get loss value (weighted by batch size)
-            loss_val += loss.item() * (idx_end - idx_beg)
+                # get loss value (weighted by batch size)
+                loss_val += loss.item() * (idx_end - idx_beg)
 
         loss_val /= batch_size
 
@@ -1017,34 +1064,37 @@ class AEMSP(AE):
         y_hat_all = []
         for chunk in range(n_chunks):
 
-            idx_beg = chunk * chunk_size
-            idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
+            with trace_span('loss_chunk', 'model', chunk=int(chunk)):
+                idx_beg = chunk * chunk_size
+                idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
 
-            x_in = x[idx_beg:idx_end]
-            y_in = y[idx_beg:idx_end]
-            m_in = m[idx_beg:idx_end] if m is not None else None
-            x_hat, z, y_hat = self.forward(x_in, dataset=dataset)
+                x_in = x[idx_beg:idx_end]
+                y_in = y[idx_beg:idx_end]
+                m_in = m[idx_beg:idx_end] if m is not None else None
+                dataset_in = slice_dataset(dataset, idx_beg, idx_end)
+                x_hat, z, y_hat = self.forward(x_in, dataset=dataset_in)
 
-            # mse loss
-            loss_mse = losses.mse(x_in, x_hat, m_in)
+                # mse loss
+                loss_mse = losses.mse(x_in, x_hat, m_in)
 
-            # msp loss
-            loss_msp = losses.mse(y_in, y_hat) + \
-                losses.mse(z, torch.matmul(y_hat, self.projection.weight))
-            # ^NOTE: transpose on projection weights implicitly performed due to layer def
+                # msp loss
+                loss_msp = losses.mse(y_in, y_hat) + \
+                    losses.mse(z, torch.matmul(y_hat, self.projection.weight))
+                # ^NOTE: transpose on projection weights implicitly performed due to layer def
 
-            # combine
-            loss = loss_mse + self.hparams['msp.alpha'] * loss_msp
+                # combine
+                loss = loss_mse + self.hparams['msp.alpha'] * loss_msp
 
-            if accumulate_grad:
-                loss.backward()
+                if accumulate_grad:
+                    with trace_span('backward', 'model'):
+                        loss.backward()
 
-            # get loss value (weighted by batch size)
-            loss_val += loss.item() * (idx_end - idx_beg)
-            loss_mse_val += loss_mse.item() * (idx_end - idx_beg)
-            loss_msp_val += loss_msp.item() * (idx_end - idx_beg)
+                # get loss value (weighted by batch size)
+                loss_val += loss.item() * (idx_end - idx_beg)
+                loss_mse_val += loss_mse.item() * (idx_end - idx_beg)
+                loss_msp_val += loss_msp.item() * (idx_end - idx_beg)
 
-            y_hat_all.append(y_hat.cpu().detach().numpy())
+                y_hat_all.append(y_hat.cpu().detach().numpy())
 
         loss_val /= batch_size
         loss_mse_val /= batch_size
@@ -1052,7 +1102,7 @@ class AEMSP(AE):
 
         # use variance-weighted r2s to ignore small-variance latents
         y_hat_all = np.concatenate(y_hat_all, axis=0)
-        r2 = r2_score(y.cpu().detach().numpy(), y_hat_all, multioutput='variance_weighted')
+        r2 = losses.r2_variance_weighted(y.cpu().detach().numpy(), y_hat_all)
 
         loss_dict = {
             'loss': loss_val, 'loss_mse': loss_mse_val, 'loss_msp': loss_msp_val, 'labels_r2': r2}
@@ -1220,6 +1270,10 @@ class AEMSP(AE):
 def load_pretrained_ae(model, hparams):
     """Load pretrained weights into already constructed AE model.
 
+    Weights of layers whose shapes differ from those of the pretrained model (e.g. the layers to
+    and from the latents when the number of latents differs) are partially loaded: the
+    overlapping block is copied, and the remaining weights keep their random initialization.
+
     Parameters
     ----------
     model : :obj:`behavenet.models.aes` object
@@ -1240,27 +1294,11 @@ def load_pretrained_ae(model, hparams):
             and hparams['pretrained_weights_path'] != '':
 
         print('Loading pretrained weights')
-        loaded_model_dict = torch.load(hparams['pretrained_weights_path'])
-
-        if loaded_model_dict['encoding.FF.weight'].shape == model.encoding.FF.weight.shape:
-            model.load_state_dict(loaded_model_dict, strict=False)
-        else:
+        loaded_model_dict = torch.load(hparams['pretrained_weights_path'], map_location='cpu')
+        partial_keys = _load_partial_state_dict(model, loaded_model_dict)
+        if len(partial_keys) > 0:
             print('PRETRAINED MODEL HAS DIFFERENT SPATIAL DIMENSIONS OR N LATENTS: ' +
-                  'NOT LOADING FF PARAMETERS')
-            del loaded_model_dict['encoding.FF.weight']
-            del loaded_model_dict['encoding.FF.bias']
-            del loaded_model_dict['decoding.FF.weight']
-            del loaded_model_dict['decoding.FF.bias']
-
-            # TODO: get rid of other latent-related parameters
-            if model.hparams['model_class'] == 'vae':
-                pass
-            elif model.hparams['model_class'] == 'beta_tcvae':
-                pass
-            elif model.hparams['model_class'] == 'sss_vae':
-                pass
-
-            model.load_state_dict(loaded_model_dict, strict=False)
+                  'PARTIALLY LOADING %s' % ', '.join(partial_keys))
 
     elif hparams['model_type'] == 'linear' \
             and hparams.get('pretrained_weights_path', False) \
@@ -1272,3 +1310,129 @@ def load_pretrained_ae(model, hparams):
         print('Initializing with random weights')
 
     return model
+
+
+def _load_partial_state_dict(model, state_dict):
+    """Load a state dict whose tensors may differ in shape from those of the model.
+
+    Tensors with the same shape are loaded as is. For tensors with a different shape (e.g. the
+    weights of the layers to and from the latents when the number of latents differs) the
+    overlapping block, starting at index 0 along each dimension, is copied into the initialized
+    tensor of the model; tensors with a different number of dimensions are not loaded.
+
+    Returns
+    -------
+    :obj:`list` of :obj:`str`
+        keys of the tensors that were not fully loaded
+
+    """
+    model_dict = model.state_dict()
+    partial_keys = []
+    for key, val in state_dict.items():
+        if key not in model_dict:
+            continue
+        curr = model_dict[key]
+        if val.shape == curr.shape:
+            model_dict[key] = val
+            continue
+        partial_keys.append(key)
+        if val.dim() == curr.dim():
+            idx = tuple([slice(0, min(n, m)) for n, m in zip(val.shape, curr.shape)])
+            model_dict[key] = curr.clone()
+            model_dict[key][idx] = val[idx].to(curr.device)
+    model.load_state_dict(model_dict)
+    return partial_keys
+
+
+def _fuse_batch_norm(layers):
+    """Fold eval-mode batch norm layers into the (transposed) convolutions that precede them."""
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+    names = list(layers._modules.keys())
+    for prev, name in zip(names[:-1], names[1:]):
+        conv, bn = layers._modules[prev], layers._modules[name]
+        if not isinstance(bn, nn.BatchNorm2d) or bn.running_mean is None:
+            # batch statistics are used in eval mode without running stats; cannot be folded
+            continue
+        if isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)):
+            fused = fuse_conv_bn_eval(conv, bn, transpose=isinstance(conv, nn.ConvTranspose2d))
+        elif isinstance(conv, SessionIOLayers):
+            fused = SessionIOLayers([
+                fuse_conv_bn_eval(ll, bn, transpose=isinstance(ll, nn.ConvTranspose2d))
+                for ll in conv])
+        else:
+            continue
+        setattr(layers, prev, fused)
+        setattr(layers, name, nn.Identity())
+
+
+def _to_python_ints(module):
+    """Cast numpy integers in layer attributes (set from arch dicts) to python integers.
+
+    :func:`torch.compile` traces numpy integers as tensors, which breaks graph capture.
+    """
+    attrs = ['kernel_size', 'stride', 'padding', 'dilation', 'output_padding']
+    for m in module.modules():
+        for attr in attrs:
+            value = getattr(m, attr, None)
+            if isinstance(value, (tuple, list)):
+                setattr(m, attr, tuple(int(v) for v in value))
+            elif isinstance(value, np.integer):
+                setattr(m, attr, int(value))
+
+
+def optimize_for_inference(
+        model, fuse_batch_norm=True, channels_last=False, compile=False, compile_kwargs=None):
+    """Create a copy of a convolutional autoencoder that runs faster in eval mode.
+
+    Batch norm layers are folded into the convolution (or transposed convolution) that precedes
+    them, which removes one pass over every activation; outputs are unchanged up to floating point
+    error. Training the returned copy is not supported.
+
+    Parameters
+    ----------
+    model : :obj:`AE` object
+        any autoencoder-based model with a convolutional encoder and/or decoder; the model itself
+        is not modified
+    fuse_batch_norm : :obj:`bool`, optional
+        :obj:`True` to fold batch norm layers into convolutions
+    channels_last : :obj:`bool`, optional
+        :obj:`True` to run convolutions in the channels-last (NHWC) memory format, which is faster
+        for many cpu and gpu kernels; inputs are converted automatically. Models trained with
+        :obj:`ae_channels_last=True` already use this format
+    compile : :obj:`bool`, optional
+        :obj:`True` to compile the encoder and decoder with :func:`torch.compile`; the first
+        forward pass (and each new input shape) triggers a compilation
+    compile_kwargs : :obj:`dict`, optional
+        additional arguments for :func:`torch.compile`, e.g. :obj:`{'mode': 'max-autotune'}`
+
+    Returns
+    -------
+    :obj:`AE` object
+        optimized copy of the model in eval mode, on the same device
+
+    """
+    import copy
+    # hparams may contain objects that cannot be copied
+    hparams = model.hparams
+    model.hparams = None
+    model_opt = copy.deepcopy(model)
+    model.hparams = hparams
+    model_opt.hparams = hparams
+    model_opt.eval()
+
+    for attr in ['encoding', 'decoding']:
+        module = getattr(model_opt, attr, None)
+        if not isinstance(module, (ConvAEEncoder, ConvAEDecoder)):
+            continue
+        layers = module.encoder if isinstance(module, ConvAEEncoder) else module.decoder
+        if fuse_batch_norm:
+            _fuse_batch_norm(layers)
+            module._resolve_layers()
+        if channels_last or module.channels_last:
+            module.channels_last = True
+            module.to(memory_format=torch.channels_last)
+        if compile:
+            _to_python_ints(module)
+            setattr(model_opt, attr, torch.compile(module, **(compile_kwargs or {})))
+
+    return model_opt
@@ -1,10 +1,14 @@
 """Base models/modules in PyTorch."""
 
 import math
+import torch
 from torch import nn, save, Tensor
+import torch.nn.functional as functional
 
 # to ignore imports for sphix-autoapidoc
-__all__ = ['BaseModule', 'BaseModel', 'DiagLinear', 'CustomDataParallel']
+__all__ = [
+    'BaseModule', 'BaseModel', 'DiagLinear', 'SessionIOLayers', 'slice_dataset',
+    'CustomDataParallel']
 
 
 class BaseModule(nn.Module):
@@ -103,6 +107,81 @@ class DiagLinear(nn.Module):
         return 'features={}, bias={}'.format(self.features, self.bias is not None)
 
 
+class SessionIOLayers(nn.ModuleList):
+    """Session-specific convolution or transposed convolution layers.
+
+    Holds one :obj:`nn.Conv2d` or :obj:`nn.ConvTranspose2d` layer per dataset. A batch drawn from
+    a single dataset is pushed through the corresponding layer; a batch that mixes frames from
+    several datasets is processed in a single grouped convolution, where each frame is its own
+    group and uses the weights of its dataset; layers of datasets absent from the batch are not
+    used, and their parameters receive no gradients.
+    """
+
+    def forward(self, x, dataset=None):
+        """Process input data.
+
+        Parameters
+        ----------
+        x : :obj:`torch.Tensor` object
+            input data of shape (n_frames, n_channels, y_pix, x_pix)
+        dataset : :obj:`int` or :obj:`torch.Tensor`
+            dataset of the whole batch, or dataset of each frame (:obj:`torch.LongTensor` of shape
+            (n_frames,))
+
+        Returns
+        -------
+        :obj:`torch.Tensor`
+            shape (n_frames, out_channels, y_pix_out, x_pix_out)
+
+        """
+        if not torch.is_tensor(dataset):
+            return self[dataset](x)
+
+        layer = self[0]
+        n_frames = x.shape[0]
+        # only stack the layers of datasets in the batch, so that the others receive no gradients
+        datasets, dataset = torch.unique(dataset, return_inverse=True)
+        datasets = datasets.tolist()
+        weight = torch.stack([self[d].weight for d in datasets])[dataset]
+        weight = weight.reshape(-1, *weight.shape[2:])
+        if layer.bias is not None:
+            bias = torch.stack([self[d].bias for d in datasets])[dataset].reshape(-1)
+        else:
+            bias = None
+        x = x.reshape(1, -1, *x.shape[2:])
+        if isinstance(layer, nn.ConvTranspose2d):
+            y = functional.conv_transpose2d(
+                x, weight, bias, stride=layer.stride, padding=layer.padding,
+                output_padding=layer.output_padding, groups=n_frames, dilation=layer.dilation)
+        else:
+            y = functional.conv2d(
+                x, weight, bias, stride=layer.stride, padding=layer.padding,
+                dilation=layer.dilation, groups=n_frames)
+        return y.reshape(n_frames, -1, *y.shape[2:])
+
+
+def slice_dataset(dataset, idx_beg, idx_end):
+    """Select the datasets of a chunk of frames.
+
+    Parameters
+    ----------
+    dataset : :obj:`int` or :obj:`torch.Tensor`
+        dataset of the whole batch, or dataset of each frame
+    idx_beg : :obj:`int`
+        first frame of chunk
+    idx_end : :obj:`int`
+        last frame of chunk (exclusive)
+
+    Returns
+    -------
+    :obj:`int` or :obj:`torch.Tensor`
+
+    """
+    if torch.is_tensor(dataset):
+        return dataset[idx_beg:idx_end]
+    return dataset
+
+
 class CustomDataParallel(nn.DataParallel):
     """Wrapper class for multi-gpu training.
 
@@ -1,14 +1,14 @@
 """Encoding/decoding models implemented in PyTorch."""
 
 import numpy as np
-from sklearn.metrics import r2_score, accuracy_score
 import torch
 from torch import nn
 import behavenet.fitting.losses as losses
+from behavenet.tracing import trace_span
 from behavenet.models.base import BaseModule, BaseModel
 
 # to ignore imports for sphix-autoapidoc
-__all__ = ['Decoder', 'MLP', 'LSTM', 'ConvDecoder']
+__all__ = ['Decoder', 'DecoderStack', 'MLP', 'LSTM', 'ConvDecoder']
 
 
 class Decoder(BaseModel):
@@ -103,55 +103,236 @@ class Decoder(BaseModel):
         loss_val = 0
         for chunk in range(n_chunks):
 
-            # take chunks of size chunk_size, plus overlap due to max_lags
-            idx_beg = np.max([chunk * chunk_size - max_lags, 0])
-            idx_end = np.min([(chunk + 1) * chunk_size + max_lags, batch_size])
+            with trace_span('loss_chunk', 'model', chunk=int(chunk)):
+                # take chunks of size chunk_size, plus overlap due to max_lags
+                idx_beg = np.max([chunk * chunk_size - max_lags, 0])
+                idx_end = np.min([(chunk + 1) * chunk_size + max_lags, batch_size])
 
-            outputs, precision = self.model(predictors[idx_beg:idx_end])
+                outputs, precision = self.model(predictors[idx_beg:idx_end])
 
-            # define loss on allowed window of data
-            if self.hparams['noise_dist'] == 'gaussian-full':
-                loss = self._loss(
-                    outputs[max_lags:-max_lags],
-                    targets[idx_beg:idx_end][max_lags:-max_lags],
-                    precision[max_lags:-max_lags])
-            else:
-                loss = self._loss(
-                    outputs[max_lags:-max_lags],
-                    targets[idx_beg:idx_end][max_lags:-max_lags])
+                # define loss on allowed window of data
+                if self.hparams['noise_dist'] == 'gaussian-full':
+                    loss = self._loss(
+                        outputs[max_lags:-max_lags],
+                        targets[idx_beg:idx_end][max_lags:-max_lags],
+                        precision[max_lags:-max_lags])
+                else:
+                    loss = self._loss(
+                        outputs[max_lags:-max_lags],
+                        targets[idx_beg:idx_end][max_lags:-max_lags])
 
-            if accumulate_grad:
-                loss.backward()
+                if accumulate_grad:
+                    with trace_span('backward', 'model'):
+                        loss.backward()
 
-            # get loss value (weighted by batch size)
-            loss_val += loss.item() * outputs[max_lags:-max_lags].shape[0]
+                # get loss value (weighted by batch size)
+                loss_val += loss.item() * outputs[max_lags:-max_lags].shape[0]
 
-            outputs_all.append(outputs[max_lags:-max_lags].cpu().detach().numpy())
+                outputs_all.append(outputs[max_lags:-max_lags].cpu().detach().numpy())
 
         loss_val /= batch_size
         outputs_all = np.concatenate(outputs_all, axis=0)
 
-        if self.hparams['noise_dist'] == 'gaussian' or \
-                self.hparams['noise_dist'] == 'gaussian-full':
-            # use variance-weighted r2s to ignore small-variance latents
-            r2 = r2_score(
-                targets[max_lags:-max_lags].cpu().detach().numpy(),
-                outputs_all,
-                multioutput='variance_weighted')
-            fc = 0
-        elif self.hparams['noise_dist'] == 'poisson':
-            raise NotImplementedError
-        elif self.hparams['noise_dist'] == 'categorical':
-            r2 = 0
-            fc = accuracy_score(
-                targets[max_lags:-max_lags].cpu().detach().numpy(),
-                np.argmax(outputs_all, axis=1))
-        else:
-            raise ValueError('"%s" is not a valid noise_dist' % self.hparams['noise_dist'])
+        r2, fc = _decoder_metrics(
+            self.hparams['noise_dist'], targets[max_lags:-max_lags].cpu().detach().numpy(),
+            outputs_all)
 
         return {'loss': loss_val, 'r2': r2, 'fc': fc}
 
 
+class DecoderStack(BaseModel):
+    """Stack of same-shaped decoders that process a shared input in a single vectorized pass.
+
+    Members are independent :class:`Decoder` models that share all architecture hparams (model
+    type, input/output sizes, number of hidden layers/units, lags, activation, noise dist) but may
+    differ in their initialization and in training hparams such as learning rate and l2
+    regularization. Each member keeps its own parameters, so that it can be optimized, saved and
+    loaded on its own; parameters are stacked on every forward pass and all members are evaluated
+    at once with :func:`torch.func.vmap`. Only MLP decoders are supported (see
+    :attr:`model_types`).
+    """
+
+    # model types that can be stacked
+    model_types = ('mlp', 'mlp-mv')
+
+    def __init__(self, members):
+        """
+
+        Parameters
+        ----------
+        members : :obj:`list` of :obj:`Decoder` objects
+            decoders with identical architectures
+
+        """
+        super().__init__()
+        self.members = nn.ModuleList(members)
+        self.hparams = members[0].hparams
+        self.build_model()
+
+    def __str__(self):
+        """Pretty print model architecture."""
+        format_str = '\nStack of %i decoders\n' % len(self.members)
+        format_str += self.members[0].__str__()
+        return format_str
+
+    def build_model(self):
+        """Check that members can be stacked."""
+        if self.hparams['model_type'] not in self.model_types:
+            raise ValueError(
+                '"%s" is not a valid model type for a decoder stack' % self.hparams['model_type'])
+        self._param_names = [name for name, _ in self.members[0].named_parameters()]
+        for member in self.members[1:]:
+            shapes = [p.shape for p in member.parameters()]
+            if shapes != [p.shape for p in self.members[0].parameters()] \
+                    or member.hparams['noise_dist'] != self.hparams['noise_dist']:
+                raise ValueError('all decoders in a stack must have the same architecture')
+
+    def _member_forward(self, params, x):
+        outputs, precision = torch.func.functional_call(self.members[0], params, (x,))
+        # vmap only returns tensors
+        return (outputs,) if precision is None else (outputs, precision)
+
+    def forward(self, x, members=None):
+        """Process input data with multiple members.
+
+        Parameters
+        ----------
+        x : :obj:`torch.Tensor`
+            shape of (time, neurons)
+        members : :obj:`list` of :obj:`int` or :obj:`NoneType`, optional
+            indices of members to evaluate; all members if :obj:`NoneType`
+
+        Returns
+        -------
+        :obj:`tuple`
+            - x (:obj:`torch.Tensor`): mean predictions of shape (n_members, time, n_outputs)
+            - y (:obj:`torch.Tensor`): precision matrix predictions (when using 'mlp-mv')
+
+        """
+        if members is None:
+            members = range(len(self.members))
+        member_params = [dict(self.members[m].named_parameters()) for m in members]
+        params = {
+            name: torch.stack([p[name] for p in member_params]) for name in self._param_names}
+        outputs = torch.func.vmap(self._member_forward, in_dims=(0, None))(params, x)
+        return outputs[0], outputs[1] if len(outputs) > 1 else None
+
+    def loss(self, data, accumulate_grad=True, chunk_size=200, members=None, **kwargs):
+        """Calculate negative log-likelihood loss for multiple members.
+
+        Gradients of each member only depend on that member's loss; see :meth:`Decoder.loss` for
+        more information.
+
+        Parameters
+        ----------
+        data : :obj:`dict`
+            signals are of shape (1, time, n_channels)
+        accumulate_grad : :obj:`bool`, optional
+            accumulate gradient for training step
+        chunk_size : :obj:`int`, optional
+            batch is split into chunks of this size to keep memory requirements low
+        members : :obj:`list` of :obj:`int` or :obj:`NoneType`, optional
+            indices of members to evaluate; all members if :obj:`NoneType`
+
+        Returns
+        -------
+        :obj:`list` of :obj:`dict`
+            one dict per member, with the same keys as returned by :meth:`Decoder.loss`
+
+        """
+
+        if members is None:
+            members = list(range(len(self.members)))
+
+        predictors = data[self.hparams['input_signal']][0]
+        targets = data[self.hparams['output_signal']][0]
+
+        max_lags = self.hparams['n_max_lags']
+
+        batch_size = targets.shape[0]
+        n_chunks = int(np.ceil(batch_size / chunk_size))
+
+        outputs_all = []
+        loss_vals = np.zeros(len(members))
+        for chunk in range(n_chunks):
+
+            with trace_span('loss_chunk', 'model', chunk=int(chunk)):
+                # take chunks of size chunk_size, plus overlap due to max_lags
+                idx_beg = np.max([chunk * chunk_size - max_lags, 0])
+                idx_end = np.min([(chunk + 1) * chunk_size + max_lags, batch_size])
+
+                outputs, precision = self(predictors[idx_beg:idx_end], members=members)
+                targets_ = targets[idx_beg:idx_end][max_lags:-max_lags]
+
+                # define loss on allowed window of data
+                member_losses = []
+                for i, m in enumerate(members):
+                    if self.hparams['noise_dist'] == 'gaussian-full':
+                        member_losses.append(self.members[m]._loss(
+                            outputs[i, max_lags:-max_lags], targets_,
+                            precision[i, max_lags:-max_lags]))
+                    else:
+                        member_losses.append(
+                            self.members[m]._loss(outputs[i, max_lags:-max_lags], targets_))
+
+                if accumulate_grad:
+                    # members do not share parameters, so the gradients of the summed loss are the
+                    # gradients of the individual losses
+                    with trace_span('backward', 'model'):
+                        torch.stack(member_losses).sum().backward()
+
+                # get loss values (weighted by batch size)
+                n_outputs = outputs[:, max_lags:-max_lags].shape[1]
+                loss_vals += np.array([loss.item() for loss in member_losses]) * n_outputs
+
+                outputs_all.append(outputs[:, max_lags:-max_lags].cpu().detach().numpy())
+
+        loss_vals /= batch_size
+        outputs_all = np.concatenate(outputs_all, axis=1)
+
+        loss_dicts = []
+        for i, loss_val in enumerate(loss_vals):
+            r2, fc = _decoder_metrics(
+                self.hparams['noise_dist'], targets[max_lags:-max_lags].cpu().detach().numpy(),
+                outputs_all[i])
+            loss_dicts.append({'loss': float(loss_val), 'r2': r2, 'fc': fc})
+
+        return loss_dicts
+
+
+def _decoder_metrics(noise_dist, targets, outputs):
+    """Compute goodness-of-fit metrics for decoder predictions.
+
+    Parameters
+    ----------
+    noise_dist : :obj:`str`
+        'gaussian' | 'gaussian-full' | 'poisson' | 'categorical'
+    targets : :obj:`np.ndarray`
+        shape of (time, n_outputs)
+    outputs : :obj:`np.ndarray`
+        shape of (time, n_outputs)
+
+    Returns
+    -------
+    :obj:`tuple`
+        - r2 (:obj:`float`): variance-weighted $R^2$ when noise dist is Gaussian
+        - fc (:obj:`float`): fraction correct when noise dist is Categorical
+
+    """
+    if noise_dist == 'gaussian' or noise_dist == 'gaussian-full':
+        # use variance-weighted r2s to ignore small-variance latents
+        r2 = losses.r2_variance_weighted(targets, outputs)
+        fc = 0
+    elif noise_dist == 'poisson':
+        raise NotImplementedError
+    elif noise_dist == 'categorical':
+        r2 = 0
+        fc = losses.fraction_correct(targets, np.argmax(outputs, axis=1))
+    else:
+        raise ValueError('"%s" is not a valid noise_dist' % noise_dist)
+    return r2, fc
+
+
 class MLP(BaseModule):
     """Feedforward neural network model."""
 
@@ -475,21 +656,23 @@ class ConvDecoder(BaseModel):
         loss_val = 0
         for chunk in range(n_chunks):
 
-            idx_beg = chunk * chunk_size
-            idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
+            with trace_span('loss_chunk', 'model', chunk=int(chunk)):
+                idx_beg = chunk * chunk_size
+                idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
 
-            x_in = x[idx_beg:idx_end]
-            y_in = y[idx_beg:idx_end]
-            m_in = m[idx_beg:idx_end] if m is not None else None
-            x_hat = self.forward(y_in, dataset=dataset)
+                x_in = x[idx_beg:idx_end]
+                y_in = y[idx_beg:idx_end]
+                m_in = m[idx_beg:idx_end] if m is not None else None
+                x_hat = self.forward(y_in, dataset=dataset)
 
-            loss = losses.mse(x_in, x_hat, m_in)
+                loss = losses.mse(x_in, x_hat, m_in)
 
-            if accumulate_grad:
-                loss.backward()
+                if accumulate_grad:
+                    with trace_span('backward', 'model'):
+                        loss.backward()
 
-            # get loss value (weighted by batch size)
-            loss_val += loss.item() * (idx_end - idx_beg)
+                # get loss value (weighted by batch size)
+                loss_val += loss.item() * (idx_end - idx_beg)
 
         loss_val /= batch_size
 
@@ -1,12 +1,13 @@
 """Variational autoencoder models implemented in PyTorch."""
 
 import numpy as np
-from sklearn.metrics import r2_score
 import torch
 from torch import nn
 
 import behavenet.fitting.losses as losses
-from behavenet.models.aes import AE, ConvAEDecoder, ConvAEEncoder
+from behavenet.tracing import trace_span
+from behavenet.models.aes import AE, ConvAEDecoder, ConvAEEncoder, _POOL, _SESS_IO
+from behavenet.models.base import slice_dataset
 
 # to ignore imports for sphix-autoapidoc
 __all__ = ['reparameterize', 'VAE', 'ConditionalVAE', 'BetaTCVAE', 'PSVAE', 'ConvAEPSEncoder']
@@ -168,31 +169,34 @@ class VAE(AE):
         loss_mse_val = 0
         for chunk in range(n_chunks):
 
-            idx_beg = chunk * chunk_size
-            idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
+            with trace_span('loss_chunk', 'model', chunk=int(chunk)):
+                idx_beg = chunk * chunk_size
+                idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
 
-            x_in = x[idx_beg:idx_end]
-            m_in = m[idx_beg:idx_end] if m is not None else None
-            x_hat, _, mu, logvar = self.forward(x_in, dataset=dataset, use_mean=False)
+                x_in = x[idx_beg:idx_end]
+                m_in = m[idx_beg:idx_end] if m is not None else None
+                dataset_in = slice_dataset(dataset, idx_beg, idx_end)
+                x_hat, _, mu, logvar = self.forward(x_in, dataset=dataset_in, use_mean=False)
 
-            # log-likelihood
-            loss_ll = losses.gaussian_ll(x_in, x_hat, m_in)
+                # log-likelihood
+                loss_ll = losses.gaussian_ll(x_in, x_hat, m_in)
 
-            # kl
-            loss_kl = losses.kl_div_to_std_normal(mu, logvar)
+                # kl
+                loss_kl = losses.kl_div_to_std_normal(mu, logvar)
 
-            # combine
-            loss = -loss_ll + beta * loss_kl
+                # combine
+                loss = -loss_ll + beta * loss_kl
 
-            if accumulate_grad:
-                loss.backward()
+                if accumulate_grad:
+                    with trace_span('backward', 'model'):
+                        loss.backward()
 
-            # get loss value (weighted by batch size)
-            loss_val += loss.item() * (idx_end - idx_beg)
-            loss_ll_val += loss_ll.item() * (idx_end - idx_beg)
-            loss_kl_val += loss_kl.item() * (idx_end - idx_beg)
-            loss_mse_val += losses.gaussian_ll_to_mse(
-                loss_ll.item(), np.prod(x.shape[1:])) * (idx_end - idx_beg)
+                # get loss value (weighted by batch size)
+                loss_val += loss.item() * (idx_end - idx_beg)
+                loss_ll_val += loss_ll.item() * (idx_end - idx_beg)
+                loss_kl_val += loss_kl.item() * (idx_end - idx_beg)
+                loss_mse_val += losses.gaussian_ll_to_mse(
+                    loss_ll.item(), np.prod(x.shape[1:])) * (idx_end - idx_beg)
 
         loss_val /= batch_size
         loss_ll_val /= batch_size
@@ -321,34 +325,37 @@ class ConditionalVAE(VAE):
         loss_mse_val = 0
         for chunk in range(n_chunks):
 
-            idx_beg = chunk * chunk_size
-            idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
+            with trace_span('loss_chunk', 'model', chunk=int(chunk)):
+                idx_beg = chunk * chunk_size
+                idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
 
-            x_in = x[idx_beg:idx_end]
-            y_in = y[idx_beg:idx_end]
-            m_in = m[idx_beg:idx_end] if m is not None else None
-            y_2d_in = y_2d[idx_beg:idx_end] if y_2d is not None else None
-            x_hat, _, mu, logvar = self.forward(
-                x_in, dataset=dataset, use_mean=False, labels=y_in, labels_2d=y_2d_in)
+                x_in = x[idx_beg:idx_end]
+                y_in = y[idx_beg:idx_end]
+                m_in = m[idx_beg:idx_end] if m is not None else None
+                y_2d_in = y_2d[idx_beg:idx_end] if y_2d is not None else None
+                dataset_in = slice_dataset(dataset, idx_beg, idx_end)
+                x_hat, _, mu, logvar = self.forward(
+                    x_in, dataset=dataset_in, use_mean=False, labels=y_in, labels_2d=y_2d_in)
 
-            # log-likelihood
-            loss_ll = losses.gaussian_ll(x_in, x_hat, m_in)
+                # log-likelihood
+                loss_ll = losses.gaussian_ll(x_in, x_hat, m_in)
 
-            # kl
-            loss_kl = losses.kl_div_to_std_normal(mu, logvar)
+                # kl
+                loss_kl = losses.kl_div_to_std_normal(mu, logvar)
 
-            # combine
-            loss = -loss_ll + beta * loss_kl
+                # combine
+                loss = -loss_ll + beta * loss_kl
 
-            if accumulate_grad:
-                loss.backward()
+                if accumulate_grad:
+                    with trace_span('backward', 'model'):
+                        loss.backward()
 
-            # get loss value (weighted by batch size)
-            loss_val += loss.item() * (idx_end - idx_beg)
-            loss_ll_val += loss_ll.item() * (idx_end - idx_beg)
-            loss_kl_val += loss_kl.item() * (idx_end - idx_beg)
-            loss_mse_val += losses.gaussian_ll_to_mse(
-                loss_ll.item(), np.prod(x.shape[1:])) * (idx_end - idx_beg)
+                # get loss value (weighted by batch size)
+                loss_val += loss.item() * (idx_end - idx_beg)
+                loss_ll_val += loss_ll.item() * (idx_end - idx_beg)
+                loss_kl_val += loss_kl.item() * (idx_end - idx_beg)
+                loss_mse_val += losses.gaussian_ll_to_mse(
+                    loss_ll.item(), np.prod(x.shape[1:])) * (idx_end - idx_beg)
 
         loss_val /= batch_size
         loss_ll_val /= batch_size
@@ -452,45 +459,48 @@ class BetaTCVAE(VAE):
 
         for chunk in range(n_chunks):
 
-            idx_beg = chunk * chunk_size
-            idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
+            with trace_span('loss_chunk', 'model', chunk=int(chunk)):
+                idx_beg = chunk * chunk_size
+                idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
 
-            x_in = x[idx_beg:idx_end]
-            m_in = m[idx_beg:idx_end] if m is not None else None
-            x_hat, sample, mu, logvar = self.forward(x_in, dataset=dataset, use_mean=False)
+                x_in = x[idx_beg:idx_end]
+                m_in = m[idx_beg:idx_end] if m is not None else None
+                dataset_in = slice_dataset(dataset, idx_beg, idx_end)
+                x_hat, sample, mu, logvar = self.forward(x_in, dataset=dataset_in, use_mean=False)
 
-            # reset losses
-            loss_dict_torch = {loss: 0 for loss in loss_strs}
+                # reset losses
+                loss_dict_torch = {loss: 0 for loss in loss_strs}
 
-            # data log-likelihood
-            loss_dict_torch['loss_ll'] = losses.gaussian_ll(x_in, x_hat, m_in)
-            loss_dict_torch['loss'] -= loss_dict_torch['loss_ll']
+                # data log-likelihood
+                loss_dict_torch['loss_ll'] = losses.gaussian_ll(x_in, x_hat, m_in)
+                loss_dict_torch['loss'] -= loss_dict_torch['loss_ll']
 
-            # compute all terms of decomposed elbo at once
-            index_code_mi, total_correlation, dimension_wise_kl = losses.decomposed_kl(
-                sample, mu, logvar)
+                # compute all terms of decomposed elbo at once
+                index_code_mi, total_correlation, dimension_wise_kl = losses.decomposed_kl(
+                    sample, mu, logvar, block_size=self.hparams.get('kl_block_size', None))
 
-            # unsupervised latents index-code mutual information
-            loss_dict_torch['loss_mi'] = index_code_mi
-            loss_dict_torch['loss'] += kl * loss_dict_torch['loss_mi']
+                # unsupervised latents index-code mutual information
+                loss_dict_torch['loss_mi'] = index_code_mi
+                loss_dict_torch['loss'] += kl * loss_dict_torch['loss_mi']
 
-            # unsupervised latents total correlation
-            loss_dict_torch['loss_tc'] = total_correlation
-            loss_dict_torch['loss'] += beta * loss_dict_torch['loss_tc']
+                # unsupervised latents total correlation
+                loss_dict_torch['loss_tc'] = total_correlation
+                loss_dict_torch['loss'] += beta * loss_dict_torch['loss_tc']
 
-            # unsupervised latents dimension-wise kl
-            loss_dict_torch['loss_dwkl'] = dimension_wise_kl
-            loss_dict_torch['loss'] += kl * loss_dict_torch['loss_dwkl']
+                # unsupervised latents dimension-wise kl
+                loss_dict_torch['loss_dwkl'] = dimension_wise_kl
+                loss_dict_torch['loss'] += kl * loss_dict_torch['loss_dwkl']
 
-            if accumulate_grad:
-                loss_dict_torch['loss'].backward()
+                if accumulate_grad:
+                    with trace_span('backward', 'model'):
+                        loss_dict_torch['loss'].backward()
 
-            # get loss value (weighted by batch size)
-            bs = idx_end - idx_beg
-            for key, val in loss_dict_torch.items():
-                loss_dict_vals[key] += val.item() * bs
-            loss_dict_vals['loss_mse'] += losses.gaussian_ll_to_mse(
-                loss_dict_vals['loss_ll'] / bs, np.prod(x.shape[1:])) * bs
+                # get loss value (weighted by batch size)
+                bs = idx_end - idx_beg
+                for key, val in loss_dict_torch.items():
+                    loss_dict_vals[key] += val.item() * bs
+                loss_dict_vals['loss_mse'] += losses.gaussian_ll_to_mse(
+                    loss_dict_vals['loss_ll'] / bs, np.prod(x.shape[1:])) * bs
 
         # compile (properly weighted) loss terms
         for key in loss_dict_vals.keys():
@@ -654,77 +664,82 @@ class PSVAE(AE):
 
         for chunk in range(n_chunks):
 
-            idx_beg = chunk * chunk_size
-            idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
-
-            x_in = x[idx_beg:idx_end]
-            y_in = y[idx_beg:idx_end]
-            m_in = m[idx_beg:idx_end] if m is not None else None
-            n_in = n[idx_beg:idx_end] if n is not None else None
-            x_hat, sample, mu, logvar, y_hat = self.forward(x_in, dataset=dataset, use_mean=False)
-
-            # reset losses
-            loss_dict_torch = {loss: 0 for loss in loss_strs}
-
-            # data log-likelihood
-            loss_dict_torch['loss_data_ll'] = losses.gaussian_ll(x_in, x_hat, m_in)
-            loss_dict_torch['loss'] -= loss_dict_torch['loss_data_ll']
-
-            # label log-likelihood
-            loss_dict_torch['loss_label_ll'] = losses.gaussian_ll(y_in, y_hat, n_in)
-            loss_dict_torch['loss'] -= alpha * loss_dict_torch['loss_label_ll']
-
-            # supervised latents kl
-            loss_dict_torch['loss_zs_kl'] = losses.kl_div_to_std_normal(
-                mu[:, :n_labels], logvar[:, :n_labels])
-            loss_dict_torch['loss'] += loss_dict_torch['loss_zs_kl']
-
-            # compute all terms of decomposed elbo at once
-            index_code_mi, total_correlation, dimension_wise_kl = losses.decomposed_kl(
-                sample[:, n_labels:], mu[:, n_labels:], logvar[:, n_labels:])
-
-            # unsupervised latents index-code mutual information
-            loss_dict_torch['loss_zu_mi'] = index_code_mi
-            loss_dict_torch['loss'] += kl * loss_dict_torch['loss_zu_mi']
-
-            # unsupervised latents total correlation
-            loss_dict_torch['loss_zu_tc'] = total_correlation
-            loss_dict_torch['loss'] += beta * loss_dict_torch['loss_zu_tc']
-
-            # unsupervised latents dimension-wise kl
-            loss_dict_torch['loss_zu_dwkl'] = dimension_wise_kl
-            loss_dict_torch['loss'] += kl * loss_dict_torch['loss_zu_dwkl']
-
-            # orthogonality between A and B
-            # A shape: [n_labels, n_latents]
-            # B shape: [n_latents - n_labels, n_latents]
-            # compute ||AB^T||^2
-            loss_dict_torch['loss_AB_orth'] = losses.subspace_overlap(
-                self.encoding.A.weight, self.encoding.B.weight)
-
-            loss_dict_torch['loss'] += gamma * loss_dict_torch['loss_AB_orth']
-
-            if accumulate_grad:
-                loss_dict_torch['loss'].backward()
-
-            # get loss value (weighted by batch size)
-            bs = idx_end - idx_beg
-            for key, val in loss_dict_torch.items():
-                loss_dict_vals[key] += val.item() * bs
-            loss_dict_vals['loss_data_mse'] += losses.gaussian_ll_to_mse(
-                loss_dict_vals['loss_data_ll'] / bs, np.prod(x.shape[1:])) * bs
-
-            # collect predicted labels to compute R2
-            y_hat_all.append(y_hat.cpu().detach().numpy())
+            with trace_span('loss_chunk', 'model', chunk=int(chunk)):
+                idx_beg = chunk * chunk_size
+                idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
+
+                x_in = x[idx_beg:idx_end]
+                y_in = y[idx_beg:idx_end]
+                m_in = m[idx_beg:idx_end] if m is not None else None
+                n_in = n[idx_beg:idx_end] if n is not None else None
+                dataset_in = slice_dataset(dataset, idx_beg, idx_end)
+                x_hat, sample, mu, logvar, y_hat = self.forward(
+                    x_in, dataset=dataset_in, use_mean=False)
+
+                # reset losses
+                loss_dict_torch = {loss: 0 for loss in loss_strs}
+
+                # data log-likelihood
+                loss_dict_torch['loss_data_ll'] = losses.gaussian_ll(x_in, x_hat, m_in)
+                loss_dict_torch['loss'] -= loss_dict_torch['loss_data_ll']
+
+                # label log-likelihood
+                loss_dict_torch['loss_label_ll'] = losses.gaussian_ll(y_in, y_hat, n_in)
+                loss_dict_torch['loss'] -= alpha * loss_dict_torch['loss_label_ll']
+
+                # supervised latents kl
+                loss_dict_torch['loss_zs_kl'] = losses.kl_div_to_std_normal(
+                    mu[:, :n_labels], logvar[:, :n_labels])
+                loss_dict_torch['loss'] += loss_dict_torch['loss_zs_kl']
+
+                # compute all terms of decomposed elbo at once
+                index_code_mi, total_correlation, dimension_wise_kl = losses.decomposed_kl(
+                    sample[:, n_labels:], mu[:, n_labels:], logvar[:, n_labels:],
+                    block_size=self.hparams.get('kl_block_size', None))
+
+                # unsupervised latents index-code mutual information
+                loss_dict_torch['loss_zu_mi'] = index_code_mi
+                loss_dict_torch['loss'] += kl * loss_dict_torch['loss_zu_mi']
+
+                # unsupervised latents total correlation
+                loss_dict_torch['loss_zu_tc'] = total_correlation
+                loss_dict_torch['loss'] += beta * loss_dict_torch['loss_zu_tc']
+
+                # unsupervised latents dimension-wise kl
+                loss_dict_torch['loss_zu_dwkl'] = dimension_wise_kl
+                loss_dict_torch['loss'] += kl * loss_dict_torch['loss_zu_dwkl']
+
+                # orthogonality between A and B
+                # A shape: [n_labels, n_latents]
+                # B shape: [n_latents - n_labels, n_latents]
+                # compute ||AB^T||^2
+                loss_dict_torch['loss_AB_orth'] = losses.subspace_overlap(
+                    self.encoding.A.weight, self.encoding.B.weight)
+
+                loss_dict_torch['loss'] += gamma * loss_dict_torch['loss_AB_orth']
+
+                if accumulate_grad:
+                    with trace_span('backward', 'model'):
+                        loss_dict_torch['loss'].backward()
+
+                # get loss value (weighted by batch size)
+                bs = idx_end - idx_beg
+                for key, val in loss_dict_torch.items():
+                    loss_dict_vals[key] += val.item() * bs
+                loss_dict_vals['loss_data_mse'] += losses.gaussian_ll_to_mse(
+                    loss_dict_vals['loss_data_ll'] / bs, np.prod(x.shape[1:])) * bs
+
+                # collect predicted labels to compute R2
+                y_hat_all.append(y_hat.cpu().detach().numpy())
 
         # use variance-weighted r2s to ignore small-variance latents
         y_hat_all = np.concatenate(y_hat_all, axis=0)
         y_all = y.cpu().detach().numpy()
         if n is not None:
             n_np = n.cpu().detach().numpy()
-            r2 = r2_score(y_all[n_np == 1], y_hat_all[n_np == 1], multioutput='variance_weighted')
+            r2 = losses.r2_variance_weighted(y_all[n_np == 1], y_hat_all[n_np == 1])
         else:
-            r2 = r2_score(y_all, y_hat_all, multioutput='variance_weighted')
+            r2 = losses.r2_variance_weighted(y_all, y_hat_all)
 
         # compile (properly weighted) loss terms
         for key in loss_dict_vals.keys():
@@ -901,8 +916,8 @@ class ConvAEPSEncoder(ConvAEEncoder):
         ----------
         x : :obj:`torch.Tensor` object
             input data
-        dataset : :obj:`int`
-            used with session-specific io layers
+        dataset : :obj:`int` or :obj:`torch.Tensor`
+            used with session-specific io layers; a tensor of per-frame datasets mixes sessions
 
         Returns
         -------
@@ -918,20 +933,22 @@ class ConvAEPSEncoder(ConvAEEncoder):
         """
         # loop over layers, have to collect pool_idx and output sizes if using max pooling to use
         # in unpooling
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         pool_idx = []
         target_output_size = []
-        for layer in self.encoder:
-            if isinstance(layer, nn.MaxPool2d):
+        for kind, layer in zip(self._layer_kinds, self.encoder):
+            if kind == _POOL:
                 target_output_size.append(x.size())
                 x, idx = layer(x)
                 pool_idx.append(idx)
-            elif isinstance(layer, nn.ModuleList):
-                x = layer[dataset](x)
+            elif kind == _SESS_IO:
+                x = layer(x, dataset)
             else:
                 x = layer(x)
 
         # reshape for ff layer
-        x1 = x.view(x.size(0), -1)
+        x1 = x.reshape(x.size(0), -1)
         x = self.FF(x1)
 
         # push through linear transformations
@@ -1,10 +1,8 @@
 """Utility functions shared across multiple plotting modules."""
 
-from matplotlib.animation import FFMpegWriter
 import numpy as np
 import os
 import pickle
-import pandas as pd
 
 from behavenet import make_dir_if_not_exists
 from behavenet.fitting.utils import experiment_exists
@@ -131,6 +129,7 @@ def load_metrics_csv_as_df(hparams, lab, expt, metrics_list, test=False, version
     :obj:`pandas.DataFrame` object
 
     """
+    import pandas as pd
 
     # programmatically fill out other hparams options
     get_lab_example(hparams, lab, expt)
@@ -205,6 +204,7 @@ def save_movie(save_file, ani, frame_rate=15):
         frame rate of saved movie
 
     """
+    from matplotlib.animation import FFMpegWriter
 
     if save_file is not None:
         make_dir_if_not_exists(save_file)
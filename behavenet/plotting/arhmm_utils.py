@@ -4,11 +4,7 @@ import pickle
 import os
 import numpy as np
 import torch
-import matplotlib.pyplot as plt
-import matplotlib
-import matplotlib.animation as animation
 from behavenet import make_dir_if_not_exists
-from behavenet.models import AE as AE
 from behavenet.plotting import save_movie
 
 # to ignore imports for sphix-autoapidoc
@@ -387,6 +383,9 @@ def make_syllable_movies(
         choose only a single state for movie
 
     """
+    import matplotlib
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
 
     K = len(state_list)
 
@@ -555,6 +554,7 @@ def real_vs_sampled_wrapper(
         nothing returned (movie is saved)
 
     """
+    from behavenet.models import AE
     from behavenet.data.utils import get_transforms_paths
     from behavenet.fitting.utils import get_expt_dir
     from behavenet.fitting.utils import get_session_dir
@@ -664,6 +664,8 @@ def make_real_vs_sampled_movies(
         frame rate of saved movie
 
     """
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
 
     n_frames = ims_recon.shape[0]
 
@@ -731,6 +733,7 @@ def plot_real_vs_sampled(
         matplotlib figure handle
 
     """
+    import matplotlib.pyplot as plt
 
     fig, axes = plt.subplots(2, 1, figsize=(10, 8))
 
@@ -789,6 +792,7 @@ def plot_states_overlaid_with_latents(
         matplotlib figure handle if :obj:`ax=None`, otherwise updated axis
 
     """
+    import matplotlib.pyplot as plt
     if ax is None:
         fig = plt.figure(figsize=(8, 4))
         ax = fig.gca()
@@ -842,6 +846,7 @@ def plot_state_transition_matrix(model, deridge=False):
         matplotlib figure handle
 
     """
+    import matplotlib.pyplot as plt
     trans = np.copy(model.transitions.transition_matrix)
     if deridge:
         n_states = trans.shape[0]
@@ -875,6 +880,7 @@ def plot_dynamics_matrices(model, deridge=False):
         matplotlib figure handle
 
     """
+    import matplotlib.pyplot as plt
     K = model.K
     D = model.D
     n_lags = model.observations.lags
@@ -939,6 +945,7 @@ def plot_obs_biases(model):
         matplotlib figure handle
 
     """
+    import matplotlib.pyplot as plt
     fig = plt.figure(figsize=(6, 4))
     mats = np.copy(model.observations.bs.T)
     clim = np.max(np.abs(mats))
@@ -966,6 +973,7 @@ def plot_obs_covariance_matrices(model):
         matplotlib figure handle
 
     """
+    import matplotlib.pyplot as plt
     K = model.K
     n_cols = int(np.sqrt(K))
     n_rows = int(np.ceil(K / n_cols))
@@ -0,0 +1,191 @@
+"""Lightweight tracer that records timed spans in the Chrome trace-event format.
+
+Spans are recorded with the context manager :func:`trace_span`, so that a span is closed even if
+an exception is raised inside it. Spans are opened throughout the data, model, training and export
+code (data loading, transforms, device transfer, loss chunks, backward passes, optimizer steps,
+file writes); when no tracer is active :func:`trace_span` returns a context manager that does
+nothing.
+
+A trace is recorded between calls to :func:`start_trace` and :func:`save_trace`. The resulting
+json file can be opened with `chrome://tracing` or https://ui.perfetto.dev.
+"""
+
+import json
+import os
+import threading
+import time
+
+# to ignore imports for sphix-autoapidoc
+__all__ = ['Tracer', 'start_trace', 'save_trace', 'is_tracing', 'trace_span']
+
+# currently active tracer; `None` when tracing is off
+_TRACER = None
+
+
+class Tracer(object):
+    """Collect trace events for a single process."""
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self._t0 = time.perf_counter()
+        self.events.append({
+            'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': 0,
+            'args': {'name': 'behavenet (pid %i)' % self.pid}})
+
+    def _timestamp(self):
+        # trace-event timestamps are in microseconds
+        return (time.perf_counter() - self._t0) * 1e6
+
+    def begin(self, name, cat='', args=None):
+        """Record the beginning of a span.
+
+        Parameters
+        ----------
+        name : :obj:`str`
+            span name
+        cat : :obj:`str`, optional
+            span category (e.g. 'data', 'model', 'train', 'io')
+        args : :obj:`dict`, optional
+            additional information displayed with the span
+
+        """
+        event = {
+            'name': name, 'cat': cat, 'ph': 'B', 'ts': self._timestamp(), 'pid': self.pid,
+            'tid': threading.get_ident()}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def end(self, name, cat='', args=None):
+        """Record the end of a span; see :meth:`begin` for parameters."""
+        event = {
+            'name': name, 'cat': cat, 'ph': 'E', 'ts': self._timestamp(), 'pid': self.pid,
+            'tid': threading.get_ident()}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def save(self, filepath):
+        """Save trace events as a json file.
+
+        Parameters
+        ----------
+        filepath : :obj:`str`
+            absolute path of json file
+
+        """
+        with open(filepath, 'w') as f:
+            json.dump(
+                {'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f, default=_to_json)
+
+
+def _to_json(obj):
+    """Convert span arguments that are not json-serializable (e.g. numpy scalars)."""
+    if hasattr(obj, 'item'):
+        return obj.item()
+    return str(obj)
+
+
+class _Span(object):
+    """Context manager that records a single span."""
+
+    __slots__ = ['tracer', 'name', 'cat', 'args']
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.tracer.begin(self.name, self.cat, self.args)
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.end(self.name, self.cat)
+        return False
+
+
+class _NullSpan(object):
+    """Context manager that does nothing; returned when tracing is off."""
+
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def start_trace(enabled=True):
+    """Start recording trace events.
+
+    If a trace is already being recorded (e.g. an export function called from within
+    :func:`behavenet.fitting.training.fit`) no new tracer is created, and the events are added to
+    the existing trace.
+
+    Parameters
+    ----------
+    enabled : :obj:`bool`, optional
+        :obj:`False` to skip tracing altogether
+
+    Returns
+    -------
+    :obj:`Tracer` or :obj:`NoneType`
+        new tracer, or :obj:`NoneType` if tracing is disabled or a trace is already active; pass
+        the returned value to :func:`save_trace`
+
+    """
+    global _TRACER
+    if not enabled or _TRACER is not None:
+        return None
+    _TRACER = Tracer()
+    return _TRACER
+
+
+def save_trace(tracer, filepath):
+    """Stop recording trace events and save them to a json file.
+
+    Parameters
+    ----------
+    tracer : :obj:`Tracer` or :obj:`NoneType`
+        value returned by :func:`start_trace`; nothing is done if :obj:`NoneType`
+    filepath : :obj:`str`
+        absolute path of json file
+
+    """
+    global _TRACER
+    if tracer is None:
+        return
+    if _TRACER is tracer:
+        _TRACER = None
+    tracer.save(filepath)
+    print('trace saved to %s' % filepath)
+
+
+def is_tracing():
+    """Return :obj:`True` if trace events are currently being recorded."""
+    return _TRACER is not None
+
+
+def trace_span(name, cat='', **kwargs):
+    """Context manager that records a span if a trace is active.
+
+    Parameters
+    ----------
+    name : :obj:`str`
+        span name
+    cat : :obj:`str`, optional
+        span category
+    kwargs
+        additional information displayed with the span
+
+    """
+    if _TRACER is None:
+        return _NULL_SPAN
+    return _Span(_TRACER, name, cat, kwargs)
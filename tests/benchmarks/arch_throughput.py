@@ -0,0 +1,67 @@
+"""Rank autoencoder architectures by their measured throughput on this machine.
+
+Architectures are drawn at random with
+:func:`behavenet.models.ae_model_architecture_generator.draw_archs`, or loaded from a handcrafted
+architecture json with :func:`load_handcrafted_arches` when :obj:`--ae_arch_json` is given. Each
+architecture is timed with :func:`benchmark_archs` on synthetic frames, and the ranked table
+(training and inference frames per second, peak memory, analytical parameter and FLOP counts) is
+printed and optionally saved as a csv file.
+
+Run from the top-level behavenet directory:
+
+    (behavenet) $: python tests/benchmarks/arch_throughput.py --n_archs 5 --batch_size 64 \
+        --min_train_frames_per_s 1000 --save_file arch_throughput.csv
+
+"""
+
+import argparse
+
+import pandas as pd
+import torch
+
+from behavenet.models.ae_model_architecture_generator import benchmark_archs
+from behavenet.models.ae_model_architecture_generator import draw_archs
+from behavenet.models.ae_model_architecture_generator import load_handcrafted_arches
+
+
+def main(args):
+
+    torch.set_num_threads(args.n_threads)
+    input_dim = [args.n_channels, args.y_pixels, args.x_pixels]
+    if args.ae_arch_json is None:
+        archs = draw_archs(
+            args.batch_size, input_dim, args.n_ae_latents, n_archs=args.n_archs,
+            check_memory=False)
+    else:
+        archs = load_handcrafted_arches(
+            input_dim, args.n_ae_latents, args.ae_arch_json, batch_size=args.batch_size,
+            check_memory=False)
+
+    budget = None
+    if args.min_train_frames_per_s is not None:
+        budget = {'train_frames_per_s': args.min_train_frames_per_s}
+    results = benchmark_archs(
+        archs, args.batch_size, n_steps=args.n_steps, throughput_budget=budget,
+        sort_by=args.sort_by, save_file=args.save_file)
+
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(results.to_string(index=False))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_archs', default=5, type=int)
+    parser.add_argument('--ae_arch_json', default=None, type=str)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--n_channels', default=1, type=int)
+    parser.add_argument('--y_pixels', default=128, type=int)
+    parser.add_argument('--x_pixels', default=128, type=int)
+    parser.add_argument('--n_ae_latents', default=12, type=int)
+    parser.add_argument('--n_steps', default=5, type=int)
+    parser.add_argument('--n_threads', default=4, type=int)
+    parser.add_argument('--min_train_frames_per_s', default=None, type=float)
+    parser.add_argument('--sort_by', default=None, type=str)
+    parser.add_argument('--save_file', default=None, type=str)
+    namespace, _ = parser.parse_known_args()
+    main(namespace)
@@ -0,0 +1,107 @@
+"""Measure the throughput of convolutional autoencoders in different memory formats.
+
+Random architectures are drawn with
+:func:`behavenet.models.ae_model_architecture_generator.draw_archs`. For each architecture the
+training step (forward and backward pass) is timed in the default (NCHW) and in the channels-last
+(NHWC, :obj:`ae_channels_last=True`) memory format, and the eval-mode forward pass is timed for
+the model as trained and for the copy returned by
+:func:`behavenet.models.aes.optimize_for_inference` (batch norm folded into convolutions, with and
+without channels-last; optionally compiled with :func:`torch.compile`). Throughput is reported in
+frames per second.
+
+Run from the top-level behavenet directory:
+
+    (behavenet) $: python tests/benchmarks/conv_ae_paths.py --n_archs 3 --batch_size 64
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from behavenet.models import AE
+from behavenet.models.ae_model_architecture_generator import draw_archs
+from behavenet.models.aes import optimize_for_inference
+
+
+def time_frames_per_second(fn, n_frames, n_repeats):
+    """Return the median number of frames per second over repeated calls of :obj:`fn`."""
+    fn()  # warm up
+    times = []
+    for _ in range(n_repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t_beg = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - t_beg)
+    return n_frames / np.median(times)
+
+
+def main(args):
+
+    torch.set_num_threads(args.n_threads)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    input_dim = [args.n_channels, args.y_pixels, args.x_pixels]
+    archs = draw_archs(
+        args.batch_size, input_dim, args.n_ae_latents, n_archs=args.n_archs, check_memory=False)
+    x = torch.rand([args.batch_size] + input_dim, device=device)
+
+    columns = ['train', 'train (cl)', 'eval', 'eval (fused)', 'eval (fused, cl)']
+    if args.compile:
+        columns.append('eval (compiled)')
+    print('frames/s')
+    print('%-6s %-14s' % ('arch', 'network') + ''.join(['%18s' % c for c in columns]))
+    for a, arch in enumerate(archs):
+        arch.update({
+            'model_class': 'ae', 'n_input_channels': input_dim[0], 'y_pixels': input_dim[1],
+            'x_pixels': input_dim[2], 'device': device})
+        results = []
+
+        for channels_last in [False, True]:
+            torch.manual_seed(0)
+            model = AE(dict(arch, ae_channels_last=channels_last)).to(device)
+            optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+            def train_step():
+                optimizer.zero_grad()
+                y = model(x)[0]
+                torch.mean((y - x) ** 2).backward()
+                optimizer.step()
+
+            results.append(time_frames_per_second(train_step, args.batch_size, args.n_repeats))
+
+        model.eval()
+        models = [
+            optimize_for_inference(model, fuse_batch_norm=False),
+            optimize_for_inference(model),
+            optimize_for_inference(model, channels_last=True)]
+        if args.compile:
+            models.append(optimize_for_inference(model, channels_last=True, compile=True))
+        for model_eval in models:
+            def forward():
+                with torch.no_grad():
+                    model_eval(x)
+            results.append(time_frames_per_second(forward, args.batch_size, args.n_repeats))
+
+        print('%-6i %-14s' % (a, arch['ae_network_type']) +
+              ''.join(['%18.0f' % r for r in results]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_archs', default=3, type=int)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--n_channels', default=1, type=int)
+    parser.add_argument('--y_pixels', default=128, type=int)
+    parser.add_argument('--x_pixels', default=128, type=int)
+    parser.add_argument('--n_ae_latents', default=12, type=int)
+    parser.add_argument('--n_repeats', default=5, type=int)
+    parser.add_argument('--n_threads', default=4, type=int)
+    parser.add_argument('--compile', action='store_true', default=False)
+    namespace, _ = parser.parse_known_args()
+    main(namespace)
@@ -0,0 +1,100 @@
+"""Measure how long it takes behavenet entry points to start up.
+
+Each module is imported in a fresh python process; the script reports the median import time and
+which heavy optional dependencies were loaded as a side effect. The last entry additionally builds
+a small decoder and runs a single training step, approximating the time a worker spawned by a
+scheduler needs before it starts training.
+
+Run from the top-level behavenet directory:
+
+    (behavenet) $: python tests/benchmarks/startup.py --n_repeats 5
+
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+MODULES = [
+    'behavenet',
+    'behavenet.data.data_generator',
+    'behavenet.data.utils',
+    'behavenet.fitting.utils',
+    'behavenet.fitting.training',
+    'behavenet.models',
+    'behavenet.plotting.arhmm_utils',
+    'behavenet.fitting.hyperparam_utils',
+    'behavenet.fitting.ae_grid_search',
+    'behavenet.fitting.decoder_grid_search',
+    'behavenet.fitting.arhmm_grid_search',
+]
+
+HEAVY_DEPS = ['sklearn', 'matplotlib', 'seaborn', 'pandas', 'scipy', 'ssm', 'test_tube', 'cv2']
+
+FIRST_STEP = 'first training step'
+
+CHILD_CODE = """
+import json, sys, time
+t_beg = time.perf_counter()
+%s
+t_end = time.perf_counter()
+heavy = [m for m in %r if m in sys.modules]
+print(json.dumps({'time': t_end - t_beg, 'heavy': heavy}))
+"""
+
+FIRST_STEP_CODE = """
+import torch
+from behavenet.models import Decoder
+hparams = {
+    'model_type': 'mlp', 'input_size': 16, 'output_size': 4, 'n_hid_layers': 1,
+    'n_hid_units': 32, 'n_lags': 2, 'n_max_lags': 2, 'noise_dist': 'gaussian',
+    'activation': 'relu', 'device': 'cpu'}
+model = Decoder(hparams)
+optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+data = {'neural': torch.randn(1, 100, 16), 'ae_latents': torch.randn(1, 100, 4)}
+model.hparams['input_signal'] = 'neural'
+model.hparams['output_signal'] = 'ae_latents'
+optimizer.zero_grad()
+model.loss(data, accumulate_grad=True)
+optimizer.step()
+"""
+
+
+def time_startup(code, n_repeats):
+    """Run code in fresh python processes and return import times and loaded heavy modules."""
+    times = []
+    heavy = []
+    for _ in range(n_repeats):
+        output = subprocess.check_output(
+            [sys.executable, '-c', CHILD_CODE % (code, HEAVY_DEPS)], stderr=subprocess.DEVNULL)
+        result = json.loads(output.decode().strip().split('\n')[-1])
+        times.append(result['time'])
+        heavy = result['heavy']
+    return times, heavy
+
+
+def main(args):
+
+    entries = [(module, 'import %s' % module) for module in MODULES]
+    entries.append((FIRST_STEP, FIRST_STEP_CODE))
+
+    print('%-40s %10s %10s   %s' % ('entry point', 'median (s)', 'min (s)', 'heavy deps loaded'))
+    for name, code in entries:
+        try:
+            times, heavy = time_startup(code, args.n_repeats)
+        except subprocess.CalledProcessError:
+            print('%-40s %10s' % (name, 'failed'))
+            continue
+        print('%-40s %10.2f %10.2f   %s' % (
+            name, np.median(times), np.min(times), ', '.join(heavy) if heavy else '-'))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_repeats', default=3, type=int)
+    namespace, _ = parser.parse_known_args()
+    main(namespace)
@@ -0,0 +1,81 @@
+"""Measure the throughput of online decoding with a streaming mlp decoder.
+
+Neural activity is decoded one frame at a time with
+:class:`behavenet.fitting.streaming.StreamingDecoder`, and, as a baseline, by re-running the batch
+:meth:`MLP.forward` on the window of :obj:`2 * n_lags + 1` frames around each frame. The batch
+forward pass over the entire trial (offline decoding) is reported for reference. Throughput is
+reported in frames per second, along with the latency percentiles of the streaming decoder.
+
+Run from the top-level behavenet directory:
+
+    (behavenet) $: python tests/benchmarks/streaming_decoder.py --n_lags 8 --n_frames 2000
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from behavenet.fitting.streaming import StreamingDecoder
+from behavenet.models import Decoder
+
+
+def main(args):
+
+    torch.set_num_threads(args.n_threads)
+    hparams = {
+        'model_type': 'mlp', 'input_size': args.input_size, 'output_size': args.output_size,
+        'n_hid_layers': args.n_hid_layers, 'n_hid_units': args.n_hid_units,
+        'n_lags': args.n_lags, 'n_max_lags': args.n_lags, 'noise_dist': 'gaussian',
+        'activation': 'relu'}
+    model = Decoder(hparams)
+    model.eval()
+    x = torch.randn(args.n_frames, args.input_size)
+    window = 2 * args.n_lags + 1
+
+    # offline: whole trial at once
+    with torch.no_grad():
+        t_beg = time.perf_counter()
+        model(x)
+        t_batch = time.perf_counter() - t_beg
+
+    # online baseline: batch forward on the window around each frame
+    x_pad = torch.cat([torch.zeros(args.n_lags, args.input_size), x])
+    with torch.no_grad():
+        t_beg = time.perf_counter()
+        for t in range(args.n_frames):
+            model(x_pad[t:t + window])
+        t_window = time.perf_counter() - t_beg
+
+    # online: streaming decoder
+    decoder = StreamingDecoder(model)
+    frames = x.numpy()
+    t_beg = time.perf_counter()
+    for t in range(args.n_frames):
+        decoder.push(frames[t])
+    decoder.flush()
+    t_stream = time.perf_counter() - t_beg
+    latency = decoder.latency.summary()
+
+    print('%-40s %14s' % ('method', 'frames/s'))
+    print('%-40s %14.0f' % ('batch forward (whole trial)', args.n_frames / t_batch))
+    print('%-40s %14.0f' % ('batch forward (window per frame)', args.n_frames / t_window))
+    print('%-40s %14.0f' % ('streaming decoder', args.n_frames / t_stream))
+    print('\nstreaming latency (ms): p50 %.3f | p90 %.3f | p99 %.3f | max %.3f' % (
+        latency['p50_ms'], latency['p90_ms'], latency['p99_ms'], latency['max_ms']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_frames', default=2000, type=int)
+    parser.add_argument('--input_size', default=100, type=int)
+    parser.add_argument('--output_size', default=10, type=int)
+    parser.add_argument('--n_hid_layers', default=2, type=int)
+    parser.add_argument('--n_hid_units', default=64, type=int)
+    parser.add_argument('--n_lags', default=8, type=int)
+    parser.add_argument('--n_threads', default=1, type=int)
+    namespace, _ = parser.parse_known_args()
+    main(namespace)
@@ -70,3 +70,87 @@ def test_load_pkl_dict(tmpdir):
     data3 = _load_pkl_dict(path, key, idx=1)
     assert len(data3) == 1
     assert data3[0].shape == (4, 5)
+
+    # cached data is reused
+    cache = {}
+    _load_pkl_dict(path, key, idx=0, cache=cache)
+    with open(path, 'wb') as f:
+        pickle.dump({key: [np.zeros((2, 2))]}, f)
+    data4 = _load_pkl_dict(path, key, idx=1, cache=cache)
+    assert data4[0].shape == (4, 5)
+
+
+def test_concat_sessions_generator_copy(tmpdir):
+
+    import h5py
+    import os
+    from behavenet.data.data_generator import ConcatSessionsGenerator
+
+    sess_dir = os.path.join(tmpdir, 'lab', 'expt', 'animal', 'session')
+    os.makedirs(sess_dir)
+    path = os.path.join(sess_dir, 'data.hdf5')
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('neural')
+        for tr in range(10):
+            group.create_dataset('trial_%04i' % tr, data=np.random.randn(5, 3).astype('float32'))
+    data_generator = ConcatSessionsGenerator(
+        str(tmpdir), [{'lab': 'lab', 'expt': 'expt', 'animal': 'animal', 'session': 'session'}],
+        signals_list=[['neural']], transforms_list=[[None]], paths_list=[[path]], device='cpu')
+    data_generator_copy = data_generator.copy()
+
+    # datasets are shared, iterators are not
+    assert data_generator_copy.datasets[0] is data_generator.datasets[0]
+    assert data_generator_copy.n_tot_batches == data_generator.n_tot_batches
+    data_generator.next_batch('train')
+    idxs = []
+    for _ in range(data_generator_copy.n_tot_batches['train']):
+        data, _ = data_generator_copy.next_batch('train')
+        idxs.append(data['batch_idx'].item())
+    assert np.array_equal(np.sort(idxs), np.sort(data_generator.datasets[0].batch_idxs['train']))
+
+
+def test_concat_sessions_generator_mixed_batch(tmpdir):
+
+    import h5py
+    import os
+    import torch
+    from behavenet.data.data_generator import ConcatSessionsGenerator
+
+    ids_list = []
+    paths_list = []
+    for session, n_trials in [('sess0', 10), ('sess1', 20)]:
+        sess_dir = os.path.join(tmpdir, 'lab', 'expt', 'animal', session)
+        os.makedirs(sess_dir)
+        path = os.path.join(sess_dir, 'data.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('neural')
+            for tr in range(n_trials):
+                group.create_dataset(
+                    'trial_%04i' % tr, data=np.full((5, 3), len(ids_list), dtype='float32'))
+        ids_list.append({'lab': 'lab', 'expt': 'expt', 'animal': 'animal', 'session': session})
+        paths_list.append([path])
+    data_generator = ConcatSessionsGenerator(
+        str(tmpdir), ids_list, signals_list=[['neural'], ['neural']],
+        transforms_list=[[None], [None]], paths_list=paths_list, device='cpu')
+
+    n_batches = data_generator.n_tot_batches['train']
+    datasets = []
+    idxs = []
+    for i in range(0, n_batches, 4):
+        n = min(4, n_batches - i)
+        data, dataset = data_generator.next_mixed_batch('train', n)
+        assert data['neural'].shape == (1, 5 * n, 3)
+        assert data['batch_idx'].shape == (n,)
+        assert torch.is_tensor(dataset) and dataset.shape == (5 * n,)
+        # each frame is labeled with its session
+        assert torch.equal(data['neural'][0, :, 0].long(), dataset)
+        datasets.append(dataset[::5])
+        idxs.append(data['batch_idx'])
+
+    # all batches are served once
+    datasets = torch.cat(datasets).numpy()
+    idxs = torch.cat(idxs).numpy()
+    for d in range(2):
+        assert np.array_equal(
+            np.sort(idxs[datasets == d]),
+            np.sort(data_generator.datasets[d].batch_idxs['train']))
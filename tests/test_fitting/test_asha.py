@@ -0,0 +1,83 @@
+import os
+import sqlite3
+from multiprocessing import Pool
+import pytest
+from behavenet.fitting.asha import ASHAScheduler, get_asha_scheduler
+
+
+def _run_trial(args):
+    """Fake trial whose validation loss decreases with epochs; offset sets trial quality."""
+    db_file, trial, offset, max_epochs = args
+    scheduler = ASHAScheduler(db_file, min_epochs=1, reduction_factor=2, max_epochs=max_epochs)
+    for epoch in range(max_epochs + 1):
+        if scheduler.should_stop(trial, epoch, offset + 1 / (epoch + 1)):
+            return epoch
+    return max_epochs
+
+
+def test_asha_rungs(tmpdir):
+
+    scheduler = ASHAScheduler(
+        os.path.join(tmpdir, 'asha.db'), min_epochs=2, reduction_factor=3, max_epochs=50)
+    rungs = [e for e in range(60) if scheduler.get_rung(e) is not None]
+    assert rungs == [2, 6, 18]
+    assert scheduler.get_rung(18) == 2
+
+    with pytest.raises(ValueError):
+        ASHAScheduler(os.path.join(tmpdir, 'asha.db'), reduction_factor=1)
+
+    assert get_asha_scheduler({'asha': False}) is None
+    scheduler = get_asha_scheduler({'asha': True, 'expt_dir': tmpdir, 'max_n_epochs': 10})
+    assert scheduler.db_file == os.path.join(tmpdir, 'asha.db')
+    assert scheduler.sweep == ''
+
+
+def test_asha_should_stop(tmpdir):
+
+    db_file = os.path.join(tmpdir, 'asha.db')
+
+    # trials arriving in order of decreasing quality: all but the first are stopped at rung 0
+    stopped = [_run_trial((db_file, 'trial_%i' % i, i, 8)) for i in range(4)]
+    assert stopped == [8, 1, 1, 1]
+
+    # a better trial arriving later continues
+    assert _run_trial((db_file, 'trial_best', -1, 8)) == 8
+
+    # non-epochs are not rungs, nans are treated as the worst loss
+    scheduler = ASHAScheduler(db_file, min_epochs=1, reduction_factor=2, max_epochs=8)
+    assert not scheduler.should_stop('trial_nan', 3, float('nan'))
+    assert scheduler.should_stop('trial_nan', 4, float('nan'))
+
+
+def test_asha_sweeps(tmpdir):
+
+    db_file = os.path.join(tmpdir, 'asha.db')
+
+    # results recorded before rungs were keyed by sweep are discarded
+    with sqlite3.connect(db_file) as conn:
+        conn.execute(
+            'CREATE TABLE rungs (trial TEXT, rung INTEGER, loss REAL, PRIMARY KEY (trial, rung))')
+        conn.execute('INSERT INTO rungs VALUES (?, ?, ?)', ('trial_old', 0, -10.))
+    conn.close()
+
+    # a good trial of an earlier sweep does not stop the trials of a new sweep
+    old = ASHAScheduler(db_file, min_epochs=1, reduction_factor=2, sweep='old')
+    assert not old.should_stop('trial_0', 1, 0.)
+    new = ASHAScheduler(db_file, min_epochs=1, reduction_factor=2, sweep='new')
+    assert not new.should_stop('trial_0', 1, 1.)
+    assert new.should_stop('trial_1', 1, 2.)
+
+
+def test_asha_process_pool(tmpdir):
+
+    db_file = os.path.join(tmpdir, 'asha.db')
+    args = [(db_file, 'trial_%i' % i, i, 8) for i in range(6)]
+    with Pool(3) as pool:
+        stopped = pool.map(_run_trial, args)
+
+    # the best trial is never stopped; every trial recorded a result at the first rung
+    assert stopped[0] == 8
+    assert sum(stopped) < 6 * 8
+    with sqlite3.connect(db_file) as conn:
+        n_rung_0 = conn.execute('SELECT COUNT(*) FROM rungs WHERE rung = 0').fetchone()[0]
+    assert n_rung_0 == 6
@@ -0,0 +1,109 @@
+import numpy as np
+import torch
+from behavenet.fitting import autotune
+
+
+def test_estimate_chunk_size():
+
+    from behavenet.models.aes import AE
+    from behavenet.models.ae_model_architecture_generator import draw_archs
+    from behavenet.models.ae_model_architecture_generator import estimate_model_footprint
+
+    input_dim = [1, 64, 64]
+    arch = draw_archs(
+        batch_size=100, input_dim=input_dim, n_ae_latents=8, n_archs=1, check_memory=False)[0]
+    arch['model_class'] = 'ae'
+    arch['n_input_channels'] = input_dim[0]
+    arch['y_pixels'] = input_dim[1]
+    arch['x_pixels'] = input_dim[2]
+    model = AE(arch)
+
+    # estimated chunk should be the largest that fits within budget
+    budget = 0.5e9
+    chunk_size = autotune.estimate_chunk_size(model, budget, train=True)
+    assert chunk_size > 0
+    assert estimate_model_footprint(model, tuple([chunk_size] + input_dim)) <= budget
+    assert estimate_model_footprint(model, tuple([chunk_size + 2] + input_dim)) > budget
+
+    # inference does not store gradients
+    chunk_size_inf = autotune.estimate_chunk_size(model, budget, train=False)
+    assert chunk_size_inf > chunk_size
+
+    # models without a conv encoder use default
+    arch['model_type'] = 'linear'
+    arch['n_ae_latents'] = 8
+    model = AE(arch)
+    assert autotune.estimate_chunk_size(model, budget, default=123) == 123
+
+
+def test_measure_inference_footprint():
+
+    from behavenet.models.aes import AE
+    from behavenet.models.ae_model_architecture_generator import draw_archs
+
+    input_dim = [1, 32, 32]
+    arch = draw_archs(
+        batch_size=100, input_dim=input_dim, n_ae_latents=4, n_archs=1, check_memory=False)[0]
+    arch['model_class'] = 'ae'
+    arch['n_input_channels'] = input_dim[0]
+    arch['y_pixels'] = input_dim[1]
+    arch['x_pixels'] = input_dim[2]
+    model = AE(arch)
+    data = {'images': torch.rand(1, 3, *input_dim)}
+
+    # footprint is linear in the number of frames
+    bytes_1 = autotune.measure_inference_footprint(model, data, 1)
+    bytes_2 = autotune.measure_inference_footprint(model, data, 2)
+    bytes_4 = autotune.measure_inference_footprint(model, data, 4)
+    assert bytes_2 > bytes_1
+    assert bytes_4 - bytes_2 == 2 * (bytes_2 - bytes_1)
+
+    # at least the input and the parameters are stored
+    n_bytes_params = sum([4 * p.nelement() for p in model.parameters()])
+    assert bytes_1 > n_bytes_params + 4 * np.prod(input_dim)
+
+    # chunk size on cpu is the largest whose measured footprint is within budget
+    class DataGenerator(object):
+        def reset_iterators(self, dtype):
+            pass
+
+        def next_batch(self, dtype):
+            return data, 0
+
+    budget = bytes_1 + 10.5 * (bytes_2 - bytes_1)
+    hparams = {'device': 'cpu', 'train_chunk_size': 20}
+    chunk_sizes = autotune.autotune_chunk_size(
+        hparams, model, DataGenerator(), mem_limit_gb=budget / 1e9)
+    assert chunk_sizes == {'train_chunk_size': 20, 'inference_chunk_size': 11}
+    assert hparams['inference_chunk_size'] == 11
+
+
+def test_tile_batch():
+
+    data = {
+        'images': torch.arange(5).view(1, 5, 1).float(),
+        'batch_idx': torch.tensor([3])}
+    tiled = autotune._tile_batch(data, 12)
+    assert tiled['images'].shape == (1, 12, 1)
+    assert np.all(tiled['images'][0, :, 0].numpy() == np.tile(np.arange(5), 3)[:12])
+    assert tiled['batch_idx'].item() == 3
+
+    tiled = autotune._tile_batch(data, 2)
+    assert tiled['images'].shape == (1, 2, 1)
+
+
+def test_search_chunk_size():
+
+    # linear footprint: 10 bytes fixed + 3 bytes per frame
+    def measure_fn(n):
+        return 10 + 3 * n
+
+    # largest n such that 10 + 3n <= 100 is 30
+    for init in [1, 7, 30, 31, 500]:
+        assert autotune._search_chunk_size(measure_fn, 100, init, 1, 1000) == 30
+
+    # clip to max chunk size
+    assert autotune._search_chunk_size(measure_fn, 100, 4, 1, 20) == 20
+
+    # nothing fits
+    assert autotune._search_chunk_size(measure_fn, 5, 4, 1, 20) == 1
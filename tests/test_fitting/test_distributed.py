@@ -0,0 +1,141 @@
+import os
+import h5py
+import numpy as np
+import torch
+from behavenet.data.data_generator import ConcatSessionsGenerator
+from behavenet.fitting import distributed
+from behavenet.fitting.training import Logger, fit
+from behavenet.models import AE
+
+
+class DummyExperiment(object):
+    """Minimal stand-in for a test-tube experiment that stores logged metrics in memory."""
+
+    def __init__(self, version=0):
+        self.version = version
+        self.metrics = []
+
+    def log(self, metrics):
+        self.metrics.append(metrics)
+
+    def save(self):
+        pass
+
+
+def make_data(data_dir, sessions, n_trials=20, n_t=10, n_pix=4):
+    for session in sessions:
+        sess_dir = os.path.join(data_dir, 'lab', 'expt', 'animal', session)
+        os.makedirs(sess_dir)
+        with h5py.File(os.path.join(sess_dir, 'data.hdf5'), 'w') as f:
+            group = f.create_group('images')
+            for tr in range(n_trials):
+                group.create_dataset(
+                    'trial_%04i' % tr,
+                    data=np.random.randint(0, 255, size=(n_t, 1, n_pix, n_pix)).astype('uint8'))
+
+
+def make_generator(data_dir, sessions):
+    ids_list = [
+        {'lab': 'lab', 'expt': 'expt', 'animal': 'animal', 'session': s} for s in sessions]
+    paths = [
+        [os.path.join(data_dir, 'lab', 'expt', 'animal', s, 'data.hdf5')] for s in sessions]
+    return ConcatSessionsGenerator(
+        data_dir, ids_list, signals_list=[['images']] * len(sessions),
+        transforms_list=[[None]] * len(sessions), paths_list=paths, device='cpu',
+        as_numpy=False, batch_load=True, rng_seed=0)
+
+
+def make_hparams(expt_dir):
+    return {
+        'model_type': 'linear', 'model_class': 'ae', 'n_ae_latents': 3, 'n_input_channels': 1,
+        'y_pixels': 4, 'x_pixels': 4, 'device': 'cpu', 'learning_rate': 1e-3,
+        'enable_early_stop': False, 'max_n_epochs': 2, 'val_check_interval': 1,
+        'rng_seed_train': 0, 'export_latents': False, 'expt_dir': expt_dir}
+
+
+def _fit_worker(hparams):
+    sessions = ['sess-0', 'sess-1']
+    data_generator = make_generator(hparams['data_dir'], sessions)
+    torch.manual_seed(distributed.get_rank())  # different inits; rank 0 params are broadcast
+    model = AE(hparams)
+    exp = DummyExperiment() if distributed.is_main_process() else None
+    fit(hparams, model, data_generator, exp, method='ae')
+    # record what each process ended up with
+    torch.save(
+        {'state_dict': model.state_dict(),
+         'n_train': data_generator.n_tot_batches['train'],
+         'metrics': exp.metrics if exp is not None else None},
+        os.path.join(hparams['expt_dir'], 'rank_%i.pt' % distributed.get_rank()))
+
+
+def test_fit_distributed(tmpdir):
+
+    data_dir = os.path.join(tmpdir, 'data')
+    expt_dir = os.path.join(tmpdir, 'expt')
+    os.makedirs(os.path.join(expt_dir, 'version_0'))
+    make_data(data_dir, ['sess-0', 'sess-1'])
+
+    hparams = make_hparams(expt_dir)
+    hparams['data_dir'] = data_dir
+    distributed.launch(_fit_worker, hparams, world_size=2, start_method='fork')
+
+    rank_0 = torch.load(os.path.join(expt_dir, 'rank_0.pt'), weights_only=False)
+    rank_1 = torch.load(os.path.join(expt_dir, 'rank_1.pt'), weights_only=False)
+
+    # all copies of the model are identical after training
+    for key, val in rank_0['state_dict'].items():
+        assert torch.allclose(val, rank_1['state_dict'][key])
+
+    # only the main process saves the model and logs metrics
+    assert os.path.exists(os.path.join(expt_dir, 'version_0', 'best_val_model.pt'))
+    assert rank_1['metrics'] is None
+    tr_rows = [m for m in rank_0['metrics'] if 'tr_loss' in m and m['dataset'] == -1]
+    assert len(tr_rows) == hparams['max_n_epochs'] + 1
+
+    # main process evaluates test data on the full (unsharded) generator
+    test_rows = [m for m in rank_0['metrics'] if 'test_loss' in m]
+    assert len(test_rows) == 4  # 2 test trials per session
+    assert rank_0['n_train'] == 32
+
+
+def test_shard_data_generator(tmpdir):
+
+    data_dir = os.path.join(tmpdir, 'data')
+    sessions = ['sess-0', 'sess-1']
+    make_data(data_dir, sessions)
+
+    data_generator = make_generator(data_dir, sessions)
+    idxs_full = [d.batch_idxs['train'].copy() for d in data_generator.datasets]
+    assert data_generator.n_tot_batches['train'] == 32
+
+    # shards are disjoint and cover all batches
+    shards = []
+    for rank in range(3):
+        distributed.shard_data_generator(data_generator, rank, 3)
+        shards.append([d.batch_idxs['train'].copy() for d in data_generator.datasets])
+        assert data_generator.n_tot_batches['test'] == 4
+    assert [len(s[0]) for s in shards] == [6, 5, 5]
+    for i, idxs in enumerate(idxs_full):
+        assert np.array_equal(np.sort(np.concatenate([s[i] for s in shards])), np.sort(idxs))
+
+    # iterating over a shard only returns batches from that shard
+    data_generator.reset_iterators('train')
+    batch_idxs = [[] for _ in sessions]
+    for _ in range(data_generator.n_tot_batches['train']):
+        data, dataset = data_generator.next_batch('train')
+        batch_idxs[dataset].append(data['batch_idx'].item())
+    for i in range(len(sessions)):
+        assert np.array_equal(np.sort(batch_idxs[i]), np.sort(shards[-1][i]))
+
+    # undo sharding
+    distributed.shard_data_generator(data_generator, 0, 1)
+    assert data_generator.n_tot_batches['train'] == 32
+
+
+def test_logger_all_reduce_metrics_single_process():
+
+    # no-op outside of a process group
+    logger = Logger(n_datasets=2)
+    logger.update_metrics('train', {'loss': 2.0}, dataset=0)
+    logger.all_reduce_metrics('train')
+    assert logger.get_loss('train') == 2.0
@@ -205,3 +205,106 @@ def test_add_dependent_params(tmpdir):
     namespace, _ = parser.parse_known_args([])
     with pytest.raises(ValueError):
         utils.add_dependent_params(parser, namespace)
+
+
+def test_group_trials():
+
+    trials = []
+    for n_lags in [1, 2]:
+        for lr in [1e-3, 1e-4]:
+            for seed in [0, 1]:
+                trials.append({'n_lags': n_lags, 'learning_rate': lr, 'rng_seed_model': seed})
+
+    # trials only differing in member keys are grouped
+    groups = utils.group_trials(trials, max_group_size=10)
+    assert len(groups) == 2
+    assert [len(g) for g in groups] == [4, 4]
+    assert all(len(set(t['n_lags'] for t in g)) == 1 for g in groups)
+
+    # large groups are split
+    groups = utils.group_trials(trials, max_group_size=3)
+    assert [len(g) for g in groups] == [3, 1, 3, 1]
+
+    # trials that cannot be grouped are fit on their own
+    groups = utils.group_trials(
+        trials, max_group_size=10, can_group=lambda h: h['n_lags'] == 1)
+    assert [len(g) for g in groups] == [4, 1, 1, 1, 1]
+
+
+def _trial_main(hparams):
+    import torch
+    if hparams['behavior'] == 'fail':
+        raise RuntimeError('trial failed')
+    elif hparams['behavior'] == 'crash':
+        os._exit(1)
+    with open(os.path.join(hparams['save_dir'], 'trial_%i.txt' % hparams['idx']), 'w') as f:
+        f.write(str(torch.get_num_threads()))
+
+
+def test_run_local_trials(tmpdir):
+
+    behaviors = ['ok', 'fail', 'crash', 'ok']
+    trials = [
+        {'idx': i, 'behavior': b, 'save_dir': str(tmpdir), 'max_n_epochs': i + 1}
+        for i, b in enumerate(behaviors)]
+    results = utils.run_local_trials(
+        _trial_main, trials, n_workers=2, n_threads=4, start_method='fork', poll_interval=0.05)
+
+    # failures are isolated to their own trials
+    assert [r['status'] for r in results] == ['completed', 'failed', 'crashed', 'completed']
+    assert 'trial failed' in results[1]['error']
+
+    # threads are divided between running trials
+    assert all(1 <= r['n_threads'] <= 4 for r in results)
+    for i in [0, 3]:
+        with open(os.path.join(tmpdir, 'trial_%i.txt' % i)) as f:
+            assert int(f.read()) == results[i]['n_threads']
+
+    # most expensive trial is started first and receives half the threads
+    assert results[3]['n_threads'] == 2
+
+
+def test_estimate_trial_cost():
+
+    ae = {'max_n_epochs': 10, 'y_pixels': 64, 'x_pixels': 64, 'n_input_channels': 1}
+    assert utils.estimate_trial_cost(dict(ae, model_type='conv')) > \
+        utils.estimate_trial_cost(dict(ae, model_type='linear'))
+    dec = {'max_n_epochs': 10, 'n_lags': 4, 'n_hid_layers': 1, 'n_hid_units': 32}
+    assert utils.estimate_trial_cost(dec) > utils.estimate_trial_cost(dict(dec, n_lags=1))
+
+
+def _pid_main(hparams):
+    with open(os.path.join(hparams['save_dir'], 'trial_%i.txt' % hparams['idx']), 'w') as f:
+        f.write(str(os.getpid()))
+
+
+def test_run_local_trials_grouped(tmpdir):
+
+    trials = [{'idx': i, 'data': i % 2, 'save_dir': str(tmpdir)} for i in range(4)]
+    results = utils.run_local_trials(
+        _pid_main, trials, n_workers=2, n_threads=2, group_fn=lambda t: {'data': t['data']},
+        start_method='fork', poll_interval=0.05)
+    assert all(r['status'] == 'completed' for r in results)
+
+    # trials with the same group are fit in the same process
+    pids = []
+    for i in range(4):
+        with open(os.path.join(tmpdir, 'trial_%i.txt' % i)) as f:
+            pids.append(int(f.read()))
+    assert pids[0] == pids[2]
+    assert pids[1] == pids[3]
+    assert pids[0] != pids[1]
+
+
+def test_run_local_trials_grouped_crash(tmpdir):
+
+    # results of trials finished before the process crashed are kept
+    behaviors = ['ok', 'crash', 'ok', 'ok']
+    trials = [
+        {'idx': i, 'behavior': b, 'save_dir': str(tmpdir), 'max_n_epochs': 1}
+        for i, b in enumerate(behaviors)]
+    results = utils.run_local_trials(
+        _trial_main, trials, n_workers=2, n_threads=2, group_fn=lambda t: t['idx'] < 2,
+        start_method='fork', poll_interval=0.05)
+    assert [r['status'] for r in results] == ['completed', 'crashed', 'completed', 'completed']
+    assert results[1]['error'] == 'exit code 1'
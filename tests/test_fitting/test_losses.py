@@ -62,15 +62,48 @@ def test_kl_div_to_std_normal():
 
 
 def test_index_code_mi():
-    pass
+
+    n_batch = 5
+    n_dims = 3
+    z = torch.rand(n_batch, n_dims)
+    mu = torch.rand(n_batch, n_dims)
+    logvar = torch.rand(n_batch, n_dims)
+
+    # blockwise computation
+    ic1 = losses.index_code_mi(z, mu, logvar)
+    for block_size in [1, 2, 5, 10]:
+        ic2 = losses.index_code_mi(z, mu, logvar, block_size=block_size)
+        assert ic1.item() == ic2.item()
 
 
 def test_total_correlation():
-    pass
+
+    n_batch = 5
+    n_dims = 3
+    z = torch.rand(n_batch, n_dims)
+    mu = torch.rand(n_batch, n_dims)
+    logvar = torch.rand(n_batch, n_dims)
+
+    # blockwise computation
+    tc1 = losses.total_correlation(z, mu, logvar)
+    for block_size in [1, 2, 5, 10]:
+        tc2 = losses.total_correlation(z, mu, logvar, block_size=block_size)
+        assert tc1.item() == tc2.item()
 
 
 def test_dimension_wise_kl_to_std_normal():
-    pass
+
+    n_batch = 5
+    n_dims = 3
+    z = torch.rand(n_batch, n_dims)
+    mu = torch.rand(n_batch, n_dims)
+    logvar = torch.rand(n_batch, n_dims)
+
+    # blockwise computation
+    dw1 = losses.dimension_wise_kl_to_std_normal(z, mu, logvar)
+    for block_size in [1, 2, 5, 10]:
+        dw2 = losses.dimension_wise_kl_to_std_normal(z, mu, logvar, block_size=block_size)
+        assert dw1.item() == dw2.item()
 
 
 def test_decomposed_kl():
@@ -93,6 +126,19 @@ def test_decomposed_kl():
     assert tc1.item() == tc2.item()
     assert dw1.item() == dw2.item()
 
+    # blockwise computation, with gradients recomputed block by block
+    z.requires_grad_(True)
+    mu.requires_grad_(True)
+    logvar.requires_grad_(True)
+    terms1 = losses.decomposed_kl(z, mu, logvar)
+    grads1 = torch.autograd.grad(sum(terms1), [z, mu, logvar])
+    terms2 = losses.decomposed_kl(z, mu, logvar, block_size=2)
+    grads2 = torch.autograd.grad(sum(terms2), [z, mu, logvar])
+    for t1, t2 in zip(terms1, terms2):
+        assert t1.item() == t2.item()
+    for g1, g2 in zip(grads1, grads2):
+        assert torch.allclose(g1, g2)
+
 
 def test_subspace_overlap():
 
@@ -127,3 +173,30 @@ def test_subspace_overlap():
     M = torch.from_numpy(np.eye(k)).float()
     overlap = losses.subspace_overlap(M, M)
     assert overlap == 2 * k / ((2 * k) ** 2)
+
+
+def test_r2_variance_weighted():
+
+    from sklearn.metrics import r2_score
+
+    y_true = np.random.randn(50, 4)
+    y_pred = y_true + 0.5 * np.random.randn(50, 4)
+    assert np.isclose(
+        losses.r2_variance_weighted(y_true, y_pred),
+        r2_score(y_true, y_pred, multioutput='variance_weighted'))
+
+    # dimensions without variance are ignored
+    y_true[:, 0] = 1
+    assert np.isclose(
+        losses.r2_variance_weighted(y_true, y_pred),
+        r2_score(y_true, y_pred, multioutput='variance_weighted'))
+
+    # no variance at all
+    assert losses.r2_variance_weighted(np.ones((5, 2)), np.ones((5, 2))) == 1
+    assert losses.r2_variance_weighted(np.ones((5, 2)), np.zeros((5, 2))) == 0
+    assert np.isnan(losses.r2_variance_weighted(np.ones((1, 2)), np.ones((1, 2))))
+
+
+def test_fraction_correct():
+
+    assert losses.fraction_correct(np.array([0, 1, 2, 2]), np.array([0, 1, 1, 2])) == 0.75
@@ -0,0 +1,114 @@
+import pickle
+import numpy as np
+import pytest
+import torch
+from behavenet.fitting import model_export
+
+
+def _get_arch(network_type):
+    from behavenet.models.ae_model_architecture_generator import get_handcrafted_dims
+    input_dim = [1, 16, 16]
+    arch = {
+        'ae_network_type': network_type, 'ae_padding_type': 'same', 'ae_batch_norm': True,
+        'ae_batch_norm_momentum': None, 'ae_decoding_last_FF_layer': 0,
+        'n_input_channels': 1, 'y_pixels': 16, 'x_pixels': 16, 'ae_input_dim': input_dim,
+        'n_ae_latents': 4}
+    if network_type == 'max_pooling':
+        arch.update({
+            'ae_encoding_n_channels': [4, 4, 8, 8],
+            'ae_encoding_kernel_size': [3, 2, 3, 2],
+            'ae_encoding_stride_size': [1, 2, 1, 2],
+            'ae_encoding_layer_type': ['conv', 'maxpool', 'conv', 'maxpool']})
+    else:
+        arch.update({
+            'ae_encoding_n_channels': [4, 8],
+            'ae_encoding_kernel_size': [3, 3],
+            'ae_encoding_stride_size': [2, 2],
+            'ae_encoding_layer_type': ['conv', 'conv']})
+    return get_handcrafted_dims(arch, symmetric=True)
+
+
+@pytest.mark.parametrize('model_class,network_type', [
+    ('ae', 'strides_only'), ('ae', 'max_pooling'), ('vae', 'max_pooling'),
+    ('ps-vae', 'max_pooling')])
+def test_export_ae(tmpdir, model_class, network_type):
+
+    from behavenet.models import AE, VAE, PSVAE
+
+    torch.manual_seed(0)
+    hparams = _get_arch(network_type)
+    hparams.update({
+        'model_class': model_class, 'n_labels': 2, 'max_n_epochs': 1, 'vae.beta': 1,
+        'vae.beta_anneal_epochs': 0, 'ps_vae.alpha': 1, 'ps_vae.beta': 1,
+        'ps_vae.anneal_epochs': 0, 'device': 'cpu'})
+    model = {'ae': AE, 'vae': VAE, 'ps-vae': PSVAE}[model_class](hparams)
+    model.eval()
+    metadata = model_export.export_model(model, str(tmpdir))
+    n_pool = 2 if network_type == 'max_pooling' else 0
+    pool_names = ['pool_idx_%i' % i for i in range(n_pool)]
+    assert metadata['parts']['decoder']['inputs'] == ['latents'] + pool_names
+
+    # exported parts reproduce the model, for other batch sizes than the traced one
+    exported = model_export.ExportedModel(str(tmpdir))
+    frames = np.random.RandomState(0).randint(0, 256, size=(5, 1, 16, 16)).astype('uint8')
+    x = torch.from_numpy(frames).float() / 255
+    outputs = exported.encode(frames)
+    with torch.no_grad():
+        x_hat = model(x, use_mean=True)[0]
+    latents = outputs['latents'] if model_class == 'ae' else outputs['mu']
+    pool_idx = [outputs[name] for name in pool_names]
+    assert np.allclose(exported.decode(latents, pool_idx), x_hat.numpy(), atol=1e-5)
+
+
+def test_export_linear_ae_and_decoders(tmpdir):
+
+    from behavenet.models import AE, Decoder
+
+    # linear autoencoder with tied weights
+    torch.manual_seed(0)
+    hparams = {
+        'model_type': 'linear', 'model_class': 'ae', 'n_input_channels': 1, 'y_pixels': 8,
+        'x_pixels': 8, 'n_ae_latents': 3}
+    model = AE(hparams)
+    model_export.export_model(model, str(tmpdir.join('ae')))
+    exported = model_export.ExportedModel(str(tmpdir.join('ae')))
+    x = torch.rand(4, 1, 8, 8)
+    latents = exported.encode(x.numpy())['latents']
+    with torch.no_grad():
+        x_hat, z = model(x)
+    assert np.allclose(latents, z.numpy(), atol=1e-6)
+    assert np.allclose(exported.decode(latents), x_hat.numpy(), atol=1e-6)
+
+    # export from a version directory
+    version_dir = tmpdir.join('version_0')
+    version_dir.mkdir()
+    with open(str(version_dir.join('meta_tags.pkl')), 'wb') as f:
+        pickle.dump(hparams, f)
+    torch.save(model.state_dict(), str(version_dir.join('best_val_model.pt')))
+    model_export.export_version(str(version_dir))
+    exported = model_export.ExportedModel(str(version_dir.join('export')))
+    assert np.allclose(exported.encode(x.numpy())['latents'], z.numpy(), atol=1e-6)
+
+    # mlp decoders, predictions for trials of any length
+    for model_type, noise_dist in [('mlp', 'gaussian'), ('mlp-mv', 'gaussian-full')]:
+        hparams = {
+            'model_type': model_type, 'input_size': 6, 'output_size': 3, 'n_hid_layers': 1,
+            'n_hid_units': 8, 'n_lags': 2, 'n_max_lags': 2, 'noise_dist': noise_dist,
+            'activation': 'relu'}
+        model = Decoder(hparams)
+        model.eval()
+        save_dir = str(tmpdir.join(model_type))
+        model_export.export_model(model, save_dir)
+        exported = model_export.ExportedModel(save_dir)
+        x = torch.randn(20, 6)
+        outputs = exported.predict(x.numpy())
+        with torch.no_grad():
+            y, precision = model(x)
+        assert np.allclose(outputs['predictions'], y.numpy(), atol=1e-5)
+        if model_type == 'mlp-mv':
+            assert np.allclose(outputs['precision'], precision.numpy(), atol=1e-5)
+        else:
+            assert 'precision' not in outputs
+
+    with pytest.raises(ValueError):
+        model_export.export_model(model, str(tmpdir), format='tflite')
@@ -0,0 +1,163 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from behavenet.fitting import pca
+
+
+def _get_data_generator(tmpdir, n_sessions=2, masks=False, n_trials=10, n_frames=20):
+    """Low-rank images plus noise, with the same pixel means in all sessions."""
+
+    import h5py
+    from behavenet.data.data_generator import ConcatSessionsGenerator
+
+    rng = np.random.RandomState(0)
+    basis = rng.rand(3, 1, 6, 5)
+    ids_list, paths_list = [], []
+    for sess in range(n_sessions):
+        ids = {'lab': 'lab', 'expt': 'expt', 'animal': 'animal', 'session': 'sess%i' % sess}
+        sess_dir = os.path.join(tmpdir, 'lab', 'expt', 'animal', 'sess%i' % sess)
+        os.makedirs(sess_dir)
+        path = os.path.join(sess_dir, 'data.hdf5')
+        with h5py.File(path, 'w') as f:
+            group_i = f.create_group('images')
+            group_m = f.create_group('masks')
+            for tr in range(n_trials):
+                coeffs = rng.rand(n_frames, 3)
+                images = np.einsum('tk,kcyx->tcyx', coeffs, basis) / 3 + 0.02 * rng.rand(
+                    n_frames, 1, 6, 5)
+                group_i.create_dataset(
+                    'trial_%04i' % tr, data=(255 * images).astype('uint8'))
+                mask = np.ones((n_frames, 1, 6, 5), dtype='float32')
+                if masks:
+                    mask[:, :, 0] = rng.rand(n_frames, 1, 5) > 0.5
+                group_m.create_dataset('trial_%04i' % tr, data=mask)
+        ids_list.append(ids)
+        paths_list.append([path, path] if masks else [path])
+    signals = ['images', 'masks'] if masks else ['images']
+    return ConcatSessionsGenerator(
+        str(tmpdir), ids_list, signals_list=[signals] * n_sessions,
+        transforms_list=[[None] * len(signals)] * n_sessions, paths_list=paths_list,
+        device='cpu', rng_seed=0)
+
+
+def _get_frames(data_generator):
+    frames = []
+    data_generator.reset_iterators('train')
+    for _ in range(data_generator.n_tot_batches['train']):
+        data, _ = data_generator.next_batch('train')
+        frames.append(data['images'][0].reshape(data['images'][0].shape[0], -1).numpy())
+    return np.concatenate(frames).astype('float64')
+
+
+def test_compute_pca(tmpdir):
+
+    data_generator = _get_data_generator(tmpdir)
+    frames = _get_frames(data_generator)
+
+    # exact pca matches the svd of all training frames of all sessions
+    results = pca.compute_pca(data_generator, 3, method='exact')
+    mean = frames.mean(axis=0)
+    _, s, vh = np.linalg.svd(frames - mean, full_matrices=False)
+    assert results['n_frames'] == frames.shape[0]
+    assert np.allclose(results['mean'].numpy(), mean)
+    assert np.allclose(results['explained_variance'].numpy(), s[:3] ** 2 / frames.shape[0])
+    assert np.allclose(np.abs(results['components'].numpy()), np.abs(vh[:3].T), atol=1e-6)
+    assert np.isclose(results['total_variance'], np.sum(s ** 2) / frames.shape[0])
+
+    # randomized pca finds the same components
+    results_r = pca.compute_pca(data_generator, 3, method='randomized', n_oversamples=5)
+    assert np.allclose(results_r['components'].numpy(), results['components'].numpy(), atol=1e-4)
+    assert np.allclose(
+        results_r['explained_variance'].numpy(), results['explained_variance'].numpy())
+    assert np.isclose(results_r['total_variance'], results['total_variance'])
+
+    with pytest.raises(ValueError):
+        pca.compute_pca(data_generator, 3, method='svd')
+    with pytest.raises(ValueError):
+        pca.compute_pca(data_generator, 31)
+
+
+def test_compute_pca_masks(tmpdir):
+
+    data_generator = _get_data_generator(tmpdir, n_sessions=1, masks=True)
+    results = pca.compute_pca(data_generator, 2)
+
+    # masked pixels do not contribute to the means
+    frames, masks = [], []
+    data_generator.reset_iterators('train')
+    for _ in range(data_generator.n_tot_batches['train']):
+        data, _ = data_generator.next_batch('train')
+        frames.append(data['images'][0].reshape(data['images'][0].shape[0], -1).numpy())
+        masks.append(np.broadcast_to(
+            data['masks'][0].reshape(-1, frames[-1].shape[1]).numpy(), frames[-1].shape))
+    frames = np.concatenate(frames).astype('float64')
+    masks = np.concatenate(masks).astype('float64')
+    assert np.any(masks == 0)
+    mean = np.sum(frames * masks, axis=0) / np.sum(masks, axis=0)
+    assert np.allclose(results['mean'].numpy(), mean)
+    assert np.allclose(results['components'].T @ results['components'], np.eye(2))
+
+
+def test_fit_pca(tmpdir):
+
+    from behavenet.models import AE
+
+    class Exp(object):
+        def __init__(self, version):
+            self.version = version
+            self.metrics = []
+
+    data_generator = _get_data_generator(tmpdir.join('data'))
+    expt_dir = str(tmpdir.join('expt'))
+    os.makedirs(os.path.join(expt_dir, 'version_0'))
+    hparams = {
+        'model_type': 'linear', 'model_class': 'ae', 'n_input_channels': 1, 'y_pixels': 6,
+        'x_pixels': 5, 'n_ae_latents': 3, 'expt_dir': expt_dir, 'export_latents': False,
+        'device': 'cpu'}
+    torch.manual_seed(0)
+    model = AE(hparams)
+    model.version = 0
+    exp = Exp(0)
+    pca.fit_pca(hparams, model, data_generator, exp)
+
+    # reconstructions are projections onto the principal components
+    results = pca.compute_pca(data_generator, 3)
+    frames = torch.from_numpy(_get_frames(data_generator)).float()
+    centered = frames - results['mean'].float()
+    proj = results['components'].float()
+    x_hat, z = model(frames.reshape(-1, 1, 6, 5))
+    assert torch.allclose(z, centered @ proj, atol=1e-5)
+    assert torch.allclose(
+        x_hat.reshape(frames.shape), centered @ proj @ proj.T + results['mean'].float(),
+        atol=1e-5)
+    assert hparams['pca_explained_variance'] > 0.95
+
+    # same metrics as fit, for all sessions
+    version_dir = os.path.join(expt_dir, 'version_0')
+    assert os.path.exists(os.path.join(version_dir, 'best_val_model.pt'))
+    metrics = pd.read_csv(os.path.join(version_dir, 'metrics.csv'))
+    assert metrics.shape[0] == len(exp.metrics)
+    for prefix in ['tr', 'val']:
+        rows = metrics[metrics['%s_loss' % prefix].notna()]
+        assert sorted(rows.dataset) == [-1, 0, 1]
+    assert metrics.best_val_epoch.dropna().unique().tolist() == [0]
+    assert metrics.test_loss.notna().sum() == data_generator.n_tot_batches['test']
+
+    # mse of the pca solution is not improved by gradient descent
+    tr_loss = metrics.tr_loss[(metrics.dataset == -1) & metrics.tr_loss.notna()].item()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    data_generator.reset_iterators('train')
+    for _ in range(data_generator.n_tot_batches['train']):
+        optimizer.zero_grad()
+        data, dataset = data_generator.next_batch('train')
+        model.loss(data, dataset=dataset, accumulate_grad=True)
+        optimizer.step()
+    loss = 0
+    data_generator.reset_iterators('train')
+    with torch.no_grad():
+        for _ in range(data_generator.n_tot_batches['train']):
+            data, dataset = data_generator.next_batch('train')
+            loss += model.loss(data, dataset=dataset, accumulate_grad=False)['loss']
+    assert loss / data_generator.n_tot_batches['train'] > tr_loss - 1e-6
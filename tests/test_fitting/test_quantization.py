@@ -0,0 +1,94 @@
+import os
+import numpy as np
+import pytest
+import torch
+from behavenet.fitting import quantization
+
+
+def _get_data_generator(tmpdir, signals, n_trials=10, n_frames=10):
+
+    import h5py
+    from behavenet.data.data_generator import ConcatSessionsGenerator
+
+    sess_dir = os.path.join(tmpdir, 'lab', 'expt', 'animal', 'session')
+    os.makedirs(sess_dir)
+    path = os.path.join(sess_dir, 'data.hdf5')
+    rng = np.random.RandomState(0)
+    with h5py.File(path, 'w') as f:
+        for signal, shape in signals.items():
+            group = f.create_group(signal)
+            for tr in range(n_trials):
+                if signal == 'images':
+                    data = rng.randint(0, 256, size=(n_frames, *shape)).astype('uint8')
+                else:
+                    data = rng.randn(n_frames, *shape).astype('float32')
+                group.create_dataset('trial_%04i' % tr, data=data)
+    return ConcatSessionsGenerator(
+        str(tmpdir), [{'lab': 'lab', 'expt': 'expt', 'animal': 'animal', 'session': 'session'}],
+        signals_list=[list(signals.keys())], transforms_list=[[None] * len(signals)],
+        paths_list=[[path] * len(signals)], device='cpu')
+
+
+def test_quantize_ae(tmpdir):
+
+    from behavenet.models.aes import AE
+    from behavenet.models.ae_model_architecture_generator import draw_archs
+
+    input_dim = [1, 16, 16]
+    data_generator = _get_data_generator(tmpdir, {'images': input_dim})
+    np.random.seed(0)
+    torch.manual_seed(0)
+    arch = draw_archs(
+        batch_size=8, input_dim=input_dim, n_ae_latents=4, n_archs=1, check_memory=False)[0]
+    arch.update({
+        'model_class': 'ae', 'n_input_channels': 1, 'y_pixels': 16, 'x_pixels': 16,
+        'expt_dir': str(tmpdir), 'inference_chunk_size': 8})
+    model = AE(arch)
+    model.version = 0
+    model.eval()
+
+    for method in ['static', 'dynamic']:
+        model_q = quantization.quantize_model(
+            model, data_generator, method=method, n_calibration_batches=2)
+        assert model.encoding is not model_q.encoding
+        report = quantization.quantization_report(
+            model, model_q, data_generator, dtype='train', n_batches=2)
+        assert report['n_frames'] == 20
+        assert report['rel_error'] < 0.1
+        assert report['speedup'] > 0
+
+        # saved models are loaded with the same parameters
+        os.makedirs(os.path.join(str(tmpdir), 'version_0'), exist_ok=True)
+        filepath = quantization.save_quantized_model(model_q)
+        assert filepath.endswith('best_val_model_int8_%s.pt' % method)
+        model_l = quantization.load_quantized_model(model, filepath)
+        x = torch.rand(5, *input_dim)
+        assert torch.allclose(model_q.encoding(x)[0], model_l.encoding(x)[0])
+
+    with pytest.raises(ValueError):
+        quantization.quantize_model(model, None, method='static')
+
+
+def test_quantize_decoder(tmpdir):
+
+    from behavenet.models import Decoder
+
+    data_generator = _get_data_generator(tmpdir, {'neural': [12], 'labels': [3]})
+    torch.manual_seed(0)
+    hparams = {
+        'model_type': 'mlp', 'input_size': 12, 'output_size': 3, 'n_hid_layers': 1,
+        'n_hid_units': 16, 'n_lags': 2, 'n_max_lags': 2, 'noise_dist': 'gaussian',
+        'activation': 'relu', 'input_signal': 'neural', 'output_signal': 'labels'}
+    model = Decoder(hparams)
+    model.eval()
+
+    model_q = quantization.quantize_model(model, data_generator, method='static')
+    report = quantization.quantization_report(model, model_q, data_generator)
+    assert report['n_frames'] == 10 * data_generator.n_tot_batches['val']
+    assert report['rel_error'] < 0.1
+
+    filepath = os.path.join(str(tmpdir), 'decoder_int8.pt')
+    quantization.save_quantized_model(model_q, filepath)
+    model_l = quantization.load_quantized_model(model, filepath)
+    x = torch.randn(10, 12)
+    assert torch.allclose(model_q(x)[0], model_l(x)[0])
@@ -0,0 +1,330 @@
+import os
+import pickle
+import numpy as np
+from behavenet.fitting.registry import ExperimentRegistry
+from behavenet.fitting.registry import hash_model_params
+from behavenet.fitting.utils import experiment_exists
+from behavenet.fitting.utils import export_hparams
+
+
+def _get_hparams(expt_dir, learning_rate, training_completed=True):
+    return {
+        'expt_dir': expt_dir, 'rng_seed_data': 0, 'trial_splits': '8;1;1;0', 'train_frac': 1.0,
+        'rng_seed_model': 0, 'model_class': 'ae', 'model_type': 'conv', 'n_ae_latents': 4,
+        'fit_sess_io_layers': False, 'learning_rate': learning_rate, 'l2_reg': 0,
+        'training_completed': training_completed}
+
+
+def test_hash_model_params():
+
+    params = {'a': 1, 'b': [1, 2], 'c': 'x', 'd': 1e-4}
+    assert hash_model_params(params) == hash_model_params(dict(reversed(list(params.items()))))
+    # values that compare equal hash equally
+    assert hash_model_params(params) == hash_model_params(
+        {'a': np.int64(1), 'b': (1.0, 2), 'c': 'x', 'd': np.float64(1e-4)})
+    assert hash_model_params(params) != hash_model_params({**params, 'd': 1e-3})
+
+
+def test_experiment_registry(tmpdir):
+
+    class Exp(object):
+        def __init__(self, version):
+            self.version = version
+
+        def tag(self, hparams):
+            pass
+
+        def save(self):
+            pass
+
+    expt_dir = str(tmpdir)
+
+    # version exported before the registry existed
+    os.makedirs(os.path.join(expt_dir, 'version_0'))
+    with open(os.path.join(expt_dir, 'version_0', 'meta_tags.pkl'), 'wb') as f:
+        pickle.dump(_get_hparams(expt_dir, 1e-4), f)
+    assert not os.path.exists(os.path.join(expt_dir, 'registry.db'))
+    assert experiment_exists(_get_hparams(expt_dir, 1e-4), which_version=True) == (True, 0)
+    assert not experiment_exists(_get_hparams(expt_dir, 1e-3))
+
+    # versions exported with export_hparams are registered directly
+    for version, training_completed in [(1, False), (2, True)]:
+        os.makedirs(os.path.join(expt_dir, 'version_%i' % version))
+        export_hparams(_get_hparams(expt_dir, 1e-3, training_completed), Exp(version))
+    registry = ExperimentRegistry(expt_dir)
+    params = {key: val for key, val in _get_hparams(expt_dir, 1e-3).items()
+              if key not in ['expt_dir', 'training_completed']}
+    assert registry.find(params) == [2]
+    assert registry.find(params, training_completed=False) == [1, 2]
+    assert experiment_exists(_get_hparams(expt_dir, 1e-3), which_version=True) == (True, 2)
+
+    # deleted versions are removed on sync
+    os.remove(os.path.join(expt_dir, 'version_2', 'meta_tags.pkl'))
+    os.rmdir(os.path.join(expt_dir, 'version_2'))
+    assert not experiment_exists(_get_hparams(expt_dir, 1e-3))
+    assert registry.find(params, training_completed=False) == [1]
+
+    # rebuild from directory tree
+    registry.rebuild()
+    assert registry.find(params, training_completed=False) == [1]
+    assert experiment_exists(_get_hparams(expt_dir, 1e-4))
+
+    # corrupted registry is not deleted; all versions are searched instead
+    with open(registry.db_file, 'w') as f:
+        f.write('not a database')
+    assert experiment_exists(_get_hparams(expt_dir, 1e-4), which_version=True) == (True, 0)
+    with open(registry.db_file, 'r') as f:
+        assert f.read() == 'not a database'
+
+
+def test_registry_unavailable(tmpdir):
+
+    import pandas as pd
+    from behavenet.fitting.utils import get_best_model_version
+
+    class Exp(object):
+        version = 1
+
+        def tag(self, hparams):
+            pass
+
+        def save(self):
+            pass
+
+    # registry cannot be opened, e.g. in a read-only experiment directory
+    expt_dir = str(tmpdir)
+    os.makedirs(os.path.join(expt_dir, 'registry.db'))
+    for version, val_loss in enumerate([2., 1.]):
+        os.makedirs(os.path.join(expt_dir, 'version_%i' % version))
+        pd.DataFrame({'val_loss': [val_loss]}).to_csv(
+            os.path.join(expt_dir, 'version_%i' % version, 'metrics.csv'), index=False)
+    with open(os.path.join(expt_dir, 'version_0', 'meta_tags.pkl'), 'wb') as f:
+        pickle.dump(_get_hparams(expt_dir, 1e-4), f)
+    export_hparams(_get_hparams(expt_dir, 1e-3), Exp())
+    assert experiment_exists(_get_hparams(expt_dir, 1e-3), which_version=True) == (True, 1)
+    assert get_best_model_version(expt_dir) == [1]
+    assert os.path.isdir(os.path.join(expt_dir, 'registry.db'))
+
+
+def test_get_best_measures(tmpdir):
+
+    import pandas as pd
+    from behavenet.fitting.utils import get_best_model_version
+
+    expt_dir = str(tmpdir)
+    results = [(2., True), (1., True), (0., False)]
+    for version, (val_loss, training_completed) in enumerate(results):
+        version_dir = os.path.join(expt_dir, 'version_%i' % version)
+        os.makedirs(version_dir)
+        with open(os.path.join(version_dir, 'meta_tags.pkl'), 'wb') as f:
+            pickle.dump({'training_completed': training_completed}, f)
+        pd.DataFrame({'val_loss': [val_loss + 1, val_loss, np.nan]}).to_csv(
+            os.path.join(version_dir, 'metrics.csv'), index=False)
+
+    registry = ExperimentRegistry(expt_dir)
+    versions = ['version_0', 'version_1', 'version_2']
+    assert registry.get_best_measures(versions) == {'version_0': 2., 'version_1': 1.}
+    assert registry.get_best_measures(versions, best_def='max') == {
+        'version_0': 3., 'version_1': 2.}
+    assert get_best_model_version(expt_dir) == [1]
+
+    # cached values are used without reading files
+    conn = registry._connect()
+    with conn:
+        conn.execute('UPDATE best_measures SET value = 5 WHERE version = 1')
+    conn.close()
+    assert get_best_model_version(expt_dir) == [0]
+
+    # re-registered versions are read again
+    version_dir = os.path.join(expt_dir, 'version_1')
+    metrics_file = os.path.join(version_dir, 'metrics.csv')
+    pd.DataFrame({'val_loss': [0.5]}).to_csv(metrics_file, index=False)
+    registry.update(1, {'training_completed': True})
+    assert registry.get_best_measures(versions)['version_1'] == 0.5
+    with open(os.path.join(expt_dir, 'version_2', 'meta_tags.pkl'), 'wb') as f:
+        pickle.dump({'training_completed': True}, f)
+    registry.update(2, {'training_completed': True})
+    assert get_best_model_version(expt_dir) == [2]
+
+    # deleted versions are dropped
+    for filename in ['meta_tags.pkl', 'metrics.csv']:
+        os.remove(os.path.join(expt_dir, 'version_2', filename))
+    os.rmdir(os.path.join(expt_dir, 'version_2'))
+    assert get_best_model_version(expt_dir) == [1]
+
+
+def _allocate_version(expt_dir):
+    from behavenet.fitting.registry import allocate_version
+    return allocate_version(expt_dir)
+
+
+def test_allocate_version(tmpdir):
+
+    from multiprocessing import get_context
+
+    expt_dir = str(tmpdir)
+    os.makedirs(os.path.join(expt_dir, 'version_3'))
+    with get_context('fork').Pool(4) as pool:
+        versions = pool.map(_allocate_version, [expt_dir] * 8)
+    assert sorted(versions) == list(range(4, 12))
+
+
+def test_claim(tmpdir):
+
+    import time
+    from behavenet.fitting.registry import allocate_version
+
+    expt_dir = str(tmpdir)
+    registry = ExperimentRegistry(expt_dir)
+    hparams = _get_hparams(expt_dir, 1e-4, training_completed=False)
+    params = {key: val for key, val in hparams.items()
+              if key not in ['expt_dir', 'training_completed']}
+
+    def _set_pid(pid):
+        conn = registry._connect()
+        with conn:
+            conn.execute('UPDATE claims SET pid = ?', (pid,))
+        conn.close()
+
+    # concurrent job with the same params cannot claim them
+    version_0 = allocate_version(expt_dir)
+    version_1 = allocate_version(expt_dir)
+    assert registry.claim(params, version_0)
+    _set_pid(os.getppid())
+    assert not registry.claim(params, version_1)
+    assert registry.claim({**params, 'learning_rate': 1e-3}, version_1)
+
+    # claims of dead processes are stale
+    _set_pid(2 ** 22 + 1)
+    assert registry.claim(params, version_1)
+
+    # claims left by a failed fit of the current process do not block a retry
+    assert registry.claim(params, version_0)
+
+    # claims of versions that have not been modified for a while are stale
+    _set_pid(os.getppid())
+    registry.claim_timeout = 0.1
+    time.sleep(0.2)
+    assert registry.claim(params, version_0)
+
+    # claim is released once training has completed; model cannot be claimed again
+    class Exp(object):
+        version = version_0
+
+        def tag(self, hparams):
+            pass
+
+        def save(self):
+            pass
+
+    registry.claim_timeout = 3600
+    export_hparams({**hparams, 'training_completed': True}, Exp())
+    conn = registry._connect()
+    assert conn.execute('SELECT COUNT(*) FROM claims').fetchone()[0] == 1
+    conn.close()
+    assert not registry.claim(params, version_1)
+
+
+def test_claim_retry_after_exception(tmpdir):
+
+    from behavenet.fitting.registry import allocate_version
+
+    class Exp(object):
+        def __init__(self, version):
+            self.version = version
+
+        def tag(self, hparams):
+            pass
+
+        def save(self):
+            pass
+
+    expt_dir = str(tmpdir)
+    registry = ExperimentRegistry(expt_dir)
+    hparams = _get_hparams(expt_dir, 1e-4, training_completed=False)
+    params = {key: val for key, val in hparams.items()
+              if key not in ['expt_dir', 'training_completed']}
+
+    # trial claims its params and raises before training completes
+    version = allocate_version(expt_dir)
+    try:
+        assert registry.claim(params, version)
+        raise RuntimeError('fit failed')
+    except RuntimeError:
+        pass
+
+    # retry of the trial in the same process
+    version = allocate_version(expt_dir)
+    assert registry.claim(params, version)
+    export_hparams({**hparams, 'training_completed': True}, Exp(version))
+    assert experiment_exists(hparams, which_version=True) == (True, version)
+
+
+def test_find_neighbors(tmpdir):
+
+    expt_dir = str(tmpdir)
+    registry = ExperimentRegistry(expt_dir)
+    results = [
+        (1e-4, 1, True), (1e-4, 4, True), (1e-4, 2, False), (1e-3, 1, True), (1e-4, 'x', True)]
+    for version, (learning_rate, beta, training_completed) in enumerate(results):
+        hparams = _get_hparams(expt_dir, learning_rate, training_completed)
+        hparams.update({'model_class': 'vae', 'vae.beta': beta})
+        registry.update(version, hparams)
+
+    params = {key: val for key, val in _get_hparams(expt_dir, 1e-4).items()
+              if key not in ['expt_dir', 'training_completed']}
+    params.update({'model_class': 'vae', 'vae.beta': 3})
+    # nearest completed versions with the same learning rate and a numeric beta
+    assert registry.find_neighbors(params, ['vae.beta']) == [(1, 0.25), (0, 2 / 3)]
+    assert registry.find_neighbors(params, ['vae.beta'], training_completed=False) == [
+        (1, 0.25), (2, 1 / 3), (0, 2 / 3)]
+    assert registry.find_neighbors(params, []) == []
+
+
+def test_find_warm_start_model(tmpdir):
+
+    import torch
+    from behavenet.fitting.utils import find_warm_start_model
+
+    class Exp(object):
+        def __init__(self, version):
+            self.version = version
+
+        def tag(self, hparams):
+            pass
+
+        def save(self):
+            pass
+
+    def _get_expt_hparams(n_ae_latents, beta, n_channels=8, training_completed=True):
+        expt_dir = os.path.join(str(tmpdir), '%02i_latents' % n_ae_latents, 'expt')
+        hparams = _get_hparams(expt_dir, 1e-4, training_completed)
+        hparams.update({
+            'experiment_name': 'expt', 'model_class': 'vae', 'n_ae_latents': n_ae_latents,
+            'vae.beta': beta, 'architecture_params': {
+                'ae_encoding_n_channels': [4, n_channels], 'n_ae_latents': n_ae_latents,
+                'mem_size_gb': 0.1 * n_ae_latents}})
+        return hparams
+
+    def _export(hparams):
+        version = len(os.listdir(hparams['expt_dir'])) if os.path.isdir(hparams['expt_dir']) \
+            else 0
+        version_dir = os.path.join(hparams['expt_dir'], 'version_%i' % version)
+        os.makedirs(version_dir)
+        export_hparams(hparams, Exp(version))
+        torch.save({}, os.path.join(version_dir, 'best_val_model.pt'))
+        return os.path.join(version_dir, 'best_val_model.pt')
+
+    hparams = _get_expt_hparams(8, 1)
+    os.makedirs(hparams['expt_dir'])
+    assert find_warm_start_model(hparams) is None
+
+    # only completed models with the same architecture are used
+    model_files = [
+        _export(_get_expt_hparams(4, 1)),
+        _export(_get_expt_hparams(8, 4)),
+        _export(_get_expt_hparams(8, 1, n_channels=16)),
+        _export(_get_expt_hparams(8, 2, training_completed=False))]
+    assert find_warm_start_model(hparams) == model_files[0]
+    assert find_warm_start_model(_get_expt_hparams(8, 3)) == model_files[1]
+    assert find_warm_start_model(_get_expt_hparams(8, 1, n_channels=16)) == model_files[2]
@@ -0,0 +1,57 @@
+import os
+import pytest
+from behavenet.fitting.session_index import SessionIndex
+from behavenet.fitting.utils import export_session_info_to_csv
+
+
+def _set_old_mtime(path, mtime=10 ** 18):
+    # entries modified within the last few seconds are not cached
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_session_index(tmpdir):
+
+    save_dir = str(tmpdir)
+    lab_dir = os.path.join(save_dir, 'lab')
+    for expt in ['expt0', 'expt1']:
+        os.makedirs(os.path.join(lab_dir, expt))
+    sessions = [
+        {'lab': 'lab', 'expt': 'expt0', 'animal': 'animal', 'session': 'session'},
+        {'lab': 'lab', 'expt': 'expt1', 'animal': 'animal', 'session': 'session'}]
+    multi_dir = os.path.join(lab_dir, 'multisession-00')
+    export_session_info_to_csv(multi_dir, sessions)
+    _set_old_mtime(lab_dir)
+    _set_old_mtime(os.path.join(multi_dir, 'session_info.csv'))
+
+    index = SessionIndex(save_dir)
+    assert sorted(index.get_subdirs(lab_dir)) == ['expt0', 'expt1', 'multisession-00']
+    assert index.read_session_info(multi_dir) == sessions
+    with pytest.raises(StopIteration):
+        index.get_subdirs(multi_dir)
+    with pytest.raises(NotADirectoryError):
+        index.get_subdirs(os.path.join(save_dir, 'ZzZtestingZzZ'))
+
+    # recently modified directories are not cached
+    assert lab_dir in index.subdirs
+    assert os.path.join(save_dir, 'lab', 'expt0') not in index.subdirs
+
+    # index is persistent
+    index.flush()
+    index = SessionIndex(save_dir)
+    assert lab_dir in index.subdirs
+    assert os.path.join(multi_dir, 'session_info.csv') in index.session_info
+
+    # cached entries are used while mtimes are unchanged...
+    index.subdirs[lab_dir][1] = ['expt0']
+    assert index.get_subdirs(lab_dir) == ['expt0']
+    # ...and refreshed otherwise
+    os.makedirs(os.path.join(lab_dir, 'expt2'))
+    assert sorted(index.get_subdirs(lab_dir)) == [
+        'expt0', 'expt1', 'expt2', 'multisession-00']
+    export_session_info_to_csv(multi_dir, sessions[:1])
+    _set_old_mtime(os.path.join(multi_dir, 'session_info.csv'), 10 ** 18 + 1)
+    assert index.read_session_info(multi_dir) == sessions[:1]
+
+    # returned session dicts can be modified
+    index.read_session_info(multi_dir)[0].pop('lab')
+    assert index.read_session_info(multi_dir) == sessions[:1]
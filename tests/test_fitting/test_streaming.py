@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+import torch
+from behavenet.fitting.streaming import LatencyTracker, StreamingEncoder
+
+
+def _get_ae(input_dim, n_ae_latents=4):
+    from behavenet.models.aes import AE
+    from behavenet.models.ae_model_architecture_generator import draw_archs
+    np.random.seed(0)
+    torch.manual_seed(0)
+    arch = draw_archs(
+        batch_size=10, input_dim=input_dim, n_ae_latents=n_ae_latents, n_archs=1,
+        check_memory=False)[0]
+    arch['model_class'] = 'ae'
+    arch['n_input_channels'] = input_dim[0]
+    arch['y_pixels'] = input_dim[1]
+    arch['x_pixels'] = input_dim[2]
+    return AE(arch)
+
+
+def test_latency_tracker():
+
+    tracker = LatencyTracker()
+    assert tracker.summary() == {'n_samples': 0}
+    tracker.update([0.0, 0.5], 1.0)
+    tracker.update(1.0, 1.5)
+    summary = tracker.summary(percentiles=(50, 100))
+    assert summary['n_samples'] == 3
+    assert np.isclose(summary['throughput'], 2)
+    assert np.isclose(summary['p50_ms'], 500)
+    assert np.isclose(summary['p100_ms'], 1000)
+    assert np.isclose(summary['max_ms'], 1000)
+
+
+def test_streaming_encoder():
+
+    input_dim = [1, 32, 32]
+    model = _get_ae(input_dim)
+    model.eval()
+    frames = np.random.randint(0, 256, size=(5, 32, 32), dtype='uint8')
+    with torch.no_grad():
+        latents_ = model.encoding(torch.from_numpy(frames[:, None] / 255).float())[0].numpy()
+
+    # single frames and micro-batches
+    encoder = StreamingEncoder(model, batch_size=3, max_delay=60)
+    assert np.allclose(encoder.encode(frames[0]), latents_[:1], atol=1e-5)
+    assert np.allclose(encoder.encode(frames[:, None]), latents_, atol=1e-5)
+    assert encoder.n_frames == 6
+    encoder.reset()
+
+    # queued frames are encoded once the queue is full
+    idxs, latents = encoder.push(frames[0])
+    assert len(idxs) == 0 and latents.shape == (0, 4)
+    encoder.push(frames[1])
+    idxs, latents = encoder.push(frames[2])
+    assert np.array_equal(idxs, [0, 1, 2])
+    assert np.allclose(latents, latents_[:3], atol=1e-5)
+    encoder.push(frames[3])
+    idxs, latents = encoder.flush()
+    assert np.array_equal(idxs, [3])
+    assert np.allclose(latents, latents_[3:4], atol=1e-5)
+    assert encoder.latency.summary()['n_samples'] == 4
+
+    # ... or once the oldest frame has waited too long
+    encoder.max_delay = 0
+    idxs, latents = encoder.push(frames[4])
+    assert np.array_equal(idxs, [4])
+
+    # frames of a different size
+    frames_large = np.repeat(np.repeat(frames, 2, axis=1), 2, axis=2)
+    with pytest.raises(ValueError):
+        encoder.encode(frames_large[0])
+    encoder.resize = True
+    assert encoder.encode(frames_large[0]).shape == (1, 4)
+
+
+def test_streaming_decoder():
+
+    from behavenet.fitting.streaming import StreamingDecoder
+    from behavenet.models import Decoder
+
+    torch.manual_seed(0)
+    x = torch.randn(50, 6)
+    for n_hid_layers, n_lags in [(0, 3), (2, 2), (1, 0)]:
+        hparams = {
+            'model_type': 'mlp', 'input_size': 6, 'output_size': 3, 'n_hid_layers': n_hid_layers,
+            'n_hid_units': 8, 'n_lags': n_lags, 'n_max_lags': n_lags, 'noise_dist': 'poisson',
+            'activation': 'relu', 'input_signal': 'neural', 'output_signal': 'labels'}
+        model = Decoder(hparams)
+        model.eval()
+        with torch.no_grad():
+            y_, _ = model(x)
+        decoder = StreamingDecoder(model)
+
+        # frame by frame, predictions are emitted with a lag of n_lags frames
+        idxs, y = [], []
+        for t in range(x.shape[0]):
+            idxs_, y_t = decoder.push(x[t].numpy())
+            assert np.array_equal(idxs_, [t - n_lags] if t >= n_lags else [])
+            idxs.append(idxs_)
+            y.append(y_t)
+        idxs_, y_t = decoder.flush()
+        idxs.append(idxs_)
+        y.append(y_t)
+        assert np.array_equal(np.concatenate(idxs), np.arange(x.shape[0]))
+        assert np.allclose(np.concatenate(y), y_.numpy(), atol=1e-5)
+
+        # micro-batches, new trial
+        y = [decoder.push(x[i:i + 7])[1] for i in range(0, 14, 7)] + [decoder.flush()[1]]
+        assert np.allclose(np.concatenate(y), model(x[:14])[0].detach().numpy(), atol=1e-5)
+
+        # trials shorter than the window
+        y = [decoder.push(x[:2])[1], decoder.flush()[1]]
+        assert np.allclose(np.concatenate(y), model(x[:2])[0].detach().numpy(), atol=1e-5)
+
+
+def test_streaming_decoder_precision():
+
+    from behavenet.fitting.streaming import StreamingDecoder
+    from behavenet.models import Decoder
+
+    torch.manual_seed(0)
+    x = torch.randn(20, 6)
+    for n_hid_layers in [0, 2]:
+        hparams = {
+            'model_type': 'mlp-mv', 'input_size': 6, 'output_size': 3,
+            'n_hid_layers': n_hid_layers, 'n_hid_units': 8, 'n_lags': 2, 'n_max_lags': 2,
+            'noise_dist': 'gaussian-full', 'activation': 'relu', 'input_signal': 'neural',
+            'output_signal': 'labels'}
+        model = Decoder(hparams)
+        model.eval()
+        with torch.no_grad():
+            y_, precision_ = model(x)
+        decoder = StreamingDecoder(model)
+        outputs = [decoder.push(x[t]) for t in range(x.shape[0])] + [decoder.flush()]
+        assert all(len(output) == 3 for output in outputs)
+        assert np.allclose(np.concatenate([o[1] for o in outputs]), y_.numpy(), atol=1e-5)
+        assert np.allclose(
+            np.concatenate([o[2] for o in outputs]), precision_.numpy(), atol=1e-5)
@@ -0,0 +1,197 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from behavenet.fitting.training import MetricsWriter
+from behavenet.fitting.training import PhaseTimer
+
+
+def test_phase_timer(tmpdir):
+
+    # disabled timer records nothing
+    timer = PhaseTimer(enabled=False)
+    timer.start('a')
+    timer.stop('a', dataset=0)
+    assert timer.times == {}
+    assert timer.summary() == ''
+
+    # accumulate over phases and sessions
+    timer = PhaseTimer(enabled=True)
+    for dataset in [0, 1, 1]:
+        timer.start('train/loss')
+        timer.stop('train/loss', dataset)
+    timer.start('logging')
+    timer.stop('logging')
+    assert timer.counts[('train/loss', 0)] == 1
+    assert timer.counts[('train/loss', 1)] == 2
+    assert timer.counts[('logging', -1)] == 1
+
+    # export to csv, one row per phase/session pair per epoch
+    filepath = os.path.join(tmpdir, 'phase_timing.csv')
+    timer.export_epoch(0, filepath)
+    assert timer.times == {}
+    timer.start('train/loss')
+    timer.stop('train/loss', 0)
+    timer.export_epoch(1, filepath)
+    df = pd.read_csv(filepath)
+    assert list(df.columns) == ['epoch', 'phase', 'dataset', 'n_calls', 'total_s', 'mean_ms']
+    assert df.shape[0] == 4
+    assert df[(df.epoch == 0) & (df.phase == 'train/loss')].n_calls.sum() == 3
+
+    # summary table sums over sessions and epochs
+    summary = timer.summary()
+    line = [ln for ln in summary.split('\n') if ln.startswith('train/loss')][0]
+    assert int(line.split()[1]) == 4
+    assert 'wall time' in summary
+
+
+def test_phase_timer_context(tmpdir):
+
+    timer = PhaseTimer(enabled=True)
+    with timer.phase('train/loss', 0):
+        pass
+    with timer.phase('train/next_batch') as phase:
+        phase.dataset = 1
+    assert timer.counts == {('train/loss', 0): 1, ('train/next_batch', 1): 1}
+
+    # failed phases are not timed
+    with pytest.raises(ValueError):
+        with timer.phase('logging'):
+            raise ValueError
+    assert ('logging', -1) not in timer.counts
+
+
+def test_fit_trace_on_failure(tmpdir, monkeypatch):
+
+    from behavenet import tracing
+    from behavenet.fitting import training
+
+    class Exp(object):
+        version = 0
+
+    def _fit(*args, **kwargs):
+        raise RuntimeError('training failed')
+
+    monkeypatch.setattr(training, '_fit', _fit)
+    os.makedirs(os.path.join(tmpdir, 'version_0'))
+    hparams = {'expt_dir': str(tmpdir), 'export_trace': True}
+    with pytest.raises(RuntimeError):
+        training.fit(hparams, None, None, Exp())
+    # tracing is stopped and the partial trace is saved
+    assert not tracing.is_tracing()
+    assert os.path.exists(os.path.join(tmpdir, 'version_0', 'trace_fit.json'))
+
+
+def test_metrics_writer(tmpdir):
+
+    class Exp(object):
+        def __init__(self):
+            self.metrics = []
+
+    filepath = os.path.join(tmpdir, 'metrics.csv')
+    exp = Exp()
+    writer = MetricsWriter(filepath, exp=exp, flush_interval=1000)
+
+    # rows are buffered until the flush interval has passed
+    writer.log({'epoch': 0, 'batch': 0, 'trial': -1, 'best_val_epoch': None,
+                'val_loss': np.float32(1.5), 'dataset': -1})
+    writer.flush()
+    assert not os.path.exists(filepath)
+    writer.flush(force=True)
+    assert pd.read_csv(filepath).shape[0] == 1
+
+    # new columns trigger a rewrite, existing columns are appended
+    writer.flush_interval = 0
+    writer.log({'epoch': 0, 'batch': 0, 'trial': -1, 'tr_loss': 2.0, 'dataset': -1})
+    writer.flush()
+    writer.log({'epoch': 1, 'batch': 0, 'trial': -1, 'tr_loss': 1.0, 'dataset': -1})
+    writer.close()
+
+    df = pd.read_csv(filepath)
+    assert df.shape[0] == 3
+    assert list(df.columns) == [
+        'epoch', 'batch', 'trial', 'best_val_epoch', 'val_loss', 'dataset', 'created_at',
+        'tr_loss']
+    assert np.isnan(df.tr_loss[0]) and df.tr_loss[2] == 1.0
+    assert df.val_loss[0] == 1.5
+
+    # same file as the one written by test-tube from the experiment metrics
+    assert len(exp.metrics) == 3
+    filepath_tt = os.path.join(tmpdir, 'metrics_tt.csv')
+    pd.DataFrame(exp.metrics).to_csv(filepath_tt, index=False)
+    pd.testing.assert_frame_equal(pd.read_csv(filepath_tt), df)
+
+
+def test_fit_decoder_stack(tmpdir):
+
+    import h5py
+    import torch
+    from behavenet.data.data_generator import ConcatSessionsGenerator
+    from behavenet.fitting.training import fit_decoder_stack
+    from behavenet.models import Decoder, DecoderStack
+
+    class Exp(object):
+        def __init__(self, version):
+            self.version = version
+            self.metrics = []
+
+    # data
+    data_dir = os.path.join(tmpdir, 'data')
+    sess_dir = os.path.join(data_dir, 'lab', 'expt', 'animal', 'session')
+    os.makedirs(sess_dir)
+    with h5py.File(os.path.join(sess_dir, 'data.hdf5'), 'w') as f:
+        for signal, n_channels in [('neural', 5), ('labels', 3)]:
+            group = f.create_group(signal)
+            for tr in range(10):
+                group.create_dataset(
+                    'trial_%04i' % tr, data=np.random.randn(20, n_channels).astype('float32'))
+    data_generator = ConcatSessionsGenerator(
+        data_dir, [{'lab': 'lab', 'expt': 'expt', 'animal': 'animal', 'session': 'session'}],
+        signals_list=[['neural', 'labels']], transforms_list=[[None, None]],
+        paths_list=[[os.path.join(sess_dir, 'data.hdf5')] * 2], device='cpu', as_numpy=False,
+        batch_load=True, rng_seed=0)
+
+    # models
+    expt_dir = os.path.join(tmpdir, 'expt')
+    hparams_list, models, exps = [], [], []
+    for version, lr in enumerate([1e-3, 1e-2]):
+        os.makedirs(os.path.join(expt_dir, 'version_%i' % version))
+        hparams = {
+            'model_type': 'mlp', 'input_size': 5, 'output_size': 3, 'n_hid_layers': 1,
+            'n_hid_units': 8, 'n_lags': 1, 'n_max_lags': 1, 'noise_dist': 'gaussian',
+            'activation': 'relu', 'input_signal': 'neural', 'output_signal': 'labels',
+            'learning_rate': lr, 'enable_early_stop': version == 0, 'early_stop_history': 1,
+            'min_n_epochs': 1, 'max_n_epochs': 4, 'val_check_interval': 1, 'rng_seed_train': 0,
+            'export_predictions': False, 'expt_dir': expt_dir, 'metrics_flush_interval': 0}
+        hparams_list.append(hparams)
+        models.append(Decoder(hparams))
+        exps.append(Exp(version))
+
+    fit_decoder_stack(hparams_list, DecoderStack(models), data_generator, exps)
+
+    for exp in exps:
+        version_dir = os.path.join(expt_dir, 'version_%i' % exp.version)
+        assert os.path.exists(os.path.join(version_dir, 'best_val_model.pt'))
+        metrics = pd.read_csv(os.path.join(version_dir, 'metrics.csv'))
+        assert metrics.shape[0] == len(exp.metrics)
+        assert metrics.test_loss.notna().sum() == data_generator.n_tot_batches['test']
+        # models saved by each member can be loaded into a single decoder
+        model = Decoder(hparams_list[exp.version])
+        model.load_state_dict(torch.load(os.path.join(version_dir, 'best_val_model.pt')))
+    # member without early stopping trains for all epochs
+    metrics = pd.read_csv(os.path.join(expt_dir, 'version_1', 'metrics.csv'))
+    assert metrics.epoch.max() == 4
+
+
+def test_main_stack_fallback(monkeypatch):
+
+    from behavenet.fitting import decoder_grid_search
+
+    fit_trials = []
+    monkeypatch.setattr(
+        decoder_grid_search, 'main', lambda hparams, *args: fit_trials.append(hparams))
+
+    # lstm decoders cannot be stacked and are fit one at a time
+    hparams_list = [{'model_type': 'lstm', 'learning_rate': lr} for lr in [1e-3, 1e-4]]
+    decoder_grid_search.main_stack(hparams_list)
+    assert fit_trials == hparams_list
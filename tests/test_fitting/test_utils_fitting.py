@@ -1083,6 +1083,59 @@ class TestClass:
         with pytest.raises(NotImplementedError):
             utils.get_model_params({**misc_hparams, **base_hparams, **model_hparams})
 
+    def test_get_data_params(self):
+
+        base_hparams = {
+            'data_dir': '/tmp/path', 'rng_seed_data': 4, 'trial_splits': '4;1;1;0',
+            'train_frac': 0.9, 'rng_seed_model': 11, 'learning_rate': 1e-4, 'l2_reg': 1e-2}
+
+        # ae: architecture and training params do not affect data
+        ae_hparams = {
+            **base_hparams, 'model_class': 'ae', 'model_type': 'conv', 'n_ae_latents': 5,
+            'fit_sess_io_layers': False}
+        assert utils.get_data_params(ae_hparams) == {
+            'rng_seed_data': 4, 'trial_splits': '4;1;1;0', 'train_frac': 0.9, 'model_class': 'ae',
+            'data_dir': '/tmp/path'}
+        assert utils.get_data_params(ae_hparams) == utils.get_data_params(
+            {**ae_hparams, 'n_ae_latents': 8, 'learning_rate': 1e-3, 'rng_seed_model': 0})
+        assert utils.get_data_params(ae_hparams) != utils.get_data_params(
+            {**ae_hparams, 'rng_seed_data': 0})
+
+        # decoders: upstream ae defines the data
+        dec_hparams = {
+            **base_hparams, 'model_class': 'neural-ae', 'model_type': 'mlp', 'n_ae_latents': 5,
+            'ae_experiment_name': 'ae', 'ae_version': 0, 'ae_model_class': 'ae',
+            'ae_model_type': 'conv', 'n_lags': 2, 'n_hid_layers': 0, 'activation': 'relu',
+            'subsample_method': 'none'}
+        data_params = utils.get_data_params(dec_hparams)
+        assert data_params['n_ae_latents'] == 5
+        assert 'n_lags' not in data_params
+        assert data_params == utils.get_data_params({**dec_hparams, 'n_lags': 4})
+        assert data_params != utils.get_data_params({**dec_hparams, 'n_ae_latents': 8})
+
+        # arhmms: number of states and lags do not affect data
+        arhmm_hparams = {
+            **base_hparams, 'model_class': 'arhmm', 'model_type': None, 'n_ae_latents': 5,
+            'n_arhmm_states': 4, 'n_arhmm_lags': 1, 'noise_type': 'gaussian',
+            'transitions': 'sticky', 'kappa': 1e4, 'ae_experiment_name': 'ae', 'ae_version': 0,
+            'ae_model_class': 'ae', 'ae_model_type': 'conv'}
+        data_params = utils.get_data_params(arhmm_hparams)
+        assert 'n_arhmm_states' not in data_params
+        assert data_params == utils.get_data_params(
+            {**arhmm_hparams, 'n_arhmm_states': 8, 'n_arhmm_lags': 2, 'kappa': 1e2})
+        assert data_params != utils.get_data_params({**arhmm_hparams, 'n_ae_latents': 8})
+
+        # decoders of arhmm states: upstream arhmm defines the data
+        dec_hparams = {
+            **base_hparams, 'model_class': 'neural-arhmm', 'model_type': 'mlp',
+            'n_ae_latents': 5, 'n_arhmm_states': 4, 'n_arhmm_lags': 1, 'noise_type': 'gaussian',
+            'transitions': 'stationary', 'arhmm_experiment_name': 'arhmm', 'arhmm_version': 0,
+            'ae_model_class': 'ae', 'ae_model_type': 'conv', 'n_lags': 2, 'n_hid_layers': 0,
+            'activation': 'relu', 'subsample_method': 'none'}
+        data_params = utils.get_data_params(dec_hparams)
+        assert data_params['n_arhmm_states'] == 4
+        assert data_params != utils.get_data_params({**dec_hparams, 'n_arhmm_states': 8})
+
     def test_get_region_dir(self):
 
         # no subsample method specified
@@ -38,6 +38,29 @@ def test_draw_archs():
         assert matching == 1
 
 
+def test_draw_archs_cost_budget():
+
+    n_archs = 3
+    input_dim = [1, 64, 64]
+    budget = {'flops': 2e7, 'train_bytes': 2e8}
+    archs = utils.draw_archs(
+        batch_size=16, input_dim=input_dim, n_ae_latents=6, n_archs=n_archs,
+        check_memory=False, cost_budget=budget, sort_by='latency_ms')
+    assert len(archs) == n_archs
+    costs = [utils.estimate_arch_cost(arch, batch_size=16) for arch in archs]
+    for cost in costs:
+        assert cost['flops'] <= budget['flops']
+        assert cost['train_bytes'] <= budget['train_bytes']
+    latencies = [cost['latency_ms'] for cost in costs]
+    assert latencies == sorted(latencies)
+
+    # unreachable budget
+    with pytest.raises(ValueError):
+        utils.draw_archs(
+            batch_size=16, input_dim=input_dim, n_ae_latents=6, n_archs=1, check_memory=False,
+            cost_budget={'n_params': 0})
+
+
 def test_get_possible_arch():
 
     input_dim = [2, 32, 32]
@@ -371,6 +394,105 @@ def test_estimate_model_footprint():
     assert 100 < f2a < f2
 
 
+@pytest.mark.parametrize('network_type,batch_norm,last_ff,model_class', [
+    ('strides_only', False, False, 'ae'), ('strides_only', True, False, 'vae'),
+    ('max_pooling', True, False, 'ae'), ('max_pooling', False, True, 'ae')])
+def test_estimate_arch_cost(network_type, batch_norm, last_ff, model_class):
+
+    import torch
+    from torch import nn
+    from behavenet.models import AE, VAE
+
+    arch = {
+        'ae_network_type': network_type, 'ae_padding_type': 'same', 'ae_batch_norm': batch_norm,
+        'ae_batch_norm_momentum': None, 'ae_decoding_last_FF_layer': last_ff,
+        'n_input_channels': 1, 'y_pixels': 24, 'x_pixels': 20, 'ae_input_dim': [1, 24, 20],
+        'n_ae_latents': 4, 'model_class': model_class, 'vae.beta': 1,
+        'vae.beta_anneal_epochs': 0, 'max_n_epochs': 1}
+    if network_type == 'max_pooling':
+        arch.update({
+            'ae_encoding_n_channels': [4, 4, 8, 8],
+            'ae_encoding_kernel_size': [3, 2, 3, 2],
+            'ae_encoding_stride_size': [1, 2, 1, 2],
+            'ae_encoding_layer_type': ['conv', 'maxpool', 'conv', 'maxpool']})
+    else:
+        arch.update({
+            'ae_encoding_n_channels': [4, 8, 16],
+            'ae_encoding_kernel_size': [5, 3, 3],
+            'ae_encoding_stride_size': [2, 2, 1],
+            'ae_encoding_layer_type': ['conv', 'conv', 'conv']})
+    arch = utils.get_handcrafted_dims(arch, symmetric=True)
+    cost = utils.estimate_arch_cost(arch, batch_size=8)
+    model = {'ae': AE, 'vae': VAE}[model_class](dict(arch))
+
+    # same number of parameters as the model
+    assert cost['n_params'] == sum(p.numel() for p in model.parameters())
+
+    # same number of multiply-adds as measured in a forward pass
+    macs = []
+
+    def hook(module, inputs, output):
+        if isinstance(module, nn.Conv2d):
+            macs.append(output[0].numel() * module.in_channels * np.prod(module.kernel_size))
+        elif isinstance(module, nn.ConvTranspose2d):
+            macs.append(inputs[0][0].numel() * module.out_channels * np.prod(module.kernel_size))
+        elif isinstance(module, nn.Linear):
+            macs.append(module.in_features * module.out_features)
+        elif isinstance(module, nn.BatchNorm2d):
+            macs.append(output[0].numel())
+
+    for module in model.modules():
+        module.register_forward_hook(hook)
+    model.eval()
+    with torch.no_grad():
+        model(torch.rand(1, *arch['ae_input_dim']))
+    assert cost['flops'] == 2 * sum(macs)
+    assert cost['flops_train'] == 3 * cost['flops']
+
+    # memory and latency grow with the batch size
+    cost_2 = utils.estimate_arch_cost(arch, batch_size=16)
+    assert cost_2['train_bytes'] - cost['train_bytes'] == \
+        8 * (4 * np.prod(arch['ae_input_dim']) + 2 * cost['activation_bytes'])
+    assert cost_2['inference_bytes'] > cost['inference_bytes']
+    assert cost['peak_activation_bytes'] < cost['activation_bytes']
+    assert 0 < cost['latency_ms'] < cost['train_latency_ms']
+
+
+def test_benchmark_archs(tmpdir):
+
+    import pandas as pd
+
+    archs = utils.draw_archs(
+        batch_size=4, input_dim=[1, 16, 16], n_ae_latents=3, n_archs=2, check_memory=False)
+    archs += utils.load_handcrafted_arches(
+        [1, 16, 16], 3, None, batch_size=4, check_memory=False)
+    save_file = str(tmpdir.join('benchmark.csv'))
+    results = utils.benchmark_archs(
+        archs, batch_size=4, n_steps=2, device='cpu',
+        throughput_budget={'train_frames_per_s': 0, 'inference_frames_per_s': np.inf},
+        save_file=save_file)
+
+    # one row per architecture, ranked by training throughput
+    assert sorted(results.arch) == [0, 1, 2]
+    assert results['rank'].tolist() == [0, 1, 2]
+    assert np.all(np.diff(results.train_frames_per_s) <= 0)
+    assert np.all(results.train_frames_per_s > 0)
+    assert not np.any(results.within_budget)
+    for _, row in results.iterrows():
+        cost = utils.estimate_arch_cost(archs[row.arch], batch_size=4)
+        assert row.n_params == cost['n_params']
+        assert 4 * cost['n_params'] < row.inference_peak_bytes < row.train_peak_bytes
+
+    # ranked table is saved
+    assert pd.read_csv(save_file).arch.tolist() == results.arch.tolist()
+
+    # rank by memory
+    results = utils.benchmark_archs(
+        archs, batch_size=4, n_steps=1, device='cpu', sort_by='train_peak_bytes')
+    assert np.all(np.diff(results.train_peak_bytes) >= 0)
+    assert 'within_budget' not in results
+
+
 def test_get_handcrafted_dims():
 
     # symmetric arch
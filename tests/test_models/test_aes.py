@@ -0,0 +1,95 @@
+import pytest
+import torch
+from torch import nn
+from behavenet.models.aes import AE, optimize_for_inference
+
+
+def _get_hparams(network_type, channels_last=False):
+    from behavenet.models.ae_model_architecture_generator import get_handcrafted_dims
+    arch = {
+        'model_class': 'ae', 'ae_network_type': network_type, 'ae_padding_type': 'same',
+        'ae_batch_norm': True, 'ae_batch_norm_momentum': 0.5, 'ae_decoding_last_FF_layer': 0,
+        'n_input_channels': 1, 'y_pixels': 16, 'x_pixels': 12, 'ae_input_dim': [1, 16, 12],
+        'n_ae_latents': 4, 'ae_channels_last': channels_last}
+    if network_type == 'max_pooling':
+        arch.update({
+            'ae_encoding_n_channels': [4, 4, 8, 8],
+            'ae_encoding_kernel_size': [3, 2, 3, 2],
+            'ae_encoding_stride_size': [1, 2, 1, 2],
+            'ae_encoding_layer_type': ['conv', 'maxpool', 'conv', 'maxpool']})
+    else:
+        arch.update({
+            'ae_encoding_n_channels': [4, 8],
+            'ae_encoding_kernel_size': [4, 3],
+            'ae_encoding_stride_size': [2, 2],
+            'ae_encoding_layer_type': ['conv', 'conv']})
+    return get_handcrafted_dims(arch, symmetric=True)
+
+
+@pytest.mark.parametrize('network_type', ['max_pooling', 'strides_only'])
+def test_channels_last(network_type):
+
+    torch.manual_seed(0)
+    model = AE(_get_hparams(network_type))
+    model_cl = AE(_get_hparams(network_type, channels_last=True))
+    model_cl.load_state_dict(model.state_dict())
+    assert model_cl.encoding.encoder.conv0.weight.is_contiguous(memory_format=torch.channels_last)
+
+    # same outputs and gradients as the default memory format
+    x = torch.rand(6, 1, 16, 12)
+    y, z = model(x)
+    y_cl, z_cl = model_cl(x)
+    assert torch.allclose(y, y_cl, atol=1e-6)
+    assert torch.allclose(z, z_cl, atol=1e-6)
+    y.sum().backward()
+    y_cl.sum().backward()
+    # biases of convolutions followed by batch norm have zero gradient up to rounding errors
+    for p, p_cl in zip(model.parameters(), model_cl.parameters()):
+        assert torch.allclose(p.grad, p_cl.grad, atol=1e-4)
+
+
+@pytest.mark.parametrize('network_type', ['max_pooling', 'strides_only'])
+def test_optimize_for_inference(network_type):
+
+    torch.manual_seed(0)
+    model = AE(_get_hparams(network_type))
+    x = torch.rand(6, 1, 16, 12)
+    # update batch norm running stats
+    model(x)
+    model.eval()
+    with torch.no_grad():
+        y = model(x)[0]
+
+    for kwargs in [
+            {}, {'channels_last': True},
+            {'compile': True, 'compile_kwargs': {'backend': 'eager'}}]:
+        model_opt = optimize_for_inference(model, **kwargs)
+        with torch.no_grad():
+            assert torch.allclose(model_opt(x)[0], y, atol=1e-5)
+
+    # batch norm layers are folded into the copy only
+    assert not any(isinstance(m, nn.BatchNorm2d) for m in model_opt.modules())
+    assert any(isinstance(m, nn.BatchNorm2d) for m in model.modules())
+
+
+def test_load_pretrained_ae(tmpdir):
+
+    from behavenet.models.aes import load_pretrained_ae
+
+    torch.manual_seed(0)
+    model = AE(_get_hparams('strides_only'))
+    weights_file = str(tmpdir.join('best_val_model.pt'))
+    torch.save(model.state_dict(), weights_file)
+
+    # different number of latents; overlapping weights of latent layers are copied
+    hparams = _get_hparams('strides_only')
+    hparams.update({'n_ae_latents': 6, 'pretrained_weights_path': weights_file})
+    model_6 = load_pretrained_ae(AE(hparams), hparams)
+    for key, val in model.state_dict().items():
+        val_6 = model_6.state_dict()[key]
+        if key == 'encoding.FF.weight' or key == 'encoding.FF.bias':
+            assert torch.equal(val_6[:4], val)
+        elif key == 'decoding.FF.weight':
+            assert torch.equal(val_6[:, :4], val)
+        else:
+            assert torch.equal(val_6, val)
@@ -0,0 +1,34 @@
+import torch
+from torch import nn
+from behavenet.models.base import SessionIOLayers
+
+
+def test_session_io_layers():
+
+    torch.manual_seed(0)
+    dataset = torch.tensor([0, 2, 1, 2, 0])
+    for layer_class, kwargs in [
+            (nn.Conv2d, {'stride': 2, 'padding': 1}),
+            (nn.ConvTranspose2d, {'stride': 2, 'padding': 1, 'output_padding': 1})]:
+        layers = SessionIOLayers([layer_class(2, 3, kernel_size=3, **kwargs) for _ in range(3)])
+        x = torch.randn(5, 2, 8, 6, requires_grad=True)
+
+        # single dataset
+        assert torch.allclose(layers(x, 1), layers[1](x))
+
+        # per-frame datasets match per-frame layers, including gradients
+        y = layers(x, dataset)
+        y_ = torch.cat([layers[d](x[i:i + 1]) for i, d in enumerate(dataset.tolist())])
+        assert torch.allclose(y, y_, atol=1e-6)
+        grad, = torch.autograd.grad(y.sum(), layers[2].weight)
+        grad_, = torch.autograd.grad(y_.sum(), layers[2].weight)
+        assert torch.allclose(grad, grad_, atol=1e-5)
+
+        # datasets absent from the batch receive no gradients
+        layers.zero_grad(set_to_none=True)
+        layers(x, torch.tensor([0, 2, 2, 0, 0])).sum().backward()
+        assert layers[0].weight.grad is not None and layers[2].weight.grad is not None
+        assert layers[1].weight.grad is None and layers[1].bias.grad is None
+
+    # state dict keys are those of a module list
+    assert list(layers.state_dict().keys()) == list(nn.ModuleList(layers).state_dict().keys())
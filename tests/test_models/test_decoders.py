@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import torch
+from behavenet.models import Decoder, DecoderStack
+
+
+def test_decoder_stack():
+
+    hparams = {
+        'model_type': 'mlp', 'input_size': 5, 'output_size': 3, 'n_hid_layers': 1,
+        'n_hid_units': 8, 'n_lags': 2, 'n_max_lags': 2, 'noise_dist': 'gaussian',
+        'activation': 'relu', 'input_signal': 'neural', 'output_signal': 'labels'}
+    members = []
+    for seed in range(3):
+        torch.manual_seed(seed)
+        members.append(Decoder(dict(hparams)))
+    stack = DecoderStack(members)
+    data = {'neural': torch.randn(1, 50, 5), 'labels': torch.randn(1, 50, 3)}
+
+    # stacked losses/gradients match those of individual members
+    loss_dicts = stack.loss(data, chunk_size=20, members=[0, 2])
+    grads = [[p.grad.clone() for p in members[m].parameters()] for m in [0, 2]]
+    assert all(p.grad is None for p in members[1].parameters())
+    for m, loss_dict, grad in zip([0, 2], loss_dicts, grads):
+        members[m].zero_grad()
+        loss_dict_ = members[m].loss(data, chunk_size=20)
+        assert np.isclose(loss_dict['loss'], loss_dict_['loss'])
+        assert np.isclose(loss_dict['r2'], loss_dict_['r2'])
+        for g, p in zip(grad, members[m].parameters()):
+            assert torch.allclose(g, p.grad, atol=1e-6)
+
+    # members must share an architecture
+    hparams_ = dict(hparams, n_lags=1)
+    with pytest.raises(ValueError):
+        DecoderStack([members[0], Decoder(hparams_)])
@@ -0,0 +1,40 @@
+import json
+import os
+import numpy as np
+import pytest
+from behavenet import tracing
+
+
+def test_tracing(tmpdir):
+
+    # no events are recorded when tracing is off
+    assert not tracing.is_tracing()
+    with tracing.trace_span('a'):
+        with tracing.trace_span('b'):
+            pass
+    assert tracing.start_trace(enabled=False) is None
+    assert not tracing.is_tracing()
+
+    tracer = tracing.start_trace()
+    try:
+        assert tracing.is_tracing()
+        # nested calls reuse the active tracer
+        assert tracing.start_trace() is None
+
+        with tracing.trace_span('outer', 'train', epoch=np.int64(3)):
+            # spans are closed when an exception is raised
+            with pytest.raises(ValueError):
+                with tracing.trace_span('inner', 'data'):
+                    raise ValueError
+    finally:
+        filepath = os.path.join(tmpdir, 'trace.json')
+        tracing.save_trace(tracer, filepath)
+    assert not tracing.is_tracing()
+
+    with open(filepath, 'r') as f:
+        trace = json.load(f)
+    events = [e for e in trace['traceEvents'] if e['ph'] != 'M']
+    assert [(e['name'], e['ph']) for e in events] == [
+        ('outer', 'B'), ('inner', 'B'), ('inner', 'E'), ('outer', 'E')]
+    assert events[0]['args']['epoch'] == 3
+    assert all(e1['ts'] <= e2['ts'] for e1, e2 in zip(events[:-1], events[1:]))